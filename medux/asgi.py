@@ -0,0 +1,27 @@
+"""
+ASGI config for medux project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+for ASGI servers like uvicorn: ``uvicorn medux.asgi:application``
+
+Streaming responses (NDJSON exports, attachments, $everything) are then sent from the event loop,
+and their chunks read in the thread pool, without holding a worker for slow clients, see
+medux.core.streaming. The views run in Django's thread
+pool, each request in its own thread, so they keep their own database connection.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/stable/howto/deployment/asgi/
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "medux.settings")
+
+from medux.core.streaming import get_asgi_application
+
+application = get_asgi_application()
+
+# after the apps are loaded: the in-process code index is built while the server starts, not on the first search
+from medux.core.code_search import start_code_index  # noqa: E402
+
+start_code_index()
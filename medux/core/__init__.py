@@ -0,0 +1 @@
+default_app_config = 'medux.core.apps.CoreConfig'
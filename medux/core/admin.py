@@ -17,16 +17,283 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext as _, ugettext_lazy
+
 from medux.core.models import *
 
+# The admin has to stay fast with millions of rows:
+# * counting is capped (or estimated from the statistics on PostgreSQL) instead of COUNT(*)
+# * changelists in the default order (newest first) are paginated by primary key ranges,
+#   so the 1000th page is as fast as the first one
+# * search only does exact and prefix matches, which can use indexes
+# * relations are edited with autocomplete or raw id widgets, never with a select of all rows
+
+# the pagination parameters of keyset paginated changelists
+CURSOR_VAR = "after"
+PREVIOUS_CURSOR_VAR = "before"
+
+# rows counted at most; larger tables are shown as "more than ..."
+COUNT_LIMIT = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """A Paginator which doesn't count more than COUNT_LIMIT rows.
+
+    For unfiltered querysets on PostgreSQL, the row estimate of the table statistics is used."""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > COUNT_LIMIT:
+                return int(row[0])
+        return queryset.order_by()[:COUNT_LIMIT + 1].count()
+
+    @property
+    def count_display(self):
+        """The count as text; the exact number is only known up to COUNT_LIMIT"""
+        if self.count <= COUNT_LIMIT:
+            return str(self.count)
+        if self.count == COUNT_LIMIT + 1:
+            return _("more than {}").format(COUNT_LIMIT)
+        return _("about {}").format(self.count)
+
+
+class KeysetChangeList(ChangeList):
+    """A ChangeList that pages by primary key ("?after=<pk>" and "?before=<pk>") instead of OFFSET,
+    if it is ordered by pk.
+
+    Sorting by another column falls back to normal pagination, with the estimated count."""
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = None
+        self.next_cursor = None
+        self.previous_cursor = None
+        self.keyset = False
+        super().__init__(request, *args, **kwargs)
+        # links to other orderings or filters start at the first page again
+        self.params.pop(CURSOR_VAR, None)
+        self.params.pop(PREVIOUS_CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        params.pop(PREVIOUS_CURSOR_VAR, None)
+        return params
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if self.model_admin.list_prefetch_related:
+            queryset = queryset.prefetch_related(*self.model_admin.list_prefetch_related)
+        return queryset
+
+    def parse_cursor(self, value):
+        """Returns the primary key of a cursor parameter, or None if it is missing or invalid"""
+        if not value:
+            return None
+        try:
+            return self.opts.pk.to_python(value)
+        except (ValidationError, ValueError):
+            # e.g. an edited or truncated link, which shows the first page then
+            return None
+
+    def get_results(self, request):
+        pk_names = ("pk", self.opts.pk.name, self.opts.pk.attname)
+        # the ChangeList appends "-pk" to make any ordering deterministic, so it may be there more than once
+        ordering = {field if not isinstance(field, str) or field.lstrip("-") not in pk_names
+                    else "-pk" if field.startswith("-") else "pk"
+                    for field in self.queryset.query.order_by}
+        if ordering not in ({"pk"}, {"-pk"}):
+            return super().get_results(request)
+
+        self.keyset = True
+        descending = ordering == {"-pk"}
+        after, before = ("pk__lt", "pk__gt") if descending else ("pk__gt", "pk__lt")
+        per_page = self.list_per_page
+        queryset = self.queryset
+        # only the primary keys are read to find the edges of the page, which needs the index only
+        pks = []
+        cursor = self.parse_cursor(request.GET.get(PREVIOUS_CURSOR_VAR))
+        if cursor is not None:
+            # the page in front of the cursor, read backwards from it
+            pks = list(queryset.filter(**{before: cursor}).reverse().values_list("pk", flat=True)[:per_page + 1])
+        if len(pks) > per_page:
+            self.cursor = cursor
+            self.next_cursor = pks[0]
+            self.previous_cursor = pks[per_page - 1]
+            queryset = queryset.filter(pk__in=pks[:per_page])
+        else:
+            # without a page in front of it, this is the (full) first page
+            self.cursor = None if cursor is not None else self.parse_cursor(request.GET.get(CURSOR_VAR))
+            if self.cursor is not None:
+                queryset = queryset.filter(**{after: self.cursor})
+            pks = list(queryset.values_list("pk", flat=True)[:per_page + 1])
+            self.next_cursor = pks[per_page - 1] if len(pks) > per_page else None
+            self.previous_cursor = pks[0] if self.cursor is not None and pks else None
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, per_page)
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = queryset[:per_page]
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor is not None or self.next_cursor is not None)
+        self.paginator = paginator
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR, PREVIOUS_CURSOR_VAR])
+
+    @property
+    def previous_page_url(self):
+        return self.get_query_string({PREVIOUS_CURSOR_VAR: self.previous_cursor}, remove=[CURSOR_VAR])
+
+    @property
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor}, remove=[PREVIOUS_CURSOR_VAR])
+
+
+class MeduxModelAdmin(admin.ModelAdmin):
+    """Base class of all MedUX admins, tuned for large tables"""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    # newest first, which allows keyset pagination
+    ordering = ("-pk",)
+    # like list_select_related, for the many-to-many fields shown in list_display
+    list_prefetch_related = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # Django's default search (icontains) has to scan the whole table, prefix matches use the
+        # indexes of the searched columns (with the pattern operator class on PostgreSQL)
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        condition = Q()
+        for field in self.get_search_fields(request):
+            condition |= Q(**{field + "__startswith": search_term})
+        return queryset.filter(condition), False
+
+
+def reference_display(reference):
+    """The text of a Reference in a changelist column"""
+    if reference is None:
+        return None
+    return reference.display or reference.references
+
+
+class ResourceAdmin(MeduxModelAdmin):
+    list_display = ("versionId", "id", "lastUpdated")
+    search_fields = ("id", "versionId")
+    autocomplete_fields = ("security", "profile")
+
+
+class DomainResourceAdmin(ResourceAdmin):
+    # with flat resources, contained resources are stored inline
+    raw_id_fields = () if FLAT_RESOURCES else ("contained",)
+
+
+class ConformanceResourceAdmin(DomainResourceAdmin):
+    list_display = ("name", "id", "version", "status", "lastUpdated")
+    list_filter = ("status",)
+    search_fields = ("name", "url", "id")
+    autocomplete_fields = ResourceAdmin.autocomplete_fields + ("identifier", "contact")
+    raw_id_fields = DomainResourceAdmin.raw_id_fields + ("use_context",)
+
+
+class StructureDefinitionAdmin(ConformanceResourceAdmin):
+    list_display = ("name", "type", "id", "version", "status", "lastUpdated")
+
+
+class ValueSetAdmin(ConformanceResourceAdmin):
+    autocomplete_fields = ConformanceResourceAdmin.autocomplete_fields + ("expansion",)
+    raw_id_fields = ConformanceResourceAdmin.raw_id_fields + ("jurisdiction",)
+
+
+class OrganisationAdmin(DomainResourceAdmin):
+    autocomplete_fields = ResourceAdmin.autocomplete_fields + ("identifier",)
+
+
+class ElementAdmin(MeduxModelAdmin):
+    autocomplete_fields = ()
+
+
+class CodingAdmin(MeduxModelAdmin):
+    list_display = ("code", "display", "system", "version")
+    search_fields = ("code", "display")
+
+
+class IdentifierAdmin(MeduxModelAdmin):
+    list_display = ("value", "system", "use", "assigned_by", "period_start", "period_end")
+    list_select_related = ("assigner",)
+    search_fields = ("value",)
+    raw_id_fields = ("type", "assigner")
+
+    def assigned_by(self, obj):
+        return reference_display(obj.assigner)
+    assigned_by.short_description = ugettext_lazy("assigner")
+
+
+class ContactDetailAdmin(ElementAdmin):
+    list_display = ("name",)
+    search_fields = ("name",)
+    autocomplete_fields = ElementAdmin.autocomplete_fields + ("telecom",)
+
+
+class ContactPointAdmin(ElementAdmin):
+    list_display = ("value", "system", "use", "rank", "period_start", "period_end")
+    search_fields = ("value",)
+
+
+class PatientAdmin(MeduxModelAdmin):
+    list_display = ("id", "names", "gender", "birthdate", "organisation", "active")
+    list_select_related = ("managingOrganisation",)
+    list_prefetch_related = ("name",)
+    list_filter = ("active",)
+    autocomplete_fields = ("identifier", "telecom")
+    raw_id_fields = ("name", "address", "photo", "generalPractitioner", "managingOrganisation")
+
+    def names(self, obj):
+        # from the prefetched names, .all() doesn't query again
+        return "; ".join(name.text or "{} {}".format(name.given, name.family).strip() for name in obj.name.all())
+    names.short_description = ugettext_lazy("name")
+
+    def organisation(self, obj):
+        return reference_display(obj.managingOrganisation)
+    organisation.short_description = ugettext_lazy("managing organisation")
+
+
+class SubscriptionAdmin(MeduxModelAdmin):
+    list_display = ("criteria", "channel_type", "endpoint", "status", "delivered", "failures")
+    list_filter = ("status", "channel_type")
+    search_fields = ("criteria", "endpoint")
+    readonly_fields = ("delivered", "failures", "retry_after", "error")
+
 
-admin.site.register(Resource)
-admin.site.register(DomainResource)
-admin.site.register(Coding)
-admin.site.register(Period)
-admin.site.register(StructureDefinition)
-admin.site.register(Identifier)
-admin.site.register(ValueSet)
-admin.site.register(ContactDetail)
-admin.site.register(ContactPoint)
-admin.site.register(Extension)
+if not FLAT_RESOURCES:
+    admin.site.register(Resource, ResourceAdmin)
+    admin.site.register(DomainResource, DomainResourceAdmin)
+admin.site.register(Coding, CodingAdmin)
+admin.site.register(StructureDefinition, StructureDefinitionAdmin)
+admin.site.register(Identifier, IdentifierAdmin)
+admin.site.register(ValueSet, ValueSetAdmin)
+admin.site.register(ContactDetail, ContactDetailAdmin)
+admin.site.register(ContactPoint, ContactPointAdmin)
+admin.site.register(Organisation, OrganisationAdmin)
+admin.site.register(Patient, PatientAdmin)
+admin.site.register(Subscription, SubscriptionAdmin)
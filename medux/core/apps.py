@@ -20,4 +20,9 @@ from django.apps import AppConfig
 
 
 class CoreConfig(AppConfig):
-    name = 'core'
+    name = 'medux.core'
+    label = 'core'
+
+    def ready(self):
+        # connect the signal handlers
+        from medux.core import signals  # noqa: F401
@@ -0,0 +1,460 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import io
+import json
+import os
+import random
+import time
+import tracemalloc
+import uuid
+
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from medux.core.bulk import bulk_create, bulk_create_m2m
+from medux.core.bundle import BundleImporter
+from medux.core.derived import refresh_resources
+from medux.core.export import export_queryset, write_ndjson
+from medux.core.fhir import serialization_queryset, to_fhir
+from medux.core.ids import allocate_ids
+from medux.core.matching import find_duplicates
+from medux.core.models import FLAT_RESOURCES, Address, Coding, ContactPoint, Identifier, Organisation, Patient, ValueSet
+from medux.core.periods import PERIOD_MAX, PERIOD_MIN
+
+# Benchmarks of the core model graph with synthetic data, see the "benchmark" management command.
+#
+# Every scenario reports wall time, number of queries and peak Python memory. The query counts
+# don't depend on the machine, so they are compared against stored baselines: a scenario that
+# needs more queries than before is a regression (e.g. a lost prefetch_related()).
+
+__all__ = ["BASELINES_FILE", "ID_SCHEMES", "PERIOD_LAYOUTS", "SCALES", "SCENARIOS", "Measurement", "baseline_key",
+           "check_baselines", "compare_id_schemes", "compare_period_layouts", "generate", "load_baselines",
+           "run_scenarios", "save_baselines"]
+
+# number of Patients; Organisations, ValueSets and Codings are generated relative to it
+SCALES = {
+    "1k": 1000,
+    "10k": 10000,
+    "100k": 100000,
+    "1M": 1000000,
+}
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+
+FAMILY_NAMES = ("Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker", "Schulz",
+                "Hoffmann", "Gruber", "Huber", "Bauer", "Wimmer", "Moser", "Mayer", "Steiner", "Berger")
+GIVEN_NAMES = ("Anna", "Maria", "Lena", "Sophie", "Paul", "Lukas", "Felix", "Jonas", "Elias", "Emma",
+               "Leon", "Laura", "David", "Sarah", "Tobias", "Julia")
+CITIES = ("Wien", "Graz", "Linz", "Salzburg", "Innsbruck", "Klagenfurt", "Berlin", "München", "Hamburg")
+
+BATCH_SIZE = 1000
+
+
+class Measurement:
+    __slots__ = ("scenario", "seconds", "queries", "joins", "inserts", "peak_memory")
+
+    def __init__(self, scenario, seconds, queries, joins, inserts, peak_memory):
+        self.scenario = scenario
+        self.seconds = seconds
+        self.queries = queries
+        # joins in all queries, and INSERT statements (round-trips for writing)
+        self.joins = joins
+        self.inserts = inserts
+        self.peak_memory = peak_memory
+
+    def __str__(self):
+        return "{:<24} {:>9.3f} s {:>8} queries {:>8} joins {:>7} inserts {:>9.1f} MiB".format(
+            self.scenario, self.seconds, self.queries, self.joins, self.inserts, self.peak_memory / 1024 / 1024)
+
+
+def _measure(name, function):
+    # tracing the allocations makes Python slower, so the times are only comparable with each other
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as context:
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    statements = [query["sql"] for query in context.captured_queries]
+    return Measurement(name, seconds, len(statements), sum(sql.count(" JOIN ") for sql in statements),
+                       sum(1 for sql in statements if sql.startswith("INSERT")), peak_memory)
+
+
+# Synthetic data
+
+def patient_resource(rng, number, organisations):
+    """Returns a random, but plausible Patient resource as FHIR dict"""
+    family = rng.choice(FAMILY_NAMES)
+    return {
+        "resourceType": "Patient",
+        "identifier": [
+            {"use": "official", "system": "urn:oid:1.2.40.0.10.1.4.3.1", "value": "{:010d}".format(number)},
+            {"use": "usual", "system": "urn:medux:benchmark:mrn", "value": "MRN{}".format(number),
+             "assigner": {"reference": "Organization/{}".format(rng.choice(organisations))}},
+        ],
+        "active": rng.random() > 0.05,
+        "name": [{"use": "official", "family": family, "given": rng.sample(GIVEN_NAMES, rng.randint(1, 2))}],
+        "telecom": [{"system": "phone", "value": "+43 {:09d}".format(rng.randrange(10 ** 9)), "use": "home"}],
+        "gender": rng.choice(("male", "female", "other", "unknown")),
+        "birthDate": "{:04d}-{:02d}-{:02d}".format(rng.randint(1920, 2020), rng.randint(1, 12), rng.randint(1, 28)),
+        "address": [{"use": "home", "line": ["{}gasse {}".format(family, rng.randint(1, 200))],
+                     "city": rng.choice(CITIES), "postalCode": str(rng.randint(1000, 9999))}],
+        "managingOrganization": {"reference": "Organization/{}".format(rng.choice(organisations))},
+    }
+
+
+def _generate_organisations(count, security):
+    now = timezone.now()
+    ids = []
+    for start in range(0, count, BATCH_SIZE):
+        numbers = range(start, min(start + BATCH_SIZE, count))
+        organisations = [Organisation(versionId=version_id, id="org-{}".format(number), created=now,
+                                      security=security)
+                         for number, version_id in zip(numbers, allocate_ids(len(numbers)))]
+        identifiers = [Identifier(use="official", system="urn:medux:benchmark:org", value=organisation.id)
+                       for organisation in organisations]
+        bulk_create(Organisation, organisations)
+        bulk_create(Identifier, identifiers)
+        bulk_create_m2m(Organisation._meta.get_field("identifier"), list(zip(organisations, identifiers)))
+        refresh_resources(Organisation, [organisation.pk for organisation in organisations])
+        ids.extend(organisation.id for organisation in organisations)
+    return ids
+
+
+def _generate_value_sets(count, codes, security):
+    now = timezone.now()
+    value_sets = [ValueSet(versionId=version_id, id="vs-{}".format(number), created=now, security=security,
+                           url="http://medux.org/fhir/ValueSet/benchmark-{}".format(number),
+                           name="Benchmark{}".format(number), status="active", date=now)
+                  for number, version_id in enumerate(allocate_ids(count))]
+    bulk_create(ValueSet, value_sets)
+    for value_set in value_sets:
+        codings = [Coding(system="http://medux.org/fhir/CodeSystem/{}".format(value_set.name),
+                          code="C{}".format(number), display="Code {}".format(number), userselected=False)
+                   for number in range(codes)]
+        bulk_create(Coding, codings)
+        bulk_create_m2m(ValueSet._meta.get_field("expansion"), [(value_set, coding) for coding in codings])
+    refresh_resources(ValueSet, [value_set.pk for value_set in value_sets])
+
+
+def generate(patients, seed=0, stdout=None):
+    """Fills the database with synthetic data: the given number of Patients, one Organisation per
+    100 Patients, and one ValueSet with 100 Codings per 1000 Patients"""
+    rng = random.Random(seed)
+    with transaction.atomic():
+        security = Coding.objects.create(system="http://hl7.org/fhir/v3/Confidentiality", code="N",
+                                         display="normal", userselected=False)
+        organisations = _generate_organisations(max(1, patients // 100), security)
+        _generate_value_sets(max(1, patients // 1000), 100, security)
+
+    importer = BundleImporter(batch_size=BATCH_SIZE)
+    for start in range(0, patients, BATCH_SIZE):
+        with transaction.atomic():
+            for number in range(start, min(start + BATCH_SIZE, patients)):
+                importer.add({"resource": patient_resource(rng, number, organisations)})
+            importer.flush()
+        importer.responses = []
+        if stdout is not None:
+            stdout.write("  {} patients".format(min(start + BATCH_SIZE, patients)))
+
+
+# Scenarios; each one gets a Client and a random generator
+
+def create(client, rng):
+    """Imports a transaction Bundle of 1000 new Patients"""
+    organisations = list(Organisation.objects.values_list("id", flat=True)[:100])
+    bundle = {"resourceType": "Bundle", "type": "transaction",
+              "entry": [{"resource": patient_resource(rng, 10 ** 8 + number, organisations)}
+                        for number in range(1000)]}
+    BundleImporter().run(io.BytesIO(json.dumps(bundle).encode("utf-8")))
+
+
+def read(client, rng):
+    """Reads 100 random Patients by id"""
+    ids = list(Patient.objects.values_list("pk", flat=True)[:10000])
+    for pk in rng.sample(ids, min(100, len(ids))):
+        client.get(reverse("read", args=["Patient", pk]))
+
+
+def search(client, rng):
+    """20 Patient searches by name, birthdate and identifier"""
+    for _ in range(20):
+        client.get(reverse("search", args=["Patient"]), {
+            "family": rng.choice(FAMILY_NAMES)[:3],
+            "birthdate": "ge{}".format(rng.randint(1920, 2010)),
+            "_count": 50,
+        })
+        client.get(reverse("search", args=["Patient"]), {
+            "identifier": "urn:medux:benchmark:mrn|MRN{}".format(rng.randrange(1000)),
+        })
+
+
+def everything(client, rng):
+    """Gets the compartments of 100 random Patients with $everything"""
+    ids = list(Patient.objects.values_list("pk", flat=True)[:10000])
+    for pk in rng.sample(ids, min(100, len(ids))):
+        b"".join(client.get(reverse("everything", args=[pk])).streaming_content)
+
+
+def match(client, rng):
+    """20 Patient $match requests, and finding all duplicates"""
+    for number in range(20):
+        client.post(reverse("match"), json.dumps({"resourceType": "Parameters", "parameter": [
+            {"name": "resource", "resource": patient_resource(rng, rng.randrange(1000), ["org"])}]}),
+            content_type="application/fhir+json")
+    for _ in find_duplicates():
+        pass
+
+
+def valid_at(client, rng):
+    """Gets the current identifiers, telecoms and addresses of 100 random Patients"""
+    ids = list(Patient.objects.values_list("pk", flat=True)[:10000])
+    now = timezone.now()
+    for pk in rng.sample(ids, min(100, len(ids))):
+        for model in (Identifier, ContactPoint, Address):
+            list(model.objects.valid_at(now).filter(patient=pk))
+
+
+def export(client, rng):
+    """Exports all Patients as NDJSON"""
+    with open(os.devnull, "w") as stream:
+        write_ndjson(export_queryset("Patient"), stream)
+
+
+def resource_create(client, rng):
+    """Saves 100 Organisations one by one, and bulk creates 1000 more"""
+    security = Coding.objects.order_by("pk").first()
+    now = timezone.now()
+    for number in range(100):
+        Organisation.objects.create(id="saved-org-{}".format(number), created=now, security=security)
+    bulk_create(Organisation, [Organisation(versionId=version_id, id="bulk-org-{}".format(number), created=now,
+                                            security=security)
+                               for number, version_id in enumerate(allocate_ids(1000))])
+
+
+def resource_read(client, rng):
+    """Serializes all Organisations and ValueSets"""
+    for model in (Organisation, ValueSet):
+        for obj in serialization_queryset(model):
+            to_fhir(obj)
+
+
+def admin_changelist(client, rng):
+    """Shows the first admin changelist page of the generated models"""
+    for model in (Patient, Organisation, Identifier, ValueSet, Coding):
+        if admin.site.is_registered(model):
+            client.get(reverse("admin:{}_{}_changelist".format(model._meta.app_label, model._meta.model_name)))
+
+
+SCENARIOS = {
+    "create": create,
+    "read": read,
+    "search": search,
+    "everything": everything,
+    "match": match,
+    "valid_at": valid_at,
+    "export": export,
+    "resource_create": resource_create,
+    "resource_read": resource_read,
+    "admin_changelist": admin_changelist,
+}
+
+
+def run_scenarios(names, seed=0):
+    """Runs the scenarios, and returns a list of Measurements"""
+    user_model = get_user_model()
+    user = user_model.objects.filter(username="benchmark").first() or \
+        user_model.objects.create_superuser("benchmark", "benchmark@example.org", "benchmark")
+    client = Client()
+    client.force_login(user)
+    return [_measure(name, lambda: SCENARIOS[name](client, random.Random(seed))) for name in names]
+
+
+# Primary key schemes, for compare_id_schemes()
+
+ID_SCHEMES = {
+    "uuid4": lambda count: [str(uuid.uuid4()) for _ in range(count)],
+    "time-ordered": allocate_ids,
+}
+
+ID_TABLE = "medux_benchmark_ids"
+
+
+def _index_size(cursor, table):
+    """Returns the size of the primary key index of table in bytes, or None if it can't be determined"""
+    if connection.vendor == "sqlite":
+        # needs SQLite's dbstat virtual table, which most builds have
+        try:
+            cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = %s", ["sqlite_autoindex_{}_1".format(table)])
+        except DatabaseError:
+            return None
+        return cursor.fetchone()[0]
+    if connection.vendor == "postgresql":
+        cursor.execute("SELECT pg_relation_size(%s)", ["{}_pkey".format(table)])
+        return cursor.fetchone()[0]
+    return None
+
+
+def compare_id_schemes(count, batch_size=BATCH_SIZE):
+    """Inserts count rows into a scratch table with a varchar(64) primary key (like Meta.versionId),
+    once per scheme of ID_SCHEMES, and returns (scheme, rows per second, index size in bytes) tuples.
+
+    Random ids land on random pages of the index, which are split when full and stay half empty;
+    time-ordered ids are only ever appended to the last page."""
+    table = connection.ops.quote_name(ID_TABLE)
+    payload = "x" * 200
+    results = []
+    for scheme, generate_ids in ID_SCHEMES.items():
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE {} (id varchar(64) PRIMARY KEY, payload varchar(255))".format(table))
+            try:
+                start = time.perf_counter()
+                for offset in range(0, count, batch_size):
+                    with transaction.atomic():
+                        cursor.executemany("INSERT INTO {} (id, payload) VALUES (%s, %s)".format(table),
+                                           [(id, payload) for id in generate_ids(min(batch_size, count - offset))])
+                seconds = time.perf_counter() - start
+                results.append((scheme, count / seconds if seconds else 0, _index_size(cursor, ID_TABLE)))
+            finally:
+                cursor.execute("DROP TABLE {}".format(table))
+    return results
+
+
+# Storage of element periods, for compare_period_layouts()
+
+PERIOD_TABLE = "medux_benchmark_periods"
+ELEMENT_TABLE = "medux_benchmark_elements"
+
+# the valid_at() query of each layout; %s is the instant
+PERIOD_LAYOUTS = {
+    # the old layout: a nullable ForeignKey to a Period table, with nullable start and end
+    "join": "SELECT COUNT(*) FROM {elements} e LEFT JOIN {periods} p ON p.id = e.period_id "
+            "WHERE p.id IS NULL OR ((p.period_start IS NULL OR p.period_start <= %s) "
+            "AND (p.period_end IS NULL OR p.period_end >= %s))",
+    # medux.core.periods: inline columns with sentinels for open ends, and a B-tree index on both
+    "inline": "SELECT COUNT(*) FROM {elements} WHERE period_start <= %s AND period_end >= %s",
+    # ... and the GiST index of the PostgreSQL ranges
+    "inline+gist": "SELECT COUNT(*) FROM {elements} WHERE tstzrange(period_start, period_end, '[]') @> %s::timestamptz",
+}
+
+
+def _period_rows(rng, count):
+    """Returns (element id, start, end) rows: a quarter without period, the others of up to five years
+    between 1900 and 2020, and one in ten of those without end"""
+    rows = []
+    for number in range(count):
+        if rng.random() < 0.25:
+            rows.append((number, None, None))
+            continue
+        start = datetime.datetime(rng.randint(1900, 2019), rng.randint(1, 12), 1, tzinfo=datetime.timezone.utc)
+        end = None if rng.random() < 0.1 else start + datetime.timedelta(days=rng.randint(1, 5 * 365))
+        rows.append((number, start, end))
+    return rows
+
+
+def compare_period_layouts(count, queries=100, seed=0):
+    """Stores count element periods in scratch tables, once per layout of PERIOD_LAYOUTS ("inline+gist" only
+    on PostgreSQL), and returns (layout, valid_at queries per second, number of valid elements) tuples.
+
+    Every layout answers the same random instants, so the numbers of valid elements are equal."""
+    rng = random.Random(seed)
+    rows = _period_rows(rng, count)
+    instants = [datetime.datetime(rng.randint(1900, 2020), rng.randint(1, 12), 15, tzinfo=datetime.timezone.utc)
+                for _ in range(queries)]
+    quote = connection.ops.quote_name
+    datetime_type = connection.data_types["DateTimeField"]
+    adapt = connection.ops.adapt_datetimefield_value
+    tables = {"elements": quote(ELEMENT_TABLE), "periods": quote(PERIOD_TABLE)}
+    results = []
+    for layout, query in PERIOD_LAYOUTS.items():
+        if layout.endswith("+gist") and connection.vendor != "postgresql":
+            continue
+        with connection.cursor() as cursor:
+            try:
+                if layout == "join":
+                    cursor.execute("CREATE TABLE {periods} (id integer PRIMARY KEY, period_start {type} NULL, "
+                                   "period_end {type} NULL)".format(type=datetime_type, **tables))
+                    cursor.execute("CREATE TABLE {elements} (id integer PRIMARY KEY, period_id integer NULL "
+                                   "REFERENCES {periods} (id))".format(**tables))
+                    with transaction.atomic():
+                        cursor.executemany("INSERT INTO {periods} (id, period_start, period_end) VALUES (%s, %s, %s)"
+                                           .format(**tables), [(number, adapt(start), adapt(end))
+                                                               for number, start, end in rows if start])
+                        cursor.executemany("INSERT INTO {elements} (id, period_id) VALUES (%s, %s)".format(**tables),
+                                           [(number, number if start else None) for number, start, end in rows])
+                else:
+                    cursor.execute("CREATE TABLE {elements} (id integer PRIMARY KEY, period_start {type} NOT NULL, "
+                                   "period_end {type} NOT NULL)".format(type=datetime_type, **tables))
+                    with transaction.atomic():
+                        cursor.executemany("INSERT INTO {elements} (id, period_start, period_end) VALUES (%s, %s, %s)"
+                                           .format(**tables), [(number, adapt(start or PERIOD_MIN),
+                                                                adapt(end or PERIOD_MAX))
+                                                               for number, start, end in rows])
+                    cursor.execute("CREATE INDEX {} ON {elements} (period_start, period_end)".format(
+                        quote(ELEMENT_TABLE + "_period"), **tables))
+                    if layout.endswith("+gist"):
+                        cursor.execute("CREATE INDEX {} ON {elements} USING gist (tstzrange(period_start, period_end, "
+                                       "'[]'))".format(quote(ELEMENT_TABLE + "_period_gist"), **tables))
+                valid = 0
+                start = time.perf_counter()
+                for instant in instants:
+                    cursor.execute(query.format(**tables), [adapt(instant)] * query.count("%s"))
+                    valid += cursor.fetchone()[0]
+                seconds = time.perf_counter() - start
+                results.append((layout, queries / seconds if seconds else 0, valid))
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS {elements}".format(**tables))
+                cursor.execute("DROP TABLE IF EXISTS {periods}".format(**tables))
+    return results
+
+
+# Baselines: {database vendor and layout: {scale: {scenario: number of queries}}}
+
+def baseline_key(connection):
+    """e.g. "postgresql", or "postgresql+flat" with MEDUX_FLAT_RESOURCES"""
+    return connection.vendor + ("+flat" if FLAT_RESOURCES else "")
+
+
+def load_baselines():
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE, encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def save_baselines(baselines):
+    with open(BASELINES_FILE, "w", encoding="utf-8") as stream:
+        json.dump(baselines, stream, indent=2, sort_keys=True)
+        stream.write("\n")
+
+
+def check_baselines(baselines, key, scale, measurements):
+    """Returns a list of messages for the scenarios that need more queries than their baseline"""
+    stored = baselines.get(key, {}).get(scale, {})
+    return ["{}: {} queries, baseline is {}".format(measurement.scenario, measurement.queries,
+                                                    stored[measurement.scenario])
+            for measurement in measurements
+            if measurement.scenario in stored and measurement.queries > stored[measurement.scenario]]
@@ -0,0 +1,161 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Content-addressed storage of the data of Attachments, see http://hl7.org/fhir/datatypes.html#Attachment
+#
+# Every blob is stored once, in a file named by the SHA-1 of its content - which is what FHIR wants
+# in Attachment.hash anyway. Uploading the same photo twice therefore doesn't need any more space.
+# Data is always read and written in chunks, so large scans never have to fit into memory.
+
+__all__ = ["BlobStore", "BlobTooLargeError", "FileSystemBlobStore", "decode_hash", "encode_hash", "get_blob_store",
+           "max_blob_size"]
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class BlobTooLargeError(ValueError):
+    """Raised when the content to save is larger than the allowed size"""
+
+
+def max_blob_size():
+    """Returns the MEDUX_BLOB_MAX_SIZE setting: the maximum size of a blob in bytes, or None"""
+    return getattr(settings, "MEDUX_BLOB_MAX_SIZE", None)
+
+
+def encode_hash(key):
+    """Returns the base64 representation of Attachment.hash for a (hex) blob key"""
+    return base64.b64encode(binascii.unhexlify(key)).decode("ascii")
+
+
+def decode_hash(value):
+    """Returns the (hex) blob key for the base64 value of Attachment.hash"""
+    return binascii.hexlify(base64.b64decode(value)).decode("ascii")
+
+
+class BlobStore:
+    """Interface of the blob stores. Blobs are identified by the hex SHA-1 of their content."""
+
+    def save(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, max_size=None):
+        """Reads a file-like object in chunks and stores its content.
+
+        The hash and size are computed on the way. Returns (key, size).
+        Raises BlobTooLargeError as soon as more than max_size bytes are read, nothing is stored then."""
+        raise NotImplementedError
+
+    def open(self, key):
+        """Returns a binary file-like object to read the blob from"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def iter_range(self, key, start=0, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yields the bytes start..end (inclusive, like HTTP ranges) of a blob in chunks"""
+        if end is None:
+            end = self.size(key) - 1
+        with self.open(key) as stream:
+            stream.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class FileSystemBlobStore(BlobStore):
+    """Stores blobs as files below a root directory, like <root>/ab/cd/abcd...
+
+    Files are written to a temporary file first and then renamed, so a blob is either complete
+    or not there at all, even if an upload is interrupted."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        if len(key) != 40 or any(char not in "0123456789abcdef" for char in key):
+            raise ValueError("Invalid blob key: {}".format(key))
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def save(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, max_size=None):
+        os.makedirs(self.root, exist_ok=True)
+        sha1 = hashlib.sha1()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLargeError("The content is larger than {} bytes".format(max_size))
+                    sha1.update(chunk)
+                    temp.write(chunk)
+            key = sha1.hexdigest()
+            path = self.path(key)
+            if os.path.exists(path):
+                # we have that content already
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return key, size
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+def get_blob_store():
+    root = getattr(settings, "MEDUX_BLOB_ROOT", None)
+    if not root:
+        raise ImproperlyConfigured("MEDUX_BLOB_ROOT must be set to the directory of the blob store")
+    return FileSystemBlobStore(root)
@@ -0,0 +1,141 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.db import connections, models, router, transaction
+
+__all__ = ["bulk_create", "bulk_create_m2m"]
+
+# Django's own QuerySet.bulk_create() refuses multi-table inherited models, and only
+# returns primary keys on backends which support "INSERT ... RETURNING" (PostgreSQL).
+# Nearly all of our FHIR elements (HumanName, ContactPoint, Address, Reference, ...) inherit
+# from the concrete Element model, so we need our own helper here which does one INSERT per
+# table and batch, no matter how many objects are saved.
+
+
+def _can_return_pks(connection):
+    return connection.features.can_return_rows_from_bulk_insert
+
+
+def _last_pk(model, using):
+    """Returns the highest primary key in the table of model, and keeps other transactions from
+    inserting into that table until the current one ends."""
+    connection = connections[using]
+    if connection.vendor == "sqlite":
+        # SQLite ignores FOR UPDATE, but the first write of a transaction takes the database's write
+        # lock - even if it changes no rows.
+        table = connection.ops.quote_name(model._meta.db_table)
+        column = connection.ops.quote_name(model._meta.pk.column)
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE {0} SET {1} = {1} WHERE 1 = 0".format(table, column))
+    # InnoDB locks the gap after the last row too, so nobody else can insert a higher key meanwhile
+    return model._base_manager.using(using).select_for_update().order_by("-pk").values_list("pk", flat=True).first()
+
+
+def _reserve_pks(model, objs, using):
+    """Assigns a contiguous block of primary keys to all objs that have none yet.
+
+    This is only used on backends that can't return the ids of a bulk insert (SQLite, MySQL).
+    It must be called within a transaction: the table stays locked until the rows are inserted,
+    so concurrent imports can't reserve the same block."""
+    # objs may be instances of a model inheriting from the given one
+    attname = model._meta.pk.attname
+    pending = [obj for obj in objs if getattr(obj, attname) is None]
+    if not pending:
+        return
+    last = _last_pk(model, using) or 0
+    for pk, obj in enumerate(pending, start=last + 1):
+        setattr(obj, attname, pk)
+
+
+def _insert_fields(fields, objs):
+    """Returns the fields without the nullable ones that are NULL for all objs, like the extensions of
+    elements. They are NULL without being inserted, and SQLite fits more rows into one INSERT then."""
+    return [field for field in fields
+            if not field.null or any(field.get_prep_value(getattr(obj, field.attname)) is not None for obj in objs)]
+
+
+def _insert(model, objs, fields, using, batch_size=None):
+    """Inserts the given fields of objs into the table of model, batched"""
+    connection = connections[using]
+    fields = _insert_fields(fields, objs)
+    batch_size = batch_size or max(connection.ops.bulk_batch_size(fields, objs), 1)
+    for start in range(0, len(objs), batch_size):
+        # Manager._insert() is what Model.save() uses too - it writes exactly one (multi-row) INSERT.
+        model._base_manager._insert(objs[start:start + batch_size], fields=fields, using=using)
+
+
+def bulk_create(model, objs, batch_size=None):
+    """Saves a list of unsaved model instances using a constant number of queries.
+
+    In contrary to QuerySet.bulk_create() this works with multi-table inheritance, and
+    the primary keys are always set on the objects afterwards, on every database backend.
+    No signals are sent, and save() is not called."""
+    objs = list(objs)
+    if not objs:
+        return objs
+
+    using = router.db_for_write(model)
+    opts = model._meta
+
+    # ancestors, starting with the root model which owns the primary key
+    chain = list(reversed(opts.get_parent_list())) + [model]
+    root = chain[0]
+
+    auto_pk = isinstance(root._meta.pk, models.AutoField)
+    if len(chain) == 1 and (not auto_pk or _can_return_pks(connections[using])):
+        return model._base_manager.using(using).bulk_create(objs, batch_size=batch_size)
+
+    with transaction.atomic(using=using, savepoint=False):
+        if auto_pk and not _can_return_pks(connections[using]):
+            _reserve_pks(root, objs, using)
+
+        if len(chain) > 1:
+            # create the root rows first, so that the database hands out the primary keys
+            parents = [root(**{f.attname: getattr(obj, f.attname) for f in root._meta.concrete_fields})
+                       for obj in objs]
+            if auto_pk and not _can_return_pks(connections[using]):
+                # the primary keys are reserved already
+                _insert(root, parents, root._meta.local_concrete_fields, using, batch_size)
+            else:
+                root._base_manager.using(using).bulk_create(parents, batch_size=batch_size)
+            for obj, parent in zip(objs, parents):
+                # all parent links of an inherited model share the root's primary key
+                for link in chain:
+                    setattr(obj, link._meta.pk.attname, parent.pk)
+            for link in chain[1:]:
+                _insert(link, objs, link._meta.local_concrete_fields, using, batch_size)
+        else:
+            _insert(root, objs, opts.local_concrete_fields, using, batch_size)
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+    return objs
+
+
+def bulk_create_m2m(field, pairs, batch_size=None):
+    """Creates the rows of a ManyToManyField's through table.
+
+    :param field: the ManyToManyField, e.g. ``Patient._meta.get_field("name")``
+    :param pairs: iterable of (source instance, target instance) tuples
+    """
+    through = field.remote_field.through
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    rows = [through(**{source + "_id": obj.pk, target + "_id": related.pk}) for obj, related in pairs]
+    return through._base_manager.using(router.db_for_write(through)).bulk_create(rows, batch_size=batch_size)
@@ -0,0 +1,270 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from medux.core.bulk import bulk_create, bulk_create_m2m
+from medux.core.fields import validate_extensions
+from medux.core.derived import refresh_resources
+from medux.core.jsonstream import JSONStreamError, StreamDecoder
+from medux.core.models import Address, ContactPoint, HumanName, Identifier, Patient, Reference
+from medux.core.periods import Period
+from medux.core.profiles import validate_resource
+from medux.core.search import date_range
+from medux.core.terminology import validate_codes
+
+__all__ = ["BundleError", "BundleImporter", "iter_bundle_entries"]
+
+# http://hl7.org/fhir/valueset-bundle-type.html
+# Only these two types carry resources that should be written to the database.
+IMPORTABLE_BUNDLE_TYPES = ("transaction", "batch")
+
+DEFAULT_BATCH_SIZE = 500
+
+
+class BundleError(ValueError):
+    """Raised if a Bundle can't be parsed or contains something we can't import"""
+
+
+def iter_bundle_entries(stream, chunk_size=64 * 1024):
+    """Yields the "entry" items of a FHIR Bundle JSON document one at a time.
+
+    The Bundle is never loaded completely into memory, so this works with arbitrarily large files.
+    Top level elements in front of "entry" (like resourceType and type) are checked on the way.
+    """
+    reader = StreamDecoder(stream, chunk_size)
+    try:
+        for key in reader.members():
+            if key == "entry":
+                for _ in reader.items():
+                    yield reader.value()
+                continue
+            value = reader.value()
+            if key == "resourceType" and value != "Bundle":
+                raise BundleError("Expected a Bundle, got a {}".format(value))
+            if key == "type" and value not in IMPORTABLE_BUNDLE_TYPES:
+                raise BundleError("Bundle type '{}' can't be imported".format(value))
+    except JSONStreamError as e:
+        raise BundleError(str(e))
+
+
+def _date_range(value):
+    """Returns the (low, high) range of aware datetimes of a FHIR date/dateTime/instant, which may be
+    a partial date like "1980" or "1980-05" """
+    try:
+        return date_range(value)
+    except ValueError:
+        raise BundleError("Invalid date: {}".format(value))
+
+
+def _parse_instant(value):
+    """Returns an aware datetime for a FHIR dateTime/instant, the start of a (partial) date"""
+    if not value:
+        return None
+    return _date_range(value)[0]
+
+
+def _parse_date(value):
+    """Returns a date for a FHIR date. The model has no precision, so a partial date is stored as
+    its first day."""
+    if not value:
+        return None
+    return _date_range(value)[0].date()
+
+
+class BundleImporter:
+    """Imports the Patients of a FHIR transaction/batch Bundle in batches.
+
+    Each batch of patients is saved with a constant number of queries (one INSERT per table),
+    independent of how many identifiers, names, telecoms and addresses they have.
+
+    Supported elements of Patient are identifier, active, name, telecom, gender, birthDate,
+    deceased[x], address, multipleBirth[x], generalPractitioner and managingOrganization.
+    References are stored as they are, and not resolved against other entries of the Bundle.
+    A deceasedBoolean of true can't be stored without the date of death, such Patients are rejected.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.responses = []
+        self._batch = []
+
+    def run(self, stream):
+        """Imports a whole Bundle from a file-like object.
+
+        Everything is done within one transaction, like FHIR requires for "transaction" Bundles.
+        Returns the list of response entries, in the order of the Bundle entries."""
+        with transaction.atomic():
+            for entry in iter_bundle_entries(stream):
+                self.add(entry)
+            self.flush()
+        return self.responses
+
+    def add(self, entry):
+        """Queues one Bundle entry, and saves the batch when it is full"""
+        resource = entry.get("resource") or {}
+        method = (entry.get("request") or {}).get("method", "POST")
+        if method != "POST":
+            raise BundleError("Only POST (create) entries can be imported, got {}".format(method))
+        if resource.get("resourceType") != "Patient":
+            raise BundleError("Resource type '{}' can't be imported yet".format(resource.get("resourceType")))
+        # against the profiles in meta.profile, if they are known
+        errors = validate_resource(resource)
+        if errors:
+            raise BundleError("; ".join(errors))
+        self._batch.append(resource)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Saves all queued resources"""
+        if not self._batch:
+            return
+        patients = self.save_patients(self._batch)
+        self._batch = []
+        # the bulk inserts don't send any signals
+        refresh_resources(Patient, [patient.pk for patient in patients])
+        for patient in patients:
+            self.responses.append({
+                "response": {
+                    "status": "201 Created",
+                    "location": "Patient/{}".format(patient.pk),
+                }
+            })
+
+    def save_patients(self, resources):
+        """Saves a list of Patient resources (as dicts), and returns the created Patient objects"""
+        references = []
+
+        def period(data):
+            if not data:
+                return None
+            # a date covers the whole day, so the period ends at its end
+            end = data.get("end")
+            return Period(_parse_instant(data.get("start")), _date_range(end)[1] if end else None)
+
+        def reference(data):
+            if not data:
+                return None
+            obj = Reference(references=data.get("reference", ""), display=data.get("display", ""),
+                            extensions=data.get("extension", []))
+            references.append(obj)
+            return obj
+
+        patients = []
+        # (Patient, element) tuples per M2M field
+        identifiers = []
+        names = []
+        telecoms = []
+        addresses = []
+
+        for resource in resources:
+            multiple_birth = resource.get("multipleBirthInteger", resource.get("multipleBirthBoolean", 0))
+            if resource.get("deceasedBoolean"):
+                # Patient.deceased is a DateTimeField, false is stored as NULL like a missing deceased[x]
+                raise BundleError("deceasedBoolean true can't be stored, use deceasedDateTime instead")
+            patient = Patient(
+                active=resource.get("active", True),
+                gender=resource.get("gender", ""),
+                birthdate=_parse_date(resource.get("birthDate")),
+                deceased=_parse_instant(resource.get("deceasedDateTime")),
+                multipleBirth=int(multiple_birth),
+            )
+            # the model only has one generalPractitioner, FHIR allows many
+            general_practitioners = resource.get("generalPractitioner") or [None]
+            patient._general_practitioner = reference(general_practitioners[0])
+            patient._managing_organisation = reference(resource.get("managingOrganization"))
+            patients.append(patient)
+
+            for data in resource.get("identifier", []):
+                identifier = Identifier(
+                    use=data.get("use", ""),
+                    system=data.get("system", ""),
+                    value=data.get("value", ""),
+                )
+                identifier.period = period(data.get("period"))
+                identifier._assigner = reference(data.get("assigner"))
+                identifiers.append((patient, identifier))
+
+            for data in resource.get("name", []):
+                names.append((patient, HumanName(
+                    use=data.get("use", ""),
+                    text=data.get("text", ""),
+                    family=data.get("family", ""),
+                    given=" ".join(data.get("given", [])),
+                    extensions=data.get("extension", []),
+                )))
+
+            for data in resource.get("telecom", []):
+                contact_point = ContactPoint(
+                    system=data.get("system", ""),
+                    value=data.get("value", ""),
+                    use=data.get("use", ""),
+                    rank=data.get("rank", 0),
+                    extensions=data.get("extension", []),
+                )
+                contact_point.period = period(data.get("period"))
+                telecoms.append((patient, contact_point))
+
+            for data in resource.get("address", []):
+                address = Address(
+                    use=data.get("use", ""),
+                    type=data.get("type", ""),
+                    text=data.get("text", ""),
+                    line=", ".join(data.get("line", [])),
+                    city=data.get("city", ""),
+                    district=data.get("district", ""),
+                    state=data.get("state", ""),
+                    postalCode=data.get("postalCode", ""),
+                    country=data.get("country", ""),
+                    extensions=data.get("extension", []),
+                )
+                address.period = period(data.get("period"))
+                addresses.append((patient, address))
+
+        # the ValueSet expansions are cached, so this doesn't need any query per code
+        try:
+            for obj in patients + [obj for _, obj in identifiers + names + telecoms + addresses]:
+                validate_codes(obj)
+            for obj in references + [obj for _, obj in names + telecoms + addresses]:
+                validate_extensions(obj.extensions)
+        except ValidationError as e:
+            raise BundleError("; ".join(e.messages))
+
+        # rows that others point to have to be saved first, to get their primary keys
+        bulk_create(Reference, references)
+
+        for _, identifier in identifiers:
+            identifier.assigner = identifier._assigner
+        for patient in patients:
+            patient.generalPractitioner = patient._general_practitioner
+            patient.managingOrganisation = patient._managing_organisation
+
+        bulk_create(Identifier, [obj for _, obj in identifiers])
+        bulk_create(HumanName, [obj for _, obj in names])
+        bulk_create(ContactPoint, [obj for _, obj in telecoms])
+        bulk_create(Address, [obj for _, obj in addresses])
+        bulk_create(Patient, patients)
+
+        bulk_create_m2m(Patient._meta.get_field("identifier"), identifiers)
+        bulk_create_m2m(Patient._meta.get_field("name"), names)
+        bulk_create_m2m(Patient._meta.get_field("telecom"), telecoms)
+        bulk_create_m2m(Patient._meta.get_field("address"), addresses)
+
+        return patients
@@ -0,0 +1,78 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# In-process caches of data derived from the database, like ValueSet expansions (medux.core.terminology)
+# and compiled profiles (medux.core.profiles).
+#
+# They are bounded LRU caches, cleared by the signal handlers in medux.core.signals whenever the
+# data changes in this process. Changes made by other processes (or bulk imports without signals)
+# are picked up when the entries expire.
+
+__all__ = ["TimedLRUCache"]
+
+# cached for keys that load() found nothing for, so they aren't queried again and again
+_UNKNOWN = object()
+
+
+class TimedLRUCache:
+    """A bounded LRU cache of the values of a loader function, whose entries expire after timeout seconds.
+
+    load(*key) returns the value of a key, or None if there is none. That is cached too, for
+    unknown_timeout seconds if given (which shouldn't be longer than timeout)."""
+
+    def __init__(self, load, maxsize, timeout, unknown_timeout=None):
+        self.load = load
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.unknown_timeout = unknown_timeout
+        # key -> (value or _UNKNOWN, expiry time)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        """Returns the value of the key, loading it if it isn't cached or has expired; None if there is none"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return None if entry[0] is _UNKNOWN else entry[0]
+
+        # loaded outside of the lock, so that other keys can be read meanwhile
+        value = self.load(*key)
+        timeout = self.timeout
+        if value is None:
+            value = _UNKNOWN
+            if self.unknown_timeout is not None:
+                timeout = min(timeout, self.unknown_timeout)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return None if value is _UNKNOWN else value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,222 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+
+from django.db import transaction
+
+from medux.core.code_search import code_index
+from medux.core.jsonstream import JSONStreamError, StreamDecoder
+from medux.core.models import Coding
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Import of code systems (LOINC, SNOMED CT, ...) into the Coding table.
+#
+# The release files are read as a stream of (system, version, code, display) tuples, and saved in
+# batches with INSERTs that skip codes which exist already (Coding is unique on system, version and
+# code). After every batch, the number of processed records is written to a checkpoint file, so an
+# interrupted import continues where it stopped.
+
+__all__ = ["CodeImportError", "CodeImporter", "ImportStatistics", "iter_csv_codes", "iter_json_codes"]
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+class CodeImportError(ValueError):
+    """Raised if a release file can't be read"""
+
+
+def _concepts(system, version, concepts, key):
+    """Yields the codes of nested CodeSystem.concept or ValueSet.expansion.contains elements"""
+    for concept in concepts:
+        if concept.get("code"):
+            yield (concept.get("system", system), concept.get("version", version), concept["code"],
+                   concept.get("display", ""))
+        yield from _concepts(system, version, concept.get(key, []), key)
+
+
+def iter_json_codes(stream):
+    """Yields (system, version, code, display) for the codes of a CodeSystem or ValueSet JSON file.
+
+    CodeSystem.concept and ValueSet.expansion.contains are read one concept at a time, so they can
+    be arbitrarily large. The url and version of a CodeSystem must come before its concepts,
+    which is the order of the FHIR specification."""
+    reader = StreamDecoder(stream)
+    header = {}
+    try:
+        for key in reader.members():
+            if key == "concept":
+                if header.get("resourceType") != "CodeSystem" or not header.get("url"):
+                    raise CodeImportError("resourceType and url have to come before the concepts")
+                for _ in reader.items():
+                    yield from _concepts(header["url"], header.get("version", ""), [reader.value()], "concept")
+            elif key == "compose":
+                # the enumerated concepts of the included code systems
+                for include in reader.value().get("include", []):
+                    yield from _concepts(include.get("system", ""), include.get("version", ""),
+                                         include.get("concept", []), "concept")
+            elif key == "expansion":
+                for expansion_key in reader.members():
+                    if expansion_key != "contains":
+                        reader.value()
+                        continue
+                    for _ in reader.items():
+                        yield from _concepts("", "", [reader.value()], "contains")
+            else:
+                header[key] = reader.value()
+                if key == "resourceType" and header[key] not in ("CodeSystem", "ValueSet"):
+                    raise CodeImportError("Expected a CodeSystem or ValueSet, got a {}".format(header[key]))
+    except JSONStreamError as e:
+        raise CodeImportError(str(e))
+
+
+def iter_csv_codes(stream, system, version="", code_column="code", display_column="display", delimiter=",",
+                   where=None):
+    """Yields (system, version, code, display) for the rows of a CSV file, like Loinc.csv or a SNOMED CT RF2
+    description file (which is tab separated).
+
+    :param where: optional dict {column: value} - only rows with these values are imported, e.g.
+        {"active": "1"} for RF2 files
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="") if isinstance(stream, io.BufferedIOBase) \
+        else stream
+    # RF2 files don't quote their fields
+    quoting = csv.QUOTE_NONE if delimiter == "\t" else csv.QUOTE_MINIMAL
+    reader = csv.DictReader(text, delimiter=delimiter, quoting=quoting)
+    missing = {code_column, display_column, *(where or {})} - set(reader.fieldnames or [])
+    if missing:
+        raise CodeImportError("Missing columns: {}".format(", ".join(sorted(missing))))
+    for row in reader:
+        if where and any(row[column] != value for column, value in where.items()):
+            continue
+        yield system, version, row[code_column], row[display_column]
+
+
+class ImportStatistics:
+    """Counts and timings of an import"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.records = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.inserted = 0
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.started
+
+    @property
+    def peak_memory(self):
+        """The peak resident memory of the process in bytes, or None if it can't be determined"""
+        if resource is None:
+            return None
+        # kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __str__(self):
+        seconds = self.seconds
+        text = "{} records ({} skipped, {} already done before), {} new codes in {:.1f} s, {:.0f} records/s".format(
+            self.records, self.skipped, self.resumed, self.inserted, seconds,
+            (self.records - self.resumed) / seconds if seconds else 0)
+        if self.peak_memory is not None:
+            text += ", peak memory {:.1f} MiB".format(self.peak_memory / 1024 / 1024)
+        return text
+
+
+class CodeImporter:
+    """Saves a stream of (system, version, code, display) tuples as Codings, in batches.
+
+    Each batch is committed in its own transaction, and the number of processed records is written
+    to the checkpoint file afterwards. Running the import of the same file again skips that many
+    records, and continues with the first batch that wasn't committed.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None):
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.statistics = ImportStatistics()
+        self._max_lengths = {name: Coding._meta.get_field(name).max_length
+                             for name in ("system", "version", "code", "display")}
+
+    def _read_checkpoint(self, source):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint) as f:
+            data = json.load(f)
+        # a changed file has to be imported from the start
+        return data["records"] if data.get("source") == source else 0
+
+    def _write_checkpoint(self, source, records):
+        if not self.checkpoint:
+            return
+        # replaced atomically, so an interruption never leaves a broken checkpoint
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"source": source, "records": records}, f)
+        os.replace(temporary, self.checkpoint)
+
+    def run(self, codes, source=None):
+        """Imports all codes, and returns the ImportStatistics.
+
+        :param source: identifies the input in the checkpoint, e.g. file name, size and modification time
+        """
+        statistics = self.statistics
+        done = self._read_checkpoint(source)
+        count = Coding.objects.count()
+        batch = {}
+        for record in codes:
+            statistics.records += 1
+            if statistics.records <= done:
+                statistics.resumed += 1
+                continue
+            system, version, code, display = record
+            if not code or len(code) > self._max_lengths["code"] or len(system) > self._max_lengths["system"] \
+                    or len(version) > self._max_lengths["version"]:
+                statistics.skipped += 1
+                continue
+            # duplicates within the batch are dropped here, those in the database by the unique index
+            batch.setdefault((system, version, code), display[:self._max_lengths["display"]])
+            if len(batch) >= self.batch_size:
+                self._save(batch)
+                self._write_checkpoint(source, statistics.records)
+                batch = {}
+        if batch:
+            self._save(batch)
+        statistics.inserted = Coding.objects.count() - count
+        # bulk_create() doesn't send signals
+        code_index.refresh()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            # finished, a new run starts from the beginning
+            os.remove(self.checkpoint)
+        return statistics
+
+    def _save(self, batch):
+        with transaction.atomic():
+            Coding.objects.bulk_create([
+                Coding(system=system, version=version, code=code, display=display, userselected=False)
+                for (system, version, code), display in batch.items()
+            ], ignore_conflicts=True)
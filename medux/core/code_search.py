@@ -0,0 +1,493 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import datetime
+import logging
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max, Q
+
+from medux.core.models import Coding
+
+# Typeahead search over the codes (Coding.code and Coding.display), for pick lists.
+#
+# By default, the codes are held in an in-process index: a sorted list of the words of all displays
+# for prefix matches, and an inverted trigram index for fuzzy matches (like PostgreSQL's pg_trgm).
+# It is built in a background thread when the server starts (see medux.wsgi), so no search has to
+# wait for it; until it is done, searches only get the prefix matches of a database query. It is
+# kept up to date by the signal handlers in medux.core.signals, once the changes are committed.
+# Codes created or changed by other processes (or by bulk imports, which send no signals) are
+# picked up every MEDUX_CODE_INDEX_REFRESH_INTERVAL seconds, by Coding.lastUpdated. Codes deleted
+# by other processes are only noticed by the full rebuild every MEDUX_CODE_INDEX_REBUILD_INTERVAL
+# seconds.
+# On PostgreSQL with the pg_trgm extension, the database is searched instead, using trigram
+# indexes which are created by the migrations.
+
+__all__ = ["CodeIndex", "CodeMatch", "DatabaseCodeSearch", "code_index", "create_last_updated_column",
+           "get_code_search", "normalize", "search_codes", "similarity", "start_code_index", "trigrams"]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 20
+DEFAULT_REFRESH_INTERVAL = 60
+DEFAULT_REBUILD_INTERVAL = 3600
+
+# changes are looked for this far behind the newest lastUpdated seen, for transactions which
+# committed after others that started later
+REFRESH_OVERLAP = datetime.timedelta(minutes=1)
+
+# pg_trgm's default similarity threshold
+SIMILARITY_THRESHOLD = 0.3
+
+# at most this many candidates are looked at per search, so that short (unselective) queries stay fast
+MAX_CANDIDATES = 5000
+
+# ranking: exact code, code prefix, display prefix, word prefixes, then fuzzy matches by similarity
+RANK_CODE = 4
+RANK_CODE_PREFIX = 3
+RANK_DISPLAY_PREFIX = 2
+RANK_WORD_PREFIX = 1
+RANK_FUZZY = 0
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize(text):
+    """Returns text in lower case, without accents, for matching"""
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in text if not unicodedata.combining(char)).casefold()
+
+
+def trigrams(text):
+    """Returns the set of trigrams of the (normalized) text, the way pg_trgm builds them"""
+    result = set()
+    for word in _WORD_RE.findall(text):
+        word = "  " + word + " "
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return result
+
+
+def similarity(first, second):
+    """The trigram similarity (0..1) of two trigram sets"""
+    if not first or not second:
+        return 0.0
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+
+class CodeMatch:
+    __slots__ = ("pk", "system", "version", "code", "display", "userselected", "rank", "score")
+
+    def __init__(self, pk, system, version, code, display, userselected=False, rank=RANK_FUZZY, score=0.0):
+        self.pk = pk
+        self.system = system
+        self.version = version
+        self.code = code
+        self.display = display
+        self.userselected = userselected
+        self.rank = rank
+        self.score = score
+
+    def sort_key(self):
+        # codes picked by users before come first within a rank, then shorter displays
+        return -self.rank, -self.score, not self.userselected, len(self.display), self.display
+
+    def __repr__(self):
+        return "<CodeMatch {}|{} {}>".format(self.system, self.code, self.rank)
+
+
+def _prefix_rank(code, normalized, query, words):
+    """Returns the rank of a code matching the normalized query by prefix, or None"""
+    code = code.casefold()
+    if code == query:
+        return RANK_CODE
+    if code.startswith(query):
+        return RANK_CODE_PREFIX
+    if normalized.startswith(query):
+        return RANK_DISPLAY_PREFIX
+    display_words = _WORD_RE.findall(normalized)
+    if all(any(word.startswith(part) for word in display_words) for part in words):
+        return RANK_WORD_PREFIX
+    return None
+
+
+class CodeIndex:
+    """In-process prefix and trigram index of all Codings.
+
+    The postings (word -> pks, trigram -> pks) only find candidates, which are checked against the
+    current entry of each pk. So changed or deleted codes just leave stale postings behind, which
+    never match.
+
+    Builds and refreshes read the database without holding the lock, so searches go on with the
+    old data meanwhile; the new data is swapped in (or added) at the end."""
+
+    def __init__(self, refresh_interval=None, rebuild_interval=None):
+        self.refresh_interval = refresh_interval if refresh_interval is not None else getattr(
+            settings, "MEDUX_CODE_INDEX_REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL)
+        self.rebuild_interval = rebuild_interval if rebuild_interval is not None else getattr(
+            settings, "MEDUX_CODE_INDEX_REBUILD_INTERVAL", DEFAULT_REBUILD_INTERVAL)
+        # held while searching and changing the index
+        self._lock = threading.RLock()
+        # held while reading the database for a build or refresh, so only one runs at a time
+        self._loading = threading.Lock()
+        self._built = False
+        # the thread of build_in_background()
+        self._builder = None
+        self._checked = 0
+        self._rebuilt = 0
+        # changes of this process while a build reads the database, replayed on the new data
+        self._pending = None
+        self._clear()
+
+    def _clear(self):
+        # pk -> (system, version, code, display, userselected)
+        self._entries = {}
+        self._words = {}
+        self._trigrams = {}
+        # the words of all displays and codes, sorted for prefix searches
+        self._sorted_words = []
+        self._unsorted = False
+        # the newest pk and lastUpdated loaded, to find the changes since
+        self._max_pk = 0
+        self._last_updated = None
+
+    @property
+    def built(self):
+        return self._built
+
+    def _add(self, pk, system, version, code, display, userselected, bulk=False):
+        # the systems and versions are shared by many codes
+        entry = (sys.intern(system), sys.intern(version), code, display, userselected)
+        if self._entries.get(pk) == entry:
+            # loaded again by an overlapping refresh
+            return
+        self._entries[pk] = entry
+        normalized = normalize(display)
+        for word in set(_WORD_RE.findall(normalized)) | {code.casefold()}:
+            postings = self._words.get(word)
+            if postings is None:
+                postings = self._words[word] = array("i")
+                if bulk:
+                    self._unsorted = True
+                else:
+                    bisect.insort(self._sorted_words, word)
+            postings.append(pk)
+        for trigram in trigrams(normalized):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                postings = self._trigrams[trigram] = array("i")
+            postings.append(pk)
+
+    def _load(self, rows, bulk=False):
+        """Adds rows of _rows(), and moves the marks of the loaded changes.
+
+        Codings saved in this process (see update()) don't move them, as other processes may have
+        saved older ones which weren't loaded yet."""
+        for pk, system, version, code, display, userselected, last_updated in rows:
+            self._add(pk, system, version, code, display, userselected, bulk)
+            self._max_pk = max(self._max_pk, pk)
+            if self._last_updated is None or last_updated > self._last_updated:
+                self._last_updated = last_updated
+
+    @staticmethod
+    def _rows(queryset):
+        fields = ("pk", "system", "version", "code", "display", "userselected", "lastUpdated")
+        return queryset.order_by("pk").values_list(*fields).iterator(chunk_size=10000)
+
+    def build(self):
+        """(Re)builds the index from all Codings"""
+        with self._loading:
+            self._build()
+
+    def _build(self):
+        started = time.monotonic()
+        with self._lock:
+            self._pending = []
+        try:
+            fresh = CodeIndex(self.refresh_interval, self.rebuild_interval)
+            fresh._load(self._rows(Coding.objects.all()), bulk=True)
+            if fresh._unsorted:
+                fresh._sorted_words = sorted(fresh._words)
+                fresh._unsorted = False
+            with self._lock:
+                for change in self._pending:
+                    if isinstance(change, Coding):
+                        fresh._add(change.pk, change.system, change.version, change.code, change.display,
+                                   change.userselected)
+                    else:
+                        fresh._entries.pop(change, None)
+                for name in ("_entries", "_words", "_trigrams", "_sorted_words", "_unsorted", "_max_pk",
+                             "_last_updated"):
+                    setattr(self, name, getattr(fresh, name))
+                self._built = True
+                self._checked = self._rebuilt = started
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def build_in_background(self):
+        """Starts building the index in a daemon thread, unless it is built or being built already"""
+        with self._lock:
+            # after a fork, the thread of the parent process isn't alive in the child
+            if self._built or (self._builder is not None and self._builder.is_alive()):
+                return
+            self._builder = threading.Thread(target=self._build_in_thread, name="code-index", daemon=True)
+        self._builder.start()
+
+    def _build_in_thread(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Could not build the code index")
+        finally:
+            # a thread gets its own database connection, which Django doesn't close for us
+            connection.close()
+
+    def refresh(self):
+        """Adds the Codings created or changed since the last build or refresh, e.g. by other processes or
+        bulk imports.
+
+        Changes are found by max(pk) and max(lastUpdated) of the Codings, which are read from their indexes.
+        If the newest Codings were deleted, or the rebuild interval passed, the index is rebuilt."""
+        if not self._built:
+            return
+        with self._loading:
+            self._refresh()
+
+    def _refresh(self):
+        started = time.monotonic()
+        current = Coding.objects.aggregate(max_pk=Max("pk"), last_updated=Max("lastUpdated"))
+        if (current["max_pk"] or 0) < self._max_pk or started - self._rebuilt > self.rebuild_interval:
+            self._build()
+            return
+        if current["max_pk"] != self._max_pk or current["last_updated"] != self._last_updated:
+            changed = Q(pk__gt=self._max_pk)
+            if self._last_updated is not None:
+                changed |= Q(lastUpdated__gte=self._last_updated - REFRESH_OVERLAP)
+            rows = list(self._rows(Coding.objects.filter(changed)))
+            with self._lock:
+                self._load(rows)
+        self._checked = started
+
+    def update(self, coding):
+        """Adds or replaces one Coding, called when it is saved"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(coding)
+            if self._built:
+                self._add(coding.pk, coding.system, coding.version, coding.code, coding.display,
+                          coding.userselected)
+
+    def remove(self, pk):
+        """Removes one Coding, called when it is deleted"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(pk)
+            self._entries.pop(pk, None)
+
+    def _ensure_current(self):
+        """Refreshes the index when the refresh interval passed, and returns whether it is built.
+
+        If it isn't, it is built in the background. A build or refresh running in another thread
+        isn't waited for."""
+        if not self._built:
+            self.build_in_background()
+            return False
+        if time.monotonic() - self._checked > self.refresh_interval and self._loading.acquire(blocking=False):
+            try:
+                self._refresh()
+            finally:
+                self._loading.release()
+        return True
+
+    @staticmethod
+    def _database_search(query, words, system, limit):
+        """Returns the CodeMatches of codes and displays starting with the query, from the database"""
+        queryset = Coding.objects.filter(Q(code__istartswith=query) | Q(display__istartswith=query))
+        if system:
+            queryset = queryset.filter(system=system)
+        matches = []
+        for row in queryset.values_list("pk", "system", "version", "code", "display", "userselected")[:MAX_CANDIDATES]:
+            rank = _prefix_rank(row[3], normalize(row[4]), query, words)
+            if rank is not None:
+                matches.append(CodeMatch(*row, rank=rank, score=1.0))
+        return sorted(matches, key=CodeMatch.sort_key)[:limit]
+
+    def _prefix_postings(self, prefix):
+        """Yields the postings of all words (and codes) starting with prefix"""
+        words = self._sorted_words
+        for i in range(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix):
+                break
+            yield self._words[words[i]]
+
+    def _prefix_count(self, prefix, limit):
+        """Returns the number of postings for prefix, counting up to limit"""
+        count = 0
+        for postings in self._prefix_postings(prefix):
+            count += len(postings)
+            if count >= limit:
+                break
+        return count
+
+    def _prefix_candidates(self, prefix, limit):
+        """Returns up to limit pks of the codes with a word (or code) starting with prefix"""
+        candidates = set()
+        for postings in self._prefix_postings(prefix):
+            candidates.update(postings[:limit - len(candidates)])
+            if len(candidates) >= limit:
+                break
+        return candidates
+
+    def _fuzzy_candidates(self, query_trigrams, limit):
+        """Returns up to limit pks sharing the most of the rarest trigrams of the query"""
+        # common trigrams have long postings, but select little; the rare ones are enough to find candidates
+        counter = Counter()
+        budget = MAX_CANDIDATES * 10
+        for trigram in sorted((trigram for trigram in query_trigrams if trigram in self._trigrams),
+                              key=lambda trigram: len(self._trigrams[trigram])):
+            postings = self._trigrams[trigram]
+            if counter and len(postings) > budget:
+                break
+            counter.update(postings)
+            budget -= len(postings)
+        return [pk for pk, _ in counter.most_common(limit)]
+
+    def search(self, text, system=None, limit=DEFAULT_LIMIT):
+        """Returns up to limit CodeMatches for text, best first"""
+        query = normalize(text).strip()
+        words = _WORD_RE.findall(query)
+        if not words:
+            return []
+        if not self._ensure_current():
+            return self._database_search(query, words, system, limit)
+        matches = {}
+        with self._lock:
+            # all words have to match, so the candidates of the most selective one are enough
+            word = min(words, key=lambda word: self._prefix_count(word, MAX_CANDIDATES))
+            for pk in self._prefix_candidates(word, MAX_CANDIDATES):
+                entry = self._entries.get(pk)
+                if entry is None or (system and entry[0] != system):
+                    continue
+                rank = _prefix_rank(entry[2], normalize(entry[3]), query, words)
+                if rank is not None:
+                    matches[pk] = CodeMatch(pk, *entry, rank=rank, score=1.0)
+            if len(matches) < limit and len(query) >= 3:
+                query_trigrams = trigrams(query)
+                for pk in self._fuzzy_candidates(query_trigrams, limit * 10):
+                    entry = self._entries.get(pk)
+                    if pk in matches or entry is None or (system and entry[0] != system):
+                        continue
+                    score = similarity(query_trigrams, trigrams(normalize(entry[3])))
+                    if score >= SIMILARITY_THRESHOLD:
+                        matches[pk] = CodeMatch(pk, *entry, rank=RANK_FUZZY, score=score)
+        return sorted(matches.values(), key=CodeMatch.sort_key)[:limit]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DatabaseCodeSearch:
+    """Searches the codes with PostgreSQL's pg_trgm, using the trigram indexes created by the migrations"""
+
+    def search(self, text, system=None, limit=DEFAULT_LIMIT):
+        query = text.strip()
+        if not query:
+            return []
+        table = connection.ops.quote_name(Coding._meta.db_table)
+        prefix = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        sql = (
+            "SELECT id, system, version, code, display, userselected, "
+            "CASE WHEN lower(code) = lower(%s) THEN {code} WHEN code ILIKE %s THEN {code_prefix} "
+            "WHEN display ILIKE %s THEN {display_prefix} ELSE {fuzzy} END AS rank, "
+            "similarity(display, %s) AS score "
+            "FROM {table} WHERE (code ILIKE %s OR display ILIKE %s OR display %% %s)"
+        ).format(table=table, code=RANK_CODE, code_prefix=RANK_CODE_PREFIX, display_prefix=RANK_DISPLAY_PREFIX,
+                 fuzzy=RANK_FUZZY)
+        params = [query, prefix, prefix, query, prefix, prefix, query]
+        if system:
+            sql += " AND system = %s"
+            params.append(system)
+        sql += " ORDER BY rank DESC, score DESC, userselected DESC, length(display), display LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [CodeMatch(*row) for row in cursor.fetchall()]
+
+
+def _trigram_available():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+
+def create_last_updated_column(using_connection):
+    """Adds Coding.lastUpdated (and its index) to databases created before it existed.
+
+    New databases get it with their tables. The existing codes get the current time."""
+    table = Coding._meta.db_table
+    field = Coding._meta.get_field("lastUpdated")
+    with using_connection.cursor() as cursor:
+        if table not in using_connection.introspection.table_names(cursor):
+            return
+        columns = {column.name for column in using_connection.introspection.get_table_description(cursor, table)}
+    if field.column not in columns:
+        with using_connection.schema_editor() as editor:
+            editor.add_field(Coding, field)
+
+
+code_index = CodeIndex()
+database_search = DatabaseCodeSearch()
+
+_backend = None
+
+
+def get_code_search():
+    """Returns the code search backend: DatabaseCodeSearch on PostgreSQL with pg_trgm, else the in-process index.
+
+    MEDUX_CODE_SEARCH = "database" or "memory" overrides the automatic choice."""
+    global _backend
+    if _backend is None:
+        setting = getattr(settings, "MEDUX_CODE_SEARCH", None)
+        if setting == "database" or (setting is None and _trigram_available()):
+            _backend = database_search
+        else:
+            _backend = code_index
+    return _backend
+
+
+def start_code_index():
+    """Starts building the in-process index in the background, if the codes are searched with it"""
+    if get_code_search() is code_index:
+        code_index.build_in_background()
+
+
+def search_codes(text, system=None, limit=DEFAULT_LIMIT):
+    """Returns up to limit CodeMatches for a typeahead text, best first"""
+    return get_code_search().search(text, system, limit)
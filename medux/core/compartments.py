@@ -0,0 +1,152 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+from itertools import groupby
+
+from django.db.models import Q
+
+from medux.core.documents import document_store_enabled, get_documents
+from medux.core.fhir import RESOURCE_TYPES
+from medux.core.history import current_versions
+from medux.core.models import ResourceVersion, SearchReference
+
+# The compartment of a resource (http://hl7.org/fhir/compartmentdefinition.html) for operations
+# like Patient/$everything: the resource itself, all resources that refer to it, and the
+# resources it refers to (like the managingOrganization of a Patient).
+#
+# The references of all resources are precomputed into the SearchReference index when they are
+# written (see medux.core.search), which has an index on the target, too. So the members of a
+# compartment are found with one query, without looking into any resource. The resources are
+# then loaded as stored JSON, with one query per resource type and batch, and can be streamed
+# out while they are loaded - a large chart is never completely in memory.
+
+__all__ = ["BATCH_SIZE", "compartment_members", "compartment_page", "compartments_filter", "iter_entries",
+           "stored_resources"]
+
+DEFAULT_COUNT = 1000
+MAX_COUNT = 10000
+# resources per query
+BATCH_SIZE = 500
+
+
+def stored_resources(resource_type, resource_ids):
+    """Returns {resource id: FHIR JSON string} of the current versions of resources of one type, with one query.
+
+    Deleted resources are left out."""
+    if document_store_enabled():
+        return get_documents(resource_type, resource_ids)
+    return {resource_id: version.content for resource_id, version in
+            current_versions(resource_type, resource_ids).items() if version.method != "delete"}
+
+
+def compartment_members(resource_type, resource_id):
+    """Returns the set of (resource type, id) of the compartment of a resource, with one query.
+
+    Only resource types stored on this server are returned, and the members may not exist
+    (any more), e.g. if a reference can't be resolved."""
+    members = {(resource_type, resource_id)}
+    for source_type, source_id, target_type, target_id in SearchReference.objects.filter(
+            Q(target_type=resource_type, target_id=resource_id) |
+            Q(resource_type=resource_type, resource_id=resource_id)).values_list(
+            "resource_type", "resource_id", "target_type", "target_id"):
+        if (target_type, target_id) == (resource_type, resource_id):
+            members.add((source_type, source_id))
+        else:
+            members.add((target_type, target_id))
+    return {member for member in members if member[0] in RESOURCE_TYPES}
+
+
+def compartments_filter(compartment_type, resource_type):
+    """Returns a filter of the ResourceVersions of resource_type in the compartment of any resource of
+    compartment_type, like compartment_members() of all of them at once, e.g. for a Patient level $export.
+
+    The members are selected in the database with subqueries, so they never have to be loaded."""
+    if resource_type == compartment_type:
+        return Q()
+    return Q(resource_id__in=SearchReference.objects.filter(
+        resource_type=resource_type, target_type=compartment_type).values("resource_id")) | \
+        Q(resource_id__in=SearchReference.objects.filter(
+            resource_type=compartment_type, target_type=resource_type).values("target_id"))
+
+
+def _last_updated(members):
+    """Returns {member: lastUpdated} of the members which exist, with one query per resource type and batch"""
+    result = {}
+    for member_type, group in groupby(sorted(members), key=lambda member: member[0]):
+        ids = [member_id for _, member_id in group]
+        for start in range(0, len(ids), BATCH_SIZE):
+            result.update(((member_type, member_id), last_updated) for member_id, last_updated in
+                          ResourceVersion.objects.filter(resource_type=member_type, current=True,
+                                                         resource_id__in=ids[start:start + BATCH_SIZE])
+                          .exclude(method="delete").values_list("resource_id", "lastUpdated"))
+    return result
+
+
+def compartment_page(resource_type, resource_id, since=None, types=None, count=DEFAULT_COUNT, cursor=None):
+    """Returns (total, members of the page, cursor of the next page or None) of a compartment.
+
+    The resource itself comes first, then the other members, ordered by type and id. The cursor is
+    "type/id" of the last member of the previous page. Returns None if the resource doesn't exist.
+
+    :param since: only members which were changed since then
+    :param types: only members of these resource types
+    """
+    members = compartment_members(resource_type, resource_id)
+    if types:
+        # the resource itself is still needed to tell whether it exists
+        members = {member for member in members if member[0] in types or member == (resource_type, resource_id)}
+    last_updated = _last_updated(members)
+    if (resource_type, resource_id) not in last_updated:
+        return None
+    members = [member for member, updated in last_updated.items()
+               if (not types or member[0] in types) and (since is None or updated >= since)]
+
+    def key(member):
+        return (member != (resource_type, resource_id),) + member
+
+    members = sorted(members, key=key)
+    if cursor:
+        cursor_type, _, cursor_id = cursor.partition("/")
+        after = key((cursor_type, cursor_id))
+        page = [member for member in members if key(member) > after]
+    else:
+        page = members
+    next_cursor = "{}/{}".format(*page[count - 1]) if len(page) > count else None
+    return len(members), page[:count], next_cursor
+
+
+def iter_entries(members, full_url, match=None):
+    """Yields the Bundle entries of the members as JSON strings, in batches joined by commas.
+
+    Consecutive members of one type are loaded with one query per batch.
+
+    :param full_url: callable, returns the fullUrl of (resource type, id)
+    :param match: the member with search mode "match", the others are "include"
+    """
+    for member_type, group in groupby(members, key=lambda member: member[0]):
+        ids = [member_id for _, member_id in group]
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = ids[start:start + BATCH_SIZE]
+            resources = stored_resources(member_type, batch)
+            entries = ['{{"fullUrl":{},"resource":{},"search":{{"mode":"{}"}}}}'.format(
+                json.dumps(full_url(member_type, member_id)), resources[member_id],
+                "match" if (member_type, member_id) == match else "include")
+                for member_id in batch if member_id in resources]
+            if entries:
+                yield ",".join(entries)
@@ -0,0 +1,99 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.db import transaction
+
+from medux.core import documents, history, matching, search
+from medux.core.fhir import PREFETCH, SELECT_RELATED, SERIALIZERS, resource_type, serialization_queryset, to_fhir
+from medux.core.instrumentation import section
+
+# Data that is derived from the FHIR representation of resources: the version history
+# (medux.core.history), the JSON documents (medux.core.documents), the search indexes
+# (medux.core.search) and the match records of Patients (medux.core.matching).
+# It has to be rewritten whenever a resource or one of its elements changes, which is done by
+# the signal handlers, or explicitly by bulk operations which don't send signals.
+
+__all__ = ["DERIVED_MODELS", "affects_derived", "delete_resources", "dependency_paths", "refresh_dependents",
+           "refresh_resources"]
+
+
+def _paths(model):
+    """Yields (lookup, related model) for everything the serializer of a resource model reads"""
+    for path in SELECT_RELATED[model] + PREFETCH[model]:
+        current = model
+        parts = path.split("__")
+        for i, part in enumerate(parts):
+            current = current._meta.get_field(part).related_model
+            yield "__".join(parts[:i + 1]), current
+
+
+# all models whose changes affect the derived data
+DERIVED_MODELS = set(SERIALIZERS) | {related for model in SERIALIZERS for _, related in _paths(model)}
+
+
+def affects_derived(model):
+    return any(issubclass(model, related) for related in DERIVED_MODELS)
+
+
+def dependency_paths(sender):
+    """Yields (resource model, lookup) for each way a resource contains an instance of sender"""
+    for model in SERIALIZERS:
+        seen = set()
+        for lookup, related in _paths(model):
+            if issubclass(sender, related) and lookup not in seen:
+                seen.add(lookup)
+                yield model, lookup
+
+
+def refresh_resources(model, pks):
+    """Rewrites the derived data of the given resources, with a constant number of queries"""
+    pks = list(pks)
+    if not pks:
+        return
+    instances = list(serialization_queryset(model).filter(pk__in=pks))
+    with section("serialization"):
+        serialized = [(instance, to_fhir(instance)) for instance in instances]
+    with transaction.atomic():
+        # first, as it sets the versionId the others use
+        history.record_versions(model, serialized)
+        if documents.document_store_enabled():
+            documents.write_documents(model, serialized)
+        search.index_resources(model, [data for _, data in serialized])
+        if resource_type(model) == "Patient":
+            matching.index_patients([data for _, data in serialized])
+
+
+def delete_resources(model, resource_ids):
+    """Removes the derived data of deleted resources"""
+    with transaction.atomic():
+        history.record_deletes(model, resource_ids)
+        if documents.document_store_enabled():
+            documents.delete_documents(model, resource_ids)
+        search.delete_index(model, resource_ids)
+        if resource_type(model) == "Patient":
+            matching.delete_records(resource_ids)
+
+
+def refresh_dependents(instance):
+    """Rewrites the derived data of the resource instance, or of all resources containing the element instance"""
+    sender = type(instance)
+    if sender in SERIALIZERS:
+        refresh_resources(sender, [instance.pk])
+        return
+    for model, lookup in dependency_paths(sender):
+        refresh_resources(model, model.objects.filter(**{lookup: instance.pk}).values_list("pk", flat=True))
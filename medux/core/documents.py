@@ -0,0 +1,81 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from medux.core.fhir import resource_type
+from medux.core.models import ResourceDocument
+
+# The document store keeps the FHIR JSON of every resource in one row (ResourceDocument), so that
+# reading a resource doesn't need to join through all its elements. It is enabled with the
+# MEDUX_DOCUMENT_STORE setting. The documents are written by medux.core.derived.
+
+__all__ = ["current_document", "delete_documents", "document_store_enabled", "get_document", "get_documents",
+           "write_documents"]
+
+
+def document_store_enabled():
+    return getattr(settings, "MEDUX_DOCUMENT_STORE", False)
+
+
+def get_document(resource_type, resource_id):
+    """Returns the FHIR JSON of a resource as string, or None"""
+    return ResourceDocument.objects.filter(resource_type=resource_type, resource_id=resource_id) \
+        .values_list("content", flat=True).first()
+
+
+def current_document(resource_type, resource_id, content=True):
+    """Returns the ResourceDocument of a resource, or None.
+
+    :param content: if False, the content is only loaded when it is accessed
+    """
+    queryset = ResourceDocument.objects.filter(resource_type=resource_type, resource_id=resource_id)
+    if not content:
+        queryset = queryset.defer("content")
+    return queryset.first()
+
+
+def get_documents(resource_type, resource_ids):
+    """Returns {resource id: FHIR JSON string} for many resources of one type, with one query"""
+    return dict(ResourceDocument.objects.filter(resource_type=resource_type, resource_id__in=resource_ids)
+                .values_list("resource_id", "content"))
+
+
+def write_documents(model, serialized):
+    """(Re)writes the documents of resources, from a list of (instance, FHIR dict) tuples"""
+    type_name = resource_type(model)
+    now = timezone.now()
+    documents = [ResourceDocument(
+        resource_type=type_name,
+        resource_id=data["id"],
+        versionId=data.get("meta", {}).get("versionId", ""),
+        lastUpdated=getattr(instance, "lastUpdated", None) or now,
+        content=json.dumps(data, separators=(",", ":")),
+    ) for instance, data in serialized]
+    with transaction.atomic():
+        ResourceDocument.objects.filter(resource_type=type_name,
+                                        resource_id__in=[document.resource_id for document in documents]).delete()
+        ResourceDocument.objects.bulk_create(documents)
+
+
+def delete_documents(model, resource_ids):
+    ResourceDocument.objects.filter(resource_type=resource_type(model), resource_id__in=resource_ids).delete()
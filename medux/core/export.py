@@ -0,0 +1,147 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from medux.core.compartments import compartments_filter
+from medux.core.models import ExportJob, ResourceVersion
+
+# FHIR Bulk Data export, see http://hl7.org/fhir/uv/bulkdata/export/index.html
+#
+# The resources are exported in their stored JSON, the current version of the history
+# (medux.core.history), with the same meta.versionId as the read and search interactions.
+#
+# Jobs run in a thread of the server process that accepted them. A running job updates its
+# heartbeat after every chunk, so a job whose process has died (e.g. in a restart) is found by
+# pending_exports(), and is taken over by "manage.py export_resources --pending".
+
+__all__ = ["EXPORT_TYPES", "export_dir", "export_file", "export_queryset", "pending_exports", "run_export",
+           "start_export", "write_ndjson"]
+
+logger = logging.getLogger(__name__)
+
+EXPORT_TYPES = ("Patient", "Organization", "ValueSet", "StructureDefinition")
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# a job in progress without a heartbeat for this long has died
+STALE_AFTER = timedelta(minutes=10)
+
+
+def export_dir(job):
+    """Returns the directory where the NDJSON files of an ExportJob are written to"""
+    root = getattr(settings, "MEDUX_EXPORT_ROOT", None)
+    if not root:
+        raise ImproperlyConfigured("MEDUX_EXPORT_ROOT must be set to the directory of the $export files")
+    return os.path.join(root, str(job.pk))
+
+
+def export_file(job, resource_type):
+    return os.path.join(export_dir(job), "{}.ndjson".format(resource_type))
+
+
+def export_queryset(resource_type, compartment=None):
+    """Returns the current ResourceVersions of all (not deleted) resources of a type.
+
+    :param compartment: e.g. "Patient", to export only the resources in the compartments of all Patients
+    """
+    queryset = ResourceVersion.objects.filter(resource_type=resource_type, current=True).exclude(method="delete")
+    if compartment:
+        queryset = queryset.filter(compartments_filter(compartment, resource_type))
+    return queryset.order_by("pk")
+
+
+def write_ndjson(queryset, stream, chunk_size=DEFAULT_CHUNK_SIZE, cancelled=None):
+    """Writes the JSON of each ResourceVersion of the queryset as one line into stream.
+
+    The rows are read with a server-side cursor where the database supports it, so only one
+    chunk is in memory at a time, no matter how large the table is. The stored JSON is
+    written as it is, without decoding it.
+
+    :param cancelled: optional callable, which is checked after every chunk; the export
+        stops if it returns True.
+    :returns: the number of written resources
+    """
+    count = 0
+    for content in queryset.values_list("content", flat=True).iterator(chunk_size=chunk_size):
+        stream.write(content)
+        stream.write("\n")
+        count += 1
+        if cancelled is not None and count % chunk_size == 0 and cancelled():
+            break
+    return count
+
+
+def pending_exports():
+    """Returns the ExportJobs waiting to be processed: the accepted ones, and those whose process has died"""
+    return ExportJob.objects.filter(Q(status="accepted") |
+                                    Q(status="in-progress", heartbeat__lt=timezone.now() - STALE_AFTER))
+
+
+def run_export(job, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Processes an ExportJob: writes one NDJSON file per resource type.
+
+    Does nothing if the job isn't pending (any more), e.g. if another process has taken it over."""
+    if not pending_exports().filter(pk=job.pk).update(status="in-progress", heartbeat=timezone.now()):
+        return
+
+    def cancelled():
+        # the heartbeat isn't updated any more once the job is cancelled
+        return not ExportJob.objects.filter(pk=job.pk, status="in-progress").update(heartbeat=timezone.now())
+
+    directory = export_dir(job)
+    os.makedirs(directory, exist_ok=True)
+    output = {}
+    try:
+        for resource_type in job.type_list:
+            with open(export_file(job, resource_type), "w", encoding="utf-8") as stream:
+                output[resource_type] = write_ndjson(export_queryset(resource_type, job.compartment or None),
+                                                     stream, chunk_size, cancelled)
+            if cancelled():
+                shutil.rmtree(directory, ignore_errors=True)
+                return
+    except Exception as e:
+        logger.exception("Export %s failed", job.pk)
+        ExportJob.objects.filter(pk=job.pk).update(status="error", error=str(e), finished=timezone.now())
+        return
+    ExportJob.objects.filter(pk=job.pk).update(status="completed", output=json.dumps(output),
+                                               finished=timezone.now())
+
+
+def _run_in_thread(job_pk):
+    try:
+        run_export(ExportJob.objects.get(pk=job_pk))
+    finally:
+        # a thread gets its own database connection, which Django doesn't close for us
+        connection.close()
+
+
+def start_export(job):
+    """Runs the ExportJob in a background thread, as soon as it is committed to the database"""
+    transaction.on_commit(lambda: threading.Thread(target=_run_in_thread, args=(job.pk,), daemon=True).start())
@@ -0,0 +1,125 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, models, transaction
+from django.db.models import F, Func
+
+from medux.core.models import Element
+
+# Queries on the extensions of elements, see medux.core.fields.ExtensionField.
+#
+# The extensions of an element are stored inline, as JSON object that groups their values by url.
+# ExtensionValue(url) is the SQL expression of the values of one url (NULL if an element has
+# none). With the urls in MEDUX_INDEXED_EXTENSIONS, the migrations create an expression index on
+# exactly that expression for each (and "manage.py index_extensions" after changing the setting),
+# so searching for elements with such an extension doesn't need to parse the JSON of every row.
+# The indexes are partial, they only contain the elements which actually have that extension.
+# This works on PostgreSQL and SQLite (with JSON1); MySQL can query the extensions too, but
+# doesn't get the indexes.
+
+__all__ = ["ExtensionValue", "create_extension_indexes", "drop_extension_indexes", "extension_index_name",
+           "with_extension"]
+
+logger = logging.getLogger(__name__)
+
+# characters which can't be quoted safely within the JSON path of SQLite and MySQL, or the SQL literal
+UNSUPPORTED_URL_CHARACTERS = set("\"'%\\")
+
+EXTENSION_INDEX_PREFIX = "core_element_ext_"
+
+
+def _values_sql(vendor, column, url):
+    if UNSUPPORTED_URL_CHARACTERS.intersection(url):
+        raise ValueError("Extension urls with quotes, % or backslashes can't be queried: {}".format(url))
+    if vendor == "postgresql":
+        return "({}::jsonb -> '{}')".format(column, url)
+    return "JSON_EXTRACT({}, '$.\"{}\"')".format(column, url)
+
+
+class ExtensionValue(Func):
+    """The values of the extensions with one url of an element, as JSON array, or NULL if it has none.
+
+    The url is part of the SQL itself and not a parameter, as the query has to match the
+    expression of the index exactly."""
+
+    def __init__(self, url, field="extensions"):
+        # fails early for urls that can't be queried
+        _values_sql("", "", url)
+        self.url = url
+        super().__init__(F(field), output_field=models.TextField())
+
+    def as_sql(self, compiler, connection, **extra_context):
+        column, params = compiler.compile(self.source_expressions[0])
+        return _values_sql(connection.vendor, column, self.url), params
+
+
+def _encode(values):
+    # the same compact form as ExtensionField, which SQLite returns unchanged
+    return json.dumps(values, separators=(",", ":"), ensure_ascii=False)
+
+
+def with_extension(queryset, url, value=None):
+    """Filters a queryset of elements to those with an extension of that url.
+
+    With a value, like ``{"valueCode": "I"}``, only those with exactly this one extension of that url
+    are returned."""
+    alias = "_extension_" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:10]
+    queryset = queryset.annotate(**{alias: ExtensionValue(url)})
+    if value is None:
+        return queryset.filter(**{alias + "__isnull": False})
+    return queryset.filter(**{alias: _encode([value])})
+
+
+def extension_index_name(url):
+    return EXTENSION_INDEX_PREFIX + hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+
+
+def create_extension_indexes(using_connection):
+    """Creates the expression indexes of the MEDUX_INDEXED_EXTENSIONS urls, on PostgreSQL and SQLite.
+
+    Fails silently (with a warning in the log) if they can't be created, e.g. by an SQLite without
+    JSON support - queries just don't use an index then."""
+    vendor = using_connection.vendor
+    if vendor not in ("postgresql", "sqlite"):
+        return
+    quote = using_connection.ops.quote_name
+    for url in getattr(settings, "MEDUX_INDEXED_EXTENSIONS", ()):
+        expression = _values_sql(vendor, quote(Element._meta.get_field("extensions").column), url)
+        try:
+            with transaction.atomic(using=using_connection.alias), using_connection.cursor() as cursor:
+                cursor.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({}) WHERE {} IS NOT NULL".format(
+                    quote(extension_index_name(url)), quote(Element._meta.db_table), expression, expression))
+        except DatabaseError:
+            logger.warning("Could not create the index of the extension %s", url, exc_info=True)
+
+
+def drop_extension_indexes(using_connection, keep=()):
+    """Drops the expression indexes of all extension urls, except those in keep"""
+    if using_connection.vendor not in ("postgresql", "sqlite"):
+        return
+    keep = {extension_index_name(url) for url in keep}
+    with using_connection.cursor() as cursor:
+        names = [name for name in using_connection.introspection.get_constraints(cursor, Element._meta.db_table)
+                 if name.startswith(EXTENSION_INDEX_PREFIX) and name not in keep]
+        for name in names:
+            cursor.execute("DROP INDEX IF EXISTS {}".format(using_connection.ops.quote_name(name)))
@@ -0,0 +1,394 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+
+from medux.core.models import (CodeableConcept, ContactDetail, Identifier, Organisation, Patient, StructureDefinition,
+                               ValueSet)
+from medux.core.references import id_values
+
+# Conversion of our models into FHIR JSON (as Python dicts).
+# http://hl7.org/fhir/json.html
+#
+# The serializers never query the database themselves, as long as the related objects
+# of loading_plan() (for all elements: PREFETCH and SELECT_RELATED) were loaded before.
+
+__all__ = ["RESOURCE_TYPES", "PREFETCH", "SELECT_RELATED", "SERIALIZERS", "SUMMARY_ELEMENTS", "loading_plan",
+           "requested_elements", "resource_id", "resource_queryset", "resource_type", "serialization_queryset",
+           "to_fhir"]
+
+
+def _clean(data):
+    """Removes empty values, FHIR does not allow them in JSON"""
+    return {key: value for key, value in data.items() if value not in (None, "", [], {})}
+
+
+def _instant(value):
+    return value.isoformat() if value else None
+
+
+def period_to_fhir(period):
+    if period is None:
+        return None
+    return _clean({"start": _instant(period.start), "end": _instant(period.end)})
+
+
+def reference_to_fhir(reference):
+    if reference is None:
+        return None
+    return _clean({"extension": reference.extensions, "reference": reference.references,
+                   "display": reference.display})
+
+
+def identifier_to_fhir(identifier):
+    return _clean({
+        "use": identifier.use,
+        "system": identifier.system,
+        "value": identifier.value,
+        "period": period_to_fhir(identifier.period),
+        "assigner": reference_to_fhir(identifier.assigner),
+    })
+
+
+def human_name_to_fhir(name):
+    return _clean({
+        "extension": name.extensions,
+        "use": name.use,
+        "text": name.text,
+        "family": name.family,
+        "given": name.given.split(),
+    })
+
+
+def contact_point_to_fhir(contact_point):
+    return _clean({
+        "extension": contact_point.extensions,
+        "system": contact_point.system,
+        "value": contact_point.value,
+        "use": contact_point.use,
+        "rank": contact_point.rank or None,
+        "period": period_to_fhir(contact_point.period),
+    })
+
+
+def address_to_fhir(address):
+    return _clean({
+        "extension": address.extensions,
+        "use": address.use,
+        "type": address.type,
+        "text": address.text,
+        "line": [line for line in address.line.split(", ") if line],
+        "city": address.city,
+        "district": address.district,
+        "state": address.state,
+        "postalCode": address.postalCode,
+        "country": address.country,
+        "period": period_to_fhir(address.period),
+    })
+
+
+def contact_detail_to_fhir(contact):
+    return _clean({
+        "name": contact.name,
+        "telecom": [contact_point_to_fhir(telecom) for telecom in contact.telecom.all()],
+    })
+
+
+def usage_context_to_fhir(usage_context):
+    return _clean({
+        "extension": usage_context.extensions,
+        "code": {"code": usage_context.code},
+        "valueCodeableConcept": {"text": usage_context.value},
+    })
+
+
+def codeable_concept_to_fhir(concept):
+    return _clean({
+        "coding": [_clean({
+            "system": coding.system,
+            "version": coding.version,
+            "code": coding.code,
+            "display": coding.display,
+            "userSelected": coding.userselected,
+        }) for coding in concept.coding.all()],
+        "text": concept.text,
+    })
+
+
+def attachment_to_fhir(attachment):
+    # the data itself is never inlined, it can be downloaded from the url
+    if attachment is None:
+        return None
+    return _clean({
+        "contentType": attachment.contentType,
+        "language": attachment.language,
+        "url": attachment.url,
+        "size": attachment.size,
+        "hash": attachment.hash,
+        "title": attachment.title,
+        "creation": _instant(attachment.creation),
+    })
+
+
+def resource_id(instance):
+    """Returns the FHIR id of a resource model instance"""
+    if isinstance(instance, Patient):
+        return str(instance.pk)
+    return instance.id or instance.pk
+
+
+# The serializers of the resources are tables of FHIR element -> function returning its value, in
+# the order of the JSON output. Elements that weren't requested (with _elements or _summary) are
+# not serialized at all, and the related objects they need are not loaded (see loading_plan()).
+
+def _serialize(obj, resource_type, functions, elements=None):
+    data = {"resourceType": resource_type, "id": resource_id(obj)}
+    for name, function in functions.items():
+        if elements is None or name in elements:
+            data[name] = function(obj)
+    return _clean(data)
+
+
+def _meta_to_fhir(resource):
+    return _clean({
+        "versionId": resource.versionId,
+        "lastUpdated": _instant(resource.lastUpdated),
+    })
+
+
+# the elements every (Domain)Resource has
+RESOURCE_ELEMENTS = {
+    "meta": _meta_to_fhir,
+    "implicitRules": lambda resource: resource.implicitRules,
+    "language": lambda resource: resource.language,
+}
+
+PATIENT_ELEMENTS = {
+    "identifier": lambda patient: [identifier_to_fhir(identifier) for identifier in patient.identifier.all()],
+    "active": lambda patient: patient.active,
+    "name": lambda patient: [human_name_to_fhir(name) for name in patient.name.all()],
+    "telecom": lambda patient: [contact_point_to_fhir(telecom) for telecom in patient.telecom.all()],
+    "gender": lambda patient: patient.gender,
+    "birthDate": lambda patient: patient.birthdate.isoformat() if patient.birthdate else None,
+    "deceasedDateTime": lambda patient: _instant(patient.deceased),
+    "address": lambda patient: [address_to_fhir(address) for address in patient.address.all()],
+    "multipleBirthInteger": lambda patient: patient.multipleBirth or None,
+    "photo": lambda patient: [attachment_to_fhir(patient.photo)] if patient.photo is not None else None,
+    "managingOrganization": lambda patient: reference_to_fhir(patient.managingOrganisation),
+    # the model only has one generalPractitioner, FHIR allows many
+    "generalPractitioner": lambda patient: [reference_to_fhir(patient.generalPractitioner)]
+    if patient.generalPractitioner is not None else None,
+}
+
+ORGANISATION_ELEMENTS = dict(RESOURCE_ELEMENTS, **{
+    "identifier": lambda organisation: [identifier_to_fhir(identifier)
+                                        for identifier in organisation.identifier.all()],
+})
+
+# elements that are shared by the conformance resources ValueSet and StructureDefinition
+CONFORMANCE_RESOURCE_ELEMENTS = dict(RESOURCE_ELEMENTS, **{
+    "url": lambda resource: resource.url,
+    "identifier": lambda resource: [identifier_to_fhir(identifier) for identifier in resource.identifier.all()],
+    "version": lambda resource: resource.version,
+    "name": lambda resource: resource.name,
+    "title": lambda resource: resource.title,
+    "status": lambda resource: resource.status,
+    "experimental": lambda resource: resource.experimental,
+    "date": lambda resource: _instant(resource.date),
+    "publisher": lambda resource: resource.publisher,
+})
+
+VALUE_SET_ELEMENTS = dict(CONFORMANCE_RESOURCE_ELEMENTS, **{
+    "description": lambda value_set: value_set.descripttion,
+    "useContext": lambda value_set: [usage_context_to_fhir(context) for context in value_set.use_context.all()],
+    "contact": lambda value_set: [contact_detail_to_fhir(value_set.contact)] if value_set.contact else [],
+    "jurisdiction": lambda value_set: [codeable_concept_to_fhir(concept)
+                                       for concept in value_set.jurisdiction.all()],
+    "immutable": lambda value_set: value_set.immutable,
+    "purpose": lambda value_set: value_set.purpose,
+    "copyright": lambda value_set: value_set.copyright,
+    "extensible": lambda value_set: value_set.extensible,
+})
+
+STRUCTURE_DEFINITION_ELEMENTS = dict(CONFORMANCE_RESOURCE_ELEMENTS, **{
+    "description": lambda structure_definition: structure_definition.description,
+    "useContext": lambda structure_definition: [usage_context_to_fhir(context)
+                                                for context in structure_definition.use_context.all()],
+    "contact": lambda structure_definition: [contact_detail_to_fhir(contact)
+                                             for contact in structure_definition.contact.all()],
+    "type": lambda structure_definition: structure_definition.type,
+    "differential": lambda structure_definition: {"element": json.loads(structure_definition.differential)}
+    if structure_definition.differential else None,
+})
+
+
+def patient_to_fhir(patient, elements=None):
+    return _serialize(patient, "Patient", PATIENT_ELEMENTS, elements)
+
+
+def organisation_to_fhir(organisation, elements=None):
+    return _serialize(organisation, "Organization", ORGANISATION_ELEMENTS, elements)
+
+
+def value_set_to_fhir(value_set, elements=None):
+    return _serialize(value_set, "ValueSet", VALUE_SET_ELEMENTS, elements)
+
+
+def structure_definition_to_fhir(structure_definition, elements=None):
+    return _serialize(structure_definition, "StructureDefinition", STRUCTURE_DEFINITION_ELEMENTS, elements)
+
+
+# FHIR resource type name -> model
+RESOURCE_TYPES = {
+    "Patient": Patient,
+    "Organization": Organisation,
+    "ValueSet": ValueSet,
+    "StructureDefinition": StructureDefinition,
+}
+
+SERIALIZERS = {
+    Patient: patient_to_fhir,
+    Organisation: organisation_to_fhir,
+    ValueSet: value_set_to_fhir,
+    StructureDefinition: structure_definition_to_fhir,
+}
+
+# The relations each element is read from, and the relations the serializers of the data types
+# read in turn. loading_plan() derives the select_related()/prefetch_related() lookups from them.
+ELEMENT_FIELDS = {
+    Patient: {"identifier": "identifier", "name": "name", "telecom": "telecom", "address": "address",
+              "photo": "photo", "managingOrganization": "managingOrganisation",
+              "generalPractitioner": "generalPractitioner"},
+    Organisation: {"identifier": "identifier"},
+    ValueSet: {"identifier": "identifier", "useContext": "use_context", "contact": "contact",
+               "jurisdiction": "jurisdiction"},
+    StructureDefinition: {"identifier": "identifier", "useContext": "use_context", "contact": "contact"},
+}
+
+DATATYPE_FIELDS = {
+    # periods are stored inline, see medux.core.periods
+    Identifier: ["assigner"],
+    ContactDetail: ["telecom"],
+    CodeableConcept: ["coding"],
+}
+
+# the elements marked as "summary" in the specification, returned for _summary=true
+SUMMARY_ELEMENTS = {
+    Patient: {"identifier", "active", "name", "telecom", "gender", "birthDate", "deceasedDateTime", "address",
+              "managingOrganization"},
+    Organisation: {"identifier"},
+    ValueSet: {"url", "identifier", "version", "name", "title", "status", "experimental", "date", "publisher",
+               "contact", "useContext", "jurisdiction", "immutable", "extensible"},
+    StructureDefinition: {"url", "identifier", "version", "name", "title", "status", "experimental", "date",
+                          "publisher", "contact", "useContext", "type"},
+}
+
+# returned even if they aren't requested, see http://hl7.org/fhir/search.html#elements
+MANDATORY_ELEMENTS = {"meta", "implicitRules"}
+
+# http://hl7.org/fhir/search.html#summary
+SUMMARY_VALUES = ("true", "text", "data", "count", "false")
+
+# tags resources that don't contain all their elements
+SUBSETTED = {"system": "http://hl7.org/fhir/v3/ObservationValue", "code": "SUBSETTED"}
+
+
+def _lookups(model, name, path=(), many=False):
+    """Yields (lookup, many) for the relation name of model and the relations below it.
+
+    A lookup is yielded for each chain of ForeignKeys from the resource, which can be joined, and for the
+    end of each chain containing a ManyToManyField, which has to be prefetched."""
+    field = model._meta.get_field(name)
+    path = path + (name,)
+    many = many or field.many_to_many
+    children = DATATYPE_FIELDS.get(field.related_model, [])
+    if not many or not children:
+        yield "__".join(path), many
+    for child in children:
+        yield from _lookups(field.related_model, child, path, many)
+
+
+def loading_plan(model, elements=None):
+    """Returns the (select_related, prefetch_related) lookups to serialize the elements of model.
+
+    :param elements: the element names, or None for all of them
+    """
+    select_related = []
+    prefetch_related = []
+    for element, name in ELEMENT_FIELDS[model].items():
+        if elements is not None and element not in elements:
+            continue
+        for lookup, many in _lookups(model, name):
+            (prefetch_related if many else select_related).append(lookup)
+    return select_related, prefetch_related
+
+
+# related objects the serializers need for all elements
+SELECT_RELATED = {model: loading_plan(model)[0] for model in SERIALIZERS}
+PREFETCH = {model: loading_plan(model)[1] for model in SERIALIZERS}
+
+
+def resource_type(model):
+    """Returns the FHIR resource type name of a model"""
+    for name, resource_model in RESOURCE_TYPES.items():
+        if resource_model is model:
+            return name
+    raise KeyError(model)
+
+
+def requested_elements(model, summary=None, elements=None):
+    """Returns the element names to serialize for the _summary and _elements parameters, or None for all.
+
+    Raises ValueError for invalid values. _summary=count has to be handled by the caller."""
+    if summary is not None and elements is not None:
+        raise ValueError("_summary and _elements can't be combined")
+    if elements is not None:
+        # unknown elements are ignored
+        return {element.strip() for element in elements.split(",")} | MANDATORY_ELEMENTS
+    if summary is None or summary in ("false", "data", "count"):
+        # there's no narrative text element which "data" would leave out
+        return None
+    if summary == "true":
+        return SUMMARY_ELEMENTS[model] | MANDATORY_ELEMENTS
+    if summary == "text":
+        return set(MANDATORY_ELEMENTS)
+    raise ValueError("_summary must be one of {}".format(", ".join(SUMMARY_VALUES)))
+
+
+def to_fhir(obj, elements=None):
+    """Returns the FHIR JSON representation (as dict) of a resource model instance.
+
+    :param elements: the element names to include, or None for all of them
+    """
+    data = SERIALIZERS[type(obj)](obj, elements)
+    if elements is not None:
+        meta = dict(data.get("meta", {}))
+        meta["tag"] = meta.get("tag", []) + [SUBSETTED]
+        data["meta"] = meta
+    return data
+
+
+def serialization_queryset(model, elements=None):
+    """Returns a QuerySet of model, which loads everything to_fhir() needs with a constant number of queries"""
+    select_related, prefetch_related = loading_plan(model, elements)
+    return model.objects.select_related(*select_related).prefetch_related(*prefetch_related)
+
+
+def resource_queryset(model, ids, elements=None):
+    """serialization_queryset() of the resources with the given FHIR ids"""
+    return serialization_queryset(model, elements).filter(id__in=id_values(model, ids))
@@ -15,12 +15,16 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+from django import forms
+from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
 
 import base64
-from uuid import uuid4
+import json
+
+from medux.core.ids import new_id
 
 __author__ = "Christian González <christian.gonzalez@nerdocs.at>"
 
@@ -30,33 +34,156 @@ __author__ = "Christian González <christian.gonzalez@nerdocs.at>"
 # Especially the ReferenceField is used very often and must be implemented very well.
 
 
-__all__ = ["Base64TextField", "UriField", "InstantField", "CodeField", "OidField", "IdField", "MarkdownField",
-           "NarrativeField", "ReferenceField"]
+__all__ = ["ID_PATTERN", "OID_PATTERN", "Base64TextField", "ExtensionField", "UriField", "InstantField", "CodeField",
+           "OidField", "IdField", "MarkdownField", "NarrativeField", "ReferenceField"]
 
 
 class Base64TextField(models.TextField):
     """A stream of bytes, base64 encoded"""
 
-    @staticmethod
-    def from_db_value(value):
-        """Returns a str from the database value, which is encoded as base64 string"""
+    def from_db_value(self, value, *args):
+        """Returns the bytes of the database value, which is encoded as base64 string"""
         if value is None:
             return None
-        else:
-            return base64.b64decode(value).decode("utf-8")
+        return base64.b64decode(value)
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return base64.b64decode(value)
+        return value
+
+    def get_prep_value(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            return base64.b64encode(value).decode("ascii")
+        # strings are base64 already
+        return value
+
+
+# http://hl7.org/fhir/datatypes.html#id and #oid (without the "urn:oid:" prefix)
+ID_PATTERN = r'[A-Za-z0-9\-\.]{1,64}'
+OID_PATTERN = r'[0-2](\.[1-9]\d*)+'
+
+# The data types an extension value may have, see http://hl7.org/fhir/extensibility.html#Extension
+# with the (Python) type of their JSON representation. The keys are the suffixes of "value[x]".
+EXTENSION_VALUE_TYPES = dict(
+    [(name, str) for name in ("Base64Binary", "Canonical", "Code", "Date", "DateTime", "Id", "Instant",
+                              "Markdown", "Oid", "String", "Time", "Uri", "Url", "Uuid")] +
+    [("Boolean", bool), ("Decimal", (int, float))] +
+    [(name, int) for name in ("Integer", "PositiveInt", "UnsignedInt")] +
+    [(name, dict) for name in ("Address", "Age", "Annotation", "Attachment", "CodeableConcept", "Coding",
+                               "ContactDetail", "ContactPoint", "Contributor", "Count", "DataRequirement",
+                               "Distance", "Dosage", "Duration", "Expression", "HumanName", "Identifier", "Meta",
+                               "Money", "ParameterDefinition", "Period", "Quantity", "Range", "Ratio", "Reference",
+                               "RelatedArtifact", "SampledData", "Signature", "Timing", "TriggerDefinition",
+                               "UsageContext")])
+
+
+def validate_extensions(extensions):
+    """Raises a ValidationError unless extensions is a list of valid FHIR extensions (as JSON dicts)"""
+    if not isinstance(extensions, list):
+        raise ValidationError("Extensions must be a list")
+    for extension in extensions:
+        if not isinstance(extension, dict) or not isinstance(extension.get("url"), str) or not extension["url"]:
+            raise ValidationError("Each extension needs a url")
+        values = [key for key in extension if key.startswith("value")]
+        if len(values) + ("extension" in extension) != 1:
+            # ext-1
+            raise ValidationError("The extension {} must have either extensions or a value[x]".format(
+                extension["url"]))
+        for key in extension:
+            if key in ("url", "id"):
+                continue
+            if key == "extension":
+                validate_extensions(extension[key])
+                continue
+            python_type = EXTENSION_VALUE_TYPES.get(key[5:])
+            value = extension[key]
+            if python_type is None or not isinstance(value, python_type) or (
+                    isinstance(value, bool) and python_type is not bool):
+                raise ValidationError("Invalid element {} in the extension {}".format(key, extension["url"]))
+
+
+class ExtensionFormField(forms.CharField):
+    """Edits extensions as FHIR JSON"""
+    widget = forms.Textarea
+
+    def prepare_value(self, value):
+        if isinstance(value, list):
+            return json.dumps(value, indent=2, ensure_ascii=False) if value else ""
+        return value
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if not value:
+            return []
+        try:
+            return json.loads(value)
+        except ValueError as e:
+            raise ValidationError("Invalid JSON: {}".format(e))
+
+
+class ExtensionField(models.TextField):
+    """The extensions of an element, a list of FHIR extensions as JSON dicts, like
+    ``[{"url": "http://hl7.org/fhir/StructureDefinition/iso21090-EN-use", "valueCode": "I"}]``.
+
+    They are stored inline, as compact JSON object that groups the values by url:
+    ``{"http://hl7.org/fhir/...": [{"valueCode": "I"}]}``, so the values of one url can be
+    indexed and queried (see medux.core.extensions). Elements without extensions, which are
+    the vast majority, store NULL and don't need any JSON parsing when they are loaded. The
+    order of extensions with different urls isn't kept, FHIR gives it no meaning anyway."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("blank", True)
+        kwargs.setdefault("default", list)
+        super().__init__(*args, **kwargs)
+
+    def from_db_value(self, value, *args):
+        if value is None:
+            return []
+        return [dict(url=url, **data) for url, values in json.loads(value).items() for data in values]
+
+    def to_python(self, value):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            try:
+                return json.loads(value) if value else []
+            except ValueError as e:
+                raise ValidationError("Invalid JSON: {}".format(e))
+        return value
+
+    def get_prep_value(self, value):
+        value = self.to_python(value)
+        if not value:
+            return None
+        grouped = {}
+        for extension in value:
+            grouped.setdefault(extension["url"], []).append(
+                {key: data for key, data in extension.items() if key != "url"})
+        return json.dumps(grouped, separators=(",", ":"), ensure_ascii=False)
 
-    # TODO: read only yet
+    def validate(self, value, model_instance):
+        super().validate(value, model_instance)
+        validate_extensions(value)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj), ensure_ascii=False)
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{"form_class": ExtensionFormField, **kwargs})
 
 
 class ReferenceField(models.ForeignKey):
     """A field that holds a Foreignkey to a Reference Object, which points to another object.
 
-    The Reference object should return the real object.
-    FIXME this has to be coded in Django, does not work yet.
+    The Reference object returns the real object as ``reference.resource``. To resolve the references
+    of many objects at once, use ``prefetch_references()`` of the ReferenceQuerySet.
     """
 
     # This regex is true if the reference to a resource is consistent with a FHIR API
-    fhir_server_abs_url_conformance = r"((http|https)://([A-Za-z0-9\\\.\:\%\$]\/)*)?(Account|ActivityDefinition|AdverseEvent|"\
+    # Groups: 1 = server base URL, 4 = resource type, 5 = id, 7 = version id
+    fhir_server_abs_url_conformance = r"((http|https)://([A-Za-z0-9\\\.\:\%\$]*\/)*)?(Account|ActivityDefinition|AdverseEvent|"\
         "AllergyIntolerance|Appointment|AppointmentResponse|AuditEvent|Basic|Binary|BodySite|Bundle|"\
         "CapabilityStatement|CarePlan|CareTeam|ChargeItem|Claim|ClaimResponse|ClinicalImpression|CodeSystem|"\
         "Communication|CommunicationRequest|CompartmentDefinition|Composition|ConceptMap|Condition|Consent|"\
@@ -73,7 +200,7 @@ class ReferenceField(models.ForeignKey):
         "Questionnaire|QuestionnaireResponse|ReferralRequest|RelatedPerson|RequestGroup|ResearchStudy|"\
         "ResearchSubject|RiskAssessment|Schedule|SearchParameter|Sequence|ServiceDefinition|Slot|Specimen|"\
         "StructureDefinition|StructureMap|Subscription|Substance|SupplyDelivery|SupplyRequest|Task|TestReport|"\
-        "TestScript|ValueSet|VisionPrescription)\/[A-Za-z0-9\-\.]{1,64}(\/_history\/[A-Za-z0-9\-\.]{1,64})?"
+        r"TestScript|ValueSet|VisionPrescription)\/([A-Za-z0-9\-\.]{1,64})(\/_history\/([A-Za-z0-9\-\.]{1,64}))?"
 
     description = _("A dynamic reference to another Ressource")
 
@@ -86,7 +213,8 @@ class ReferenceField(models.ForeignKey):
         kwargs['to'] = "Reference"
         kwargs['on_delete'] = on_delete
 
-        # FIXME This does not do anything here...
+        # The resource type(s) this field may refer to: a model, or FHIR resource type names
+        # separated by "|", like "Organization|Practitioner"
         self.referred_object = to
 
         super().__init__(*args, **kwargs)
@@ -94,6 +222,39 @@ class ReferenceField(models.ForeignKey):
     def __str__(self):
         return ""
 
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if isinstance(self.referred_object, str):
+            kwargs['to'] = self.referred_object
+        else:
+            kwargs['to'] = self.referred_object._meta.label
+        return name, path, args, kwargs
+
+    @property
+    def target_types(self):
+        """The FHIR resource type names this field may refer to"""
+        # the references module needs the models, which need the fields
+        from medux.core.references import resource_type_names
+        return resource_type_names(self.referred_object)
+
+    def validate(self, value, model_instance):
+        """Checks that the Reference exists, and that it points to one of the target types"""
+        if value is None:
+            return super().validate(value, model_instance)
+        models.Field.validate(self, value, model_instance)
+        reference = self.remote_field.model._base_manager.filter(pk=value).first()
+        if reference is None:
+            raise ValidationError(self.error_messages['invalid'], code='invalid', params={
+                'model': self.remote_field.model._meta.verbose_name, 'pk': value,
+                'field': self.remote_field.field_name, 'value': value,
+            })
+        if reference.resource_type and reference.resource_type not in self.target_types:
+            raise ValidationError(
+                _("A %(field)s can't refer to a %(type)s."),
+                code='invalid_reference',
+                params={'field': self.name, 'type': reference.resource_type},
+            )
+
 
 class UriField(models.URLField):
     """A Uniform Resource Identifier Reference.
@@ -125,20 +286,45 @@ class CodeField(models.CharField):
 
     def __init__(self, value_set=None, *args, **kwargs):
 
-        # The ValueSet this code is defined in
+        # The ValueSet this code is defined in, by name (e.g. "AdministrativeGender") or URL
         self.value_set = value_set
 
         # TODO: we set this to an arbitrary 64 char string as max. Could be more specific
         kwargs['max_length'] = 64
         super().__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        del kwargs['max_length']
+        if self.value_set is not None:
+            kwargs['value_set'] = self.value_set
+        return name, path, args, kwargs
+
+    def validate(self, value, model_instance):
+        super().validate(value, model_instance)
+        self.validate_code(value)
+
+    def validate_code(self, value):
+        """Checks that the code is contained in the field's ValueSet, if that one is known"""
+        if value in self.empty_values or not isinstance(self.value_set, str):
+            return
+        # the terminology module needs the models, which need the fields
+        from medux.core.terminology import expansions
+        expansion = expansions.get(self.value_set)
+        if expansion is not None and value not in expansion:
+            raise ValidationError(
+                _("'%(code)s' is not a code of the ValueSet %(value_set)s."),
+                code='invalid_code',
+                params={'code': value, 'value_set': self.value_set},
+            )
+
 
 class OidField(UriField):
     """An OID represented as a URI"""
 
     def __init__(self, *args, **kwargs):
         kwargs['validators'] = [RegexValidator(
-            regex='[0-2](\.[1-9]\d*)+',
+            regex=OID_PATTERN,
             message='Given string is no OID'
         )]
         super().__init__(*args, **kwargs)
@@ -150,15 +336,22 @@ class IdField(models.CharField):
     Any combination of upper or lower case ASCII letters ('A'..'Z', and 'a'..'z',
     numerals ('0'..'9'), '-' and '.', with a length limit of 64 characters.
     This might be an integer, an un-prefixed OID, UUID or any other identifier
-    pattern that meets these constraints."""
+    pattern that meets these constraints.
+
+    New objects get a time-ordered id of medux.core.ids.new_id() by default."""
+
+    default_validators = [RegexValidator(
+        regex=r'^{}$'.format(ID_PATTERN),
+        message=_("Enter a valid FHIR id.")
+    )]
 
     def __init__(self, *args, **kwargs):
         kwargs['max_length'] = 64
-        kwargs['default'] = uuid4()
+        # a callable, which is called for every new object
+        kwargs.setdefault('default', new_id)
         super().__init__(*args, **kwargs)
 
 
-
 class MarkdownField(models.TextField):
     """A string that *may* contain markdown syntax.
 
@@ -166,7 +359,7 @@ class MarkdownField(models.TextField):
 
 
 # http://hl7.org/fhir/narrative-status
-# FIXME implement/import as ValueSet
+# Built-in expansion of the "NarrativeStatus" ValueSet, see medux.core.terminology.
 NARRATIVE_STATUS = (
     ("generated", "Generated"),
     ("extensions", "Extensions"),
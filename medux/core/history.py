@@ -0,0 +1,287 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from medux.core.fhir import resource_type
+from medux.core.models import ResourceVersion
+
+# Version history of resources, see http://hl7.org/fhir/http.html#history
+#
+# Every write of a resource appends a ResourceVersion with its complete FHIR JSON. The versions
+# are recorded by medux.core.derived, together with the other derived data, so the normalized
+# tables stay the master data of the current version.
+
+__all__ = ["changes", "compact_deleted", "current_version", "current_versions", "get_version", "history",
+           "history_bundle", "history_entry", "latest_cursor", "prune_history", "record_deletes", "record_versions",
+           "with_version_meta"]
+
+DEFAULT_BATCH_SIZE = 1000
+
+# seconds for which changes() holds back new versions, see there
+DEFAULT_CHANGE_FEED_DELAY = 5
+
+
+def current_versions(type_name, resource_ids):
+    """Returns {resource id: current ResourceVersion} for many resources of one type, with one query"""
+    return {version.resource_id: version for version in ResourceVersion.objects.filter(
+        resource_type=type_name, resource_id__in=resource_ids, current=True)}
+
+
+def _without_meta(data):
+    return {key: value for key, value in data.items() if key != "meta"}
+
+
+def _with_meta(data, meta):
+    """Returns a copy of data with meta placed after id, where FHIR puts it"""
+    result = {}
+    for key, value in data.items():
+        if key != "meta":
+            result[key] = value
+        if key == "id":
+            result["meta"] = meta
+    return result
+
+
+def with_version_meta(data, version):
+    """Returns a copy of the FHIR dict data, with the meta.versionId and meta.lastUpdated of a ResourceVersion"""
+    return _with_meta(data, dict(data.get("meta", {}), versionId=str(version.version),
+                                 lastUpdated=version.lastUpdated.isoformat()))
+
+
+def _append(type_name, versions):
+    """Makes the new versions the current ones"""
+    with transaction.atomic():
+        ResourceVersion.objects.filter(resource_type=type_name, current=True,
+                                       resource_id__in=[version.resource_id for version in versions]) \
+            .update(current=False)
+        ResourceVersion.objects.bulk_create(versions)
+
+
+def record_versions(model, serialized):
+    """Appends a new version for each changed resource, from a list of (instance, FHIR dict) tuples.
+
+    The meta.versionId and meta.lastUpdated of the dicts are set to those of the version, so that the
+    other derived data is written with them, too. Resources whose content didn't change (apart from
+    meta) don't get a new version - e.g. when saving an element sends several signals."""
+    type_name = resource_type(model)
+    current = current_versions(type_name, [data["id"] for _, data in serialized])
+    now = timezone.now()
+    versions = []
+    for i, (instance, data) in enumerate(serialized):
+        previous = current.get(data["id"])
+        if previous is not None and previous.method != "delete":
+            content = json.loads(previous.content)
+            if _without_meta(content) == _without_meta(data):
+                serialized[i] = (instance, _with_meta(data, content["meta"]))
+                continue
+        version = ResourceVersion(
+            resource_type=type_name,
+            resource_id=data["id"],
+            version=previous.version + 1 if previous is not None else 1,
+            lastUpdated=getattr(instance, "lastUpdated", None) or now,
+            method="update" if previous is not None and previous.method != "delete" else "create",
+        )
+        data = with_version_meta(data, version)
+        version.content = json.dumps(data, separators=(",", ":"))
+        serialized[i] = (instance, data)
+        versions.append(version)
+    _append(type_name, versions)
+
+
+def record_deletes(model, resource_ids):
+    """Appends a deletion version for each of the resources"""
+    type_name = resource_type(model)
+    now = timezone.now()
+    current = current_versions(type_name, resource_ids)
+    _append(type_name, [ResourceVersion(
+        resource_type=type_name,
+        resource_id=resource_id,
+        version=current[resource_id].version + 1 if resource_id in current else 1,
+        lastUpdated=now,
+        method="delete",
+    ) for resource_id in resource_ids if resource_id not in current or current[resource_id].method != "delete"])
+
+
+def current_version(resource_type, resource_id, content=True):
+    """Returns the current ResourceVersion of a resource, or None.
+
+    :param content: if False, the content is only loaded when it is accessed, e.g. if a client's
+        copy turns out to be outdated
+    """
+    queryset = ResourceVersion.objects.filter(resource_type=resource_type, resource_id=resource_id, current=True)
+    if not content:
+        queryset = queryset.defer("content")
+    return queryset.first()
+
+
+def get_version(resource_type, resource_id, version):
+    """Returns a ResourceVersion by its version number, or None"""
+    return ResourceVersion.objects.filter(resource_type=resource_type, resource_id=resource_id,
+                                          version=version).first()
+
+
+def history(resource_type=None, resource_id=None, since=None, count=50, cursor=None):
+    """Returns a list of versions, newest first, and the cursor of the next page or None.
+
+    Without resource_id, this is the history of all resources of the type; without resource_type,
+    that of the whole server. The cursor is the pk of the last version of the previous page."""
+    queryset = ResourceVersion.objects.order_by("-pk")
+    if resource_type is not None:
+        queryset = queryset.filter(resource_type=resource_type)
+    if resource_id is not None:
+        queryset = queryset.filter(resource_id=resource_id)
+    if since is not None:
+        queryset = queryset.filter(lastUpdated__gte=since)
+    if cursor:
+        queryset = queryset.filter(pk__lt=cursor)
+    versions = list(queryset[:count + 1])
+    next_cursor = versions[count - 1].pk if len(versions) > count else None
+    return versions[:count], next_cursor
+
+
+def changes(cursor=0, resource_types=None, count=50, since=None, content=True):
+    """Returns a list of versions recorded after the cursor, oldest first, and the cursor of the next call.
+
+    This is the change feed of the server: the cursor is the pk of the last returned version, so
+    every call continues exactly where the previous one stopped, reading the primary key index
+    instead of the resource tables. Without a cursor, the feed starts at since (or at the beginning).
+
+    With concurrent writers, a transaction which started earlier may commit its versions after those
+    of a later one, with lower pks - a cursor that had passed them would skip them. So the feed stops
+    before the first version recorded less than MEDUX_CHANGE_FEED_DELAY seconds ago, until it is
+    settled: versions are recorded at the end of a write, and its transaction has to commit within
+    that time.
+
+    :param content: if False, the JSON of the resources isn't loaded
+    """
+    queryset = ResourceVersion.objects.order_by("pk")
+    if not content:
+        queryset = queryset.defer("content")
+    if resource_types:
+        queryset = queryset.filter(resource_type__in=resource_types)
+    if cursor:
+        queryset = queryset.filter(pk__gt=cursor)
+    elif since is not None:
+        queryset = queryset.filter(lastUpdated__gte=since)
+    delay = getattr(settings, "MEDUX_CHANGE_FEED_DELAY", DEFAULT_CHANGE_FEED_DELAY)
+    if delay:
+        # of all resource types, as the cursor is shared by them
+        unsettled = ResourceVersion.objects.filter(
+            pk__gt=cursor or 0, lastUpdated__gt=timezone.now() - datetime.timedelta(seconds=delay))
+        first_unsettled = unsettled.order_by("pk").values_list("pk", flat=True).first()
+        if first_unsettled is not None:
+            queryset = queryset.filter(pk__lt=first_unsettled)
+    versions = list(queryset[:count])
+    return versions, versions[-1].pk if versions else cursor
+
+
+def latest_cursor():
+    """Returns the cursor of changes() after the latest recorded version"""
+    return ResourceVersion.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+
+_METHODS = {"create": "POST", "update": "PUT", "delete": "DELETE"}
+_STATUSES = {"create": "201 Created", "update": "200 OK", "delete": "204 No Content"}
+
+
+def history_entry(version, full_url, resource=True):
+    """Returns a Bundle entry for a version as JSON string.
+
+    The stored JSON of the resource is put into the entry without decoding it."""
+    entry = json.dumps({
+        "fullUrl": full_url,
+        "request": {
+            "method": _METHODS[version.method],
+            "url": version.resource_type if version.method == "create" else "{}/{}".format(
+                version.resource_type, version.resource_id),
+        },
+        "response": {
+            "status": _STATUSES[version.method],
+            "etag": 'W/"{}"'.format(version.version),
+            "lastModified": version.lastUpdated.isoformat(),
+        },
+    })
+    if resource and version.content:
+        entry = '{},"resource":{}}}'.format(entry[:-1], version.content)
+    return entry
+
+
+def history_bundle(entries, links):
+    """Returns a "history" Bundle with the JSON strings of history_entry(), as JSON string"""
+    bundle = json.dumps({"resourceType": "Bundle", "type": "history", "link": links, "entry": []})
+    return bundle[:-2] + ",".join(entries) + "]}"
+
+
+def _batches(queryset, batch_size, *fields):
+    """Yields lists of values_list() rows of the queryset, keyset-paginated by pk"""
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by("pk").values_list("pk", *fields)[:batch_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def prune_history(before, keep=1, batch_size=DEFAULT_BATCH_SIZE):
+    """Deletes old versions which were replaced before the given time.
+
+    :param keep: the number of latest versions to keep of every resource, including the current one
+    :returns: the number of deleted versions
+
+    Every batch is deleted in its own transaction, so the history tables are never locked for long.
+    """
+    deleted = 0
+    candidates = ResourceVersion.objects.filter(current=False, lastUpdated__lt=before)
+    for rows in _batches(candidates, batch_size, "resource_type", "resource_id", "version"):
+        ids_by_type = defaultdict(set)
+        for _, type_name, resource_id, _ in rows:
+            ids_by_type[type_name].add(resource_id)
+        latest = {}
+        for type_name, resource_ids in ids_by_type.items():
+            for resource_id, version in current_versions(type_name, resource_ids).items():
+                latest[(type_name, resource_id)] = version.version
+        pks = [pk for pk, type_name, resource_id, version in rows
+               if latest.get((type_name, resource_id), version) - version >= keep]
+        with transaction.atomic():
+            deleted += ResourceVersion.objects.filter(pk__in=pks).delete()[0]
+    return deleted
+
+
+def compact_deleted(before, batch_size=DEFAULT_BATCH_SIZE):
+    """Deletes the whole history of resources that were deleted before the given time.
+
+    :returns: the number of deleted versions"""
+    deleted = 0
+    tombstones = ResourceVersion.objects.filter(current=True, method="delete", lastUpdated__lt=before)
+    for rows in _batches(tombstones, batch_size, "resource_type", "resource_id"):
+        ids_by_type = defaultdict(list)
+        for _, type_name, resource_id in rows:
+            ids_by_type[type_name].append(resource_id)
+        with transaction.atomic():
+            for type_name, resource_ids in ids_by_type.items():
+                deleted += ResourceVersion.objects.filter(resource_type=type_name,
+                                                          resource_id__in=resource_ids).delete()[0]
+    return deleted
@@ -0,0 +1,101 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Time-ordered ids for resources (Resource.id and Meta.versionId), as UUID version 7,
+# see https://www.rfc-editor.org/rfc/rfc9562#name-uuid-version-7
+#
+# The first 48 bits are the Unix time in milliseconds, so new ids are always appended at the
+# end of the primary key index, instead of being scattered all over it like random UUIDs, which
+# splits and fragments the index pages. The next 12 bits count up within a millisecond, the
+# remaining 62 bits are random. The canonical string form ("0190b6b0-7f3c-7a4e-9c1d-...")
+# is 36 characters of [0-9a-f-], a valid FHIR id (http://hl7.org/fhir/datatypes.html#id), and
+# sorts like the ids themselves.
+
+__all__ = ["allocate_ids", "id_timestamp", "new_id"]
+
+_COUNTER_BITS = 12
+_MAX_COUNTER = (1 << _COUNTER_BITS) - 1
+
+_lock = threading.Lock()
+# the millisecond and counter of the last id
+_last = [0, 0]
+
+
+def _reserve(count):
+    """Reserves count consecutive (millisecond, counter) values, and returns the first one.
+
+    If the counter of a millisecond is exhausted, or the clock goes backwards, the ids continue
+    in the (future) millisecond after the last one, so they never repeat and always ascend."""
+    now = time.time_ns() // 1000000
+    with _lock:
+        milliseconds, counter = _last
+        if now > milliseconds:
+            # start at a random point in the lower half, so that the counter rarely overflows
+            milliseconds, counter = now, int.from_bytes(os.urandom(2), "big") & (_MAX_COUNTER >> 1)
+        else:
+            counter += 1
+        first = milliseconds, counter
+        # the last reserved value
+        position = milliseconds * (_MAX_COUNTER + 1) + counter + count - 1
+        _last[:] = divmod(position, _MAX_COUNTER + 1)
+    return first
+
+
+def _format(milliseconds, counter, random_bits):
+    value = (milliseconds << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | random_bits
+    return str(uuid.UUID(int=value))
+
+
+def new_id():
+    """Returns a new, unique and time-ordered id, the default of IdField"""
+    milliseconds, counter = _reserve(1)
+    return _format(milliseconds, counter, int.from_bytes(os.urandom(8), "big") >> 2)
+
+
+def allocate_ids(count):
+    """Returns a list of count new ids in ascending order, e.g. for the objects of a bulk import.
+
+    This is much cheaper than count calls of new_id(): the ids are reserved at once, and their
+    random bits come from one call to the OS."""
+    if count <= 0:
+        return []
+    milliseconds, counter = _reserve(count)
+    position = milliseconds * (_MAX_COUNTER + 1) + counter
+    random_bytes = os.urandom(8 * count)
+    ids = []
+    for i in range(count):
+        milliseconds, counter = divmod(position + i, _MAX_COUNTER + 1)
+        ids.append(_format(milliseconds, counter, int.from_bytes(random_bytes[8 * i:8 * i + 8], "big") >> 2))
+    return ids
+
+
+def id_timestamp(value):
+    """Returns the creation time (UTC) of an id of new_id(), or None for other ids"""
+    try:
+        value = uuid.UUID(value)
+    except (TypeError, ValueError):
+        return None
+    if value.version != 7:
+        return None
+    return datetime.fromtimestamp((value.int >> 80) / 1000, tz=timezone.utc)
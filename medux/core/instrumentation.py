@@ -0,0 +1,232 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+# Instrumentation of database queries and timings, to find N+1 query storms.
+#
+# ``instrument()`` records all queries in a block of code, e.g. in a test or a background job.
+# The InstrumentationMiddleware (medux.core.middleware) does the same per request, and adds the
+# results to the process-wide ``metrics``, which are served by the metrics view and dumped by the
+# "dump_metrics" management command.
+
+__all__ = ["Histogram", "Metrics", "Report", "fingerprint", "instrument", "metrics", "section"]
+
+_local = threading.local()
+
+_IN_LIST_RE = re.compile(r"\bIN \((?:\s*%s\s*,)*\s*%s\s*\)")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+\b")
+
+
+def fingerprint(sql):
+    """Returns the SQL with all literals and parameter lists replaced, so that the same query
+    with different values (like in a N+1 loop) has the same fingerprint"""
+    sql = _IN_LIST_RE.sub("IN (...)", sql)
+    sql = _STRING_RE.sub("?", sql)
+    return _NUMBER_RE.sub("?", sql)
+
+
+class Report:
+    """The queries and timings recorded by ``instrument()``"""
+
+    def __init__(self, label):
+        self.label = label
+        # (fingerprint, seconds) of every query
+        self.queries = []
+        # seconds per section, see section()
+        self.sections = defaultdict(float)
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # used as database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((fingerprint(sql), time.perf_counter() - start))
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    @property
+    def db_time(self):
+        return sum(seconds for _, seconds in self.queries)
+
+    @property
+    def python_time(self):
+        return max(0.0, self.elapsed - self.db_time)
+
+    def duplicates(self):
+        """Returns {fingerprint: count} of the queries that were executed more than once"""
+        return {sql: count for sql, count in Counter(sql for sql, _ in self.queries).items() if count > 1}
+
+    def as_dict(self):
+        return {
+            "label": self.label,
+            "queries": self.query_count,
+            "duplicate_queries": sum(count - 1 for count in self.duplicates().values()),
+            "time": self.elapsed,
+            "db_time": self.db_time,
+            "python_time": self.python_time,
+            "sections": dict(self.sections),
+            "duplicates": self.duplicates(),
+        }
+
+
+@contextmanager
+def instrument(label=None, record=False):
+    """Records the queries and timings of a block of code, on all database connections of this thread.
+
+    ::
+
+        with instrument("export") as report:
+            write_ndjson(queryset, stream)
+        print(report.query_count, report.duplicates())
+
+    :param record: add the report to the process-wide metrics, too
+    """
+    report = Report(label)
+    reports = getattr(_local, "reports", None)
+    if reports is None:
+        reports = _local.reports = []
+    reports.append(report)
+    start = time.perf_counter()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(report))
+            yield report
+    finally:
+        report.elapsed = time.perf_counter() - start
+        reports.remove(report)
+        if record:
+            metrics.record(report)
+
+
+@contextmanager
+def section(name):
+    """Adds the time spent in a block of code to the named section of the running reports,
+    e.g. "serialization". Costs nearly nothing if nothing is instrumented."""
+    reports = getattr(_local, "reports", None)
+    if not reports:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for report in reports:
+            report.sections[name] += elapsed
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, like Prometheus histograms"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        return {
+            "buckets": {"le {}".format(bound): count for bound, count in zip(self.buckets, self.counts)},
+            "more": self.counts[-1],
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# milliseconds
+TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# per endpoint, only the most frequent duplicate query fingerprints are kept
+MAX_FINGERPRINTS = 20
+
+
+class Metrics:
+    """Aggregated reports per label (for requests: method and view name), in process memory"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _new_endpoint(self):
+        return {
+            "requests": 0,
+            "queries": Histogram(QUERY_BUCKETS),
+            "duplicate_queries": Histogram(QUERY_BUCKETS),
+            "time_ms": Histogram(TIME_BUCKETS),
+            "db_time_ms": Histogram(TIME_BUCKETS),
+            "python_time_ms": Histogram(TIME_BUCKETS),
+            "serialization_time_ms": Histogram(TIME_BUCKETS),
+            "duplicates": Counter(),
+        }
+
+    def record(self, report):
+        duplicates = report.duplicates()
+        with self._lock:
+            endpoint = self._endpoints.get(report.label)
+            if endpoint is None:
+                endpoint = self._endpoints[report.label] = self._new_endpoint()
+            endpoint["requests"] += 1
+            endpoint["queries"].observe(report.query_count)
+            endpoint["duplicate_queries"].observe(sum(count - 1 for count in duplicates.values()))
+            endpoint["time_ms"].observe(report.elapsed * 1000)
+            endpoint["db_time_ms"].observe(report.db_time * 1000)
+            endpoint["python_time_ms"].observe(report.python_time * 1000)
+            endpoint["serialization_time_ms"].observe(report.sections.get("serialization", 0.0) * 1000)
+            endpoint["duplicates"].update(duplicates)
+            if len(endpoint["duplicates"]) > 2 * MAX_FINGERPRINTS:
+                endpoint["duplicates"] = Counter(dict(endpoint["duplicates"].most_common(MAX_FINGERPRINTS)))
+
+    def snapshot(self):
+        """Returns all metrics as JSON serializable dict"""
+        with self._lock:
+            return {label: {key: value.as_dict() if isinstance(value, Histogram)
+                            else dict(value.most_common(MAX_FINGERPRINTS)) if isinstance(value, Counter)
+                            else value
+                            for key, value in endpoint.items()}
+                    for label, endpoint in self._endpoints.items()}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+metrics = Metrics()
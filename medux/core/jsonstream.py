@@ -0,0 +1,123 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import codecs
+import json
+
+__all__ = ["JSONStreamError", "StreamDecoder"]
+
+
+class JSONStreamError(ValueError):
+    """Raised if a JSON stream is invalid"""
+
+
+class StreamDecoder:
+    """Decodes JSON values one by one from a file-like object, reading it in chunks.
+
+    Only the current value and the rest of the last chunk are kept in memory. Objects and arrays
+    can be walked through with members() and items(), to decode only their parts one by one."""
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b"", final=True)
+            return False
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk)
+        # drop what we've already consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it, or "" at EOF"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise JSONStreamError("Invalid JSON: expected '{}' at offset {}".format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise JSONStreamError("Invalid JSON: unexpected end of data")
+                continue
+            # a number may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _separator(self, end):
+        """Skips a comma, returns False at the end of the object/array"""
+        char = self.peek()
+        if char == end:
+            self.pos += 1
+            return False
+        if char == ",":
+            self.pos += 1
+        elif not char:
+            raise JSONStreamError("Invalid JSON: unexpected end of data")
+        return True
+
+    def members(self):
+        """Yields the keys of the JSON object at the current position.
+
+        The value of each key has to be consumed (with value(), members() or items()) before
+        the next key is read."""
+        self.expect("{")
+        while self._separator("}"):
+            if self.peek() == "}":
+                continue
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def items(self):
+        """Yields once for each item of the JSON array at the current position.
+
+        Each item has to be consumed (with value(), members() or items()) before the next one is read."""
+        self.expect("[")
+        while self._separator("]"):
+            if self.peek() == "]":
+                continue
+            yield
@@ -0,0 +1,119 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from graphene.utils.dataloader import DataLoader
+
+from medux.core.history import current_versions
+from medux.core.references import resolve_references
+
+# DataLoaders for the GraphQL API (medux.core.schema).
+#
+# A resolver doesn't query the database itself, but asks a loader for what it needs. The loader
+# collects the keys of all resolvers that run in the same event loop iteration - which are all
+# objects of one level of the query - and loads them with one query.
+# The queries are made with sync_to_async(): Django doesn't allow them within an event loop,
+# and runs them in the thread of the request instead, with its database connection.
+
+__all__ = ["Loaders", "ManyToManyLoader", "ObjectLoader", "ReferenceLoader", "VersionLoader"]
+
+
+class ObjectLoader(DataLoader):
+    """Loads model instances by primary key, e.g. the targets of a ForeignKey"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    async def batch_load_fn(self, keys):
+        return await sync_to_async(self.load_objects)(keys)
+
+    def load_objects(self, keys):
+        objects = self.model._default_manager.in_bulk(keys)
+        return [objects.get(key) for key in keys]
+
+
+class ManyToManyLoader(DataLoader):
+    """Loads the related objects of a ManyToManyField, with the primary keys of their owners as keys"""
+
+    def __init__(self, field):
+        super().__init__()
+        self.field = field
+
+    async def batch_load_fn(self, keys):
+        return await sync_to_async(self.load_related)(keys)
+
+    def load_related(self, keys):
+        through = self.field.remote_field.through
+        source = through._meta.get_field(self.field.m2m_field_name())
+        target = self.field.m2m_reverse_field_name()
+        related = defaultdict(list)
+        links = through.objects.filter(**{source.name + "__in": keys}).select_related(target).order_by("pk")
+        for link in links:
+            related[getattr(link, source.attname)].append(getattr(link, target))
+        return [related[key] for key in keys]
+
+
+class ReferenceLoader(DataLoader):
+    """Resolves reference strings like "Organization/123", with one query per resource type"""
+
+    async def batch_load_fn(self, keys):
+        return await sync_to_async(resolve_references)(keys)
+
+
+class VersionLoader(DataLoader):
+    """Loads the current ResourceVersions of resources, with (resource type, id) tuples as keys"""
+
+    async def batch_load_fn(self, keys):
+        return await sync_to_async(self.load_versions)(keys)
+
+    def load_versions(self, keys):
+        ids = defaultdict(list)
+        for resource_type, resource_id in keys:
+            ids[resource_type].append(resource_id)
+        versions = {(resource_type, resource_id): version for resource_type, resource_ids in ids.items()
+                    for resource_id, version in current_versions(resource_type, resource_ids).items()}
+        return [versions.get(key) for key in keys]
+
+
+class Loaders:
+    """The DataLoaders of one request.
+
+    Loaders cache everything they loaded, so they must never be shared between requests."""
+
+    def __init__(self):
+        self._loaders = {}
+
+    def _get(self, key, factory):
+        if key not in self._loaders:
+            self._loaders[key] = factory()
+        return self._loaders[key]
+
+    def object(self, model):
+        return self._get(("object", model), lambda: ObjectLoader(model))
+
+    def many(self, model, name):
+        return self._get(("many", model, name), lambda: ManyToManyLoader(model._meta.get_field(name)))
+
+    def reference(self):
+        return self._get(("reference",), ReferenceLoader)
+
+    def version(self):
+        return self._get(("version",), VersionLoader)
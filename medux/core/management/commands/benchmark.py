@@ -0,0 +1,90 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+
+from medux.core.benchmark import (SCALES, SCENARIOS, baseline_key, check_baselines, compare_id_schemes,
+                                  compare_period_layouts, generate, load_baselines, run_scenarios, save_baselines)
+
+
+class Command(BaseCommand):
+    help = "Runs the benchmarks with synthetic data in a test database, and compares the query counts " \
+           "against the stored baselines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=sorted(SCALES, key=SCALES.get), default="1k",
+                            help="Number of generated Patients (default: 1k)")
+        parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), dest="scenarios",
+                            help="Scenario to run, may be given more than once (default: all)")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keepdb", action="store_true",
+                            help="Keep the test database, so the data is only generated once per scale")
+        parser.add_argument("--update-baselines", action="store_true",
+                            help="Store the measured query counts as new baselines")
+        parser.add_argument("--compare-ids", action="store_true",
+                            help="Only compare the insert throughput and index size of random and time-ordered "
+                                 "primary keys, with as many rows as patients")
+        parser.add_argument("--compare-periods", action="store_true",
+                            help="Only compare the valid_at() queries of joined and inline element periods, "
+                                 "with as many elements as patients")
+
+    def handle(self, *args, **options):
+        scale = options["scale"]
+        # the benchmarks write lots of data, so never use the real database
+        runner = DiscoverRunner(verbosity=0, keepdb=options["keepdb"])
+        runner.setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            if options["compare_ids"]:
+                self.stdout.write("{:<14} {:>12} {:>12}".format("ids", "rows/s", "index KiB"))
+                for scheme, rate, size in compare_id_schemes(SCALES[scale]):
+                    self.stdout.write("{:<14} {:>12.0f} {:>12}".format(
+                        scheme, rate, "?" if size is None else "{:.0f}".format(size / 1024)))
+                return
+            if options["compare_periods"]:
+                self.stdout.write("{:<14} {:>12} {:>12}".format("periods", "queries/s", "valid"))
+                for layout, rate, valid in compare_period_layouts(SCALES[scale], seed=options["seed"]):
+                    self.stdout.write("{:<14} {:>12.1f} {:>12}".format(layout, rate, valid))
+                return
+            from medux.core.models import Patient
+            if not Patient.objects.exists():
+                self.stdout.write("Generating {} patients...".format(scale))
+                generate(SCALES[scale], options["seed"], self.stdout)
+            measurements = run_scenarios(options["scenarios"] or list(SCENARIOS), options["seed"])
+        finally:
+            runner.teardown_databases(old_config)
+            runner.teardown_test_environment()
+
+        key = baseline_key(connection)
+        self.stdout.write("{} @ {}".format(key, scale))
+        for measurement in measurements:
+            self.stdout.write(str(measurement))
+
+        baselines = load_baselines()
+        if options["update_baselines"]:
+            for measurement in measurements:
+                baselines.setdefault(key, {}).setdefault(scale, {})[measurement.scenario] = measurement.queries
+            save_baselines(baselines)
+            self.stdout.write(self.style.SUCCESS("Baselines updated"))
+            return
+        regressions = check_baselines(baselines, key, scale, measurements)
+        if regressions:
+            raise CommandError("Query count regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No query count regressions"))
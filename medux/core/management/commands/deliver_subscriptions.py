@@ -0,0 +1,47 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from medux.core.subscriptions import DEFAULT_BATCH_SIZE, deliver_all
+
+
+class Command(BaseCommand):
+    help = "Delivers the notifications of the active Subscriptions; runs as background worker unless --once is given"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Deliver the pending changes, and exit")
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds between two rounds (default: 1). A round without changes is one "
+                                 "indexed query.")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Maximum number of changes per notification (default: {})".format(DEFAULT_BATCH_SIZE))
+
+    def handle(self, *args, **options):
+        while True:
+            delivered = deliver_all(options["batch_size"])
+            if delivered or options["verbosity"] > 1:
+                self.stdout.write("Delivered {} changes".format(delivered))
+            if options["once"]:
+                return
+            # the worker runs for a long time, so it has to drop broken or outdated connections itself
+            close_old_connections()
+            time.sleep(options["interval"])
@@ -0,0 +1,80 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from medux.core.instrumentation import Metrics, instrument
+
+
+class Command(BaseCommand):
+    help = "Dumps the request metrics of a running server, or instruments requests to the given paths in-process"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*",
+                            help="Paths to GET in-process, e.g. /fhir/Patient/1 (default: fetch from --url)")
+        parser.add_argument("--url", default="http://127.0.0.1:8000/metrics",
+                            help="Metrics URL of the running server (default: %(default)s)")
+        parser.add_argument("--token", default=getattr(settings, "MEDUX_METRICS_TOKEN", None),
+                            help="MEDUX_METRICS_TOKEN of the running server (default: the one of these settings)")
+        parser.add_argument("--json", action="store_true", help="Output the raw JSON")
+        parser.add_argument("--user", help="Username the paths are requested as (default: the first superuser)")
+
+    def handle(self, *args, **options):
+        if options["paths"]:
+            users = get_user_model().objects.filter(is_active=True).order_by("pk")
+            user = users.filter(username=options["user"]).first() if options["user"] else \
+                users.filter(is_superuser=True).first()
+            if user is None:
+                raise CommandError("The FHIR API needs a user: pass --user, or create a superuser")
+            client = Client()
+            client.force_login(user)
+            metrics = Metrics()
+            for path in options["paths"]:
+                with instrument("GET {}".format(path)) as report:
+                    client.get(path)
+                metrics.record(report)
+                for sql, count in sorted(report.duplicates().items(), key=lambda item: -item[1]):
+                    self.stdout.write("{}: {}x {}".format(path, count, sql[:200]))
+            snapshot = metrics.snapshot()
+        else:
+            if not options["token"]:
+                raise CommandError("The metrics of a running server need --token, or the MEDUX_METRICS_TOKEN setting")
+            request = Request(options["url"], headers={"Authorization": "Bearer {}".format(options["token"])})
+            with urlopen(request) as response:
+                snapshot = json.loads(response.read().decode("utf-8"))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(snapshot, indent=2))
+            return
+        self.stdout.write("{:<48} {:>8} {:>9} {:>9} {:>11} {:>11} {:>11}".format(
+            "endpoint", "requests", "queries", "dupes", "time ms", "db ms", "ser. ms"))
+        for label, endpoint in sorted(snapshot.items()):
+            requests = endpoint["requests"]
+
+            def mean(key):
+                return endpoint[key]["sum"] / requests
+
+            self.stdout.write("{:<48} {:>8} {:>9.1f} {:>9.1f} {:>11.1f} {:>11.1f} {:>11.1f}".format(
+                label[:48], requests, mean("queries"), mean("duplicate_queries"), mean("time_ms"),
+                mean("db_time_ms"), mean("serialization_time_ms")))
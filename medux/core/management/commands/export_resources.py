@@ -0,0 +1,55 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from medux.core.export import (DEFAULT_CHUNK_SIZE, EXPORT_TYPES, export_queryset, pending_exports, run_export,
+                               write_ndjson)
+
+
+class Command(BaseCommand):
+    help = "Exports resources as FHIR NDJSON files, or processes pending $export jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="Directory the NDJSON files are written to")
+        parser.add_argument("--type", action="append", choices=EXPORT_TYPES, dest="types",
+                            help="Resource type to export, may be given more than once (default: all)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument("--pending", action="store_true",
+                            help="Process all pending $export jobs instead: the accepted ones, and those "
+                                 "whose server process has died, e.g. in a restart")
+
+    def handle(self, *args, **options):
+        if options["pending"]:
+            for job in pending_exports().order_by("created"):
+                run_export(job, options["chunk_size"])
+                job.refresh_from_db()
+                self.stdout.write("{}: {}".format(job.pk, job.status))
+            return
+
+        if not options["output"]:
+            raise CommandError("--output is required, unless --pending is given")
+        if not os.path.isdir(options["output"]):
+            raise CommandError("{} is not a directory".format(options["output"]))
+        for resource_type in options["types"] or EXPORT_TYPES:
+            filename = os.path.join(options["output"], "{}.ndjson".format(resource_type))
+            with open(filename, "w", encoding="utf-8") as stream:
+                count = write_ndjson(export_queryset(resource_type), stream, options["chunk_size"])
+            self.stdout.write(self.style.SUCCESS("{}: {} resources".format(filename, count)))
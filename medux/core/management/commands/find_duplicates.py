@@ -0,0 +1,46 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from medux.core.matching import GRADES, MAX_BLOCK_SIZE, find_duplicates, grade
+
+
+class Command(BaseCommand):
+    help = "Finds pairs of Patients which are probably duplicates, and writes them into a tab separated " \
+           "file: id, id, score and match grade"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="duplicates.tsv", help="File the pairs are written to")
+        parser.add_argument("--min-score", type=float, default=GRADES[1][0],
+                            help="Minimum score of the pairs (default: {}, probable matches)".format(GRADES[1][0]))
+        parser.add_argument("--max-block-size", type=int, default=MAX_BLOCK_SIZE,
+                            help="Larger blocks are compared in overlapping windows (default: {})".format(
+                                MAX_BLOCK_SIZE))
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        pairs = 0
+        with open(options["output"], "w", encoding="utf-8") as stream:
+            for first, second, score in find_duplicates(options["min_score"], options["max_block_size"]):
+                stream.write("{}\t{}\t{:.4f}\t{}\n".format(first, second, score, grade(score)))
+                pairs += 1
+        self.stdout.write(self.style.SUCCESS("{}: {} pairs in {:.1f} s".format(
+            options["output"], pairs, time.perf_counter() - start)))
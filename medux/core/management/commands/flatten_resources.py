@@ -0,0 +1,43 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from medux.core.models import FLAT_RESOURCES
+from medux.core.upgrades import UpgradeError, flatten_resources
+
+
+class Command(BaseCommand):
+    help = "Converts the resource tables from multi-table inheritance to the MEDUX_FLAT_RESOURCES layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drop-contained", action="store_true",
+                            help="Drop the links to contained resources, which can't be converted")
+
+    def handle(self, *args, **options):
+        if not FLAT_RESOURCES:
+            raise CommandError("Set MEDUX_FLAT_RESOURCES = True first, the tables are converted to that layout")
+        try:
+            models = flatten_resources(connection, drop_contained=options["drop_contained"])
+        except UpgradeError as e:
+            raise CommandError(str(e))
+        if not models:
+            self.stdout.write("The resource tables are flat already")
+            return
+        self.stdout.write(self.style.SUCCESS("Converted {}".format(", ".join(model.__name__ for model in models))))
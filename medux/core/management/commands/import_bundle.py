@@ -0,0 +1,40 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from medux.core.bundle import DEFAULT_BATCH_SIZE, BundleError, BundleImporter
+
+
+class Command(BaseCommand):
+    help = "Imports the Patients of a FHIR transaction Bundle (JSON) file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", help="Bundle JSON file(s)")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of resources saved at once (default: %(default)s)")
+
+    def handle(self, *args, **options):
+        for filename in options["files"]:
+            importer = BundleImporter(batch_size=options["batch_size"])
+            try:
+                with open(filename, "rb") as stream:
+                    responses = importer.run(stream)
+            except (OSError, BundleError) as e:
+                raise CommandError("{}: {}".format(filename, e))
+            self.stdout.write(self.style.SUCCESS("{}: imported {} resources".format(filename, len(responses))))
@@ -0,0 +1,75 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from medux.core.code_import import DEFAULT_BATCH_SIZE, CodeImporter, CodeImportError, iter_csv_codes, iter_json_codes
+
+
+class Command(BaseCommand):
+    help = "Imports the codes of CodeSystem/ValueSet JSON files, or of CSV release files (like LOINC or SNOMED CT)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", help="JSON or CSV file(s)")
+        parser.add_argument("--format", choices=("json", "csv"),
+                            help="Format of the files (default: by file name extension)")
+        parser.add_argument("--system", help="Code system URL of the codes in CSV files, e.g. http://loinc.org")
+        parser.add_argument("--code-system-version", default="", help="Code system version of the codes in CSV files")
+        parser.add_argument("--code-column", default="code", help="CSV column of the code (default: %(default)s)")
+        parser.add_argument("--display-column", default="display",
+                            help="CSV column of the display text (default: %(default)s)")
+        parser.add_argument("--delimiter", default=",", help="CSV delimiter, use '\\t' for tab separated files")
+        parser.add_argument("--where", action="append", default=[], metavar="COLUMN=VALUE",
+                            help="Only import CSV rows with this value, e.g. active=1. Can be given several times.")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Number of codes saved at once (default: %(default)s)")
+        parser.add_argument("--restart", action="store_true",
+                            help="Ignore the checkpoint of an interrupted import, and start from the beginning")
+
+    def handle(self, *args, **options):
+        where = {}
+        for condition in options["where"]:
+            column, sep, value = condition.partition("=")
+            if not sep:
+                raise CommandError("--where must be COLUMN=VALUE, got {}".format(condition))
+            where[column] = value
+        delimiter = "\t" if options["delimiter"] in ("\\t", "tab") else options["delimiter"]
+
+        for filename in options["files"]:
+            file_format = options["format"] or ("json" if filename.lower().endswith(".json") else "csv")
+            if file_format == "csv" and not options["system"]:
+                raise CommandError("--system is required for CSV files")
+            checkpoint = filename + ".checkpoint"
+            if options["restart"] and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            importer = CodeImporter(batch_size=options["batch_size"], checkpoint=checkpoint)
+            try:
+                stat = os.stat(filename)
+                with open(filename, "rb") as stream:
+                    if file_format == "json":
+                        codes = iter_json_codes(stream)
+                    else:
+                        codes = iter_csv_codes(stream, options["system"], options["code_system_version"],
+                                               options["code_column"], options["display_column"], delimiter, where)
+                    # the checkpoint is only used for the very same file
+                    statistics = importer.run(codes, source=[os.path.abspath(filename), stat.st_size, stat.st_mtime])
+            except (OSError, CodeImportError) as e:
+                raise CommandError("{}: {}".format(filename, e))
+            self.stdout.write(self.style.SUCCESS("{}: {}".format(filename, statistics)))
@@ -0,0 +1,33 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from medux.core.extensions import create_extension_indexes, drop_extension_indexes
+
+
+class Command(BaseCommand):
+    help = "Creates the indexes of the MEDUX_INDEXED_EXTENSIONS urls, and drops those of urls no longer in it"
+
+    def handle(self, *args, **options):
+        urls = getattr(settings, "MEDUX_INDEXED_EXTENSIONS", ())
+        create_extension_indexes(connection)
+        drop_extension_indexes(connection, keep=urls)
+        self.stdout.write(self.style.SUCCESS("Indexed the extensions of {} urls".format(len(urls))))
@@ -0,0 +1,47 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from medux.core.history import DEFAULT_BATCH_SIZE, compact_deleted, prune_history
+
+
+class Command(BaseCommand):
+    help = "Deletes old resource versions from the history; meant to be run regularly, e.g. by cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, default=365, metavar="DAYS",
+                            help="Only delete versions that were replaced more than DAYS ago (default: 365)")
+        parser.add_argument("--keep", type=int, default=1,
+                            help="Number of latest versions to keep of every resource (default: 1, the current)")
+        parser.add_argument("--compact-deleted", action="store_true",
+                            help="Also delete the whole history of resources that were deleted before")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options["keep"] < 1:
+            raise CommandError("--keep must be at least 1")
+        before = timezone.now() - datetime.timedelta(days=options["older_than"])
+        count = prune_history(before, options["keep"], options["batch_size"])
+        self.stdout.write(self.style.SUCCESS("Pruned {} versions".format(count)))
+        if options["compact_deleted"]:
+            count = compact_deleted(before, options["batch_size"])
+            self.stdout.write(self.style.SUCCESS("Removed {} versions of deleted resources".format(count)))
@@ -0,0 +1,45 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.core.management.base import BaseCommand
+
+from medux.core.derived import refresh_resources
+from medux.core.fhir import RESOURCE_TYPES
+
+
+class Command(BaseCommand):
+    help = "(Re)writes the search indexes and JSON documents of all resources, " \
+           "e.g. after enabling MEDUX_DOCUMENT_STORE"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--type", action="append", choices=sorted(RESOURCE_TYPES), dest="types",
+                            help="Resource type to rebuild, may be given more than once (default: all)")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        for resource_type in options["types"] or sorted(RESOURCE_TYPES):
+            model = RESOURCE_TYPES[resource_type]
+            count = 0
+            queryset = model.objects.order_by("pk").values_list("pk", flat=True)
+            pks = list(queryset[:chunk_size])
+            while pks:
+                refresh_resources(model, pks)
+                count += len(pks)
+                pks = list(queryset.filter(pk__gt=pks[-1])[:chunk_size])
+            self.stdout.write(self.style.SUCCESS("{}: {} resources".format(resource_type, count)))
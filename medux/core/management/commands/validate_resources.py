@@ -0,0 +1,59 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from medux.core.fhir import RESOURCE_TYPES
+from medux.core.models import ResourceVersion
+from medux.core.profiles import parse_canonical, profiles
+
+
+class Command(BaseCommand):
+    help = "Validates the current version of every resource of a profile's type against that profile"
+
+    def add_arguments(self, parser):
+        parser.add_argument("profile", help='Canonical URL of the StructureDefinition, optionally with "|version"')
+        parser.add_argument("--max-errors", type=int, default=20,
+                            help="Number of invalid resources to show (default: 20)")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        profile = profiles.get(*parse_canonical(options["profile"]))
+        if profile is None:
+            raise CommandError("Unknown profile: {}".format(options["profile"]))
+        if profile.type not in RESOURCE_TYPES:
+            raise CommandError("Resources of type {} aren't stored here".format(profile.type))
+
+        start = time.perf_counter()
+        checked = invalid = 0
+        # the stored JSON is read with a server-side cursor where possible, so memory stays flat
+        for resource_id, content in ResourceVersion.objects.filter(resource_type=profile.type, current=True) \
+                .exclude(method="delete").values_list("resource_id", "content").iterator(options["chunk_size"]):
+            checked += 1
+            errors = profile.validate(json.loads(content))
+            if errors:
+                invalid += 1
+                if invalid <= options["max_errors"]:
+                    self.stdout.write("{}/{}: {}".format(profile.type, resource_id, "; ".join(errors)))
+        self.stdout.write("Validated {} resources in {:.1f} s".format(checked, time.perf_counter() - start))
+        if invalid:
+            raise CommandError("{} of {} resources don't conform to {}".format(invalid, checked, options["profile"]))
+        self.stdout.write(self.style.SUCCESS("All resources conform to {}".format(options["profile"])))
@@ -0,0 +1,345 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+from operator import attrgetter
+
+import numpy
+from django.db.models import Q
+
+from medux.core.models import MatchRecord, SearchToken
+from medux.core.search import normalize
+
+# Patient matching, for the Patient $match operation and finding duplicates
+# (see http://hl7.org/fhir/patient-operation-match.html).
+#
+# Comparing every Patient with every other one is O(n²), so Patients are only compared within
+# "blocks" of those which share a blocking key: the phonetic family name and year of birth, the
+# date of birth and phonetic given name, or the postal code and phonetic given name. A typo in
+# one of the fields still leaves the Patients together in another block. The keys are kept in
+# indexed columns of MatchRecord, which is written with the other derived data
+# (medux.core.derived), so a block is one index range.
+#
+# Within a block, all pairs are scored at once with NumPy: names are compared by the Dice
+# coefficient of their letter bigrams, which is a matrix product of the bigram incidence
+# matrices, and the dates of birth and postal codes by element-wise comparisons. Patients with
+# a common identifier are always a certain match.
+
+__all__ = ["GRADES", "MATCH_GRADE_URL", "MAX_BLOCK_SIZE", "delete_records", "find_duplicates", "grade",
+           "index_patients", "match", "match_record", "phonetic", "scores"]
+
+# weights of the compared fields in the score, which is between 0 and 1
+WEIGHTS = {
+    "family": 0.35,
+    "given": 0.2,
+    "birthdate": 0.35,
+    "postal_code": 0.1,
+}
+# the similarity of a field which is missing in one of the Patients
+UNKNOWN = 0.5
+
+# minimum scores of the match grades, see http://hl7.org/fhir/valueset-match-grade.html
+GRADES = (
+    (0.95, "certain"),
+    (0.8, "probable"),
+    (0.6, "possible"),
+)
+MATCH_GRADE_URL = "http://hl7.org/fhir/StructureDefinition/match-grade"
+
+KEYS = ("name_key", "birth_key", "address_key")
+
+# matches returned by $match
+DEFAULT_COUNT = 10
+MAX_COUNT = 100
+
+# larger blocks are compared in overlapping windows, sorted by name
+MAX_BLOCK_SIZE = 2000
+# smaller blocks are scored together, up to this number of records
+BATCH_SIZE = 256
+# the most candidates $match compares with
+MAX_CANDIDATES = 10000
+
+_FIELDS = ("resource_id", "family", "given", "birthdate", "postal_code")
+
+
+def grade(score):
+    for minimum, name in GRADES:
+        if score >= minimum:
+            return name
+    return "certainly-not"
+
+
+# Kölner Phonetik, which suits German names better than Soundex, see
+# https://de.wikipedia.org/wiki/K%C3%B6lner_Phonetik
+_PHONETIC_CODES = {letter: code for letters, code in (
+    ("aeijouy", "0"), ("b", "1"), ("fvw", "3"), ("gkq", "4"), ("l", "5"), ("mn", "6"), ("r", "7"), ("sz", "8"))
+    for letter in letters}
+
+
+def _phonetic_code(letter, previous, following, first):
+    if letter == "p":
+        return "3" if following == "h" else "1"
+    if letter in "dt":
+        return "8" if following and following in "csz" else "2"
+    if letter == "c":
+        if first:
+            return "4" if following and following in "ahkloqrux" else "8"
+        return "4" if following and following in "ahkoqux" and previous not in "sz" else "8"
+    if letter == "x":
+        return "8" if previous and previous in "ckq" else "48"
+    return _PHONETIC_CODES.get(letter, "")
+
+
+def phonetic(value):
+    """Returns the phonetic code of the first word of a name, e.g. "657" for "Müller", "Mueller" and "Miller" """
+    letters = [letter for letter in normalize(value.replace("ß", "ss")).partition(" ")[0] if "a" <= letter <= "z"]
+    digits = []
+    for i, letter in enumerate(letters):
+        previous = letters[i - 1] if i else ""
+        following = letters[i + 1] if i + 1 < len(letters) else ""
+        for digit in _phonetic_code(letter, previous, following, i == 0):
+            # repeated digits count once
+            if not digits or digits[-1] != digit:
+                digits.append(digit)
+    # vowels only count at the beginning
+    return "".join(digits[:1] + [digit for digit in digits[1:] if digit != "0"])
+
+
+# Records
+
+def _name(data):
+    names = [name for name in data.get("name", []) if isinstance(name, dict)]
+    return next((name for name in names if name.get("use") == "official"), names[0] if names else {})
+
+
+def match_record(data):
+    """Returns the (unsaved) MatchRecord of a Patient resource (FHIR dict)"""
+    name = _name(data)
+    family = normalize(name.get("family", ""))[:255]
+    given = normalize(" ".join(name.get("given", [])))[:255]
+    birthdate = data.get("birthDate", "")[:10]
+    postal_code = next((address["postalCode"].replace(" ", "").upper()[:10] for address in data.get("address", [])
+                        if isinstance(address, dict) and address.get("postalCode")), "")
+    family_code, given_code = phonetic(family), phonetic(given)
+    return MatchRecord(
+        resource_id=data.get("id", ""), family=family, given=given, birthdate=birthdate, postal_code=postal_code,
+        name_key="{}:{}".format(family_code, birthdate[:4]) if family_code and birthdate else None,
+        birth_key="{}:{}".format(birthdate, given_code) if len(birthdate) == 10 and given_code else None,
+        address_key="{}:{}".format(postal_code, given_code) if postal_code and given_code else None,
+    )
+
+
+def index_patients(resources):
+    """(Re)writes the MatchRecords of Patient resources (FHIR dicts), with a constant number of queries.
+    Call it within a transaction, like medux.core.derived.refresh_resources does."""
+    delete_records([data["id"] for data in resources])
+    MatchRecord.objects.bulk_create([match_record(data) for data in resources])
+
+
+def delete_records(resource_ids):
+    MatchRecord.objects.filter(resource_id__in=resource_ids).delete()
+
+
+# Scoring
+
+def _bigrams(value):
+    value = " {} ".format(value)
+    return {value[i:i + 2] for i in range(len(value) - 1)} if value.strip() else ()
+
+
+def _incidence(left, right=None):
+    """Returns 0/1 matrices of the items of the sets in left and right (or only left), with common columns"""
+    vocabulary = {}
+    cells = []
+    for sets in (left,) if right is None else (left, right):
+        rows = numpy.repeat(numpy.arange(len(sets)), [len(items) for items in sets])
+        columns = [vocabulary.setdefault(item, len(vocabulary)) for items in sets for item in items]
+        cells.append((len(sets), rows, columns))
+    matrices = []
+    for size, rows, columns in cells:
+        matrix = numpy.zeros((size, max(len(vocabulary), 1)), dtype=numpy.float32)
+        matrix[rows, columns] = 1
+        matrices.append(matrix)
+    return matrices[0], matrices[-1]
+
+
+def _dice(left, right=None):
+    """Returns the Dice coefficients of the bigrams of all pairs of strings of left and right (or left)"""
+    left_matrix, right_matrix = _incidence([_bigrams(value) for value in left],
+                                           None if right is None else [_bigrams(value) for value in right])
+    left_sizes, right_sizes = left_matrix.sum(axis=1), right_matrix.sum(axis=1)
+    dice = 2 * (left_matrix @ right_matrix.T) / numpy.maximum(left_sizes[:, None] + right_sizes[None, :], 1)
+    return numpy.where((left_sizes == 0)[:, None] | (right_sizes == 0)[None, :], UNKNOWN, dice)
+
+
+def _date_parts(values):
+    """Returns the year, month and day of dates as columns of an array, 0 where they are unknown"""
+    parts = numpy.zeros((len(values), 3), dtype=numpy.int32)
+    for row, value in enumerate(values):
+        for column, part in enumerate(value.split("-")[:3]):
+            if part.isdigit():
+                parts[row, column] = int(part)
+    return parts
+
+
+def _birthdate_similarity(left, right=None):
+    """The share of equal year, month and day of all pairs of dates; a swapped month and day count as one"""
+    left_parts = _date_parts(left)
+    right_parts = left_parts if right is None else _date_parts(right)
+    year, month, day = (left_parts[:, i, None] for i in range(3))
+    other_year, other_month, other_day = (right_parts[None, :, i] for i in range(3))
+    swapped = ((month == other_day) & (day == other_month) & (month != day)).astype(numpy.int32)
+    equal = (year == other_year).astype(numpy.int32) + numpy.maximum(
+        (month == other_month).astype(numpy.int32) + (day == other_day), swapped)
+    return numpy.where((year == 0) | (other_year == 0), UNKNOWN, equal / 3)
+
+
+def _equality(left, right=None):
+    """1 for equal values, compared as integer codes"""
+    codes = {}
+    left_codes = numpy.array([codes.setdefault(value, len(codes)) if value else -1 for value in left])
+    right_codes = left_codes if right is None else \
+        numpy.array([codes.setdefault(value, len(codes)) if value else -1 for value in right])
+    equal = left_codes[:, None] == right_codes[None, :]
+    return numpy.where((left_codes < 0)[:, None] | (right_codes < 0)[None, :], UNKNOWN, equal)
+
+
+_SIMILARITIES = {
+    "family": _dice,
+    "given": _dice,
+    "birthdate": _birthdate_similarity,
+    "postal_code": _equality,
+}
+
+
+def scores(left, right=None):
+    """Returns the scores of all pairs of MatchRecords (or rows with their fields) of left and right,
+    as len(left) x len(right) array. Without right, the records of left are compared with each other."""
+    result = 0
+    for field, weight in WEIGHTS.items():
+        values = [getattr(record, field) for record in left]
+        other_values = None if right is None else [getattr(record, field) for record in right]
+        result = result + weight * _SIMILARITIES[field](values, other_values)
+    return result
+
+
+# Matching
+
+def _identifier_condition(identifiers):
+    condition = Q()
+    for identifier in identifiers:
+        if isinstance(identifier, dict) and identifier.get("value"):
+            condition |= Q(system=identifier.get("system", ""), code=identifier["value"])
+    return condition
+
+
+def match(data, count=None, min_score=GRADES[-1][0]):
+    """Returns [(resource id, score)] of the stored Patients that match a Patient resource (FHIR dict),
+    best first, with up to two queries.
+
+    Only the Patients in one of its blocks are compared; those with a common identifier are certain matches."""
+    record = match_record(data)
+    condition = Q()
+    for key in KEYS:
+        if getattr(record, key):
+            condition |= Q(**{key: getattr(record, key)})
+    identifiers = _identifier_condition(data.get("identifier", []))
+    certain = set()
+    if identifiers:
+        certain = set(SearchToken.objects.filter(identifiers, resource_type="Patient", param="identifier")
+                      .values_list("resource_id", flat=True)[:MAX_CANDIDATES])
+        condition |= Q(resource_id__in=certain)
+    if not condition:
+        return []
+    candidates = list(MatchRecord.objects.filter(condition).exclude(resource_id=record.resource_id)
+                      .only(*_FIELDS)[:MAX_CANDIDATES])
+    if not candidates:
+        return []
+    matches = [(candidate.resource_id, 1.0 if candidate.resource_id in certain else float(score))
+               for candidate, score in zip(candidates, scores([record], candidates)[0])]
+    matches = sorted((item for item in matches if item[1] >= min_score), key=lambda item: (-item[1], item[0]))
+    return matches[:count]
+
+
+def _windows(block, max_block_size):
+    if len(block) <= max_block_size:
+        yield block
+        return
+    step = max_block_size // 2
+    for start in range(0, len(block) - step, step):
+        yield block[start:start + max_block_size]
+
+
+def _blocks(key, max_block_size):
+    """Yields the lists of records (as named tuples) with the same value of the key column, in windows"""
+    rows = MatchRecord.objects.filter(**{key + "__isnull": False}).order_by(key, "family", "given", "resource_id") \
+        .values_list(key, *_FIELDS, named=True).iterator(chunk_size=10000)
+    for _, block in itertools.groupby(rows, key=attrgetter(key)):
+        block = list(block)
+        if len(block) > 1:
+            yield from _windows(block, max_block_size)
+
+
+def _identifier_blocks(max_block_size):
+    """Yields the lists of the ids of Patients with a common identifier. Identifiers of more than
+    max_block_size Patients don't identify anybody, and are left out."""
+    rows = SearchToken.objects.filter(resource_type="Patient", param="identifier").order_by("system", "code") \
+        .values_list("system", "code", "resource_id").iterator(chunk_size=10000)
+    for _, block in itertools.groupby(rows, key=lambda row: row[:2]):
+        ids = sorted({row[2] for row in block})
+        if 1 < len(ids) <= max_block_size:
+            yield ids
+
+
+def _batches(blocks, batch_size):
+    """Combines small blocks into batches of about batch_size records, so they are scored together.
+
+    Yields (records, array of the number of the block of each record)."""
+    batch, numbers = [], []
+    for number, block in enumerate(blocks):
+        if batch and len(batch) + len(block) > batch_size:
+            yield batch, numpy.array(numbers)
+            batch, numbers = [], []
+        batch.extend(block)
+        numbers.extend([number] * len(block))
+    if batch:
+        yield batch, numpy.array(numbers)
+
+
+def find_duplicates(min_score=GRADES[1][0], max_block_size=MAX_BLOCK_SIZE):
+    """Yields (resource id, resource id, score) of all pairs of Patients that match with at least min_score,
+    each pair once.
+
+    Every blocking key is one pass over its index, with one batch of blocks in memory at a time, so this
+    scales with the number of Patients times the size of the blocks."""
+    found = set()
+    for ids in _identifier_blocks(max_block_size):
+        for pair in itertools.combinations(ids, 2):
+            if pair not in found:
+                found.add(pair)
+                yield pair + (1.0,)
+    for key in KEYS:
+        for batch, numbers in _batches(_blocks(key, max_block_size), BATCH_SIZE):
+            batch_scores = scores(batch)
+            # only pairs of the same block, each once
+            candidates = numpy.triu((batch_scores >= min_score) & (numbers[:, None] == numbers[None, :]), 1)
+            for i, j in zip(*numpy.nonzero(candidates)):
+                pair = tuple(sorted((batch[i].resource_id, batch[j].resource_id)))
+                if pair not in found:
+                    found.add(pair)
+                    yield pair + (float(batch_scores[i, j]),)
@@ -0,0 +1,43 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from medux.core.instrumentation import instrument, metrics
+
+__all__ = ["InstrumentationMiddleware"]
+
+
+class InstrumentationMiddleware:
+    """Records query counts and timings of every request into medux.core.instrumentation.metrics.
+
+    It is opt-in: add "medux.core.middleware.InstrumentationMiddleware" to the top of MIDDLEWARE.
+    The timings are also sent to the browser in a Server-Timing header. For streaming responses,
+    only the time until the response is returned is measured.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with instrument() as report:
+            response = self.get_response(request)
+        match = request.resolver_match
+        report.label = "{} {}".format(request.method, match.view_name if match else "<unresolved>")
+        metrics.record(report)
+        response["Server-Timing"] = "db;dur={:.1f};desc=\"{} queries\", app;dur={:.1f}".format(
+            report.db_time * 1000, report.query_count, report.python_time * 1000)
+        return response
@@ -0,0 +1,664 @@
+# Generated by Django 3.2.25
+
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils.timezone import utc
+import medux.core.fields
+import medux.core.ids
+import medux.core.models
+import uuid
+
+
+# The resource models are either multi-table (Resource <- DomainResource <- Patient...), or one table per
+# resource type with MEDUX_FLAT_RESOURCES, so the tables created here depend on the setting.
+FLAT_RESOURCES = getattr(settings, "MEDUX_FLAT_RESOURCES", False)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('creation', models.DateTimeField(auto_created=True)),
+                ('contentType', medux.core.fields.CodeField(blank=True, value_set='MimeType')),
+                ('language', medux.core.fields.CodeField(blank=True, value_set='Common Languages')),
+                ('url', medux.core.fields.UriField(blank=True, max_length=255)),
+                ('size', models.PositiveIntegerField(blank=True, null=True)),
+                ('hash', models.CharField(blank=True, db_index=True, max_length=28)),
+                ('title', models.CharField(blank=True, max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CodeableConcept',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Coding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('system', medux.core.fields.UriField(blank=True, max_length=255)),
+                ('version', models.CharField(blank=True, max_length=35)),
+                ('code', medux.core.fields.CodeField()),
+                ('display', models.CharField(max_length=255)),
+                ('userselected', models.BooleanField()),
+                ('lastUpdated', medux.core.fields.InstantField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Element',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('extensions', medux.core.fields.ExtensionField(blank=True, default=list, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('request', models.CharField(max_length=2000)),
+                ('types', models.CharField(max_length=255)),
+                ('compartment', models.CharField(blank=True, max_length=64)),
+                ('status', models.CharField(choices=[('accepted', 'Accepted'), ('in-progress', 'In progress'), ('completed', 'Completed'), ('error', 'Error'), ('cancelled', 'Cancelled')], default='accepted', max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('output', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Identifier',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateTimeField(default=datetime.datetime(1, 1, 1, 0, 0, tzinfo=utc))),
+                ('period_end', models.DateTimeField(default=datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=utc))),
+                ('use', medux.core.fields.CodeField(choices=[('usual', 'Usual'), ('official', 'Official'), ('temp', 'Temp'), ('secondary', 'Secondary'), ('old', 'Old')], value_set='IdentifierUse')),
+                ('system', medux.core.fields.UriField(max_length=255)),
+                ('value', models.CharField(blank=True, max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MatchRecord',
+            fields=[
+                ('resource_id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('family', models.CharField(blank=True, max_length=255)),
+                ('given', models.CharField(blank=True, max_length=255)),
+                ('birthdate', models.CharField(blank=True, max_length=10)),
+                ('postal_code', models.CharField(blank=True, max_length=10)),
+                ('name_key', models.CharField(db_index=True, max_length=64, null=True)),
+                ('birth_key', models.CharField(db_index=True, max_length=64, null=True)),
+                ('address_key', models.CharField(db_index=True, max_length=64, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('active', models.BooleanField()),
+                ('gender', medux.core.fields.CodeField(value_set='AdministrativeGender')),
+                ('birthdate', models.DateField(blank=True, null=True)),
+                ('deceased', models.DateTimeField(blank=True, null=True)),
+                ('multipleBirth', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResourceDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('versionId', models.CharField(blank=True, max_length=64)),
+                ('lastUpdated', medux.core.fields.InstantField()),
+                ('content', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResourceVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('version', models.PositiveIntegerField()),
+                ('lastUpdated', medux.core.fields.InstantField()),
+                ('method', models.CharField(choices=[('create', 'create'), ('update', 'update'), ('delete', 'delete')], max_length=10)),
+                ('current', models.BooleanField(default=True)),
+                ('content', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchDate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('param', models.CharField(max_length=64)),
+                ('low', models.DateTimeField()),
+                ('high', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('param', models.CharField(max_length=64)),
+                ('target_type', models.CharField(max_length=64)),
+                ('target_id', models.CharField(max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchString',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('param', models.CharField(max_length=64)),
+                ('normalized', models.CharField(max_length=255)),
+                ('value', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(max_length=64)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('param', models.CharField(max_length=64)),
+                ('system', models.CharField(blank=True, max_length=255)),
+                ('code', models.CharField(max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Subscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('requested', 'Requested'), ('active', 'Active'), ('error', 'Error'), ('off', 'Off')], default='requested', max_length=20)),
+                ('criteria', models.CharField(max_length=2000)),
+                ('reason', models.TextField(blank=True)),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('channel_type', models.CharField(choices=[('rest-hook', 'REST hook'), ('queue', 'Queue directory')], default='rest-hook', max_length=20)),
+                ('endpoint', models.CharField(max_length=2000)),
+                ('payload', models.CharField(blank=True, default='application/fhir+json', max_length=100)),
+                ('header', models.TextField(blank=True)),
+                ('cursor', models.BigIntegerField(blank=True, null=True)),
+                ('delivered', models.DateTimeField(blank=True, null=True)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('retry_after', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Address',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('period_start', models.DateTimeField(default=datetime.datetime(1, 1, 1, 0, 0, tzinfo=utc))),
+                ('period_end', models.DateTimeField(default=datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=utc))),
+                ('use', medux.core.fields.CodeField(value_set='AddressUse')),
+                ('type', medux.core.fields.CodeField(value_set='AddressType')),
+                ('text', models.CharField(max_length=255)),
+                ('line', models.CharField(max_length=255)),
+                ('city', models.CharField(max_length=255)),
+                ('district', models.CharField(max_length=255)),
+                ('state', models.CharField(max_length=255)),
+                ('postalCode', models.CharField(max_length=10)),
+                ('country', models.CharField(max_length=255)),
+            ],
+            bases=('core.element', models.Model),
+        ),
+        migrations.CreateModel(
+            name='ContactDetail',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('name', models.CharField(max_length=255)),
+            ],
+            bases=('core.element',),
+        ),
+        migrations.CreateModel(
+            name='ContactPoint',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('period_start', models.DateTimeField(default=datetime.datetime(1, 1, 1, 0, 0, tzinfo=utc))),
+                ('period_end', models.DateTimeField(default=datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=utc))),
+                ('system', medux.core.fields.CodeField(blank=True, value_set='ContactPointSystem')),
+                ('value', models.CharField(blank=True, max_length=255)),
+                ('use', medux.core.fields.CodeField(blank=True, value_set='ContactPointUse')),
+                ('rank', models.PositiveIntegerField(default=0)),
+            ],
+            bases=('core.element', models.Model),
+        ),
+        migrations.CreateModel(
+            name='HumanName',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('use', medux.core.fields.CodeField(value_set='NameUse')),
+                ('text', models.CharField(max_length=255)),
+                ('family', models.CharField(max_length=255)),
+                ('given', models.CharField(max_length=255)),
+            ],
+            bases=('core.element',),
+        ),
+        migrations.CreateModel(
+            name='Reference',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('references', models.CharField(blank=True, max_length=255)),
+                ('display', models.CharField(blank=True, max_length=255)),
+            ],
+            bases=('core.element',),
+        ),
+        migrations.CreateModel(
+            name='UsageContext',
+            fields=[
+                ('element_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.element')),
+                ('code', medux.core.fields.CodeField(value_set='UsageContextType')),
+                ('value', medux.core.fields.CodeField(value_set=medux.core.models.CodeableConcept)),
+            ],
+            bases=('core.element',),
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['resource_type', 'param', 'code', 'system', 'resource_id'], name='core_search_resourc_008e48_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='core_search_resourc_fe33a6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchstring',
+            index=models.Index(fields=['resource_type', 'param', 'normalized', 'resource_id'], name='core_search_resourc_b78c8e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchstring',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='core_search_resourc_4c37d8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchreference',
+            index=models.Index(fields=['resource_type', 'param', 'target_id', 'target_type', 'resource_id'], name='core_search_resourc_9d50eb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchreference',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='core_search_resourc_bca773_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchreference',
+            index=models.Index(fields=['target_id', 'target_type'], name='core_search_target__735a75_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchdate',
+            index=models.Index(fields=['resource_type', 'param', 'low', 'high'], name='core_search_resourc_e4912f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchdate',
+            index=models.Index(fields=['resource_type', 'param', 'high', 'low'], name='core_search_resourc_e8c805_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchdate',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='core_search_resourc_153289_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resourceversion',
+            index=models.Index(fields=['resource_type', 'resource_id', 'current'], name='core_resour_resourc_13b928_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resourceversion',
+            index=models.Index(fields=['lastUpdated'], name='core_resour_lastUpd_d5dc5e_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='resourceversion',
+            unique_together={('resource_type', 'resource_id', 'version')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='resourcedocument',
+            unique_together={('resource_type', 'resource_id')},
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='identifier',
+            field=models.ManyToManyField(to='core.Identifier'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='photo',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.attachment'),
+        ),
+        migrations.AddField(
+            model_name='identifier',
+            name='type',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.codeableconcept'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='coding',
+            index=models.Index(fields=['code'], name='core_coding_code_like', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='coding',
+            index=models.Index(fields=['display'], name='core_coding_display_like', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AlterUniqueTogether(
+            name='coding',
+            unique_together={('system', 'version', 'code')},
+        ),
+        migrations.AddField(
+            model_name='codeableconcept',
+            name='coding',
+            field=models.ManyToManyField(to='core.Coding'),
+        ),
+        migrations.AddField(
+            model_name='reference',
+            name='identifier',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='core.identifier'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='address',
+            field=models.ManyToManyField(to='core.Address'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='generalPractitioner',
+            field=medux.core.fields.ReferenceField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Organization|Practitioner'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='name',
+            field=models.ManyToManyField(to='core.HumanName'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='telecom',
+            field=models.ManyToManyField(to='core.ContactPoint'),
+        ),
+        migrations.AddField(
+            model_name='identifier',
+            name='assigner',
+            field=medux.core.fields.ReferenceField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='asignee', to='Organisation'),
+        ),
+        migrations.AddIndex(
+            model_name='contactpoint',
+            index=models.Index(fields=['value'], name='core_contactpoint_value_like', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='contactpoint',
+            index=models.Index(fields=['period_start', 'period_end'], name='core_contac_period__9126c5_idx'),
+        ),
+        migrations.AddField(
+            model_name='contactdetail',
+            name='telecom',
+            field=models.ManyToManyField(to='core.ContactPoint'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['period_start', 'period_end'], name='core_addres_period__4645bf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='identifier',
+            index=models.Index(fields=['value', 'system'], name='core_identifier_value_like', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='identifier',
+            index=models.Index(fields=['period_start', 'period_end'], name='core_identi_period__84a28c_idx'),
+        ),
+    ]
+
+    if FLAT_RESOURCES:
+        operations += [
+            migrations.CreateModel(
+                name='Organisation',
+                fields=[
+                    ('created', models.DateTimeField(auto_created=True, editable=False)),
+                    ('versionId', medux.core.fields.IdField(default=medux.core.ids.new_id, max_length=64, primary_key=True, serialize=False)),
+                    ('lastUpdated', medux.core.fields.InstantField(auto_now=True)),
+                    ('id', medux.core.fields.IdField(blank=True, db_index=True, default=medux.core.ids.new_id, max_length=64)),
+                    ('implicitRules', medux.core.fields.UriField(blank=True, max_length=255)),
+                    ('language', medux.core.fields.CodeField(blank=True)),
+                    ('text', medux.core.fields.NarrativeField()),
+                    ('contained', models.TextField(blank=True)),
+                ],
+                options={
+                    'abstract': False,
+                },
+            ),
+            migrations.CreateModel(
+                name='StructureDefinition',
+                fields=[
+                    ('created', models.DateTimeField(auto_created=True, editable=False)),
+                    ('versionId', medux.core.fields.IdField(default=medux.core.ids.new_id, max_length=64, primary_key=True, serialize=False)),
+                    ('lastUpdated', medux.core.fields.InstantField(auto_now=True)),
+                    ('id', medux.core.fields.IdField(blank=True, db_index=True, default=medux.core.ids.new_id, max_length=64)),
+                    ('implicitRules', medux.core.fields.UriField(blank=True, max_length=255)),
+                    ('language', medux.core.fields.CodeField(blank=True)),
+                    ('text', medux.core.fields.NarrativeField()),
+                    ('contained', models.TextField(blank=True)),
+                    ('url', medux.core.fields.UriField(max_length=255)),
+                    ('version', models.CharField(blank=True, max_length=255)),
+                    ('name', models.CharField(max_length=255)),
+                    ('title', models.CharField(blank=True, max_length=255)),
+                    ('status', medux.core.fields.CodeField(choices=[('draft', 'Draft'), ('active', 'Active'), ('retired', 'Retired'), ('unknown', 'Unknown')], value_set='PublicationStatus')),
+                    ('experimental', models.BooleanField()),
+                    ('date', models.DateTimeField(null=True)),
+                    ('publisher', models.CharField(blank=True, max_length=255)),
+                    ('description', medux.core.fields.MarkdownField()),
+                    ('type', models.CharField(blank=True, max_length=64)),
+                    ('differential', models.TextField(blank=True)),
+                    ('identifier', models.ManyToManyField(to='core.Identifier')),
+                    ('profile', models.ManyToManyField(to='core.StructureDefinition')),
+                    ('security', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, to='core.coding')),
+                ],
+                options={
+                    'abstract': False,
+                },
+            ),
+            migrations.CreateModel(
+                name='ValueSet',
+                fields=[
+                    ('created', models.DateTimeField(auto_created=True, editable=False)),
+                    ('versionId', medux.core.fields.IdField(default=medux.core.ids.new_id, max_length=64, primary_key=True, serialize=False)),
+                    ('lastUpdated', medux.core.fields.InstantField(auto_now=True)),
+                    ('id', medux.core.fields.IdField(blank=True, db_index=True, default=medux.core.ids.new_id, max_length=64)),
+                    ('implicitRules', medux.core.fields.UriField(blank=True, max_length=255)),
+                    ('language', medux.core.fields.CodeField(blank=True)),
+                    ('text', medux.core.fields.NarrativeField()),
+                    ('contained', models.TextField(blank=True)),
+                    ('url', medux.core.fields.UriField(max_length=255)),
+                    ('version', models.CharField(blank=True, max_length=255)),
+                    ('name', models.CharField(blank=True, max_length=255)),
+                    ('title', models.CharField(blank=True, max_length=255)),
+                    ('status', medux.core.fields.CodeField(value_set='PublicationStatus')),
+                    ('experimental', models.BooleanField(default=False)),
+                    ('date', models.DateTimeField()),
+                    ('publisher', models.CharField(blank=True, max_length=255)),
+                    ('descripttion', medux.core.fields.MarkdownField()),
+                    ('immutable', models.BooleanField(default=False)),
+                    ('purpose', medux.core.fields.MarkdownField()),
+                    ('copyright', medux.core.fields.MarkdownField()),
+                    ('extensible', models.BooleanField(default=False)),
+                    ('expansion', models.ManyToManyField(blank=True, related_name='value_sets', to='core.Coding')),
+                    ('identifier', models.ManyToManyField(to='core.Identifier')),
+                    ('jurisdiction', models.ManyToManyField(to='core.CodeableConcept')),
+                    ('profile', models.ManyToManyField(to='core.StructureDefinition')),
+                    ('security', models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, to='core.coding')),
+                ],
+                options={
+                    'abstract': False,
+                },
+            ),
+            migrations.AddField(
+                model_name='organisation',
+                name='profile',
+                field=models.ManyToManyField(to='core.StructureDefinition'),
+            ),
+            migrations.AddField(
+                model_name='organisation',
+                name='security',
+                field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, to='core.coding'),
+            ),
+        ]
+    else:
+        operations += [
+            migrations.CreateModel(
+                name='Resource',
+                fields=[
+                    ('created', models.DateTimeField(auto_created=True, editable=False)),
+                    ('versionId', medux.core.fields.IdField(default=medux.core.ids.new_id, max_length=64, primary_key=True, serialize=False)),
+                    ('lastUpdated', medux.core.fields.InstantField(auto_now=True)),
+                    ('id', medux.core.fields.IdField(blank=True, db_index=True, default=medux.core.ids.new_id, max_length=64)),
+                    ('implicitRules', medux.core.fields.UriField(blank=True, max_length=255)),
+                    ('language', medux.core.fields.CodeField(blank=True)),
+                ],
+                options={
+                    'abstract': False,
+                },
+            ),
+            migrations.CreateModel(
+                name='DomainResource',
+                fields=[
+                    ('resource_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.resource')),
+                    ('text', medux.core.fields.NarrativeField()),
+                ],
+                options={
+                    'abstract': False,
+                },
+                bases=('core.resource',),
+            ),
+            migrations.AddField(
+                model_name='resource',
+                name='security',
+                field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.PROTECT, to='core.coding'),
+            ),
+            migrations.CreateModel(
+                name='Organisation',
+                fields=[
+                    ('domainresource_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.domainresource')),
+                ],
+                options={
+                    'abstract': False,
+                },
+                bases=('core.domainresource',),
+            ),
+            migrations.CreateModel(
+                name='StructureDefinition',
+                fields=[
+                    ('domainresource_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.domainresource')),
+                    ('url', medux.core.fields.UriField(max_length=255)),
+                    ('version', models.CharField(blank=True, max_length=255)),
+                    ('name', models.CharField(max_length=255)),
+                    ('title', models.CharField(blank=True, max_length=255)),
+                    ('status', medux.core.fields.CodeField(choices=[('draft', 'Draft'), ('active', 'Active'), ('retired', 'Retired'), ('unknown', 'Unknown')], value_set='PublicationStatus')),
+                    ('experimental', models.BooleanField()),
+                    ('date', models.DateTimeField(null=True)),
+                    ('publisher', models.CharField(blank=True, max_length=255)),
+                    ('description', medux.core.fields.MarkdownField()),
+                    ('type', models.CharField(blank=True, max_length=64)),
+                    ('differential', models.TextField(blank=True)),
+                ],
+                options={
+                    'abstract': False,
+                },
+                bases=('core.domainresource',),
+            ),
+            migrations.CreateModel(
+                name='ValueSet',
+                fields=[
+                    ('domainresource_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='core.domainresource')),
+                    ('url', medux.core.fields.UriField(max_length=255)),
+                    ('version', models.CharField(blank=True, max_length=255)),
+                    ('name', models.CharField(blank=True, max_length=255)),
+                    ('title', models.CharField(blank=True, max_length=255)),
+                    ('status', medux.core.fields.CodeField(value_set='PublicationStatus')),
+                    ('experimental', models.BooleanField(default=False)),
+                    ('date', models.DateTimeField()),
+                    ('publisher', models.CharField(blank=True, max_length=255)),
+                    ('descripttion', medux.core.fields.MarkdownField()),
+                    ('immutable', models.BooleanField(default=False)),
+                    ('purpose', medux.core.fields.MarkdownField()),
+                    ('copyright', medux.core.fields.MarkdownField()),
+                    ('extensible', models.BooleanField(default=False)),
+                ],
+                options={
+                    'abstract': False,
+                },
+                bases=('core.domainresource',),
+            ),
+            migrations.AddField(
+                model_name='domainresource',
+                name='contained',
+                field=models.ManyToManyField(related_name='parent_resource', to='core.Resource'),
+            ),
+            migrations.AddField(
+                model_name='valueset',
+                name='expansion',
+                field=models.ManyToManyField(blank=True, related_name='value_sets', to='core.Coding'),
+            ),
+            migrations.AddField(
+                model_name='valueset',
+                name='identifier',
+                field=models.ManyToManyField(to='core.Identifier'),
+            ),
+            migrations.AddField(
+                model_name='valueset',
+                name='jurisdiction',
+                field=models.ManyToManyField(to='core.CodeableConcept'),
+            ),
+            migrations.AddField(
+                model_name='structuredefinition',
+                name='identifier',
+                field=models.ManyToManyField(to='core.Identifier'),
+            ),
+            migrations.AddField(
+                model_name='resource',
+                name='profile',
+                field=models.ManyToManyField(to='core.StructureDefinition'),
+            ),
+        ]
+
+    operations += [
+        migrations.AddField(
+            model_name='valueset',
+            name='contact',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.contactdetail'),
+        ),
+        migrations.AddField(
+            model_name='valueset',
+            name='use_context',
+            field=models.ManyToManyField(to='core.UsageContext'),
+        ),
+        migrations.AddField(
+            model_name='structuredefinition',
+            name='contact',
+            field=models.ManyToManyField(to='core.ContactDetail'),
+        ),
+        migrations.AddField(
+            model_name='structuredefinition',
+            name='use_context',
+            field=models.ManyToManyField(to='core.UsageContext'),
+        ),
+        migrations.AddField(
+            model_name='organisation',
+            name='identifier',
+            field=models.ManyToManyField(to='core.Identifier'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='managingOrganisation',
+            field=medux.core.fields.ReferenceField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Organisation'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+from medux.core.code_search import create_last_updated_column
+from medux.core.references import create_id_indexes
+from medux.core.upgrades import flatten_resources, move_legacy_extensions, move_legacy_periods, restore_legacy_extensions
+
+# Databases created before MedUX had migrations are marked as migrated with "migrate --fake-initial";
+# this converts the tables of older layouts, and adds what they may lack. New databases have all of it
+# already. See medux.core.upgrades.
+
+
+def move_periods(apps, schema_editor):
+    move_legacy_periods(schema_editor.connection)
+
+
+def move_extensions(apps, schema_editor):
+    move_legacy_extensions(schema_editor.connection)
+
+
+def restore_extensions(apps, schema_editor):
+    restore_legacy_extensions(schema_editor.connection)
+
+
+def flatten(apps, schema_editor):
+    flatten_resources(schema_editor.connection)
+
+
+def upgrade(apps, schema_editor):
+    create_last_updated_column(schema_editor.connection)
+    create_id_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0001_initial"),
+    ]
+
+    # SQLite can't rename tables that are referred to within a transaction, which flattening does
+    atomic = False
+
+    operations = [
+        migrations.RunPython(move_periods, migrations.RunPython.noop, atomic=True),
+        migrations.RunPython(move_extensions, restore_extensions, atomic=True),
+        migrations.RunPython(flatten, migrations.RunPython.noop, atomic=False),
+        migrations.RunPython(upgrade, migrations.RunPython.noop, atomic=True),
+    ]
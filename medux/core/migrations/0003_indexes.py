@@ -0,0 +1,61 @@
+from django.db import migrations
+
+from medux.core.extensions import create_extension_indexes, drop_extension_indexes
+from medux.core.migrations import RunVendorSQL
+
+# Indexes which Django can't express as Meta.indexes
+
+TRIGRAM_COLUMNS = ("code", "display")
+PERIODIC_TABLES = ("core_identifier", "core_contactpoint", "core_address")
+
+# pg_trgm may not be available, or the user may lack the privileges to create it - the code search
+# uses the in-process index then (see medux.core.code_search)
+CREATE_TRIGRAM_INDEXES = """
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+EXCEPTION WHEN OTHERS THEN
+    RAISE WARNING 'Could not create the pg_trgm extension: %', SQLERRM;
+END $$;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+        {}
+    END IF;
+END $$;
+""".format("\n        ".join(
+    'CREATE INDEX IF NOT EXISTS "core_coding_{0}_trgm" ON "core_coding" USING gin ("{0}" gin_trgm_ops);'.format(
+        column) for column in TRIGRAM_COLUMNS))
+
+
+def create_extensions(apps, schema_editor):
+    create_extension_indexes(schema_editor.connection)
+
+
+def drop_extensions(apps, schema_editor):
+    drop_extension_indexes(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_unmigrated_databases"),
+    ]
+
+    operations = [
+        RunVendorSQL(
+            ["postgresql"],
+            CREATE_TRIGRAM_INDEXES,
+            ['DROP INDEX IF EXISTS "core_coding_{}_trgm"'.format(column) for column in TRIGRAM_COLUMNS],
+        ),
+        # the periods as tstzrange, for valid_at() (see medux.core.periods)
+        RunVendorSQL(
+            ["postgresql"],
+            ['CREATE INDEX IF NOT EXISTS "{0}_period_gist" ON "{0}" USING gist '
+             '(tstzrange("period_start", "period_end", \'[]\'))'.format(table) for table in PERIODIC_TABLES],
+            ['DROP INDEX IF EXISTS "{}_period_gist"'.format(table) for table in PERIODIC_TABLES],
+        ),
+        # the urls of MEDUX_INDEXED_EXTENSIONS at the time of migrating; "manage.py index_extensions" updates
+        # them when the setting changes
+        migrations.RunPython(create_extensions, drop_extensions),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25
+
+import datetime
+from django.db import migrations, models
+from django.utils.timezone import utc
+
+# The open ends of periods were stored as the limits of datetime, which overflow when converted to time
+# zones east (or, the start, west) of UTC; they are a day away from them now.
+OLD_LIMITS = (datetime.datetime(1, 1, 1, tzinfo=utc), datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=utc))
+NEW_LIMITS = (datetime.datetime(1, 1, 2, tzinfo=utc), datetime.datetime(9999, 12, 30, 23, 59, 59, 999999, tzinfo=utc))
+PERIODIC_MODELS = ("Identifier", "ContactPoint", "Address")
+
+
+def replace_limits(apps, using, old, new):
+    for name in PERIODIC_MODELS:
+        objects = apps.get_model("core", name).objects.using(using)
+        objects.filter(period_start=old[0]).update(period_start=new[0])
+        objects.filter(period_end=old[1]).update(period_end=new[1])
+
+
+def forwards(apps, schema_editor):
+    replace_limits(apps, schema_editor.connection.alias, OLD_LIMITS, NEW_LIMITS)
+
+
+def backwards(apps, schema_editor):
+    replace_limits(apps, schema_editor.connection.alias, NEW_LIMITS, OLD_LIMITS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='address',
+            name='period_end',
+            field=models.DateTimeField(default=datetime.datetime(9999, 12, 30, 23, 59, 59, 999999, tzinfo=utc)),
+        ),
+        migrations.AlterField(
+            model_name='address',
+            name='period_start',
+            field=models.DateTimeField(default=datetime.datetime(1, 1, 2, 0, 0, tzinfo=utc)),
+        ),
+        migrations.AlterField(
+            model_name='contactpoint',
+            name='period_end',
+            field=models.DateTimeField(default=datetime.datetime(9999, 12, 30, 23, 59, 59, 999999, tzinfo=utc)),
+        ),
+        migrations.AlterField(
+            model_name='contactpoint',
+            name='period_start',
+            field=models.DateTimeField(default=datetime.datetime(1, 1, 2, 0, 0, tzinfo=utc)),
+        ),
+        migrations.AlterField(
+            model_name='identifier',
+            name='period_end',
+            field=models.DateTimeField(default=datetime.datetime(9999, 12, 30, 23, 59, 59, 999999, tzinfo=utc)),
+        ),
+        migrations.AlterField(
+            model_name='identifier',
+            name='period_start',
+            field=models.DateTimeField(default=datetime.datetime(1, 1, 2, 0, 0, tzinfo=utc)),
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
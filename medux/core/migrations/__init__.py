@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+class RunVendorSQL(migrations.RunSQL):
+    """RunSQL which only runs on the databases of the given vendors, for their own SQL dialect or features"""
+
+    def __init__(self, vendors, *args, **kwargs):
+        self.vendors = tuple(vendors)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        return name, [self.vendors] + list(args), kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor in self.vendors:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor in self.vendors:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return "{} ({})".format(super().describe(), ", ".join(self.vendors))
@@ -15,12 +15,25 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+from uuid import uuid4
+
+from django.conf import settings
 from django.db import models
+from django.utils.functional import cached_property
 
 from .fields import *
+from .periods import PeriodQuerySet, Periodic
+from .references import ReferenceQuerySet, parse_reference, resolve_reference
 
 __author__ = "Christian González <christian.gonzalez@nerdocs.at>"
 
+# Storage layout of the resources. By default, Resource and DomainResource are concrete models, so
+# every resource is spread over (at least) three tables by multi-table inheritance. With
+# MEDUX_FLAT_RESOURCES, they are abstract, and each resource type has one table with all columns -
+# which saves two joins per query and two INSERTs per saved resource.
+# Existing databases are converted with the "flatten_resources" management command.
+FLAT_RESOURCES = getattr(settings, "MEDUX_FLAT_RESOURCES", False)
+
 
 class Coding(models.Model):
     """http://build.fhir.org/datatypes-definitions.html#Coding"""
@@ -42,17 +55,21 @@ class Coding(models.Model):
     # i.e. off a pick list of available items (codes or displays).
     userselected = models.BooleanField()
 
+    # not part of FHIR: when the code was last saved, so that the code search index can pick up changes
+    lastUpdated = InstantField(auto_now=True, db_index=True)
 
-# Extension
-class Period(models.Model):
-    """A time period defined by a start and end date/time.
+    class Meta:
+        # codes are shared, and imported in bulk (see medux.core.code_import)
+        unique_together = [("system", "version", "code")]
+        # for the admin search, which only does prefix matches: PostgreSQL only uses an index for
+        # LIKE 'term%' with the pattern operator class, unless the database uses the C locale
+        indexes = [
+            models.Index(fields=["code"], name="core_coding_code_like", opclasses=["varchar_pattern_ops"]),
+            models.Index(fields=["display"], name="core_coding_display_like", opclasses=["varchar_pattern_ops"]),
+        ]
 
-    If the start element is missing, the start of the period is not known.
-    If the end element is missing, it means that the period is ongoing, or the start may be in the past,
-    and the end date in the future, which means that period is expected/planned to end at the specified time
-    """
-    start = models.DateTimeField(null=True)
-    end = models.DateTimeField(null=True)
+    def __str__(self):
+        return "{} ({})".format(self.display, self.code) if self.display else self.code
 
 
 class Meta(models.Model):
@@ -76,7 +93,8 @@ class Meta(models.Model):
 
 
 class Resource(Meta):
-    id = IdField(blank=True)
+    # the logical id, which references and the REST API look resources up by
+    id = IdField(blank=True, db_index=True)
 
     # TODO: Maybe it's better to use a OneToOneField for that
     # EVERY resource uses these metadata.
@@ -90,14 +108,26 @@ class Resource(Meta):
     # TODO: language choices, see http://build.fhir.org/valueset-languages.html
     # or use the django internals?
 
+    class Meta:
+        abstract = FLAT_RESOURCES
+
 
 class DomainResource(Resource):
     text = NarrativeField()
-    contained = models.ManyToManyField(Resource, related_name="parent_resource")
+    if FLAT_RESOURCES:
+        # there is no common table to point to; contained resources have no identity outside of
+        # their container anyway, so they are kept inline, as FHIR JSON array
+        contained = models.TextField(blank=True)
+    else:
+        contained = models.ManyToManyField(Resource, related_name="parent_resource")
+
+    class Meta:
+        abstract = FLAT_RESOURCES
 
 
 # http://hl7.org/fhir/publication-status
-# FIXME: implement expansion automatically, in code
+# This is the built-in expansion of the "PublicationStatus" ValueSet, see medux.core.terminology.
+# A ValueSet with that name or URL in the database takes precedence when validating codes.
 PUBLICATION_STATUS = (
     ("draft", "Draft"),
     ("active", "Active"),
@@ -116,28 +146,28 @@ class Element(models.Model):
     * an internal id
     """
 
-    # This field originally is named "extension". This causes some problemswith name clashing
-    # So, as it's a ManyToManyField anyway, we renamed it to "extensions"
-    extensions = models.ManyToManyField("Extension", related_name="extends")
+    # This field originally is named "extension", which clashes with the reverse accessors of
+    # the elements inheriting from Element. So we renamed it to "extensions"
+    extensions = ExtensionField()
 
     # class Meta:
     #    abstract = True
 
+    def extension_values(self, url):
+        """Returns the values of the extensions with that url, in order.
 
-class Extension(Element):
-
-    # SHALL be a URL, not a URN (e.g. not an OID or a UUID),
-    url = UriField()
-
-    # FIXME: this field in reality should be more flexible.
-    # see http://build.fhir.org/extensibility.html#Extension
-    # value = models.CharField(max_length=255, blank=True)
+        A value is the value[x] of the extension (e.g. "I" for a valueCode), or the list of
+        its nested extensions for complex ones."""
+        return [next((value for key, value in extension.items() if key.startswith("value")),
+                     extension.get("extension"))
+                for extension in self.extensions if extension["url"] == url]
 
-#    class Meta:
-#        abstract = True
+    def add_extension(self, url, value_type, value):
+        """Appends an extension, e.g. ``add_extension(url, "Code", "I")`` for a valueCode"""
+        self.extensions = self.extensions + [{"url": url, "value" + value_type[0].upper() + value_type[1:]: value}]
 
 
-class ContactPoint(Element):
+class ContactPoint(Element, Periodic):
     """Details for all kinds of technology-mediated contact points for a person or organization
 
     This includes telephone, email, etc. """
@@ -151,13 +181,28 @@ class ContactPoint(Element):
     # http://hl7.org/fhir/ValueSet/contact-point-use
     use = CodeField("ContactPointUse", blank=True)
     rank = models.PositiveIntegerField(default=0)
-    period = models.ForeignKey(Period, on_delete=models.PROTECT, null=True)
+    # the period is stored inline, see medux.core.periods
+
+    objects = PeriodQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # prefix matches in the admin search, see Coding
+            models.Index(fields=["value"], name="core_contactpoint_value_like", opclasses=["varchar_pattern_ops"]),
+            models.Index(fields=["period_start", "period_end"]),
+        ]
+
+    def __str__(self):
+        return self.value
 
 
 class ContactDetail(Element):
     name = models.CharField(max_length=255)
     telecom = models.ManyToManyField(ContactPoint)
 
+    def __str__(self):
+        return self.name
+
 
 class StructureDefinition(DomainResource):
     url = UriField()
@@ -167,7 +212,7 @@ class StructureDefinition(DomainResource):
     title = models.CharField(max_length=255, blank=True)
 
     # http://hl7.org/fhir/ValueSet/publication-status
-    status = CodeField(choices=PUBLICATION_STATUS)
+    status = CodeField("PublicationStatus", choices=PUBLICATION_STATUS)
 
     experimental = models.BooleanField()
     date = models.DateTimeField(null=True)
@@ -177,9 +222,14 @@ class StructureDefinition(DomainResource):
     description = MarkdownField()
     use_context = models.ManyToManyField("UsageContext")
 
+    # the resource type that is constrained, e.g. "Patient"
+    type = models.CharField(max_length=64, blank=True)
+    # the ElementDefinitions of the differential, as FHIR JSON array; see medux.core.profiles
+    differential = models.TextField(blank=True)
+
 
 # http://hl7.org/fhir/identifier-use
-# FIXME: implement expansion automatically, as ValueSet
+# Built-in expansion of the "IdentifierUse" ValueSet, see medux.core.terminology.
 IDENTIFIER_USE = (
     ("usual", "Usual"),
     ("official", "Official"),
@@ -189,14 +239,18 @@ IDENTIFIER_USE = (
 )
 
 
-class Identifier(models.Model):
+class IdentifierQuerySet(ReferenceQuerySet, PeriodQuerySet):
+    pass
+
+
+class Identifier(Periodic):
     """A numeric or alphanumeric string that is associated with a single object or entity within a given system.
 
     Typically, identifiers are used to connect content in resources to external content available in other
     frameworks or protocols. Identifiers are associated with objects, and may be changed or retired due to
     human or system process and errors."""
 
-    use = CodeField(choices=IDENTIFIER_USE)
+    use = CodeField("IdentifierUse", choices=IDENTIFIER_USE)
     type = models.ForeignKey("CodeableConcept", null=True, on_delete=models.SET_NULL)
 
     # FIXME: this is an URI in FHIR
@@ -211,11 +265,24 @@ class Identifier(models.Model):
 
     # http://build.fhir.org/datatypes-definitions.html#Identifier.value
     # The portion of the identifier typically relevant to the user and which is unique within the context of the system.
-    value = models.CharField
-    period = models.ForeignKey(Period, null=True, on_delete=models.SET_NULL)
+    value = models.CharField(max_length=255, blank=True)
+    # the period is stored inline, see medux.core.periods
 
     assigner = ReferenceField("Organisation", null=True, on_delete=models.SET_NULL, related_name="asignee")
 
+    objects = IdentifierQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # equal values and systems, and prefix matches of the value in the admin search, see Coding
+            models.Index(fields=["value", "system"], name="core_identifier_value_like",
+                         opclasses=["varchar_pattern_ops", "varchar_pattern_ops"]),
+            models.Index(fields=["period_start", "period_end"]),
+        ]
+
+    def __str__(self):
+        return "{}|{}".format(self.system, self.value) if self.system else self.value
+
 
 class Organisation(DomainResource):
     # The organization SHALL at least have a name or an id, and possibly more than one
@@ -233,6 +300,22 @@ class Reference(Element):
     def validate_unique(self, exclude=None):
         pass
 
+    @cached_property
+    def parsed(self):
+        """The parts (resource type, id, version) of the literal reference, or None"""
+        return parse_reference(self.references)
+
+    @property
+    def resource_type(self):
+        return self.parsed.resource_type if self.parsed else None
+
+    @property
+    def resource(self):
+        """The model instance this reference points to, or None if it isn't stored here."""
+        if not hasattr(self, "_resource"):
+            self._resource = resolve_reference(self.references)
+        return self._resource
+
 
 class CodeableConcept(models.Model):
     """A CodeableConcept represents a value that is usually supplied by providing a
@@ -283,6 +366,11 @@ class ValueSet(DomainResource):
 
     extensible = models.BooleanField(default=False)
 
+    # The codes this value set contains, as listed in its expansion.
+    # http://hl7.org/fhir/valueset-definitions.html#ValueSet.expansion.contains
+    # medux.core.terminology keeps them in memory for validating codes.
+    expansion = models.ManyToManyField(Coding, blank=True, related_name="value_sets")
+
 
 class HumanName(Element):
     # https://www.hl7.org/fhir/valueset-name-use.html
@@ -298,7 +386,7 @@ class HumanName(Element):
     given = models.CharField(max_length=255)
 
 
-class Address(Element):
+class Address(Element, Periodic):
     """An address expressed using postal conventions (as opposed to GPS or other location definition formats).
     This data type may be used to convey addresses for use in delivering mail as well as for visiting
     locations which might not be valid for mail delivery.
@@ -334,7 +422,12 @@ class Address(Element):
     # ISO 3166 3 letter codes can be used in place of a full country name.
     country = models.CharField(max_length=255)
 
-    period = models.ForeignKey(Period, on_delete=models.SET_NULL, null=True)
+    # the period is stored inline, see medux.core.periods
+
+    objects = PeriodQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["period_start", "period_end"])]
 
 
 class Attachment(models.Model):
@@ -348,17 +441,18 @@ class Attachment(models.Model):
     language = CodeField("Common Languages", blank=True)
 
     # The actual data of the attachment - a sequence of bytes. In XML, represented using base64.
-    data = Base64TextField(blank=True)
+    # It isn't kept in the database, but streamed into the blob store (medux.core.blobs), with the
+    # hash as key. Use open() to read it.
 
     # An alternative location where the data can be accessed.
     url = UriField(blank=True)
     # If both data and url are provided, the url SHALL point to the same content as the data contains.
 
     # The number of bytes of data that make up this attachment (before base64 encoding, if that is done).
-    size = models.PositiveIntegerField(blank=True)
+    size = models.PositiveIntegerField(blank=True, null=True)
 
     # The calculated hash of the data using SHA-1. Represented using base64.
-    hash = Base64TextField(blank=True)
+    hash = models.CharField(max_length=28, blank=True, db_index=True)
 
     # A label or set of text to display in place of the data.
     title = models.CharField(max_length=255, blank=True)
@@ -367,7 +461,13 @@ class Attachment(models.Model):
     creation = models.DateTimeField(auto_created=True)
 
     def __str__(self):
-        return self.title if self.title else self.data
+        return self.title if self.title else self.url
+
+    def open(self):
+        """Returns a binary file-like object to read the data from the blob store"""
+        # blobs imports nothing from here, but keeps the models free of storage details
+        from medux.core.blobs import decode_hash, get_blob_store
+        return get_blob_store().open(decode_hash(self.hash))
 
 
 class Patient(models.Model):
@@ -376,11 +476,11 @@ class Patient(models.Model):
     name = models.ManyToManyField(HumanName)
     telecom = models.ManyToManyField(ContactPoint)
     gender = CodeField("AdministrativeGender")
-    birthdate = models.DateField(blank=True)
+    birthdate = models.DateField(blank=True, null=True)
 
     # if this field is blank, the REST API should return boolean "False"
     # https://www.hl7.org/fhir/patient-definitions.html#Patient.deceased_x_
-    deceased = models.DateTimeField(blank=True)
+    deceased = models.DateTimeField(blank=True, null=True)
     address = models.ManyToManyField(Address)
 
     maritialStatus = CodeableConcept("MaritialStatus")
@@ -397,3 +497,236 @@ class Patient(models.Model):
                                          related_name="+")
     managingOrganisation = ReferenceField(Organisation, on_delete=models.SET_NULL, null=True,
                                           related_name="+")
+
+    objects = ReferenceQuerySet.as_manager()
+
+
+class ExportJob(models.Model):
+    """A FHIR Bulk Data $export request, which is processed in the background.
+
+    http://hl7.org/fhir/uv/bulkdata/export/index.html"""
+
+    STATUS_CHOICES = (
+        ("accepted", "Accepted"),
+        ("in-progress", "In progress"),
+        ("completed", "Completed"),
+        ("error", "Error"),
+        ("cancelled", "Cancelled"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+
+    # only the user who requested the export may see its status and download the files
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.CASCADE)
+
+    # the kick-off request URL, which is repeated in the result manifest
+    request = models.CharField(max_length=2000)
+
+    # comma separated FHIR resource types
+    types = models.CharField(max_length=255)
+
+    # "Patient" for a Patient level export, which only contains the compartments of the Patients
+    compartment = models.CharField(max_length=64, blank=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="accepted")
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # updated while the job is in progress: if it stops, the process running the job has died
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    # number of exported resources per type, as JSON
+    output = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    @property
+    def type_list(self):
+        return self.types.split(",") if self.types else []
+
+
+class ResourceDocument(models.Model):
+    """The complete FHIR JSON representation of a resource, denormalized into one row.
+
+    Only used if MEDUX_DOCUMENT_STORE is enabled, see medux.core.documents.
+    The normalized tables stay the master data, documents are rewritten in the same
+    transaction whenever a resource or one of its elements changes."""
+
+    resource_type = models.CharField(max_length=64)
+    resource_id = models.CharField(max_length=64)
+    versionId = models.CharField(max_length=64, blank=True)
+    lastUpdated = InstantField()
+
+    # the serialized JSON, returned as is
+    content = models.TextField()
+
+    class Meta:
+        unique_together = (("resource_type", "resource_id"),)
+
+
+class SearchIndex(models.Model):
+    """Base of the search parameter index tables, see medux.core.search.
+
+    The values of all search parameters are extracted from the resources when they are written,
+    so searching never has to join through the elements of a resource."""
+
+    resource_type = models.CharField(max_length=64)
+    resource_id = models.CharField(max_length=64)
+
+    # the name of the search parameter, e.g. "family"
+    param = models.CharField(max_length=64)
+
+    class Meta:
+        abstract = True
+
+
+class SearchString(SearchIndex):
+    # lower case, without accents and punctuation, for the default "starts with" search
+    normalized = models.CharField(max_length=255)
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["resource_type", "param", "normalized", "resource_id"]),
+            models.Index(fields=["resource_type", "resource_id"]),
+        ]
+
+
+class SearchToken(SearchIndex):
+    system = models.CharField(max_length=255, blank=True)
+    code = models.CharField(max_length=255)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["resource_type", "param", "code", "system", "resource_id"]),
+            models.Index(fields=["resource_type", "resource_id"]),
+        ]
+
+
+class SearchDate(SearchIndex):
+    # every date is a range, e.g. a birthDate of 1980-01-01 covers the whole day
+    low = models.DateTimeField()
+    high = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["resource_type", "param", "low", "high"]),
+            models.Index(fields=["resource_type", "param", "high", "low"]),
+            models.Index(fields=["resource_type", "resource_id"]),
+        ]
+
+
+class SearchReference(SearchIndex):
+    target_type = models.CharField(max_length=64)
+    target_id = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["resource_type", "param", "target_id", "target_type", "resource_id"]),
+            models.Index(fields=["resource_type", "resource_id"]),
+            # all resources referring to one, for compartments (see medux.core.compartments)
+            models.Index(fields=["target_id", "target_type"]),
+        ]
+
+
+class MatchRecord(models.Model):
+    """The normalized demographics of a Patient and its blocking keys, for finding duplicates,
+    see medux.core.matching. Like the search indexes, it is derived from the FHIR representation.
+
+    Only Patients with the same value in one of the key columns are compared, so each key is indexed.
+    Keys are NULL if the Patient lacks the data for them. Identifiers are matched in SearchToken."""
+
+    resource_id = models.CharField(max_length=64, primary_key=True)
+
+    # normalized like SearchString, the given names space separated
+    family = models.CharField(max_length=255, blank=True)
+    given = models.CharField(max_length=255, blank=True)
+    # YYYY-MM-DD, or YYYY(-MM) for partial dates
+    birthdate = models.CharField(max_length=10, blank=True)
+    postal_code = models.CharField(max_length=10, blank=True)
+
+    # phonetic code of the family name and year of birth, e.g. "657:1980"
+    name_key = models.CharField(max_length=64, null=True, db_index=True)
+    # date of birth and phonetic code of the first given name
+    birth_key = models.CharField(max_length=64, null=True, db_index=True)
+    # postal code and phonetic code of the first given name
+    address_key = models.CharField(max_length=64, null=True, db_index=True)
+
+
+class ResourceVersion(models.Model):
+    """One version of a resource, as FHIR JSON. Rows are only appended, never changed,
+    except for the "current" flag.
+
+    http://hl7.org/fhir/http.html#history
+    The latest version of each resource is flagged as current, so reading it is a single
+    lookup on the (resource_type, resource_id, current) index. See medux.core.history."""
+
+    METHODS = (
+        ("create", "create"),
+        ("update", "update"),
+        ("delete", "delete"),
+    )
+
+    resource_type = models.CharField(max_length=64)
+    resource_id = models.CharField(max_length=64)
+
+    # the version number, counted up per resource from 1, used as meta.versionId
+    version = models.PositiveIntegerField()
+    lastUpdated = InstantField()
+    method = models.CharField(max_length=10, choices=METHODS)
+    current = models.BooleanField(default=True)
+
+    # the serialized JSON, empty for deletions
+    content = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = (("resource_type", "resource_id", "version"),)
+        indexes = [
+            models.Index(fields=["resource_type", "resource_id", "current"]),
+            models.Index(fields=["lastUpdated"]),
+        ]
+
+
+class Subscription(models.Model):
+    """A FHIR Subscription: changes of the resources matching the criteria are sent to a channel.
+
+    http://hl7.org/fhir/subscription.html
+    The changes are read from the version history (ResourceVersion), in the order they were
+    recorded, and delivered in batches by the "deliver_subscriptions" worker, see
+    medux.core.subscriptions."""
+
+    STATUS_CHOICES = (
+        ("requested", "Requested"),
+        ("active", "Active"),
+        ("error", "Error"),
+        ("off", "Off"),
+    )
+
+    CHANNEL_TYPES = (
+        # a POST of a "history" Bundle to the endpoint URL
+        ("rest-hook", "REST hook"),
+        # a "history" Bundle file in the endpoint directory, for local consumers
+        ("queue", "Queue directory"),
+    )
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="requested")
+    # a search URL like "Patient?gender=female", or just the resource type
+    criteria = models.CharField(max_length=2000)
+    reason = models.TextField(blank=True)
+    end = models.DateTimeField(null=True, blank=True)
+
+    channel_type = models.CharField(max_length=20, choices=CHANNEL_TYPES, default="rest-hook")
+    endpoint = models.CharField(max_length=2000)
+    # "application/fhir+json" sends the resources, empty sends only the Bundle entries without them
+    payload = models.CharField(max_length=100, blank=True, default="application/fhir+json")
+    # HTTP headers for rest-hooks, one per line, like "Authorization: Bearer ..."
+    header = models.TextField(blank=True)
+
+    # the pk of the last delivered ResourceVersion; set to the latest one when the subscription is activated
+    cursor = models.BigIntegerField(null=True, blank=True)
+    delivered = models.DateTimeField(null=True, blank=True)
+    # consecutive failed deliveries, and when the next one is tried
+    failures = models.PositiveIntegerField(default=0)
+    retry_after = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return "{} -> {}".format(self.criteria, self.endpoint)
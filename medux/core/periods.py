@@ -0,0 +1,99 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+from collections import namedtuple
+
+from django.db import connections, models
+from django.db.models import F, Func
+from django.utils import timezone
+
+# Periods of elements (Identifier, ContactPoint, Address), see http://hl7.org/fhir/datatypes.html#Period
+#
+# The start and end of a period are stored inline, in two columns of the element's own table, so
+# "valid at" queries ("the current address") don't join a separate Period table. An open start
+# or end is stored as PERIOD_MIN or PERIOD_MAX, like the dates of the search index:
+# elements without a period are valid at any time, and valid_at() is a plain range condition on
+# the indexed (period_start, period_end) columns instead of a chain of IS NULL checks.
+# On PostgreSQL, the migrations also create GiST indexes on the periods as tstzrange, which
+# valid_at() uses there.
+
+__all__ = ["PERIOD_MAX", "PERIOD_MIN", "Period", "PeriodQuerySet", "PeriodRange", "Periodic"]
+
+# a day away from the limits of datetime, so that they can be converted to any time zone
+PERIOD_MIN = datetime.datetime(1, 1, 2, tzinfo=datetime.timezone.utc)
+PERIOD_MAX = datetime.datetime(9999, 12, 30, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc)
+
+# start and end are None where the period is open
+Period = namedtuple("Period", ["start", "end"])
+
+
+class PeriodRange(Func):
+    """The period of an element as PostgreSQL tstzrange, including both ends - the expression of the GiST indexes"""
+    template = "tstzrange(%(expressions)s, '[]')"
+
+    def __init__(self, start="period_start", end="period_end"):
+        super().__init__(F(start), F(end), output_field=models.TextField())
+
+
+class _RangeContains(Func):
+    template = "(%(expressions)s)"
+    arg_joiner = " @> "
+
+    def __init__(self, instant):
+        super().__init__(PeriodRange(), models.Value(instant, output_field=models.DateTimeField()),
+                         output_field=models.BooleanField())
+
+
+class PeriodQuerySet(models.QuerySet):
+    """QuerySet for elements with a period"""
+
+    def valid_at(self, instant=None):
+        """The elements whose period contains the instant (default: now); those without a period are always valid"""
+        if instant is None:
+            instant = timezone.now()
+        if connections[self.db].vendor == "postgresql":
+            return self.annotate(_valid_at=_RangeContains(instant)).filter(_valid_at=True)
+        return self.filter(period_start__lte=instant, period_end__gte=instant)
+
+
+class Periodic(models.Model):
+    """Abstract base of the elements with a period, a time range defined by a start and end date/time.
+
+    If the start is missing, the start of the period is not known. If the end is missing, the period is
+    ongoing, or the start may be in the past, and the end date in the future, which means that the period
+    is expected/planned to end at the specified time."""
+
+    period_start = models.DateTimeField(default=PERIOD_MIN)
+    period_end = models.DateTimeField(default=PERIOD_MAX)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def period(self):
+        """The Period, or None if the element has none"""
+        if self.period_start == PERIOD_MIN and self.period_end == PERIOD_MAX:
+            return None
+        return Period(None if self.period_start == PERIOD_MIN else self.period_start,
+                      None if self.period_end == PERIOD_MAX else self.period_end)
+
+    @period.setter
+    def period(self, period):
+        self.period_start = PERIOD_MIN if period is None or period.start is None else period.start
+        self.period_end = PERIOD_MAX if period is None or period.end is None else period.end
@@ -0,0 +1,340 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import re
+
+from django.conf import settings
+
+from medux.core.caches import TimedLRUCache
+from medux.core.fields import EXTENSION_VALUE_TYPES, ID_PATTERN, OID_PATTERN
+from medux.core.models import StructureDefinition
+from medux.core.terminology import expansions
+
+# Validation of resources against profiles (StructureDefinitions), see http://hl7.org/fhir/profiling.html
+#
+# A profile is compiled once into a tree of closures, one per ElementDefinition of its
+# differential, which check the cardinality, fixed and pattern values, required ValueSet
+# bindings, the format of primitive values (like the id and oid patterns) and maxLength.
+# Validating a resource then just walks its JSON along that tree, without looking at the
+# StructureDefinition again. Compiled profiles are kept in an LRU cache, which is cleared by the
+# signal handlers in medux.core.signals whenever a StructureDefinition changes, and whose entries
+# expire to pick up the changes of other processes.
+#
+# Slices (ElementDefinitions with a sliceName) and FHIRPath invariants are not checked (yet).
+
+__all__ = ["CompiledProfile", "ProfileCache", "compile_profile", "parse_canonical", "profiles",
+           "validate_resource"]
+
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_TIMEOUT = 60
+# seconds after which profiles that didn't exist are looked up again. Resources aren't validated
+# against unknown profiles, so a profile created by another process should be used soon.
+UNKNOWN_TIMEOUT = 5
+
+REGEX_EXTENSION = "http://hl7.org/fhir/StructureDefinition/regex"
+
+_DATE = r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1]))?)?"
+_TIME = r"([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]+)?"
+_ZONE = r"(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00))"
+
+# the formats of primitive values, see http://hl7.org/fhir/datatypes.html
+PRIMITIVE_PATTERNS = {
+    "id": ID_PATTERN,
+    "oid": "urn:oid:" + OID_PATTERN,
+    "uuid": r"urn:uuid:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}",
+    "code": r"[^\s]+( [^\s]+)*",
+    "date": _DATE,
+    "dateTime": "{}(T{}{})?".format(_DATE, _TIME, _ZONE),
+    "instant": "{}T{}{}".format(_DATE, _TIME, _ZONE),
+    "time": _TIME,
+    "uri": r"\S*",
+    "url": r"\S*",
+    "canonical": r"\S*",
+}
+
+_MINIMUMS = {"positiveInt": 1, "unsignedInt": 0}
+
+
+def parse_canonical(canonical):
+    """Returns (url, version or None) of a canonical reference like "http://...|1.0" """
+    url, _, version = canonical.partition("|")
+    return url, version or None
+
+
+def _getter(name):
+    """Returns a function, which returns a list of (key, value, index or None) of an element of a JSON object"""
+    if name.endswith("[x]"):
+        prefix = name[:-3]
+
+        def get_choice(container):
+            values = []
+            for key, value in container.items():
+                if key.startswith(prefix) and key[len(prefix):len(prefix) + 1].isupper():
+                    if isinstance(value, list):
+                        values.extend((key, item, index) for index, item in enumerate(value))
+                    elif value is not None:
+                        values.append((key, value, None))
+            return values
+        return get_choice
+
+    def get(container):
+        value = container.get(name)
+        if value is None:
+            return ()
+        if isinstance(value, list):
+            return [(name, item, index) for index, item in enumerate(value)]
+        return ((name, value, None),)
+    return get
+
+
+def _path(location):
+    """Formats a location, which is the resource type or a tuple (parent location, key, index or None)"""
+    if isinstance(location, str):
+        return location
+    parent, key, index = location
+    if index is None:
+        return "{}.{}".format(_path(parent), key)
+    return "{}.{}[{}]".format(_path(parent), key, index)
+
+
+def _matches(value, pattern):
+    """True if value contains everything of pattern (see ElementDefinition.pattern[x])"""
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(_matches(value.get(key), item) for key, item in pattern.items())
+    if isinstance(pattern, list):
+        return isinstance(value, list) and all(any(_matches(item, wanted) for item in value) for wanted in pattern)
+    return value == pattern
+
+
+def _codes(value):
+    """Returns the (system, code) tuples of a code, Coding or CodeableConcept"""
+    if isinstance(value, str):
+        return [(None, value)]
+    if not isinstance(value, dict):
+        return []
+    if "coding" in value:
+        return [(coding.get("system"), coding.get("code")) for coding in value["coding"] if isinstance(coding, dict)]
+    return [(value.get("system"), value.get("code"))]
+
+
+def _type_check(type_code):
+    """Returns a check of the JSON type and format of a value of a data type, or None"""
+    python_type = EXTENSION_VALUE_TYPES.get(type_code[:1].upper() + type_code[1:])
+    if python_type is None:
+        return None
+    pattern = re.compile(PRIMITIVE_PATTERNS[type_code]) if type_code in PRIMITIVE_PATTERNS else None
+    minimum = _MINIMUMS.get(type_code)
+
+    def check(value, location, errors):
+        if not isinstance(value, python_type) or (isinstance(value, bool) and python_type is not bool):
+            errors.append("{}: not a valid {}".format(_path(location), type_code))
+        elif pattern is not None and not pattern.fullmatch(value):
+            errors.append("{}: '{}' is not a valid {}".format(_path(location), value, type_code))
+        elif minimum is not None and value < minimum:
+            errors.append("{}: {} is below the minimum of {}".format(_path(location), value, type_code))
+    return check
+
+
+def _regex(element):
+    for extension in element.get("extension", []) + [extension for type_ in element.get("type", [])
+                                                      for extension in type_.get("extension", [])]:
+        if extension.get("url") == REGEX_EXTENSION:
+            return re.compile(extension["valueString"])
+    return None
+
+
+def _value_checks(name, element):
+    """Returns the checks of one value of an element, as closures (value, location, errors, key)"""
+    checks = []
+    choice = name.endswith("[x]")
+
+    type_codes = [type_["code"] for type_ in element.get("type", []) if "code" in type_]
+    if choice:
+        # the type is given by the key, like valueQuantity
+        prefix = name[:-3]
+        allowed = {code[:1].upper() + code[1:]: _type_check(code) for code in type_codes}
+
+        def check_choice(value, location, errors, key):
+            suffix = key[len(prefix):]
+            if allowed and suffix not in allowed:
+                errors.append("{}: the type {} is not allowed".format(_path(location), suffix))
+            elif allowed.get(suffix) is not None:
+                allowed[suffix](value, location, errors)
+        checks.append(check_choice)
+    elif len(type_codes) == 1 and _type_check(type_codes[0]) is not None:
+        type_check = _type_check(type_codes[0])
+        checks.append(lambda value, location, errors, key: type_check(value, location, errors))
+
+    for key, expected in element.items():
+        if key.startswith("fixed"):
+            def check_fixed(value, location, errors, key, expected=expected):
+                if value != expected:
+                    errors.append("{}: must be {}".format(_path(location), json.dumps(expected)))
+            checks.append(check_fixed)
+        elif key.startswith("pattern"):
+            def check_pattern(value, location, errors, key, expected=expected):
+                if not _matches(value, expected):
+                    errors.append("{}: must match {}".format(_path(location), json.dumps(expected)))
+            checks.append(check_pattern)
+
+    binding = element.get("binding", {})
+    value_set = binding.get("valueSet") or binding.get("valueSetUri") or \
+        binding.get("valueSetReference", {}).get("reference")
+    if binding.get("strength") == "required" and value_set:
+        url, version = parse_canonical(value_set)
+
+        def check_binding(value, location, errors, key):
+            # looked up on every call, as the expansions have their own cache, which knows about changes
+            expansion = expansions.get(url, version)
+            if expansion is None:
+                # unknown ValueSets can't be checked
+                return
+            if not any(code and expansion.lookup(code, system)[0] for system, code in _codes(value)):
+                errors.append("{}: no code of the ValueSet {}".format(_path(location), value_set))
+        checks.append(check_binding)
+
+    regex = _regex(element)
+    if regex is not None:
+        def check_regex(value, location, errors, key):
+            if isinstance(value, str) and not regex.fullmatch(value):
+                errors.append("{}: '{}' doesn't match {}".format(_path(location), value, regex.pattern))
+        checks.append(check_regex)
+
+    max_length = element.get("maxLength")
+    if max_length:
+        def check_length(value, location, errors, key):
+            if isinstance(value, str) and len(value) > max_length:
+                errors.append("{}: longer than {} characters".format(_path(location), max_length))
+        checks.append(check_length)
+    return checks
+
+
+def _compile_node(path, definitions, children):
+    """Compiles the element at path and its children into a closure (container, location, errors).
+
+    Locations are only formatted into strings if there is an error, see _path()."""
+    name = path.rpartition(".")[2]
+    element = definitions.get(path, {})
+    get = _getter(name)
+    minimum = element.get("min", 0)
+    maximum = None if element.get("max", "*") == "*" else int(element["max"])
+    checks = _value_checks(name, element)
+    child_validators = [_compile_node(child, definitions, children) for child in children.get(path, [])]
+
+    def validate(container, location, errors):
+        values = get(container)
+        if len(values) < minimum:
+            errors.append("{}.{}: at least {} required, found {}".format(_path(location), name, minimum, len(values)))
+        if maximum is not None and len(values) > maximum:
+            errors.append("{}.{}: at most {} allowed, found {}".format(_path(location), name, maximum, len(values)))
+        for key, value, index in values:
+            here = (location, key, index)
+            for check in checks:
+                check(value, here, errors, key)
+            if child_validators and isinstance(value, dict):
+                for child in child_validators:
+                    child(value, here, errors)
+    return validate
+
+
+class CompiledProfile:
+    """The validator of one StructureDefinition version"""
+
+    __slots__ = ("url", "version", "type", "_validators")
+
+    def __init__(self, url, version, type, elements):
+        definitions = {}
+        children = {}
+        for element in elements:
+            path = element["path"]
+            if element.get("sliceName") or ":" in element.get("id", ""):
+                continue
+            definitions[path] = element
+            # intermediate elements without a definition get a node, too
+            while "." in path:
+                parent = path.rpartition(".")[0]
+                if path not in children.setdefault(parent, []):
+                    children[parent].append(path)
+                path = parent
+        self.url = url
+        self.version = version
+        self.type = type or next(iter(definitions), "").partition(".")[0]
+        self._validators = [_compile_node(path, definitions, children) for path in children.get(self.type, [])]
+
+    def validate(self, data):
+        """Returns a list of error messages for a resource (as FHIR dict), empty if it conforms to the profile"""
+        if self.type and data.get("resourceType") != self.type:
+            return ["{}: the profile {} is for {} resources".format(data.get("resourceType"), self.url, self.type)]
+        errors = []
+        for validator in self._validators:
+            validator(data, self.type, errors)
+        return errors
+
+
+def compile_profile(structure_definition):
+    """Compiles the differential of a StructureDefinition into a CompiledProfile"""
+    return CompiledProfile(structure_definition.url, structure_definition.version, structure_definition.type,
+                           json.loads(structure_definition.differential) if structure_definition.differential else [])
+
+
+def _load_profile(url, version):
+    queryset = StructureDefinition.objects.filter(url=url)
+    if version:
+        queryset = queryset.filter(version=version)
+    instance = queryset.order_by("-lastUpdated").first()
+    return compile_profile(instance) if instance is not None else None
+
+
+class ProfileCache(TimedLRUCache):
+    """A bounded LRU cache of compiled profiles, keyed by (url, version).
+
+    Like the ExpansionCache, it lives in process memory, and is cleared by the signal handlers
+    whenever a StructureDefinition is changed in this process. Changes made by other processes
+    are picked up when the entries expire, after MEDUX_PROFILE_CACHE_TIMEOUT seconds - or after
+    UNKNOWN_TIMEOUT seconds for profiles that weren't found."""
+
+    def __init__(self, maxsize=None, timeout=None):
+        maxsize = maxsize or getattr(settings, "MEDUX_PROFILE_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+        if timeout is None:
+            timeout = getattr(settings, "MEDUX_PROFILE_CACHE_TIMEOUT", DEFAULT_CACHE_TIMEOUT)
+        super().__init__(_load_profile, maxsize, timeout, unknown_timeout=UNKNOWN_TIMEOUT)
+
+    def get(self, url, version=None):
+        """Returns the CompiledProfile of a StructureDefinition, or None if it is unknown.
+
+        Without version, the most recently updated version is used."""
+        return super().get(url, version or None)
+
+
+profiles = ProfileCache()
+
+
+def validate_resource(data, canonicals=None):
+    """Validates a resource (as FHIR dict) against profiles, by default those in its meta.profile.
+
+    Returns a list of error messages, empty if the resource is valid. Profiles that aren't known
+    to this server are skipped."""
+    if canonicals is None:
+        canonicals = data.get("meta", {}).get("profile", [])
+    errors = []
+    for canonical in canonicals:
+        profile = profiles.get(*parse_canonical(canonical))
+        if profile is not None:
+            errors.extend(profile.validate(data))
+    return errors
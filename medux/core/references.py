@@ -0,0 +1,283 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import re
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, models
+from django.db.models.query import ModelIterable
+
+from medux.core.fields import ReferenceField
+
+# Resolving of Reference.references strings (like "Organization/123") into model instances.
+# http://hl7.org/fhir/references.html
+#
+# This module is imported by the models, so it must not import them at module level.
+
+__all__ = ["ParsedReference", "ReferenceQuerySet", "create_id_indexes", "id_values", "parse_reference",
+           "prefetch_references", "resolve_reference", "resolve_references", "resource_type_names"]
+
+logger = logging.getLogger(__name__)
+
+_REFERENCE_RE = re.compile(ReferenceField.fhir_server_abs_url_conformance)
+
+
+class ParsedReference:
+    __slots__ = ("base", "resource_type", "id", "version")
+
+    def __init__(self, base, resource_type, id, version):
+        self.base = base
+        self.resource_type = resource_type
+        self.id = id
+        self.version = version
+
+    def __repr__(self):
+        return "<ParsedReference {}/{}>".format(self.resource_type, self.id)
+
+
+def parse_reference(reference):
+    """Parses a literal reference, and returns a ParsedReference, or None if it's no valid reference"""
+    if not reference:
+        return None
+    match = _REFERENCE_RE.fullmatch(reference)
+    if match is None:
+        return None
+    return ParsedReference(match.group(1) or "", match.group(4), match.group(5), match.group(7))
+
+
+def _is_local(parsed):
+    """True if the reference points to a resource on this server.
+
+    Relative references always do, absolute ones only if they start with MEDUX_FHIR_BASE_URL."""
+    if not parsed.base:
+        return True
+    base_url = getattr(settings, "MEDUX_FHIR_BASE_URL", None)
+    return bool(base_url) and parsed.base.rstrip("/") == base_url.rstrip("/")
+
+
+def _resource_types():
+    # fhir imports the models, so we can't do that at module level
+    from medux.core.fhir import RESOURCE_TYPES
+    return RESOURCE_TYPES
+
+
+def resource_type_names(target):
+    """Returns the FHIR resource type names for a ReferenceField target (model, model name, or FHIR types)"""
+    if not isinstance(target, str):
+        targets = [target]
+    else:
+        targets = []
+        for name in target.split("|"):
+            try:
+                targets.append(apps.get_model(name if "." in name else "core." + name))
+            except LookupError:
+                targets.append(name)
+
+    names = []
+    for target in targets:
+        if isinstance(target, str):
+            names.append(target)
+            continue
+        for name, model in _resource_types().items():
+            if model is target:
+                names.append(name)
+                break
+        else:
+            names.append(target.__name__)
+    return names
+
+
+def id_values(model, ids):
+    """Converts the ids to the type of the model's id field, dropping those that can't match"""
+    field = model._meta.get_field("id")
+    values = set()
+    for value in ids:
+        try:
+            values.add(field.to_python(value))
+        except ValidationError:
+            pass
+    return values
+
+
+def _recorded_versions(resource_type, versions):
+    """Returns {id: [version, ...]} for those of the (id, version) tuples whose version is recorded
+    in the history of the resource"""
+    # the models import this module
+    from medux.core.models import ResourceVersion
+
+    versions = {(resource_id, version) for resource_id, version in versions if version.isdigit()}
+    if not versions:
+        return {}
+    recorded = set(ResourceVersion.objects.filter(
+        resource_type=resource_type, resource_id__in={resource_id for resource_id, _ in versions},
+        version__in={int(version) for _, version in versions}).exclude(method="delete")
+        .values_list("resource_id", "version"))
+    result = defaultdict(list)
+    for resource_id, version in versions:
+        if (resource_id, int(version)) in recorded:
+            result[resource_id].append(version)
+    return result
+
+
+def _load_resources(parsed_references):
+    """Loads the resources of a list of ParsedReferences, with one query per resource type
+    (and one more for the types with version specific references).
+
+    Returns a dict {(resource type, id, version): instance}
+
+    Version specific references ("Patient/1/_history/2") use the version numbers of the history
+    (medux.core.history), which are the meta.versionId of the API. They resolve if that version
+    was recorded, to the model instance - which holds the current version of the resource."""
+    ids = defaultdict(set)
+    versions = defaultdict(set)
+    for parsed in parsed_references:
+        if parsed.resource_type in _resource_types() and _is_local(parsed):
+            ids[parsed.resource_type].add(parsed.id)
+            if parsed.version:
+                versions[parsed.resource_type].add((parsed.id, parsed.version))
+
+    loaded = {}
+    for resource_type, values in ids.items():
+        model = _resource_types()[resource_type]
+        recorded = _recorded_versions(resource_type, versions[resource_type])
+        for instance in model._default_manager.filter(id__in=id_values(model, values)):
+            resource_id = str(instance.id)
+            loaded[(resource_type, resource_id, None)] = instance
+            for version in recorded.get(resource_id, ()):
+                loaded[(resource_type, resource_id, version)] = instance
+    return loaded
+
+
+def _lookup(loaded, parsed):
+    if parsed is None:
+        return None
+    return loaded.get((parsed.resource_type, parsed.id, parsed.version))
+
+
+def resolve_reference(reference):
+    """Returns the model instance a reference string points to, or None.
+
+    None is returned for references to resources on other servers, resource types that MedUX
+    doesn't store yet, and resources which don't exist."""
+    parsed = parse_reference(reference)
+    if parsed is None:
+        return None
+    return _lookup(_load_resources([parsed]), parsed)
+
+
+def resolve_references(references):
+    """Like resolve_reference(), for a list of reference strings, with one query per resource type.
+
+    Returns a list of model instances (or None), in the order of references."""
+    parsed_references = [parse_reference(reference) for reference in references]
+    loaded = _load_resources(parsed for parsed in parsed_references if parsed is not None)
+    return [_lookup(loaded, parsed) for parsed in parsed_references]
+
+
+def _collect(obj, path):
+    """Yields the objects at the end of a lookup path like "identifier__assigner".
+
+    The path must have been loaded before, with select_related() or prefetch_related()."""
+    if obj is None:
+        return
+    if not path:
+        yield obj
+        return
+    value = getattr(obj, path[0])
+    if isinstance(value, models.Manager):
+        for related in value.all():
+            yield from _collect(related, path[1:])
+    else:
+        yield from _collect(value, path[1:])
+
+
+def prefetch_references(instances, *lookups):
+    """Resolves the references of many objects with one query per referred resource type.
+
+    :param instances: a list of model instances
+    :param lookups: paths to ReferenceFields, like "managingOrganisation" or "identifier__assigner"
+
+    Afterwards, ``reference.resource`` doesn't query the database any more.
+    """
+    if not instances:
+        return
+    # load the Reference objects themselves (one query per lookup), and then all referred
+    # resources, grouped by resource type
+    models.prefetch_related_objects(instances, *lookups)
+    references = [reference for lookup in lookups
+                  for instance in instances
+                  for reference in _collect(instance, lookup.split("__"))]
+    loaded = _load_resources(reference.parsed for reference in references if reference.parsed)
+    for reference in references:
+        reference._resource = _lookup(loaded, reference.parsed)
+
+
+class ReferenceQuerySet(models.QuerySet):
+    """QuerySet for models with ReferenceFields, which can resolve them in bulk"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reference_lookups = ()
+
+    def prefetch_references(self, *lookups):
+        """Resolves the given ReferenceFields of all results when the QuerySet is evaluated.
+
+        Rendering a page of 100 patients with their managing organisations then takes one query
+        for the patients, one for their Reference objects, and one for all the Organisations."""
+        clone = self._chain() if hasattr(self, "_chain") else self._clone()
+        clone._reference_lookups = self._reference_lookups + lookups
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super()._clone(*args, **kwargs)
+        clone._reference_lookups = self._reference_lookups
+        return clone
+
+    def _fetch_all(self):
+        resolve = self._result_cache is None and self._reference_lookups and self._iterable_class is ModelIterable
+        super()._fetch_all()
+        if resolve:
+            prefetch_references(self._result_cache, *self._reference_lookups)
+
+
+def create_id_indexes(using_connection):
+    """Creates the index of the resources' id column, in databases created before it was added.
+
+    New databases get it with their tables. Fails silently (with a warning in the log) if it can't
+    be created - resolving references is just slower then."""
+    # models imports this module
+    from medux.core.models import Resource
+
+    # the model of the table with the id column: Resource itself, or each resource type in the flat layout
+    tables = {model._meta.get_field("id").model for model in apps.get_app_config("core").get_models()
+              if issubclass(model, Resource)}
+    for model in tables:
+        field = model._meta.get_field("id")
+        with using_connection.cursor() as cursor:
+            constraints = using_connection.introspection.get_constraints(cursor, model._meta.db_table)
+        if any(constraint["index"] and constraint["columns"] == [field.column] for constraint in constraints.values()):
+            continue
+        try:
+            with using_connection.schema_editor() as editor:
+                editor.execute(editor._create_index_sql(model, fields=[field]))
+        except DatabaseError:
+            logger.warning("Could not create the id index of %s", model._meta.db_table, exc_info=True)
@@ -0,0 +1,155 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# Cache of rendered resources for the read interaction, see medux.core.views.read.
+#
+# Entries are keyed by resource type, id and variant (e.g. "" for the complete resource, or the
+# _summary mode), and hold the content of one version. A lookup passes the current versionId,
+# which the view gets from an indexed query anyway, so a changed resource never gets a stale
+# answer: its old entry just doesn't match, and is replaced by the new version on the next read.
+# Nothing needs to be invalidated when resources are written.
+
+__all__ = ["FileSystemResponseCache", "LocalMemoryResponseCache", "ResponseCache", "get_response_cache"]
+
+DEFAULT_CACHE_SIZE = 1000
+
+BACKENDS = {
+    "memory": "medux.core.response_cache.LocalMemoryResponseCache",
+    "filesystem": "medux.core.response_cache.FileSystemResponseCache",
+}
+
+
+class ResponseCache:
+    """Base class of the response caches, see MEDUX_RESPONSE_CACHE"""
+
+    def get(self, resource_type, resource_id, version_id, variant=""):
+        """Returns the cached content of that version of a resource, or None"""
+        raise NotImplementedError
+
+    def set(self, resource_type, resource_id, version_id, content, variant=""):
+        """Stores the content of a version of a resource, replacing that of older versions"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalMemoryResponseCache(ResponseCache):
+    """A bounded LRU cache in process memory, so each worker process has its own"""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or getattr(settings, "MEDUX_RESPONSE_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, resource_type, resource_id, version_id, variant=""):
+        key = (resource_type, resource_id, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version_id:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, resource_type, resource_id, version_id, content, variant=""):
+        with self._lock:
+            self._entries[(resource_type, resource_id, variant)] = (version_id, content)
+            self._entries.move_to_end((resource_type, resource_id, variant))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSystemResponseCache(ResponseCache):
+    """Stores the entries as files below a root directory, shared by all processes of a host.
+
+    Each file starts with the versionId in its first line. Files are written to a temporary file
+    first and then renamed, so readers never see a partially written entry."""
+
+    def __init__(self, root=None):
+        self.root = root or getattr(settings, "MEDUX_RESPONSE_CACHE_ROOT", None)
+        if not self.root:
+            raise ImproperlyConfigured("MEDUX_RESPONSE_CACHE_ROOT must be set to the directory of the cache")
+
+    def path(self, resource_type, resource_id, variant):
+        # hashed, as ids may be "." or ".."
+        key = hashlib.sha1("{}/{}/{}".format(resource_type, resource_id, variant).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, resource_type, resource_id, version_id, variant=""):
+        try:
+            with open(self.path(resource_type, resource_id, variant), encoding="utf-8") as f:
+                if f.readline().rstrip("\n") != version_id:
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, resource_type, resource_id, version_id, content, variant=""):
+        path = self.path(resource_type, resource_id, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".entry-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as temp:
+                temp.write(version_id + "\n")
+                temp.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def clear(self):
+        if not os.path.isdir(self.root):
+            return
+        for directory in os.listdir(self.root):
+            directory = os.path.join(self.root, directory)
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+
+
+_cache = None
+
+
+def get_response_cache():
+    """Returns the ResponseCache configured with MEDUX_RESPONSE_CACHE, or None if it is disabled.
+
+    MEDUX_RESPONSE_CACHE is "memory", "filesystem", or the dotted path of a ResponseCache subclass."""
+    global _cache
+    backend = getattr(settings, "MEDUX_RESPONSE_CACHE", None)
+    if not backend:
+        return None
+    if _cache is None:
+        _cache = import_string(BACKENDS.get(backend, backend))()
+    return _cache
@@ -0,0 +1,341 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from inspect import isawaitable
+
+import graphene
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from graphene.validation import depth_limit_validator
+from graphql import ExecutionResult, GraphQLError, execute, parse, specified_rules, validate
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode, IntValueNode
+from graphql.validation import ValidationRule
+
+from medux.core import models
+from medux.core.fhir import resource_id
+from medux.core.loaders import Loaders
+
+# GraphQL API over the FHIR models, see http://hl7.org/fhir/graphql.html
+#
+# The element names are the FHIR ones, like in medux.core.fhir. Related objects are never
+# loaded by the resolvers themselves, but by the DataLoaders of medux.core.loaders: a query
+# for 100 patients with their names, identifiers and identifier assigners needs one query
+# per level, not one per patient.
+
+__all__ = ["DEFAULT_PAGE_SIZE", "MAX_PAGE_SIZE", "Context", "complexity_limit_validator", "execute_query",
+           "schema"]
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# fields that return a page of resources, with "first" and "after" arguments
+PAGED_FIELDS = ("patients", "organizations")
+
+
+class Context:
+    """The context_value of a GraphQL query: the request, and its DataLoaders"""
+
+    def __init__(self, request=None):
+        self.request = request
+        self.loaders = Loaders()
+
+
+def _many(model, name):
+    """Returns a resolver for the ManyToManyField name of model"""
+    def resolve(parent, info):
+        return info.context.loaders.many(model, name).load(parent.pk)
+    return resolve
+
+
+def _object(model, attname):
+    """Returns a resolver for a ForeignKey to model, with its column attname"""
+    def resolve(parent, info):
+        pk = getattr(parent, attname)
+        if pk is None:
+            return None
+        return info.context.loaders.object(model).load(pk)
+    return resolve
+
+
+class Period(graphene.ObjectType):
+    start = graphene.DateTime()
+    end = graphene.DateTime()
+
+
+class Coding(graphene.ObjectType):
+    system = graphene.String()
+    version = graphene.String()
+    code = graphene.String()
+    display = graphene.String()
+    user_selected = graphene.Boolean(source="userselected")
+
+
+class CodeableConcept(graphene.ObjectType):
+    coding = graphene.List(Coding, resolver=_many(models.CodeableConcept, "coding"))
+    text = graphene.String()
+
+
+class Reference(graphene.ObjectType):
+    reference = graphene.String(source="references")
+    identifier = graphene.Field(lambda: Identifier, resolver=_object(models.Identifier, "identifier_id"))
+    display = graphene.String()
+    # the referred resource, if it is stored on this server
+    resource = graphene.Field(lambda: Resource)
+
+    @staticmethod
+    async def resolve_resource(reference, info):
+        if not reference.references:
+            return None
+        resource = await info.context.loaders.reference().load(reference.references)
+        return resource if isinstance(resource, (models.Patient, models.Organisation)) else None
+
+
+class Identifier(graphene.ObjectType):
+    use = graphene.String()
+    type = graphene.Field(CodeableConcept, resolver=_object(models.CodeableConcept, "type_id"))
+    system = graphene.String()
+    value = graphene.String()
+    period = graphene.Field(Period)
+    assigner = graphene.Field(Reference, resolver=_object(models.Reference, "assigner_id"))
+
+
+class HumanName(graphene.ObjectType):
+    use = graphene.String()
+    text = graphene.String()
+    family = graphene.String()
+    given = graphene.List(graphene.String)
+
+    @staticmethod
+    def resolve_given(name, info):
+        return name.given.split()
+
+
+class ContactPoint(graphene.ObjectType):
+    system = graphene.String()
+    value = graphene.String()
+    use = graphene.String()
+    rank = graphene.Int()
+    period = graphene.Field(Period)
+
+
+class Address(graphene.ObjectType):
+    use = graphene.String()
+    type = graphene.String()
+    text = graphene.String()
+    line = graphene.List(graphene.String)
+    city = graphene.String()
+    district = graphene.String()
+    state = graphene.String()
+    postal_code = graphene.String(source="postalCode")
+    country = graphene.String()
+    period = graphene.Field(Period)
+
+    @staticmethod
+    def resolve_line(address, info):
+        return [line for line in address.line.split(", ") if line]
+
+
+class ResourceMeta(graphene.ObjectType):
+    """The meta of a resource, from its current ResourceVersion, like in the REST API"""
+
+    class Meta:
+        name = "Meta"
+
+    version_id = graphene.String()
+    last_updated = graphene.DateTime(source="lastUpdated")
+
+    @staticmethod
+    def resolve_version_id(version, info):
+        return str(version.version)
+
+
+class Organization(graphene.ObjectType):
+    id = graphene.ID()
+    meta = graphene.Field(ResourceMeta)
+    identifier = graphene.List(Identifier, resolver=_many(models.Organisation, "identifier"))
+
+    @staticmethod
+    def resolve_id(organisation, info):
+        return resource_id(organisation)
+
+    @staticmethod
+    def resolve_meta(organisation, info):
+        return info.context.loaders.version().load(("Organization", resource_id(organisation)))
+
+
+class Patient(graphene.ObjectType):
+    id = graphene.ID()
+    identifier = graphene.List(Identifier, resolver=_many(models.Patient, "identifier"))
+    active = graphene.Boolean()
+    name = graphene.List(HumanName, resolver=_many(models.Patient, "name"))
+    telecom = graphene.List(ContactPoint, resolver=_many(models.Patient, "telecom"))
+    gender = graphene.String()
+    birth_date = graphene.Date(source="birthdate")
+    deceased_date_time = graphene.DateTime(source="deceased")
+    address = graphene.List(Address, resolver=_many(models.Patient, "address"))
+    multiple_birth_integer = graphene.Int(source="multipleBirth")
+    general_practitioner = graphene.List(Reference)
+    managing_organization = graphene.Field(Reference, resolver=_object(models.Reference, "managingOrganisation_id"))
+
+    @staticmethod
+    def resolve_id(patient, info):
+        return resource_id(patient)
+
+    @staticmethod
+    async def resolve_general_practitioner(patient, info):
+        # the model only has one generalPractitioner, FHIR allows many
+        if patient.generalPractitioner_id is None:
+            return []
+        return [await info.context.loaders.object(models.Reference).load(patient.generalPractitioner_id)]
+
+
+class Resource(graphene.Union):
+    class Meta:
+        types = (Patient, Organization)
+
+    @classmethod
+    def resolve_type(cls, instance, info):
+        return Patient if isinstance(instance, models.Patient) else Organization
+
+
+def _page(queryset, key, first, after):
+    """Returns up to first objects of queryset, ordered by key, starting behind the value after"""
+    first = max(0, min(first, MAX_PAGE_SIZE))
+    queryset = queryset.order_by(key)
+    if after is not None:
+        try:
+            after = queryset.model._meta.get_field(key).to_python(after)
+        except ValidationError:
+            raise GraphQLError("Invalid cursor: {}".format(after))
+        queryset = queryset.filter(**{key + "__gt": after})
+    return list(queryset[:first])
+
+
+def _get(queryset, key, value):
+    try:
+        value = queryset.model._meta.get_field(key).to_python(value)
+    except ValidationError:
+        return None
+    return queryset.filter(**{key: value}).first()
+
+
+class Query(graphene.ObjectType):
+    patient = graphene.Field(Patient, id=graphene.ID(required=True))
+    patients = graphene.List(Patient, first=graphene.Int(default_value=DEFAULT_PAGE_SIZE), after=graphene.ID())
+    organization = graphene.Field(Organization, id=graphene.ID(required=True))
+    organizations = graphene.List(Organization, first=graphene.Int(default_value=DEFAULT_PAGE_SIZE),
+                                  after=graphene.ID())
+
+    @staticmethod
+    async def resolve_patient(root, info, id):
+        return await sync_to_async(_get)(models.Patient.objects.all(), "id", id)
+
+    @staticmethod
+    async def resolve_patients(root, info, first, after=None):
+        return await sync_to_async(_page)(models.Patient.objects.all(), "id", first, after)
+
+    @staticmethod
+    async def resolve_organization(root, info, id):
+        return await sync_to_async(_get)(models.Organisation.objects.all(), "id", id)
+
+    @staticmethod
+    async def resolve_organizations(root, info, first, after=None):
+        return await sync_to_async(_page)(models.Organisation.objects.all(), "id", first, after)
+
+
+schema = graphene.Schema(query=Query)
+
+
+def _page_size(field):
+    """The maximum number of results of a field, for estimating the complexity of a query"""
+    if field.name.value not in PAGED_FIELDS:
+        # nested lists (names, identifiers...) are short, and loaded with one query per level anyway
+        return 1
+    for argument in field.arguments:
+        if argument.name.value == "first":
+            if isinstance(argument.value, IntValueNode):
+                return max(0, min(int(argument.value.value), MAX_PAGE_SIZE))
+            # a variable, which isn't known yet when validating
+            return MAX_PAGE_SIZE
+    return DEFAULT_PAGE_SIZE
+
+
+def complexity_limit_validator(max_complexity):
+    """Returns a validation rule, which rejects queries that return more than max_complexity values.
+
+    Every field counts as one, multiplied by the page size for the fields in PAGED_FIELDS."""
+
+    class ComplexityLimitValidator(ValidationRule):
+        def enter_operation_definition(self, node, *args):
+            complexity = self.complexity(node.selection_set, frozenset())
+            if complexity > max_complexity:
+                self.report_error(GraphQLError(
+                    "Query is too complex: {} (maximum is {})".format(complexity, max_complexity), [node]))
+
+        def complexity(self, selection_set, fragments):
+            if selection_set is None:
+                return 0
+            result = 0
+            for selection in selection_set.selections:
+                if isinstance(selection, FieldNode):
+                    if selection.name.value.startswith("__"):
+                        continue
+                    result += _page_size(selection) * (1 + self.complexity(selection.selection_set, fragments))
+                elif isinstance(selection, InlineFragmentNode):
+                    result += self.complexity(selection.selection_set, fragments)
+                elif isinstance(selection, FragmentSpreadNode):
+                    name = selection.name.value
+                    fragment = self.context.get_fragment(name)
+                    # cycles are reported by the NoFragmentCycles rule
+                    if fragment is not None and name not in fragments:
+                        result += self.complexity(fragment.selection_set, fragments | {name})
+            return result
+
+    return ComplexityLimitValidator
+
+
+def validation_rules():
+    return tuple(specified_rules) + (
+        depth_limit_validator(getattr(settings, "MEDUX_GRAPHQL_MAX_DEPTH", 10)),
+        complexity_limit_validator(getattr(settings, "MEDUX_GRAPHQL_MAX_COMPLEXITY", 5000)),
+    )
+
+
+async def _execute(document, context, variables, operation_name):
+    result = execute(schema.graphql_schema, document, context_value=context, variable_values=variables,
+                     operation_name=operation_name)
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+def execute_query(query, variables=None, operation_name=None, request=None):
+    """Parses, validates and executes a GraphQL query, and returns the ExecutionResult.
+
+    The DataLoaders need an event loop, so the query is executed in one of its own, with
+    async_to_sync(). Their database queries come back to the calling thread (see
+    medux.core.loaders), so this works the same under WSGI and ASGI."""
+    try:
+        document = parse(query)
+    except GraphQLError as e:
+        return ExecutionResult(data=None, errors=[e])
+    errors = validate(schema.graphql_schema, document, validation_rules())
+    if errors:
+        return ExecutionResult(data=None, errors=errors)
+    return async_to_sync(_execute)(document, Context(request), variables, operation_name)
@@ -0,0 +1,375 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from medux.core.fhir import resource_type as get_resource_type
+from medux.core.models import SearchDate, SearchReference, SearchString, SearchToken
+from medux.core.references import parse_reference
+
+# FHIR search, see http://hl7.org/fhir/search.html
+#
+# When a resource is written, the values of all its search parameters are extracted from its FHIR
+# representation into the index tables SearchString, SearchToken, SearchDate and SearchReference
+# (see medux.core.derived). A search then only reads these indexes, and is paginated by resource id
+# (keyset pagination) instead of OFFSET.
+
+__all__ = ["SEARCH_PARAMETERS", "SearchError", "SearchParameter", "delete_index", "index_resources", "matching_ids",
+           "search", "search_count"]
+
+DEFAULT_COUNT = 50
+MAX_COUNT = 1000
+
+# parameters that control the search, instead of filtering it
+RESULT_PARAMETERS = ("_count", "_cursor", "_format", "_elements", "_summary")
+
+
+class SearchError(ValueError):
+    """Raised for invalid search parameters"""
+
+
+class SearchParameter:
+    """A search parameter of a resource type.
+
+    :param name: the name used in the query string
+    :param type: one of "string", "token", "date", "reference"
+    :param paths: paths to the values in the FHIR JSON, like "name.family". A condition can be given in
+        brackets, e.g. "telecom(system=phone)"
+    :param system: the code system of token values which are plain codes
+    """
+
+    def __init__(self, name, type, paths, system=""):
+        self.name = name
+        self.type = type
+        self.paths = paths
+        self.system = system
+
+    def values(self, data):
+        for path in self.paths:
+            yield from _walk(data, path.split("."))
+
+
+_CONDITION_RE = re.compile(r"^(\w+)\((\w+)=(\w+)\)$")
+
+
+def _walk(data, parts):
+    if isinstance(data, list):
+        for item in data:
+            yield from _walk(item, parts)
+        return
+    if not parts:
+        if data not in (None, ""):
+            yield data
+        return
+    if not isinstance(data, dict):
+        return
+    key, condition = parts[0], None
+    match = _CONDITION_RE.match(key)
+    if match:
+        key, condition = match.group(1), (match.group(2), match.group(3))
+    value = data.get(key)
+    if condition is not None:
+        value = [item for item in (value if isinstance(value, list) else [value])
+                 if isinstance(item, dict) and item.get(condition[0]) == condition[1]]
+    yield from _walk(value, parts[1:])
+
+
+_RESOURCE_PARAMETERS = [
+    SearchParameter("_id", "token", ["id"]),
+    SearchParameter("_lastUpdated", "date", ["meta.lastUpdated"]),
+]
+
+_CONFORMANCE_PARAMETERS = _RESOURCE_PARAMETERS + [
+    SearchParameter("url", "token", ["url"]),
+    SearchParameter("identifier", "token", ["identifier"]),
+    SearchParameter("version", "token", ["version"]),
+    SearchParameter("name", "string", ["name"]),
+    SearchParameter("title", "string", ["title"]),
+    SearchParameter("status", "token", ["status"], system="http://hl7.org/fhir/publication-status"),
+    SearchParameter("publisher", "string", ["publisher"]),
+    SearchParameter("date", "date", ["date"]),
+]
+
+_ADDRESS_PATHS = ["address.line", "address.city", "address.district", "address.state", "address.postalCode",
+                  "address.country", "address.text"]
+
+_PARAMETERS = {
+    "Patient": [
+        # Patient is no Resource model (yet), so it doesn't have a lastUpdated
+        SearchParameter("_id", "token", ["id"]),
+        SearchParameter("identifier", "token", ["identifier"]),
+        SearchParameter("active", "token", ["active"]),
+        SearchParameter("name", "string", ["name.family", "name.given", "name.text"]),
+        SearchParameter("family", "string", ["name.family"]),
+        SearchParameter("given", "string", ["name.given"]),
+        SearchParameter("gender", "token", ["gender"], system="http://hl7.org/fhir/administrative-gender"),
+        SearchParameter("birthdate", "date", ["birthDate"]),
+        SearchParameter("death-date", "date", ["deceasedDateTime"]),
+        SearchParameter("address", "string", _ADDRESS_PATHS),
+        SearchParameter("address-city", "string", ["address.city"]),
+        SearchParameter("address-state", "string", ["address.state"]),
+        SearchParameter("address-postalcode", "string", ["address.postalCode"]),
+        SearchParameter("address-country", "string", ["address.country"]),
+        SearchParameter("telecom", "token", ["telecom"]),
+        SearchParameter("phone", "token", ["telecom(system=phone)"]),
+        SearchParameter("email", "token", ["telecom(system=email)"]),
+        SearchParameter("organization", "reference", ["managingOrganization"]),
+        SearchParameter("general-practitioner", "reference", ["generalPractitioner"]),
+    ],
+    "Organization": _RESOURCE_PARAMETERS + [
+        SearchParameter("identifier", "token", ["identifier"]),
+    ],
+    "ValueSet": _CONFORMANCE_PARAMETERS,
+    "StructureDefinition": _CONFORMANCE_PARAMETERS,
+}
+# resource type -> {name: SearchParameter}
+SEARCH_PARAMETERS = {resource_type: {parameter.name: parameter for parameter in parameters}
+                     for resource_type, parameters in _PARAMETERS.items()}
+
+INDEX_MODELS = {
+    "string": SearchString,
+    "token": SearchToken,
+    "date": SearchDate,
+    "reference": SearchReference,
+}
+
+# Extraction of index values
+
+
+def normalize(value):
+    """Lower case, no accents, no punctuation, single spaces - for case and accent insensitive searches"""
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    value = re.sub(r"[^\w\s]", " ", value.lower())
+    return " ".join(value.split())
+
+
+_MIN = datetime.datetime(1, 1, 1, tzinfo=timezone.utc)
+_MAX = datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc)
+
+_PARTIAL_DATE_RE = re.compile(r"^(\d{4})(-(\d{2}))?(-(\d{2}))?$")
+
+
+def _partial_date_range(year, month, day):
+    if day:
+        low = datetime.datetime(year, int(month), int(day))
+        high = low + datetime.timedelta(days=1)
+    elif month:
+        low = datetime.datetime(year, int(month), 1)
+        high = datetime.datetime(year + int(month) // 12, int(month) % 12 + 1, 1)
+    else:
+        low = datetime.datetime(year, 1, 1)
+        high = datetime.datetime(year + 1, 1, 1)
+    high -= datetime.timedelta(microseconds=1)
+    return timezone.make_aware(low, timezone.utc), timezone.make_aware(high, timezone.utc)
+
+
+def date_range(value):
+    """Returns the (low, high) range of aware datetimes a FHIR date/dateTime/instant covers.
+
+    "1980" covers the whole year, "1980-01-01" the whole day, a dateTime is a single point in time."""
+    match = _PARTIAL_DATE_RE.match(value)
+    if match:
+        try:
+            return _partial_date_range(int(match.group(1)), match.group(3), match.group(5))
+        except ValueError:
+            raise SearchError("Invalid date: {}".format(value))
+    instant = parse_datetime(value)
+    if instant is None:
+        raise SearchError("Invalid date: {}".format(value))
+    if timezone.is_naive(instant):
+        instant = timezone.make_aware(instant, timezone.utc)
+    return instant, instant
+
+
+def _index_rows(resource_type, resource_id, parameter, value):
+    common = {"resource_type": resource_type, "resource_id": resource_id, "param": parameter.name}
+    if parameter.type == "string":
+        if isinstance(value, str):
+            yield SearchString(normalized=normalize(value)[:255], value=value[:255], **common)
+    elif parameter.type == "token":
+        if isinstance(value, bool):
+            yield SearchToken(system="", code="true" if value else "false", **common)
+        elif isinstance(value, str):
+            yield SearchToken(system=parameter.system, code=value[:255], **common)
+        elif "coding" in value:
+            for coding in value["coding"]:
+                if coding.get("code"):
+                    yield SearchToken(system=coding.get("system", ""), code=coding["code"], **common)
+        elif value.get("value") or value.get("code"):
+            yield SearchToken(system=value.get("system", ""), code=value.get("value") or value["code"], **common)
+    elif parameter.type == "date":
+        if isinstance(value, dict):
+            low = date_range(value["start"])[0] if value.get("start") else _MIN
+            high = date_range(value["end"])[1] if value.get("end") else _MAX
+        else:
+            low, high = date_range(value)
+        yield SearchDate(low=low, high=high, **common)
+    elif parameter.type == "reference":
+        parsed = parse_reference(value.get("reference"))
+        if parsed is not None:
+            yield SearchReference(target_type=parsed.resource_type, target_id=parsed.id, **common)
+
+
+def index_resources(model, resources):
+    """(Re)writes the index rows of resources (FHIR dicts) of one model, with a constant number of queries"""
+    resource_type = get_resource_type(model)
+    rows = {index_model: [] for index_model in INDEX_MODELS.values()}
+    for data in resources:
+        for parameter in SEARCH_PARAMETERS[resource_type].values():
+            for value in parameter.values(data):
+                for row in _index_rows(resource_type, data["id"], parameter, value):
+                    rows[type(row)].append(row)
+    with transaction.atomic():
+        delete_index(model, [data["id"] for data in resources])
+        for index_model, index_rows in rows.items():
+            index_model.objects.bulk_create(index_rows)
+
+
+def delete_index(model, resource_ids):
+    resource_type = get_resource_type(model)
+    for index_model in INDEX_MODELS.values():
+        index_model.objects.filter(resource_type=resource_type, resource_id__in=resource_ids).delete()
+
+
+# Searching
+
+def _string_condition(value, modifier):
+    if modifier == "exact":
+        return Q(value=value)
+    if modifier == "contains":
+        return Q(normalized__contains=normalize(value))
+    if modifier:
+        raise SearchError("Unsupported modifier for a string parameter: {}".format(modifier))
+    return Q(normalized__startswith=normalize(value))
+
+
+def _token_condition(value, modifier):
+    if modifier:
+        raise SearchError("Unsupported modifier for a token parameter: {}".format(modifier))
+    if "|" not in value:
+        return Q(code=value)
+    system, code = value.split("|", 1)
+    if not code:
+        return Q(system=system)
+    return Q(system=system, code=code)
+
+
+_DATE_PREFIXES = ("eq", "ne", "lt", "gt", "le", "ge", "sa", "eb", "ap")
+
+
+def _date_condition(value, modifier):
+    if modifier:
+        raise SearchError("Unsupported modifier for a date parameter: {}".format(modifier))
+    prefix = "eq"
+    if value[:2] in _DATE_PREFIXES:
+        prefix, value = value[:2], value[2:]
+    low, high = date_range(value)
+    return {
+        "eq": Q(low__gte=low, high__lte=high),
+        "ne": ~Q(low__gte=low, high__lte=high),
+        "lt": Q(low__lt=low),
+        "gt": Q(high__gt=high),
+        "le": Q(low__lte=high),
+        "ge": Q(high__gte=low),
+        "sa": Q(low__gt=high),
+        "eb": Q(high__lt=low),
+        "ap": Q(low__lte=high, high__gte=low),
+    }[prefix]
+
+
+def _reference_condition(value, modifier):
+    parsed = parse_reference(value)
+    if parsed is not None:
+        if modifier and modifier != parsed.resource_type:
+            raise SearchError("Reference {} doesn't match the modifier :{}".format(value, modifier))
+        return Q(target_type=parsed.resource_type, target_id=parsed.id)
+    if modifier:
+        return Q(target_type=modifier, target_id=value)
+    return Q(target_id=value)
+
+
+_CONDITIONS = {
+    "string": _string_condition,
+    "token": _token_condition,
+    "date": _date_condition,
+    "reference": _reference_condition,
+}
+
+
+def _matching_ids(resource_type, parameter, modifier, values):
+    """Returns a QuerySet of the ids of resources which match any of the values"""
+    condition = Q()
+    for value in values:
+        if not value:
+            raise SearchError("Empty value for the search parameter {}".format(parameter.name))
+        condition |= _CONDITIONS[parameter.type](value, modifier)
+    return INDEX_MODELS[parameter.type].objects.filter(condition, resource_type=resource_type,
+                                                        param=parameter.name).values("resource_id")
+
+
+def _search_queryset(resource_type, params):
+    """Returns a QuerySet of the _id tokens of the matching resources"""
+    parameters = SEARCH_PARAMETERS[resource_type]
+    # every indexed resource has an _id token, so that is the base of every search
+    queryset = SearchToken.objects.filter(resource_type=resource_type, param="_id")
+    for name, value in params:
+        if name in RESULT_PARAMETERS:
+            continue
+        name, _, modifier = name.partition(":")
+        if name not in parameters:
+            raise SearchError("Unknown search parameter for {}: {}".format(resource_type, name))
+        queryset = queryset.filter(code__in=_matching_ids(resource_type, parameters[name], modifier,
+                                                          value.split(",")))
+    return queryset
+
+
+def search(resource_type, params, count=DEFAULT_COUNT, cursor=None):
+    """Searches resources of a type.
+
+    :param params: list of (name, value) tuples from the query string. Several values for the same name
+        must all match, comma separated values are alternatives.
+    :param cursor: the last resource id of the previous page
+    :returns: (list of resource ids, cursor of the next page or None)
+    """
+    count = max(1, min(count, MAX_COUNT))
+    queryset = _search_queryset(resource_type, params)
+    if cursor:
+        queryset = queryset.filter(code__gt=cursor)
+
+    ids = list(queryset.order_by("code").values_list("code", flat=True)[:count + 1])
+    next_cursor = ids[count - 1] if len(ids) > count else None
+    return ids[:count], next_cursor
+
+
+def matching_ids(resource_type, params, resource_ids):
+    """Returns the set of those resource_ids whose resources match the search, e.g. for Subscription criteria"""
+    return set(_search_queryset(resource_type, params).filter(code__in=resource_ids)
+               .values_list("code", flat=True))
+
+
+def search_count(resource_type, params):
+    """Returns the number of resources matching the search, for _summary=count"""
+    return _search_queryset(resource_type, params).count()
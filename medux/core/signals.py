@@ -0,0 +1,100 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from medux.core.code_search import code_index
+from medux.core.derived import (affects_derived, delete_resources, dependency_paths, refresh_dependents,
+                                refresh_resources)
+from medux.core.fhir import SERIALIZERS, resource_id
+from medux.core.models import Coding, StructureDefinition, ValueSet
+from medux.core.profiles import profiles
+from medux.core.terminology import expansions
+
+# Signal handlers of the core app, connected in CoreConfig.ready()
+
+
+@receiver(post_save, sender=ValueSet)
+@receiver(post_delete, sender=ValueSet)
+@receiver(post_save, sender=Coding)
+@receiver(post_delete, sender=Coding)
+@receiver(m2m_changed, sender=ValueSet.expansion.through)
+def clear_expansions(sender, **kwargs):
+    expansions.clear()
+
+
+@receiver(post_save, sender=StructureDefinition)
+@receiver(post_delete, sender=StructureDefinition)
+def clear_profiles(sender, **kwargs):
+    profiles.clear()
+
+
+# the index must not show changes which are rolled back, and the database has to have them when the
+# index is refreshed or rebuilt
+
+@receiver(post_save, sender=Coding)
+def update_code_index(sender, instance, raw=False, using=None, **kwargs):
+    transaction.on_commit(lambda: code_index.update(instance), using=using)
+
+
+@receiver(post_delete, sender=Coding)
+def remove_from_code_index(sender, instance, using=None, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: code_index.remove(pk), using=using)
+
+
+@receiver(post_save)
+def refresh_derived(sender, instance, raw=False, **kwargs):
+    if not raw and affects_derived(sender):
+        refresh_dependents(instance)
+
+
+@receiver(pre_delete)
+def remember_resource_owners(sender, instance, **kwargs):
+    # after deleting, we can't find out any more which resources contained the element
+    if affects_derived(sender) and sender not in SERIALIZERS:
+        instance._resource_owners = [(model, list(model.objects.filter(**{lookup: instance.pk})
+                                                  .values_list("pk", flat=True)))
+                                     for model, lookup in dependency_paths(sender)]
+
+
+@receiver(post_delete)
+def delete_derived(sender, instance, **kwargs):
+    if not affects_derived(sender):
+        return
+    if sender in SERIALIZERS:
+        delete_resources(sender, [resource_id(instance)])
+    for model, pks in getattr(instance, "_resource_owners", []):
+        refresh_resources(model, pks)
+
+
+@receiver(m2m_changed)
+def refresh_m2m_derived(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action == "pre_clear" and reverse and model in SERIALIZERS:
+        field = next(field for field in model._meta.many_to_many if field.remote_field.through is sender)
+        instance._resource_owners = [(model, list(sender.objects.filter(
+            **{field.m2m_reverse_field_name(): instance.pk}).values_list(field.m2m_field_name() + "_id", flat=True)))]
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse and model in SERIALIZERS:
+        pks = pk_set if action != "post_clear" else dict(getattr(instance, "_resource_owners", [])).get(model, [])
+        refresh_resources(model, pks)
+    elif affects_derived(type(instance)):
+        refresh_dependents(instance)
@@ -0,0 +1,115 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler, ASGIRequest
+
+# Content of streaming responses (NDJSON exports, attachments, $everything), for WSGI and ASGI servers.
+#
+# Under WSGI, a worker is busy until the client has received the last byte anyway, so the
+# chunks are read synchronously. Under ASGI (medux.asgi), many responses are sent by one event
+# loop, and Django's handler would read the chunks right in the loop - blocking it while a file
+# is read, and failing with SynchronousOnlyOperation if a chunk queries the database. MedUX's
+# ASGIHandler reads every chunk in the thread pool instead, so a slow client holds neither a
+# worker nor the loop. Chunks that are read from the database have to be produced in the thread
+# of the sync views, where the connection lives (thread_sensitive).
+
+__all__ = ["ASGIHandler", "DEFAULT_CHUNK_SIZE", "get_asgi_application", "iter_file", "streaming_content"]
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_END = object()
+
+
+def iter_file(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields the content of a file in chunks"""
+    with open(path, "rb") as stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class _Chunks:
+    """An iterator over the chunks of a response, which tells the ASGIHandler where to read them"""
+
+    def __init__(self, chunks, thread_sensitive):
+        self.chunks = iter(chunks)
+        self.thread_sensitive = thread_sensitive
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def streaming_content(request, chunks, thread_sensitive=False):
+    """Returns the streaming_content of a StreamingHttpResponse for an iterable of chunks
+
+    :param thread_sensitive: True if producing the chunks queries the database
+    """
+    if isinstance(request, ASGIRequest):
+        return _Chunks(chunks, thread_sensitive)
+    return chunks
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """Django's ASGI handler, which reads the chunks of streaming responses in the thread pool"""
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        # the StreamingHttpResponse keeps the iterator it was given
+        content = getattr(response, "_iterator", None)
+        thread_sensitive = content.thread_sensitive if isinstance(content, _Chunks) else True
+
+        headers = [(header.encode("ascii") if isinstance(header, str) else header,
+                    value.encode("latin1") if isinstance(value, str) else value)
+                   for header, value in response.items()]
+        headers += [(b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+                    for cookie in response.cookies.values()]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+
+        # iterating the response makes bytes of the chunks
+        next_part = sync_to_async(next, thread_sensitive=thread_sensitive)
+        parts = iter(response)
+        try:
+            while True:
+                part = await next_part(parts, _END)
+                if part is _END:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body"})
+        finally:
+            # also if the client went away, this closes the files and cursors of the chunks
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    """Like django.core.asgi.get_asgi_application(), with MedUX's ASGIHandler"""
+    import django
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,201 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import logging
+import os
+import tempfile
+import urllib.request
+from urllib.parse import parse_qsl
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from medux.core.fhir import RESOURCE_TYPES
+from medux.core.history import changes, history_bundle, history_entry, latest_cursor
+from medux.core.models import Subscription
+from medux.core.search import RESULT_PARAMETERS, SEARCH_PARAMETERS, matching_ids
+
+# Delivery of FHIR Subscription notifications, see http://hl7.org/fhir/subscription.html
+#
+# Every write of a resource appends a ResourceVersion (medux.core.history), in the same
+# transaction. That table is the change log: a Subscription keeps the pk of the last version it
+# delivered as cursor, and the worker ("manage.py deliver_subscriptions") sends the versions
+# after it in batches, as "history" Bundles. The cursor is only moved after a batch was
+# delivered, so every change is delivered at least once - consumers should skip versions they
+# have seen already (by their ETag). As the pks of concurrent transactions aren't in the order
+# of their commits, versions are only delivered after MEDUX_CHANGE_FEED_DELAY seconds, when the
+# transactions which recorded the versions before them have committed (see history.changes()).
+
+__all__ = ["DeliveryError", "QueueSink", "RestHookSink", "SINKS", "deliver", "deliver_all", "parse_criteria"]
+
+logger = logging.getLogger(__name__)
+
+FHIR_JSON = "application/fhir+json"
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_FAILURES = 10
+# failed deliveries are retried after 2, 4, 8... seconds, but at least once an hour
+MAX_RETRY_DELAY = 3600
+TIMEOUT = 10
+
+
+class DeliveryError(Exception):
+    """Raised by a sink if a notification couldn't be delivered"""
+
+
+class RestHookSink:
+    """POSTs the notification to the endpoint URL, with the headers of the Subscription"""
+
+    def send(self, subscription, content, cursor):
+        request = urllib.request.Request(subscription.endpoint, data=content.encode("utf-8"), method="POST",
+                                         headers={"Content-Type": FHIR_JSON})
+        for line in subscription.header.splitlines():
+            name, _, value = line.partition(":")
+            if name.strip():
+                request.add_header(name.strip(), value.strip())
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                response.read()
+        except (OSError, ValueError) as e:
+            # URLError and HTTPError (for non-2xx responses) are OSErrors
+            raise DeliveryError("{}: {}".format(subscription.endpoint, e))
+
+
+class QueueSink:
+    """Writes the notification as file into the endpoint directory.
+
+    The files are named by the cursor, so they sort in the order of the changes. They are written
+    to a temporary file first and then renamed, so a consumer never sees a partial file."""
+
+    def send(self, subscription, content, cursor):
+        try:
+            os.makedirs(subscription.endpoint, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=subscription.endpoint, prefix=".notification-")
+            with os.fdopen(fd, "w", encoding="utf-8") as temp:
+                temp.write(content)
+            os.replace(temp_path, os.path.join(subscription.endpoint, "{:020d}.json".format(cursor)))
+        except OSError as e:
+            raise DeliveryError("{}: {}".format(subscription.endpoint, e))
+
+
+SINKS = {
+    "rest-hook": RestHookSink,
+    "queue": QueueSink,
+}
+
+
+def parse_criteria(criteria):
+    """Returns (resource type, list of search parameters) of a Subscription's criteria, like "Patient?gender=male".
+
+    Raises ValueError if the criteria can't be evaluated."""
+    resource_type, _, query = criteria.strip().partition("?")
+    if resource_type not in RESOURCE_TYPES:
+        raise ValueError("Unknown resource type in criteria: {}".format(resource_type))
+    params = parse_qsl(query, keep_blank_values=True)
+    for name, _ in params:
+        if name in RESULT_PARAMETERS or name.partition(":")[0] not in SEARCH_PARAMETERS[resource_type]:
+            raise ValueError("Unsupported search parameter in criteria: {}".format(name))
+    return resource_type, params
+
+
+def _full_url(version):
+    base_url = getattr(settings, "MEDUX_FHIR_BASE_URL", None)
+    url = "{}/{}".format(version.resource_type, version.resource_id)
+    return "{}/{}".format(base_url.rstrip("/"), url) if base_url else url
+
+
+def deliver(subscription, batch_size=DEFAULT_BATCH_SIZE):
+    """Sends the changes after the cursor of a subscription to its channel, and returns their number.
+
+    Raises DeliveryError if the channel fails; the cursor stays behind the last delivered batch then."""
+    resource_type, params = parse_criteria(subscription.criteria)
+    sink = SINKS[subscription.channel_type]()
+    with_resources = bool(subscription.payload)
+    delivered = 0
+    while True:
+        versions, cursor = changes(subscription.cursor, [resource_type], batch_size, content=with_resources)
+        if not versions:
+            return delivered
+        complete = len(versions) < batch_size
+        if params:
+            # evaluated against the current state; deleted resources don't match any search
+            matching = matching_ids(resource_type, params, {version.resource_id for version in versions})
+            versions = [version for version in versions if version.resource_id in matching]
+        if versions:
+            entries = [history_entry(version, _full_url(version), with_resources) for version in versions]
+            sink.send(subscription, history_bundle(entries, []), cursor)
+            subscription.delivered = timezone.now()
+        subscription.cursor = cursor
+        subscription.save(update_fields=["cursor", "delivered"])
+        delivered += len(versions)
+        if complete:
+            return delivered
+
+
+def _activate(subscription):
+    """Activates a requested Subscription, which gets the changes from now on"""
+    try:
+        parse_criteria(subscription.criteria)
+        if subscription.channel_type not in SINKS:
+            raise ValueError("Unsupported channel type: {}".format(subscription.channel_type))
+    except ValueError as e:
+        subscription.status = "error"
+        subscription.error = str(e)
+    else:
+        subscription.status = "active"
+        if subscription.cursor is None:
+            subscription.cursor = latest_cursor()
+    subscription.save(update_fields=["status", "error", "cursor"])
+
+
+def deliver_all(batch_size=DEFAULT_BATCH_SIZE):
+    """Activates requested Subscriptions, and delivers the pending changes of all active ones.
+
+    Returns the number of delivered changes. Subscriptions are switched off at their end time, and
+    set to "error" after MEDUX_SUBSCRIPTION_MAX_FAILURES consecutive failed deliveries."""
+    now = timezone.now()
+    for subscription in Subscription.objects.filter(status="requested"):
+        _activate(subscription)
+    Subscription.objects.filter(status="active", end__lte=now).update(status="off")
+
+    head = latest_cursor()
+    max_failures = getattr(settings, "MEDUX_SUBSCRIPTION_MAX_FAILURES", DEFAULT_MAX_FAILURES)
+    delivered = 0
+    # subscriptions which are up to date don't need any query
+    for subscription in Subscription.objects.filter(status="active", cursor__lt=head).filter(
+            Q(retry_after__isnull=True) | Q(retry_after__lte=now)):
+        try:
+            delivered += deliver(subscription, batch_size)
+        except DeliveryError as e:
+            logger.warning("Delivery of Subscription %s failed: %s", subscription.pk, e)
+            subscription.failures += 1
+            subscription.error = str(e)
+            subscription.retry_after = now + datetime.timedelta(
+                seconds=min(2 ** subscription.failures, MAX_RETRY_DELAY))
+            if subscription.failures >= max_failures:
+                subscription.status = "error"
+            subscription.save(update_fields=["failures", "error", "retry_after", "status"])
+        else:
+            if subscription.failures:
+                subscription.failures = 0
+                subscription.error = ""
+                subscription.retry_after = None
+                subscription.save(update_fields=["failures", "error", "retry_after"])
+    return delivered
@@ -0,0 +1,191 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf import settings
+from django.db.models import Q
+
+from medux.core.caches import TimedLRUCache
+from medux.core.fields import NARRATIVE_STATUS, CodeField
+from medux.core.models import IDENTIFIER_USE, PUBLICATION_STATUS, ValueSet
+
+__all__ = ["BUILTIN_VALUE_SETS", "Expansion", "ExpansionCache", "expansions", "validate_codes"]
+
+# Expansions of the FHIR ValueSets our CodeFields are bound to. They are used as long as there is
+# no ValueSet with that name or URL in the database, so that codes can be validated out of the box.
+# name: (ValueSet url, CodeSystem url, codes)
+BUILTIN_VALUE_SETS = {
+    "AdministrativeGender": (
+        "http://hl7.org/fhir/ValueSet/administrative-gender", "http://hl7.org/fhir/administrative-gender", (
+            ("male", "Male"),
+            ("female", "Female"),
+            ("other", "Other"),
+            ("unknown", "Unknown"),
+        )),
+    "ContactPointSystem": (
+        "http://hl7.org/fhir/ValueSet/contact-point-system", "http://hl7.org/fhir/contact-point-system", (
+            ("phone", "Phone"),
+            ("fax", "Fax"),
+            ("email", "Email"),
+            ("pager", "Pager"),
+            ("url", "URL"),
+            ("sms", "SMS"),
+            ("other", "Other"),
+        )),
+    "ContactPointUse": (
+        "http://hl7.org/fhir/ValueSet/contact-point-use", "http://hl7.org/fhir/contact-point-use", (
+            ("home", "Home"),
+            ("work", "Work"),
+            ("temp", "Temp"),
+            ("old", "Old"),
+            ("mobile", "Mobile"),
+        )),
+    "NameUse": (
+        "http://hl7.org/fhir/ValueSet/name-use", "http://hl7.org/fhir/name-use", (
+            ("usual", "Usual"),
+            ("official", "Official"),
+            ("temp", "Temp"),
+            ("nickname", "Nickname"),
+            ("anonymous", "Anonymous"),
+            ("old", "Old"),
+            ("maiden", "Name changed for Marriage"),
+        )),
+    "AddressUse": (
+        "http://hl7.org/fhir/ValueSet/address-use", "http://hl7.org/fhir/address-use", (
+            ("home", "Home"),
+            ("work", "Work"),
+            ("temp", "Temporary"),
+            ("old", "Old / Incorrect"),
+        )),
+    "AddressType": (
+        "http://hl7.org/fhir/ValueSet/address-type", "http://hl7.org/fhir/address-type", (
+            ("postal", "Postal"),
+            ("physical", "Physical"),
+            ("both", "Postal & Physical"),
+        )),
+    "IdentifierUse": (
+        "http://hl7.org/fhir/ValueSet/identifier-use", "http://hl7.org/fhir/identifier-use", IDENTIFIER_USE),
+    "PublicationStatus": (
+        "http://hl7.org/fhir/ValueSet/publication-status", "http://hl7.org/fhir/publication-status",
+        PUBLICATION_STATUS),
+    "NarrativeStatus": (
+        "http://hl7.org/fhir/ValueSet/narrative-status", "http://hl7.org/fhir/narrative-status", NARRATIVE_STATUS),
+}
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_CACHE_TIMEOUT = 60
+
+
+class Expansion:
+    """The codes of one ValueSet version, held in hash tables for O(1) membership checks"""
+
+    __slots__ = ("url", "name", "version", "concepts", "displays")
+
+    def __init__(self, url, name, version, concepts):
+        self.url = url
+        self.name = name
+        self.version = version
+        # (system, code) -> display
+        self.concepts = {(system, code): display for system, code, display in concepts}
+        # code -> display, for CodeFields which don't store a system
+        self.displays = {}
+        for (_, code), display in self.concepts.items():
+            self.displays.setdefault(code, display)
+
+    def __contains__(self, code):
+        return code in self.displays
+
+    def __len__(self):
+        return len(self.concepts)
+
+    def lookup(self, code, system=None):
+        """Returns (found, display) for a code, optionally within a given code system"""
+        if system:
+            key = (system, code)
+            return key in self.concepts, self.concepts.get(key, "")
+        return code in self.displays, self.displays.get(code, "")
+
+    @classmethod
+    def from_value_set(cls, value_set):
+        return cls(value_set.url, value_set.name, value_set.version,
+                   value_set.expansion.values_list("system", "code", "display"))
+
+    @classmethod
+    def builtin(cls, value_set):
+        """Returns the built-in Expansion for a ValueSet name or URL, or None"""
+        for name, (url, system, codes) in BUILTIN_VALUE_SETS.items():
+            if value_set in (name, url):
+                return cls(url, name, "", ((system, code, display) for code, display in codes))
+        return None
+
+
+def _load_expansion(value_set, version):
+    queryset = ValueSet.objects.filter(Q(url=value_set) | Q(name=value_set))
+    if version:
+        queryset = queryset.filter(version=version)
+    instance = queryset.order_by("-lastUpdated").first()
+    if instance is not None:
+        return Expansion.from_value_set(instance)
+    if not version:
+        return Expansion.builtin(value_set)
+    return None
+
+
+class ExpansionCache(TimedLRUCache):
+    """A bounded LRU cache of ValueSet expansions, keyed by (ValueSet name or URL, version).
+
+    The cache lives in process memory; it is cleared by the signal handlers in
+    medux.core.signals whenever a ValueSet or Coding is changed in this process.
+    As these are rarely written, but read for nearly every saved element, this is cheap.
+    Changes made by other processes (or bulk imports without signals) are picked up when
+    the entries expire, after MEDUX_VALUESET_CACHE_TIMEOUT seconds.
+    """
+
+    def __init__(self, maxsize=None, timeout=None):
+        maxsize = maxsize or getattr(settings, "MEDUX_VALUESET_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+        if timeout is None:
+            timeout = getattr(settings, "MEDUX_VALUESET_CACHE_TIMEOUT", DEFAULT_CACHE_TIMEOUT)
+        super().__init__(_load_expansion, maxsize, timeout)
+
+    def get(self, value_set, version=None):
+        """Returns the Expansion of a ValueSet, given by name or URL, or None if it is unknown.
+
+        Without version, the most recently updated version is used."""
+        return super().get(value_set, version or None)
+
+    def validate_code(self, value_set, code, system=None, version=None):
+        """Returns (result, display, message) like the $validate-code operation"""
+        expansion = self.get(value_set, version)
+        if expansion is None:
+            return False, "", "Unknown ValueSet: {}".format(value_set)
+        found, display = expansion.lookup(code, system)
+        if not found:
+            return False, "", "The code '{}' is not in the ValueSet {}".format(code, value_set)
+        return True, display, ""
+
+
+expansions = ExpansionCache()
+
+
+def validate_codes(obj):
+    """Checks the values of all CodeFields of a model instance against their ValueSets.
+
+    Raises a ValidationError for the first invalid code. Other constraints (like blank) are not
+    checked, that's what Model.full_clean() is for."""
+    for field in obj._meta.concrete_fields:
+        if isinstance(field, CodeField):
+            field.validate_code(getattr(obj, field.attname))
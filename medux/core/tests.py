@@ -16,6 +16,1796 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from django.test import TestCase
+import base64
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+from unittest import mock, skipIf, skipUnless
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection, transaction
+from django.http import StreamingHttpResponse
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from medux.core import benchmark
+from medux.core.admin import PatientAdmin
+from medux.core.benchmark import SCALES, SCENARIOS, check_baselines, generate, load_baselines, run_scenarios
+from medux.core.blobs import BlobTooLargeError, get_blob_store
+from medux.core.bundle import BundleError, BundleImporter
+from medux.core.code_import import CodeImporter, CodeImportError, iter_csv_codes, iter_json_codes
+from medux.core.code_search import RANK_WORD_PREFIX, CodeIndex, create_last_updated_column
+from medux.core.documents import get_document
+from medux.core.export import export_dir, export_file, export_queryset, run_export, write_ndjson
+from medux.core.extensions import extension_index_name, with_extension
+from medux.core.fhir import MANDATORY_ELEMENTS, SUBSETTED, loading_plan, requested_elements
+from medux.core.history import changes, latest_cursor
+from medux.core.ids import allocate_ids, id_timestamp, new_id
+from medux.core.instrumentation import fingerprint, instrument, section
+from medux.core.instrumentation import metrics as instrumentation_metrics
+from medux.core.matching import find_duplicates, grade, match_record, phonetic, scores
+from medux.core.models import (FLAT_RESOURCES, Address, Attachment, Coding, ContactPoint, Element, ExportJob, HumanName,
+                               Identifier, Organisation, Patient, ResourceDocument, ResourceVersion, StructureDefinition,
+                               Subscription, ValueSet)
+from medux.core.periods import PERIOD_MAX, PERIOD_MIN, Period
+from medux.core.profiles import ProfileCache, profiles, validate_resource
+from medux.core.references import create_id_indexes, resolve_reference, resolve_references
+from medux.core.response_cache import FileSystemResponseCache, LocalMemoryResponseCache, get_response_cache
+from medux.core.schema import execute_query
+from medux.core.streaming import _Chunks, get_asgi_application
+from medux.core.subscriptions import DeliveryError, QueueSink, deliver_all, parse_criteria
+from medux.core.terminology import ExpansionCache, expansions
+from medux.core.upgrades import UpgradeError, move_legacy_extensions, move_legacy_periods, restore_legacy_extensions
+
+FHIR_JSON = "application/fhir+json"
+
+# queries of each API request of a logged in test client: its session and its user
+AUTH_QUERIES = 2
+
+
+def api_user(*permissions):
+    """Returns a new user of the FHIR API with the given permissions ("view_patient"), or a superuser"""
+    if not permissions:
+        return get_user_model().objects.create_superuser("api", "api@example.org", "secret")
+    user = get_user_model().objects.create_user("api", "api@example.org", "secret")
+    user.user_permissions.set(Permission.objects.filter(content_type__app_label="core", codename__in=permissions))
+    return user
+
+
+def basic_auth(username="api", password="secret"):
+    """Returns the value of an HTTP Basic Authorization header"""
+    return "Basic " + base64.b64encode("{}:{}".format(username, password).encode()).decode()
+
+
+def patient_resource(family="Huber", given=("Anna",), birth_date="1980-05-17", **elements):
+    """Returns a Patient resource as FHIR dict"""
+    return dict({
+        "resourceType": "Patient",
+        "identifier": [{"use": "official", "system": "urn:oid:1.2.40.0.10.1.4.3.1", "value": "1234170580"}],
+        "name": [{"use": "official", "family": family, "given": list(given)}],
+        "telecom": [{"system": "phone", "value": "+43 123456", "use": "home"}],
+        "gender": "female",
+        "birthDate": birth_date,
+        "address": [{"use": "home", "line": ["Hauptstraße 1"], "city": "Wien", "postalCode": "1010"}],
+    }, **elements)
+
+
+def transaction_bundle(*resources):
+    return {"resourceType": "Bundle", "type": "transaction",
+            "entry": [{"resource": resource} for resource in resources]}
+
+
+def create_organisation(id):
+    return Organisation.objects.create(id=id, created=timezone.now(), security=security())
+
+
+def security():
+    return Coding.objects.get_or_create(system="http://hl7.org/fhir/v3/Confidentiality", code="N",
+                                        defaults={"display": "normal", "userselected": False})[0]
+
+
+def create_value_set(id, name, codes, system="http://medux.org/fhir/CodeSystem/test"):
+    value_set = ValueSet.objects.create(id=id, created=timezone.now(), security=security(), name=name,
+                                        url="http://medux.org/fhir/ValueSet/{}".format(id), status="active",
+                                        date=timezone.now())
+    value_set.expansion.add(*[Coding.objects.create(system=system, code=code, display=display, userselected=False)
+                              for code, display in codes])
+    return value_set
+
+
+def temporary_directory(test):
+    """Returns a new directory, which is removed after the test"""
+    directory = tempfile.mkdtemp(prefix="medux-test-")
+    test.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    return directory
+
+
+def import_patients(*resources):
+    """Imports the Patient resources, and returns the created Patients"""
+    responses = BundleImporter().run(io.BytesIO(json.dumps(transaction_bundle(*resources)).encode("utf-8")))
+    return [Patient.objects.get(pk=response["response"]["location"].split("/")[1]) for response in responses]
+
+
+class BundleImportTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+
+    def import_queries(self, count):
+        bundle = transaction_bundle(*[patient_resource(given=("Patient {}".format(number),))
+                                      for number in range(count)])
+        with CaptureQueriesContext(connection) as context:
+            BundleImporter(batch_size=100).run(io.BytesIO(json.dumps(bundle).encode("utf-8")))
+        return len(context.captured_queries)
+
+    def test_queries_per_batch_are_constant(self):
+        # the first import fills the caches of ValueSet expansions and profiles
+        self.import_queries(1)
+        # small enough that the bulk inserts don't have to be split for SQLite's parameter limit
+        self.assertEqual(self.import_queries(2), self.import_queries(10))
+        self.assertEqual(Patient.objects.count(), 13)
+
+    @skipUnless(connection.vendor == "sqlite", "SQLite can't return the ids of a bulk insert")
+    def test_reserved_pks_are_locked(self):
+        with CaptureQueriesContext(connection) as context:
+            import_patients(patient_resource())
+        statements = [query["sql"] for query in context.captured_queries]
+        lock = next(index for index, sql in enumerate(statements) if sql.endswith("WHERE 1 = 0"))
+        insert = next(index for index, sql in enumerate(statements) if sql.startswith("INSERT"))
+        # the write lock is taken before the last primary key is read
+        self.assertIn("ORDER BY", statements[lock + 1])
+        self.assertLess(lock, insert)
+
+    def test_elements(self):
+        patient, = import_patients(patient_resource(deceasedDateTime="2017-03-01T10:00:00+00:00",
+                                                    multipleBirthInteger=2))
+        self.assertEqual(patient.name.get().family, "Huber")
+        self.assertEqual(patient.identifier.get().value, "1234170580")
+        self.assertEqual(patient.address.get().city, "Wien")
+        self.assertEqual(patient.deceased.year, 2017)
+        self.assertEqual(patient.multipleBirth, 2)
+
+    def test_partial_dates(self):
+        patient, = import_patients(patient_resource(birth_date="1980", deceasedDateTime="2017-03"))
+        self.assertEqual(patient.birthdate, datetime.date(1980, 1, 1))
+        self.assertEqual(patient.deceased, datetime.datetime(2017, 3, 1, tzinfo=datetime.timezone.utc))
+        for birth_date in ("1980-02-30", "17.05.1980"):
+            with self.assertRaises(BundleError):
+                import_patients(patient_resource(birth_date=birth_date))
+        response = self.client.post(reverse("process_bundle"), json.dumps(transaction_bundle(
+            patient_resource(deceasedDateTime="2017-13"))), content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 400)
+
+    def test_deceased_boolean(self):
+        patient, = import_patients(patient_resource(deceasedBoolean=False))
+        self.assertIsNone(patient.deceased)
+        with self.assertRaises(BundleError):
+            import_patients(patient_resource(deceasedBoolean=True))
+
+    def test_rejected_bundle_is_an_operation_outcome(self):
+        response = self.client.post(reverse("process_bundle"), json.dumps(transaction_bundle(
+            patient_resource(), patient_resource(deceasedBoolean=True))), content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+        # the whole transaction is rolled back
+        self.assertFalse(Patient.objects.exists())
+
+
+class AuthTests(TestCase):
+
+    def setUp(self):
+        self.patient, = import_patients(patient_resource())
+        self.url = reverse("read", args=["Patient", self.patient.pk])
+        self.bundle = json.dumps(transaction_bundle(patient_resource(family="Gruber")))
+
+    def test_authentication_is_required(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()["issue"][0]["code"], "login")
+        self.assertEqual(response["WWW-Authenticate"], 'Basic realm="MedUX"')
+        api_user()
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION=basic_auth()).status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION=basic_auth(password="wrong")).status_code, 401)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION="Basic ?").status_code, 401)
+
+    def test_resource_permissions(self):
+        self.client.force_login(api_user("view_patient"))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.get(reverse("search", args=["Patient"])).status_code, 200)
+        response = self.client.get(reverse("search", args=["Organization"]))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()["issue"][0]["code"], "forbidden")
+        # all resource types
+        self.assertEqual(self.client.get(reverse("history")).status_code, 403)
+        response = self.client.post(reverse("process_bundle"), self.bundle, content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 403)
+
+    def test_csrf_token_is_required_with_the_session(self):
+        user = api_user()
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(user)
+        response = client.post(reverse("process_bundle"), self.bundle, content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 403)
+        client.get(reverse("admin:password_change"))
+        response = client.post(reverse("process_bundle"), self.bundle, content_type=FHIR_JSON,
+                               HTTP_X_CSRFTOKEN=client.cookies["csrftoken"].value)
+        self.assertEqual(response.status_code, 200)
+        # clients with the password of the user have no session a browser could send on its own
+        response = Client(enforce_csrf_checks=True).post(reverse("process_bundle"), self.bundle,
+                                                         content_type=FHIR_JSON, HTTP_AUTHORIZATION=basic_auth())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Patient.objects.count(), 3)
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        settings = override_settings(MEDUX_EXPORT_ROOT=temporary_directory(self))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        import_patients(patient_resource(), patient_resource(family="Gruber"))
+        create_organisation("org-1")
+        self.user = api_user()
+        self.client.force_login(self.user)
+
+    def test_export(self):
+        job = ExportJob.objects.create(user=self.user, request="http://testserver/fhir/$export",
+                                       types="Patient,Organization")
+        run_export(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(json.loads(job.output), {"Patient": 2, "Organization": 1})
+
+        response = self.client.get(reverse("export_status", args=[job.pk]))
+        self.assertEqual(response.status_code, 200)
+        output = {item["type"]: item for item in response.json()["output"]}
+        self.assertEqual(output["Patient"]["count"], 2)
+
+        response = self.client.get(reverse("export_download", args=[job.pk, "Patient"]))
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual(sorted(json.loads(line)["name"][0]["family"] for line in lines), ["Gruber", "Huber"])
+
+    def test_kickoff(self):
+        self.assertEqual(self.client.get(reverse("export_kickoff")).status_code, 400)
+        response = self.client.get(reverse("export_kickoff"), HTTP_PREFER="respond-async")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ExportJob.objects.get().type_list, ["Patient", "Organization", "ValueSet",
+                                                            "StructureDefinition"])
+        response = self.client.get(response["Content-Location"])
+        self.assertEqual(response.status_code, 202)
+
+    def test_jobs_belong_to_their_user(self):
+        job = ExportJob.objects.create(user=self.user, request="http://testserver/fhir/$export", types="Patient")
+        run_export(job)
+        self.client.force_login(get_user_model().objects.create_superuser("other", "other@example.org", "secret"))
+        self.assertEqual(self.client.get(reverse("export_status", args=[job.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse("export_download", args=[job.pk, "Patient"])).status_code, 404)
+        self.assertEqual(self.client.delete(reverse("export_status", args=[job.pk])).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("export_status", args=[job.pk])).status_code, 401)
+
+    def test_patient_level_export(self):
+        import_patients(patient_resource(managingOrganization={"reference": "Organization/org-2"}))
+        create_organisation("org-2")
+        response = self.client.get(reverse("export_kickoff", args=["Patient"]), {"_type": "Patient,Organization"},
+                                   HTTP_PREFER="respond-async")
+        self.assertEqual(response.status_code, 202)
+        job = ExportJob.objects.get()
+        self.assertEqual(job.compartment, "Patient")
+        run_export(job)
+        job.refresh_from_db()
+        # only the Organization of a Patient is in their compartments
+        self.assertEqual(json.loads(job.output), {"Patient": 3, "Organization": 1})
+        with open(export_file(job, "Organization"), encoding="utf-8") as stream:
+            self.assertEqual(json.loads(stream.read())["id"], "org-2")
+
+    def test_kickoff_permissions(self):
+        viewer = get_user_model().objects.create_user("viewer", "viewer@example.org", "secret")
+        viewer.user_permissions.set(Permission.objects.filter(content_type__app_label="core", codename="view_patient"))
+        self.client.force_login(viewer)
+        url = reverse("export_kickoff")
+        self.assertEqual(self.client.get(url, HTTP_PREFER="respond-async").status_code, 403)
+        self.assertEqual(self.client.get(url, {"_type": "Patient"}, HTTP_PREFER="respond-async").status_code, 202)
+
+    def test_stale_jobs_are_taken_over(self):
+        job = ExportJob.objects.create(user=self.user, request="http://testserver/fhir/$export", types="Patient",
+                                       status="in-progress", heartbeat=timezone.now())
+        call_command("export_resources", pending=True, stdout=io.StringIO())
+        self.assertEqual(ExportJob.objects.get().status, "in-progress")
+        # the process running the job has died
+        ExportJob.objects.update(heartbeat=timezone.now() - datetime.timedelta(hours=1))
+        call_command("export_resources", pending=True, stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(json.loads(job.output), {"Patient": 2})
+
+    @override_settings(MEDUX_EXPORT_ROOT=None)
+    def test_export_root_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            export_dir(ExportJob(types="Patient"))
+
+
+class TerminologyTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        expansions.clear()
+        self.value_set = create_value_set("colors", "Colors", [("red", "Red"), ("green", "Green")])
+
+    def test_builtin_value_sets(self):
+        self.assertEqual(expansions.validate_code("AdministrativeGender", "female"), (True, "Female", ""))
+        self.assertFalse(expansions.validate_code("AdministrativeGender", "woman")[0])
+        with self.assertRaises(BundleError):
+            import_patients(patient_resource(gender="woman"))
+
+    def test_cache_hit(self):
+        self.assertIn("red", expansions.get("Colors"))
+        self.assertIsNone(expansions.get("Unknown"))
+        with self.assertNumQueries(0):
+            self.assertIn("green", expansions.get("Colors"))
+            # unknown ValueSets are cached, too
+            self.assertIsNone(expansions.get("Unknown"))
+
+    def test_invalidated_by_signals(self):
+        self.assertNotIn("blue", expansions.get("Colors"))
+        self.value_set.expansion.add(Coding.objects.create(system="http://medux.org/fhir/CodeSystem/test",
+                                                           code="blue", display="Blue", userselected=False))
+        self.assertIn("blue", expansions.get("Colors"))
+
+    def test_entries_expire(self):
+        # changes of other processes don't send signals here
+        cache = ExpansionCache(timeout=60)
+        self.assertIsNone(cache.get("Sizes"))
+        create_value_set("sizes", "Sizes", [("s", "Small")])
+        self.assertIsNone(cache.get("Sizes"))
+        with mock.patch("medux.core.caches.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIn("s", cache.get("Sizes"))
+
+    def test_validate_code_operation(self):
+        response = self.client.get(reverse("validate_code", args=["colors"]), {"code": "red"})
+        self.assertEqual(response.json()["parameter"], [{"name": "result", "valueBoolean": True},
+                                                        {"name": "display", "valueString": "Red"}])
+        response = self.client.get(reverse("validate_code"), {"url": "http://medux.org/fhir/ValueSet/colors",
+                                                              "code": "blue"})
+        self.assertFalse(response.json()["parameter"][0]["valueBoolean"])
+
+
+class ReferenceTests(TestCase):
+
+    def setUp(self):
+        self.organisations = [create_organisation("org-{}".format(number)) for number in range(3)]
+
+    def test_resolve_reference(self):
+        self.assertEqual(resolve_reference("Organization/org-1"), self.organisations[1])
+        self.assertIsNone(resolve_reference("Organization/org-9"))
+        self.assertIsNone(resolve_reference("Organization/org 1"))
+        # resource types that aren't stored here, and resources on other servers
+        self.assertIsNone(resolve_reference("Practitioner/org-1"))
+        self.assertIsNone(resolve_reference("http://example.org/fhir/Organization/org-1"))
+        with override_settings(MEDUX_FHIR_BASE_URL="http://example.org/fhir/"):
+            self.assertEqual(resolve_reference("http://example.org/fhir/Organization/org-1"), self.organisations[1])
+
+    def test_resolve_references(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(resolve_references(["Organization/org-2", "Organization/org-9", "Organization/org-0"]),
+                             [self.organisations[2], None, self.organisations[0]])
+
+    def test_prefetch_references(self):
+        import_patients(*[patient_resource(managingOrganization={"reference": "Organization/org-{}".format(number)})
+                          for number in range(3)])
+        # the patients, their Reference objects, and the Organisations
+        with self.assertNumQueries(3):
+            organisations = [patient.managingOrganisation.resource for patient in
+                             Patient.objects.order_by("pk").prefetch_references("managingOrganisation")]
+        self.assertEqual(organisations, self.organisations)
+
+
+class IdIndexTests(TransactionTestCase):
+
+    def test_id_index(self):
+        # the id column is in the resource table, or in each resource type's table in the flat layout
+        field = Organisation._meta.get_field("id")
+
+        def indexes():
+            with connection.cursor() as cursor:
+                return [name for name, constraint in connection.introspection.get_constraints(
+                    cursor, field.model._meta.db_table).items() if constraint["index"]
+                    and constraint["columns"] == [field.column]]
+
+        # a database created before the index existed
+        with connection.schema_editor() as editor:
+            for name in indexes():
+                editor.execute(editor._delete_index_sql(field.model, name))
+        self.assertEqual(indexes(), [])
+        create_id_indexes(connection)
+        self.assertEqual(len(indexes()), 1)
+
+
+@override_settings(MEDUX_DOCUMENT_STORE=True)
+class DocumentStoreTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+
+    def test_documents_follow_the_resources(self):
+        organisation = create_organisation("org-1")
+        self.assertEqual(json.loads(get_document("Organization", "org-1"))["id"], "org-1")
+        organisation.language = "de"
+        organisation.save()
+        document = json.loads(get_document("Organization", "org-1"))
+        self.assertEqual(document["language"], "de")
+        organisation.delete()
+        self.assertIsNone(get_document("Organization", "org-1"))
+
+    def test_elements_update_the_documents(self):
+        patient, = import_patients(patient_resource())
+        name = patient.name.get()
+        name.family = "Gruber"
+        name.save()
+        self.assertEqual(json.loads(get_document("Patient", str(patient.pk)))["name"][0]["family"], "Gruber")
+
+    def test_read_is_a_single_query(self):
+        create_organisation("org-1")
+        with self.assertNumQueries(AUTH_QUERIES + 1):
+            response = self.client.get(reverse("read", args=["Organization", "org-1"]))
+        self.assertEqual(json.loads(response.content)["id"], "org-1")
+        self.assertEqual(response["ETag"], 'W/"{}"'.format(ResourceDocument.objects.get().versionId))
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        create_organisation("org-1")
+        self.patients = import_patients(
+            patient_resource(family="Müller", birth_date="1980-05-17", managingOrganization={
+                "reference": "Organization/org-1"}),
+            patient_resource(family="Mueller", birth_date="1990-01-01"),
+            patient_resource(family="Gruber", given=("Lena",), birth_date="1980-12-31",
+                             identifier=[{"system": "urn:medux:mrn", "value": "MRN1"}]),
+        )
+        self.ids = [str(patient.pk) for patient in self.patients]
+
+    def search(self, **params):
+        response = self.client.get(reverse("search", args=["Patient"]), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def found(self, **params):
+        return [entry["resource"]["id"] for entry in self.search(**params)["entry"]]
+
+    def test_string(self):
+        # prefix matches, without accents and case
+        self.assertEqual(self.found(family="mul"), self.ids[:1])
+        self.assertEqual(self.found(family="MU"), self.ids[:2])
+        self.assertEqual(self.found(**{"family:exact": "Müller"}), self.ids[:1])
+        self.assertEqual(self.found(name="lena"), self.ids[2:])
+
+    def test_token(self):
+        self.assertEqual(self.found(identifier="urn:medux:mrn|MRN1"), self.ids[2:])
+        self.assertEqual(self.found(identifier="MRN1"), self.ids[2:])
+        self.assertEqual(self.found(identifier="urn:other|MRN1"), [])
+        self.assertEqual(self.found(gender="female"), self.ids)
+
+    def test_date(self):
+        self.assertEqual(self.found(birthdate="1980"), [self.ids[0], self.ids[2]])
+        self.assertEqual(self.found(birthdate="ge1985-01-01"), self.ids[1:2])
+        self.assertEqual(self.found(birthdate="lt1980-05-17"), [])
+
+    def test_reference(self):
+        self.assertEqual(self.found(organization="Organization/org-1"), self.ids[:1])
+
+    def test_pages(self):
+        bundle = self.search(_count=2)
+        self.assertEqual(len(bundle["entry"]), 2)
+        next_url = next(link["url"] for link in bundle["link"] if link["relation"] == "next")
+        bundle = self.client.get(next_url).json()
+        self.assertEqual([entry["resource"]["id"] for entry in bundle["entry"]], self.ids[2:])
+        self.assertFalse(any(link["relation"] == "next" for link in bundle["link"]))
+        self.assertEqual(self.search(family="mu", _summary="count")["total"], 2)
+
+    def test_invalid_parameters(self):
+        response = self.client.get(reverse("search", args=["Patient"]), {"unknown": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["resourceType"], "OperationOutcome")
+
+
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.organisation = create_organisation("org-1")
+        self.organisation.language = "de"
+        self.organisation.save()
+
+    def get(self, name, *args):
+        response = self.client.get(reverse(name, args=args))
+        return response.status_code, json.loads(response.content)
+
+    def test_read_and_vread(self):
+        status, data = self.get("read", "Organization", "org-1")
+        self.assertEqual(data["meta"]["versionId"], "2")
+        self.assertEqual(data["language"], "de")
+        status, data = self.get("vread", "Organization", "org-1", "1")
+        self.assertEqual(data["meta"]["versionId"], "1")
+        self.assertNotIn("language", data)
+        self.assertEqual(self.get("vread", "Organization", "org-1", "3")[0], 404)
+
+    def test_history(self):
+        status, bundle = self.get("history", "Organization", "org-1")
+        self.assertEqual(bundle["type"], "history")
+        self.assertEqual([entry["resource"]["meta"]["versionId"] for entry in bundle["entry"]], ["2", "1"])
+        self.assertEqual([entry["request"]["method"] for entry in bundle["entry"]], ["PUT", "POST"])
+
+    def test_unchanged_resources_get_no_version(self):
+        self.organisation.save()
+        self.assertEqual(len(self.get("history", "Organization", "org-1")[1]["entry"]), 2)
+
+    def test_delete(self):
+        self.organisation.delete()
+        self.assertEqual(self.get("read", "Organization", "org-1")[0], 410)
+        self.assertEqual([entry["request"]["method"] for entry in self.get("history", "Organization", "org-1")[1][
+            "entry"]], ["DELETE", "PUT", "POST"])
+        self.assertEqual(self.get("vread", "Organization", "org-1", "2")[1]["language"], "de")
+
+    def test_version_ids_agree(self):
+        stream = io.StringIO()
+        write_ndjson(export_queryset("Organization"), stream)
+        self.assertEqual(json.loads(stream.getvalue())["meta"]["versionId"], "2")
+        search = self.client.get(reverse("search", args=["Organization"])).json()
+        self.assertEqual(search["entry"][0]["resource"]["meta"]["versionId"], "2")
+        result = execute_query('{ organization(id: "org-1") { meta { versionId } } }')
+        self.assertEqual(result.data["organization"]["meta"]["versionId"], "2")
+
+    def test_versioned_references(self):
+        self.assertEqual(resolve_reference("Organization/org-1/_history/1"), self.organisation)
+        self.assertEqual(resolve_reference("Organization/org-1/_history/2"), self.organisation)
+        self.assertIsNone(resolve_reference("Organization/org-1/_history/3"))
+        self.assertIsNone(resolve_reference("Organization/org-1/_history/{}".format(self.organisation.versionId)))
+        patient, = import_patients(patient_resource())
+        self.assertEqual(resolve_reference("Patient/{}/_history/1".format(patient.pk)), patient)
+
+
+class BlobStoreTests(TestCase):
+
+    def setUp(self):
+        self.root = temporary_directory(self)
+        settings = override_settings(MEDUX_BLOB_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.data = bytes(range(256)) * 1000
+        self.client.force_login(api_user())
+
+    def upload(self):
+        response = self.client.post(reverse("binary_upload") + "?title=scan", self.data, content_type="image/png")
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_upload_and_download(self):
+        attachment = self.upload()
+        self.assertEqual(attachment["size"], len(self.data))
+        self.assertEqual(attachment["hash"], base64.b64encode(hashlib.sha1(self.data).digest()).decode("ascii"))
+        response = self.client.get(attachment["url"])
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        with Attachment.objects.get().open() as stream:
+            self.assertEqual(stream.read(), self.data)
+
+    def test_same_content_is_stored_once(self):
+        self.upload()
+        self.upload()
+        self.assertEqual(Attachment.objects.count(), 2)
+        files = [name for _, _, names in os.walk(self.root) for name in names]
+        self.assertEqual(files, [hashlib.sha1(self.data).hexdigest()])
+
+    def test_ranges(self):
+        url = self.upload()["url"]
+        response = self.client.get(url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 10-19/{}".format(len(self.data)))
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        response = self.client.get(url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+        self.assertEqual(self.client.get(url, HTTP_RANGE="bytes={}-".format(len(self.data))).status_code, 416)
+        self.assertEqual(self.client.get(url[:-1] + "0").status_code, 404)
+
+    def test_max_size(self):
+        with override_settings(MEDUX_BLOB_MAX_SIZE=len(self.data) - 1):
+            response = self.client.post(reverse("binary_upload"), self.data, content_type="image/png")
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()["issue"][0]["code"], "too-long")
+        # without a Content-Length, the upload is stopped while it is read
+        with self.assertRaises(BlobTooLargeError):
+            get_blob_store().save(io.BytesIO(self.data), chunk_size=1000, max_size=len(self.data) - 1)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual([name for _, _, names in os.walk(self.root) for name in names], [])
+        with override_settings(MEDUX_BLOB_MAX_SIZE=len(self.data)):
+            self.upload()
+
+    def test_permissions(self):
+        url = self.upload()["url"]
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.post(reverse("binary_upload"), self.data, content_type="image/png").status_code,
+                         401)
+        viewer = get_user_model().objects.create_user("viewer", "viewer@example.org", "secret")
+        viewer.user_permissions.set(Permission.objects.filter(codename="view_attachment"))
+        self.client.force_login(viewer)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.post(reverse("binary_upload"), self.data, content_type="image/png").status_code,
+                         403)
+
+    @override_settings(MEDUX_BLOB_ROOT=None)
+    def test_blob_root_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_blob_store()
+
+
+class BenchmarkTests(TestCase):
+
+    def test_generate(self):
+        generate(150)
+        self.assertEqual(Patient.objects.count(), 150)
+        self.assertEqual(Organisation.objects.count(), 1)
+        self.assertEqual(ValueSet.objects.get().expansion.count(), 100)
+        # same seed, same data
+        self.assertEqual(Patient.objects.order_by("pk").first().name.get().family,
+                         benchmark.patient_resource(random.Random(0), 0, ["org-0"])["name"][0]["family"])
+
+    def test_run_scenarios(self):
+        generate(20)
+        measurements = run_scenarios(["read", "valid_at"])
+        self.assertEqual([measurement.scenario for measurement in measurements], ["read", "valid_at"])
+        self.assertGreaterEqual(measurements[0].queries, 20)
+        # the ids, and then one query per patient and element model
+        self.assertEqual(measurements[1].queries, 1 + 20 * 3)
+        self.assertEqual(measurements[1].inserts, 0)
+
+    def test_check_baselines(self):
+        measurements = [benchmark.Measurement("read", 1.0, 100, 0, 0, 0),
+                        benchmark.Measurement("search", 1.0, 40, 0, 0, 0)]
+        baselines = {"sqlite": {"1k": {"read": 100, "search": 39}}}
+        self.assertEqual(check_baselines(baselines, "sqlite", "1k", measurements),
+                         ["search: 40 queries, baseline is 39"])
+        self.assertEqual(check_baselines(baselines, "postgresql", "1k", measurements), [])
+
+    def test_stored_baselines(self):
+        for scales in load_baselines().values():
+            for scale, scenarios in scales.items():
+                self.assertIn(scale, SCALES)
+                self.assertLessEqual(set(scenarios), set(SCENARIOS))
+
+
+class InstrumentationTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'it''s' AND pk IN (%s, %s, %s)"),
+                         "SELECT * FROM t WHERE id = ? AND name = ? AND pk IN (...)")
+
+    def test_duplicates(self):
+        import_patients(patient_resource(), patient_resource(family="Maier"))
+        with instrument("loop") as report:
+            for patient in Patient.objects.all():
+                list(patient.name.all())
+        self.assertEqual(report.query_count, 3)
+        self.assertEqual(list(report.duplicates().values()), [2])
+        self.assertEqual(report.as_dict()["duplicate_queries"], 1)
+
+    def test_sections(self):
+        with section("serialization"):
+            pass
+        with instrument() as outer, instrument() as inner, section("serialization"):
+            time.sleep(0.01)
+        self.assertGreater(outer.sections["serialization"], 0)
+        self.assertEqual(outer.sections, inner.sections)
+
+    @override_settings(MIDDLEWARE=["medux.core.middleware.InstrumentationMiddleware"] + settings.MIDDLEWARE)
+    def test_middleware_and_metrics_view(self):
+        instrumentation_metrics.reset()
+        self.addCleanup(instrumentation_metrics.reset)
+        import_patients(patient_resource())
+        response = self.client.get(reverse("search", args=["Patient"]))
+        self.assertIn("queries", response["Server-Timing"])
+        endpoint = self.client.get(reverse("metrics")).json()["GET search"]
+        self.assertEqual(endpoint["requests"], 1)
+        self.assertEqual(endpoint["queries"]["count"], 1)
+        self.assertEqual(self.client.delete(reverse("metrics")).status_code, 204)
+        # only the DELETE itself is left
+        self.assertEqual(list(instrumentation_metrics.snapshot()), ["DELETE metrics"])
+
+    @override_settings(MEDUX_METRICS_TOKEN="s3cret")
+    def test_metrics_access(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+        self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+        response = Client(enforce_csrf_checks=True).delete(reverse("metrics"), HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 204)
+        self.client.force_login(get_user_model().objects.create_user("user", "user@example.org", "secret"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        with override_settings(MEDUX_METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create_superuser("admin", "admin@example.org", "admin")
+        self.client.force_login(user)
+        self.pks = [patient.pk for patient in import_patients(*[patient_resource(family="Huber{}".format(number))
+                                                                 for number in range(5)])]
+        self.pks.reverse()
+        patcher = mock.patch.object(PatientAdmin, "list_per_page", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def changelist(self, **params):
+        response = self.client.get(reverse("admin:core_patient_changelist"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context["cl"]
+
+    def page(self, **params):
+        changelist = self.changelist(**params)
+        return ([patient.pk for patient in changelist.result_list], changelist.previous_cursor,
+                changelist.next_cursor)
+
+    def test_keyset_paging(self):
+        first, second, third, fourth, fifth = self.pks
+        self.assertEqual(self.page(), ([first, second], None, second))
+        self.assertEqual(self.page(after=second), ([third, fourth], third, fourth))
+        self.assertEqual(self.page(after=fourth), ([fifth], fifth, None))
+        self.assertEqual(self.page(before=fifth), ([third, fourth], third, fourth))
+        # the page in front of the first rows is the first page
+        self.assertEqual(self.page(before=third), ([first, second], None, second))
+        changelist = self.changelist(after=second)
+        self.assertEqual(changelist.next_page_url, "?after={}".format(fourth))
+        self.assertEqual(changelist.previous_page_url, "?before={}".format(third))
+        self.assertEqual(changelist.first_page_url, "?")
+        # other orderings are paginated by offset
+        self.assertFalse(self.changelist(o="3").keyset)
+
+    def test_invalid_cursors(self):
+        first, second = self.pks[:2]
+        self.assertEqual(self.page(after="abc"), ([first, second], None, second))
+        self.assertEqual(self.page(before="1x"), ([first, second], None, second))
+
+    def test_prefetched_names(self):
+        with CaptureQueriesContext(connection) as two:
+            self.changelist()
+        with mock.patch.object(PatientAdmin, "list_per_page", 4):
+            with CaptureQueriesContext(connection) as four:
+                response = self.client.get(reverse("admin:core_patient_changelist"))
+        self.assertEqual(len(two), len(four))
+        self.assertContains(response, "Anna Huber3")
+
+    def test_search_indexes(self):
+        for model, field, name in ((Coding, "code", "core_coding_code_like"),
+                                   (Coding, "display", "core_coding_display_like"),
+                                   (ContactPoint, "value", "core_contactpoint_value_like"),
+                                   (Identifier, "value", "core_identifier_value_like")):
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            self.assertTrue(constraints[name]["index"])
+            self.assertEqual(constraints[name]["columns"][0], field)
+
+
+class ResourceLayoutTests(TestCase):
+
+    def test_layout(self):
+        sql = str(Organisation.objects.all().query)
+        if FLAT_RESOURCES:
+            self.assertEqual(Organisation._meta.parents, {})
+            self.assertNotIn(" JOIN ", sql)
+            self.assertEqual(benchmark.baseline_key(connection), connection.vendor + "+flat")
+        else:
+            self.assertEqual(sql.count(" JOIN "), 2)
+            self.assertEqual(benchmark.baseline_key(connection), connection.vendor)
+
+    def test_migrations(self):
+        # the migrations create the tables of either layout
+        call_command("makemigrations", "core", check=True, dry_run=True, stdout=io.StringIO())
+
+    @skipIf(FLAT_RESOURCES, "needs the multi-table layout")
+    def test_flatten_needs_flat_setting(self):
+        with self.assertRaisesMessage(CommandError, "MEDUX_FLAT_RESOURCES"):
+            call_command("flatten_resources")
+
+    @skipUnless(FLAT_RESOURCES, "needs the flat layout")
+    def test_flatten_flat_tables(self):
+        stdout = io.StringIO()
+        call_command("flatten_resources", stdout=stdout)
+        self.assertIn("flat already", stdout.getvalue())
+
+    @skipUnless(FLAT_RESOURCES, "needs the flat layout")
+    def test_contained_inline(self):
+        organisation = create_organisation("inline")
+        organisation.contained = json.dumps([{"resourceType": "Organization", "id": "department"}])
+        organisation.save()
+        organisation.refresh_from_db()
+        self.assertEqual(json.loads(organisation.contained)[0]["id"], "department")
+
+
+class GraphQLTests(TestCase):
+    QUERY = """{ patients(first: 50) { id birthDate name { family given }
+        identifier { value assigner { resource { ... on Organization { id } } } }
+        managingOrganization { display resource { ... on Organization { id identifier { value } } } } } }"""
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        create_organisation("org-1")
+
+    def import_patients(self, count):
+        return import_patients(*[patient_resource(
+            family="Huber{}".format(number), identifier=[{"value": str(number),
+                                                          "assigner": {"reference": "Organization/org-1"}}],
+            managingOrganization={"reference": "Organization/org-1", "display": "Ordination"})
+            for number in range(count)])
+
+    def test_batched_queries(self):
+        self.import_patients(2)
+        with CaptureQueriesContext(connection) as few:
+            result = execute_query(self.QUERY)
+        self.assertIsNone(result.errors)
+        self.import_patients(8)
+        with CaptureQueriesContext(connection) as many:
+            result = execute_query(self.QUERY)
+        self.assertEqual(len(result.data["patients"]), 10)
+        self.assertEqual(len(few), len(many))
+        patient = result.data["patients"][0]
+        self.assertEqual(patient["name"], [{"family": "Huber0", "given": ["Anna"]}])
+        self.assertEqual(patient["identifier"][0]["assigner"]["resource"], {"id": "org-1"})
+        self.assertEqual(patient["managingOrganization"]["resource"]["id"], "org-1")
+
+    def test_paging(self):
+        patients = self.import_patients(3)
+        result = execute_query("query($after: ID) { patients(first: 2, after: $after) { id } }",
+                               {"after": str(patients[1].pk)})
+        self.assertEqual(result.data["patients"], [{"id": str(patients[2].pk)}])
+        result = execute_query('{ patients(after: "x") { id } }')
+        self.assertIn("Invalid cursor", result.errors[0].message)
+        self.assertIsNone(execute_query('{ patient(id: "x") { id } }').data["patient"])
+
+    @override_settings(MEDUX_GRAPHQL_MAX_DEPTH=3, MEDUX_GRAPHQL_MAX_COMPLEXITY=100)
+    def test_limits(self):
+        result = execute_query("{ patients(first: 10) { identifier { assigner { display } } } }")
+        self.assertIsNone(result.errors)
+        result = execute_query("{ patients(first: 10) { identifier { assigner { identifier { value } } } } }")
+        self.assertIn("exceeds maximum operation depth", result.errors[0].message)
+        result = execute_query("{ patients(first: 100) { id gender } }")
+        self.assertEqual(result.errors[0].message, "Query is too complex: 300 (maximum is 100)")
+
+    def test_view(self):
+        patient, = self.import_patients(1)
+        url = reverse("graphql")
+        response = self.client.post(url, json.dumps({"query": "query($id: ID!) { patient(id: $id) { gender } }",
+                                                     "variables": {"id": str(patient.pk)}}),
+                                    content_type="application/json")
+        self.assertEqual(response.json(), {"data": {"patient": {"gender": "female"}}})
+        response = self.client.get(url, {"query": "{ organization(id: \"org-1\") { id } }"})
+        self.assertEqual(response.json()["data"]["organization"]["id"], "org-1")
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {"query": "{ nothing }"}).status_code, 400)
+
+
+class ElementsTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.patient, = import_patients(patient_resource(telecom=[{"system": "phone", "value": "123"}]))
+        self.url = reverse("read", args=["Patient", self.patient.pk])
+
+    def test_loading_plan(self):
+        self.assertEqual(loading_plan(Patient, {"gender", "birthDate"} | MANDATORY_ELEMENTS), ([], []))
+        select_related, prefetch_related = loading_plan(Patient, {"name"})
+        self.assertEqual(select_related, [])
+        self.assertEqual(prefetch_related, ["name"])
+        self.assertIn("photo", loading_plan(Patient)[0])
+        self.assertNotIn("photo", loading_plan(Patient, requested_elements(Patient, "true"))[0])
+
+    def test_requested_elements(self):
+        self.assertIsNone(requested_elements(Patient))
+        self.assertIsNone(requested_elements(Patient, "false"))
+        self.assertEqual(requested_elements(Patient, elements="gender, name"), {"gender", "name"} | MANDATORY_ELEMENTS)
+        self.assertEqual(requested_elements(Patient, "text"), MANDATORY_ELEMENTS)
+        for summary, elements in (("maybe", None), ("true", "gender")):
+            with self.assertRaises(ValueError):
+                requested_elements(Patient, summary, elements)
+
+    def test_read_elements(self):
+        response = self.client.get(self.url, {"_elements": "gender,birthDate"})
+        resource = response.json()
+        self.assertEqual(set(resource), {"resourceType", "id", "meta", "gender", "birthDate"})
+        self.assertIn(SUBSETTED, resource["meta"]["tag"])
+        self.assertEqual(resource["meta"]["versionId"], "1")
+        self.assertEqual(response["ETag"], 'W/"1"')
+
+    def test_read_summary(self):
+        resource = self.client.get(self.url, {"_summary": "true"}).json()
+        self.assertEqual(resource["telecom"][0]["value"], "123")
+        self.assertNotIn("photo", resource)
+        self.assertEqual(set(self.client.get(self.url, {"_summary": "text"}).json()), {"resourceType", "id", "meta"})
+        self.assertNotIn("tag", self.client.get(self.url, {"_summary": "false"}).json().get("meta", {}))
+        self.assertEqual(self.client.get(self.url, {"_summary": "true", "_elements": "gender"}).status_code, 400)
+
+    def test_search(self):
+        import_patients(patient_resource(), patient_resource())
+        url = reverse("search", args=["Patient"])
+        self.assertEqual(self.client.get(url, {"_summary": "count"}).json()["total"], 3)
+        with CaptureQueriesContext(connection) as queries:
+            bundle = self.client.get(url, {"_elements": "gender"}).json()
+        self.assertEqual([set(entry["resource"]) for entry in bundle["entry"]],
+                         [{"resourceType", "id", "meta", "gender"}] * 3)
+        # the search index, the history versions and the patients
+        self.assertEqual(len(queries), AUTH_QUERIES + 3)
+
+
+class CodeImportTests(TestCase):
+    CODE_SYSTEM = {
+        "resourceType": "CodeSystem", "url": "http://example.org/cs", "version": "2",
+        "concept": [{"code": "A", "display": "Alpha", "concept": [{"code": "A1", "display": "Alpha one"}]},
+                    {"code": "B", "display": "Beta"}],
+    }
+
+    def test_json_codes(self):
+        codes = list(iter_json_codes(io.BytesIO(json.dumps(self.CODE_SYSTEM).encode("utf-8"))))
+        self.assertEqual(codes, [("http://example.org/cs", "2", "A", "Alpha"),
+                                 ("http://example.org/cs", "2", "A1", "Alpha one"),
+                                 ("http://example.org/cs", "2", "B", "Beta")])
+        value_set = {"resourceType": "ValueSet",
+                     "compose": {"include": [{"system": "http://example.org/cs", "concept": [{"code": "A"}]}]},
+                     "expansion": {"total": 1, "contains": [{"system": "http://loinc.org", "code": "1-8"}]}}
+        codes = list(iter_json_codes(io.BytesIO(json.dumps(value_set).encode("utf-8"))))
+        self.assertEqual(codes, [("http://example.org/cs", "", "A", ""), ("http://loinc.org", "", "1-8", "")])
+        for document in ({"concept": [], "resourceType": "CodeSystem"}, {"resourceType": "Patient"}):
+            with self.assertRaises(CodeImportError):
+                list(iter_json_codes(io.BytesIO(json.dumps(document).encode("utf-8"))))
+
+    def test_csv_codes(self):
+        rf2 = "id\tactive\tconceptId\tterm\n1\t1\t22298006\tMyocardial infarction\n2\t0\t1234\tInactive\n"
+        codes = iter_csv_codes(io.BytesIO(rf2.encode("utf-8")), "http://snomed.info/sct", code_column="conceptId",
+                               display_column="term", delimiter="\t", where={"active": "1"})
+        self.assertEqual(list(codes), [("http://snomed.info/sct", "", "22298006", "Myocardial infarction")])
+        with self.assertRaisesMessage(CodeImportError, "Missing columns: display"):
+            list(iter_csv_codes(io.StringIO("code\n1\n"), "http://loinc.org"))
+
+    def test_duplicates(self):
+        Coding.objects.create(system="http://loinc.org", code="1", display="old", userselected=False)
+        statistics = CodeImporter(batch_size=2).run([
+            ("http://loinc.org", "", "1", "one"), ("http://loinc.org", "", "2", "two"),
+            ("http://loinc.org", "", "2", "two"), ("http://loinc.org", "", "", "no code"),
+            ("http://loinc.org", "", "3", "three")])
+        self.assertEqual((statistics.records, statistics.skipped, statistics.inserted), (5, 1, 2))
+        self.assertEqual(Coding.objects.get(code="1").display, "old")
+
+    def test_resume(self):
+        checkpoint = os.path.join(temporary_directory(self), "codes.checkpoint")
+        records = [("http://loinc.org", "", str(number), "") for number in range(10)]
+
+        def interrupted():
+            yield from records[:5]
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            CodeImporter(batch_size=2, checkpoint=checkpoint).run(interrupted(), source="codes.csv")
+        self.assertEqual(Coding.objects.count(), 4)
+        statistics = CodeImporter(batch_size=2, checkpoint=checkpoint).run(records, source="codes.csv")
+        self.assertEqual((statistics.resumed, statistics.inserted), (4, 6))
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_command(self):
+        filename = os.path.join(temporary_directory(self), "codesystem.json")
+        with open(filename, "w") as f:
+            json.dump(self.CODE_SYSTEM, f)
+        stdout = io.StringIO()
+        call_command("import_codes", filename, stdout=stdout)
+        self.assertIn("3 new codes", stdout.getvalue())
+        with self.assertRaisesMessage(CommandError, "--system"):
+            call_command("import_codes", filename, format="csv")
+
+
+class CodeSearchTests(TestCase):
+
+    def setUp(self):
+        for code, display in (("I21", "Akuter Myokardinfarkt"), ("I21.0", "Akuter transmuraler Myokardinfarkt"),
+                              ("I22", "Rezidivierender Myokardinfarkt"), ("R07", "Hals- und Brustschmerzen"),
+                              ("K21", "Gastroösophageale Refluxkrankheit")):
+            Coding.objects.create(system="http://fhir.de/CodeSystem/dimdi/icd-10-gm", code=code, display=display,
+                                  userselected=False)
+        # not connected to the signals, like the index of another process
+        self.index = CodeIndex(refresh_interval=0)
+        self.index.build()
+
+    def search(self, text, **kwargs):
+        return [match.code for match in self.index.search(text, **kwargs)]
+
+    def test_ranking(self):
+        # exact code, code prefix, display prefix, then word prefixes
+        self.assertEqual(self.search("i21"), ["I21", "I21.0"])
+        self.assertEqual(self.search("akut"), ["I21", "I21.0"])
+        self.assertEqual(self.search("myokard"), ["I21", "I22", "I21.0"])
+        self.assertEqual(self.search("brust hals"), ["R07"])
+        # accents don't matter, and typos are found by trigrams
+        self.assertEqual(self.search("gastrooesophageale"), ["K21"])
+        self.assertEqual(self.search("myokardinfrakt")[:1], ["I21"])
+        self.assertEqual(self.search("myokard", system="http://loinc.org"), [])
+        matches = self.index.search("infarkt")
+        self.assertTrue(all(match.rank == RANK_WORD_PREFIX for match in matches))
+
+    def test_refresh(self):
+        self.assertEqual(self.search("angina"), [])
+        # a bulk import, and a change without signals of this index
+        Coding.objects.bulk_create([Coding(system="", code="I20", display="Angina pectoris", userselected=False)])
+        coding = Coding.objects.get(code="R07")
+        coding.display = "Angina-ähnliche Brustschmerzen"
+        coding.save()
+        self.assertEqual(self.search("angina"), ["I20", "R07"])
+        with CaptureQueriesContext(connection) as queries:
+            self.index.search("angina")
+        # max(pk) and max(lastUpdated) only
+        self.assertEqual(len(queries), 1)
+
+    def test_rebuild(self):
+        Coding.objects.filter(code="K21").delete()
+        self.assertEqual(self.search("reflux"), [])
+        Coding.objects.filter(code="I21.0").delete()
+        # older codes are only dropped by the periodic rebuild
+        self.assertEqual(self.search("transmural"), ["I21.0"])
+        self.index.rebuild_interval = 0
+        self.assertEqual(self.search("transmural"), [])
+
+    def test_signals(self):
+        self.index.refresh_interval = 3600
+        with mock.patch("medux.core.signals.code_index", self.index):
+            with self.captureOnCommitCallbacks(execute=True):
+                Coding.objects.create(system="", code="Z00", display="Allgemeinuntersuchung", userselected=False)
+                # not before the transaction is committed
+                self.assertEqual(self.search("allgemein"), [])
+            self.assertEqual(self.search("allgemein"), ["Z00"])
+            with self.captureOnCommitCallbacks(execute=True):
+                Coding.objects.filter(code="Z00").delete()
+            self.assertEqual(self.search("allgemein"), [])
+
+    def test_searches_before_the_index_is_built(self):
+        index = CodeIndex()
+        with mock.patch.object(index, "build_in_background") as build_in_background:
+            # prefix matches of the codes and displays only, from the database
+            self.assertEqual([match.code for match in index.search("i21")], ["I21", "I21.0"])
+            self.assertEqual([match.code for match in index.search("akut")], ["I21", "I21.0"])
+            self.assertEqual(index.search("infarkt"), [])
+        build_in_background.assert_called_with()
+        self.assertFalse(index.built)
+
+
+class CodeSearchColumnTests(TransactionTestCase):
+
+    def test_last_updated_column(self):
+        field = Coding._meta.get_field("lastUpdated")
+        # a database created before the column existed
+        with connection.schema_editor() as editor:
+            editor.remove_field(Coding, field)
+        create_last_updated_column(connection)
+        with connection.cursor() as cursor:
+            columns = [column.name for column in connection.introspection.get_table_description(
+                cursor, Coding._meta.db_table)]
+        self.assertIn(field.column, columns)
+
+
+class IdTests(TestCase):
+
+    def test_new_ids_ascend(self):
+        ids = [new_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        for value in ids[:10]:
+            self.assertRegex(value, r"^[0-9a-f]{8}-[0-9a-f]{4}-7[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}$")
+
+    def test_allocate_ids(self):
+        before = new_id()
+        ids = allocate_ids(5000)
+        after = new_id()
+        self.assertEqual(len(set(ids)), 5000)
+        self.assertEqual([before] + ids + [after], sorted([before] + ids + [after]))
+        self.assertEqual(allocate_ids(0), [])
+
+    def test_clock_going_backwards(self):
+        first = new_id()
+        with mock.patch("medux.core.ids.time.time_ns", return_value=0):
+            second = new_id()
+        self.assertGreater(second, first)
+        self.assertEqual(id_timestamp(second), id_timestamp(first))
+
+    def test_id_timestamp(self):
+        now = timezone.now()
+        self.assertLess(abs((id_timestamp(new_id()) - now).total_seconds()), 1)
+        self.assertIsNone(id_timestamp("4b0d5a34-1a5b-4e1a-9c3e-0c1f4e1f2a3b"))
+        self.assertIsNone(id_timestamp("org-1"))
+
+    def test_id_field(self):
+        first, second = create_organisation("org-1"), create_organisation("org-2")
+        self.assertNotEqual(first.versionId, second.versionId)
+        self.assertLess(first.versionId, second.versionId)
+        field = Organisation._meta.get_field("id")
+        field.run_validators("Patient.1-a")
+        for value in ("with space", "x" * 65):
+            with self.assertRaises(ValidationError):
+                field.clean(value, None)
+
+
+class ConditionalReadTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        organisation = create_organisation("org-1")
+        organisation.language = "de"
+        organisation.save()
+        self.url = reverse("read", args=["Organization", "org-1"])
+
+    def test_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["ETag"], 'W/"2"')
+        last_modified = response["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='W/"2"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], 'W/"2"')
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='W/"1"').status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        vread = reverse("vread", args=["Organization", "org-1", "1"])
+        self.assertEqual(self.client.get(vread, HTTP_IF_NONE_MATCH='W/"1"').status_code, 304)
+
+    def test_not_modified_without_content(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, HTTP_IF_NONE_MATCH='W/"2"')
+        self.assertEqual(len(queries), AUTH_QUERIES + 1)
+        self.assertNotIn("content", queries[0]["sql"])
+
+    @mock.patch("medux.core.response_cache._cache", None)
+    @override_settings(MEDUX_RESPONSE_CACHE="memory")
+    def test_response_cache(self):
+        cache = get_response_cache()
+        self.assertIsInstance(cache, LocalMemoryResponseCache)
+        self.assertEqual(self.client.get(self.url).json()["language"], "de")
+        self.assertEqual(json.loads(cache.get("Organization", "org-1", "2"))["language"], "de")
+        # the cached content is sent, without loading it from the database
+        cache.set("Organization", "org-1", "2", '{"cached": true}')
+        self.assertEqual(self.client.get(self.url).json(), {"cached": True})
+        self.assertIsNone(cache.get("Organization", "org-1", "2", "true"))
+        self.client.get(self.url, {"_summary": "true"})
+        self.assertIn(SUBSETTED, json.loads(cache.get("Organization", "org-1", "2", "true"))["meta"]["tag"])
+        # a new version replaces the cached one
+        organisation = Organisation.objects.get(id="org-1")
+        organisation.language = "en"
+        organisation.save()
+        self.assertEqual(self.client.get(self.url).json()["language"], "en")
+        self.assertIsNone(cache.get("Organization", "org-1", "2"))
+
+
+class ResponseCacheTests(TestCase):
+
+    def test_memory_cache_is_bounded(self):
+        cache = LocalMemoryResponseCache(maxsize=2)
+        cache.set("Patient", "1", "1", "one")
+        cache.set("Patient", "2", "1", "two")
+        self.assertEqual(cache.get("Patient", "1", "1"), "one")
+        cache.set("Patient", "3", "1", "three")
+        # the least recently used one is dropped
+        self.assertIsNone(cache.get("Patient", "2", "1"))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("Patient", "1", "2"))
+
+    def test_filesystem_cache(self):
+        cache = FileSystemResponseCache(temporary_directory(self))
+        cache.set("Organization", "..", "1", '{"id": ".."}')
+        self.assertEqual(cache.get("Organization", "..", "1"), '{"id": ".."}')
+        self.assertIsNone(cache.get("Organization", "..", "2"))
+        self.assertIsNone(cache.get("Organization", "..", "1", "true"))
+        cache.set("Organization", "..", "2", "{}")
+        self.assertIsNone(cache.get("Organization", "..", "1"))
+        cache.clear()
+        self.assertIsNone(cache.get("Organization", "..", "2"))
+        with override_settings(MEDUX_RESPONSE_CACHE_ROOT=None), self.assertRaises(ImproperlyConfigured):
+            FileSystemResponseCache()
+
+
+class ASGIStreamingTests(TestCase):
+
+    def setUp(self):
+        # like the test client: closing the connection would end the transaction of the test
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        self.application = get_asgi_application()
+        self.user = api_user()
+
+    def get(self, url):
+        """Sends a GET request to the ASGI application, and returns the status, headers and body messages"""
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        headers = [(b"host", b"testserver"), (b"authorization", basic_auth().encode())]
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": url, "query_string": b"", "headers": headers,
+                 "server": ("testserver", 80), "client": ("127.0.0.1", 50000)}
+        async_to_sync(self.application)(scope, receive, send)
+        start, *body = messages
+        self.assertEqual(body[-1], {"type": "http.response.body"})
+        return start["status"], dict(start["headers"]), body
+
+    def test_everything(self):
+        patient, = import_patients(patient_resource())
+        status, headers, body = self.get(reverse("everything", args=[patient.pk]))
+        self.assertEqual(status, 200)
+        # the chunks were read from the database in the thread of the views
+        self.assertGreater(len(body), 2)
+        bundle = json.loads(b"".join(message.get("body", b"") for message in body))
+        self.assertEqual(bundle["entry"][0]["resource"]["id"], str(patient.pk))
+
+    def test_export_download(self):
+        root = temporary_directory(self)
+        with override_settings(MEDUX_EXPORT_ROOT=root):
+            import_patients(patient_resource(), patient_resource(family="Gruber"))
+            job = ExportJob.objects.create(user=self.user, request="http://testserver/fhir/$export",
+                                           types="Patient")
+            run_export(job)
+            status, headers, body = self.get(reverse("export_download", args=[job.pk, "Patient"]))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"Content-Type"], b"application/fhir+ndjson")
+        content = b"".join(message.get("body", b"") for message in body)
+        self.assertEqual(len(content), int(headers[b"Content-Length"]))
+        self.assertEqual(len(content.splitlines()), 2)
+
+    def test_closed_when_client_disconnects(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b"first"
+                yield b"second"
+            finally:
+                closed.append(True)
+
+        async def send(message):
+            if message.get("body"):
+                raise OSError("client went away")
+
+        response = StreamingHttpResponse(_Chunks(chunks(), False))
+        with self.assertRaises(OSError):
+            async_to_sync(self.application.send_response)(response, send)
+        self.assertEqual(closed, [True])
+
+
+@override_settings(MEDUX_CHANGE_FEED_DELAY=0)
+class ChangeFeedTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+
+    def test_follow_the_cursor(self):
+        organisation = create_organisation("org-1")
+        patient, = import_patients(patient_resource())
+        organisation.language = "de"
+        organisation.save()
+        url = reverse("changes")
+        bundle = self.client.get(url, {"_count": 2}).json()
+        self.assertEqual([entry["request"]["method"] for entry in bundle["entry"]], ["POST", "POST"])
+        self.assertEqual(bundle["entry"][1]["fullUrl"], "http://testserver/fhir/Patient/{}".format(patient.pk))
+        next_url = next(link["url"] for link in bundle["link"] if link["relation"] == "next")
+        bundle = self.client.get(next_url).json()
+        self.assertEqual([entry["request"]["url"] for entry in bundle["entry"]], ["Organization/org-1"])
+        self.assertEqual(bundle["entry"][0]["response"]["etag"], 'W/"2"')
+        # without changes, the next link stays the same
+        next_url = next(link["url"] for link in bundle["link"] if link["relation"] == "next")
+        bundle = self.client.get(next_url).json()
+        self.assertEqual(bundle["entry"], [])
+        self.assertEqual(next(link["url"] for link in bundle["link"] if link["relation"] == "next"), next_url)
+
+    def test_parameters(self):
+        create_organisation("org-1")
+        import_patients(patient_resource())
+        url = reverse("changes")
+        bundle = self.client.get(url, {"_type": "Patient"}).json()
+        self.assertEqual([entry["resource"]["resourceType"] for entry in bundle["entry"]], ["Patient"])
+        self.assertEqual(self.client.get(url, {"_since": "2999-01-01T00:00:00Z"}).json()["entry"], [])
+        self.assertEqual(self.client.get(url, {"_type": "Unknown"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"_cursor": "x"}).status_code, 400)
+        self.assertEqual(latest_cursor(), changes(0, count=10)[1])
+
+    @override_settings(MEDUX_CHANGE_FEED_DELAY=60)
+    def test_delay(self):
+        create_organisation("org-1")
+        import_patients(patient_resource())
+        self.assertEqual(changes(0), ([], 0))
+        first, second = ResourceVersion.objects.order_by("pk")
+        # the later version is settled, but the one before may still be uncommitted - the feed waits for it
+        ResourceVersion.objects.filter(pk=second.pk).update(lastUpdated=timezone.now() - datetime.timedelta(minutes=2))
+        self.assertEqual(changes(0), ([], 0))
+        ResourceVersion.objects.filter(pk=first.pk).update(lastUpdated=timezone.now() - datetime.timedelta(minutes=2))
+        self.assertEqual(changes(0)[1], second.pk)
+
+
+@override_settings(MEDUX_CHANGE_FEED_DELAY=0)
+class SubscriptionTests(TestCase):
+
+    def setUp(self):
+        self.queue = temporary_directory(self)
+        self.subscription = Subscription.objects.create(criteria="Patient?gender=female", channel_type="queue",
+                                                        endpoint=self.queue)
+        # changes from before the activation aren't delivered
+        import_patients(patient_resource())
+        deliver_all()
+        self.subscription.refresh_from_db()
+
+    def notifications(self):
+        notifications = []
+        for name in sorted(os.listdir(self.queue)):
+            with open(os.path.join(self.queue, name), encoding="utf-8") as f:
+                notifications.append(json.load(f))
+        return notifications
+
+    def test_delivery(self):
+        self.assertEqual(self.subscription.status, "active")
+        self.assertEqual(self.subscription.cursor, latest_cursor())
+        female, male = import_patients(patient_resource(family="Gruber"), patient_resource(gender="male"))
+        self.assertEqual(deliver_all(), 1)
+        bundle, = self.notifications()
+        self.assertEqual(bundle["type"], "history")
+        self.assertEqual([entry["resource"]["id"] for entry in bundle["entry"]], [str(female.pk)])
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.cursor, latest_cursor())
+        self.assertIsNotNone(self.subscription.delivered)
+        # nothing to do for up to date subscriptions
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(deliver_all(), 0)
+        self.assertLessEqual(len(queries), 4)
+
+    def test_batches_without_payload(self):
+        Subscription.objects.filter(pk=self.subscription.pk).update(payload="")
+        import_patients(*[patient_resource(family="Huber{}".format(number)) for number in range(5)])
+        self.assertEqual(deliver_all(batch_size=2), 5)
+        notifications = self.notifications()
+        self.assertEqual([len(bundle["entry"]) for bundle in notifications], [2, 2, 1])
+        self.assertNotIn("resource", notifications[0]["entry"][0])
+
+    @override_settings(MEDUX_SUBSCRIPTION_MAX_FAILURES=2)
+    def test_failures(self):
+        import_patients(patient_resource())
+        cursor = self.subscription.cursor
+        with mock.patch.object(QueueSink, "send", side_effect=DeliveryError("disk full")):
+            with self.assertLogs("medux.core.subscriptions", "WARNING"):
+                deliver_all()
+            self.subscription.refresh_from_db()
+            self.assertEqual((self.subscription.failures, self.subscription.cursor), (1, cursor))
+            self.assertGreater(self.subscription.retry_after, timezone.now())
+            # backing off
+            self.assertEqual(deliver_all(), 0)
+            Subscription.objects.update(retry_after=None)
+            with self.assertLogs("medux.core.subscriptions", "WARNING"):
+                deliver_all()
+        self.subscription.refresh_from_db()
+        self.assertEqual((self.subscription.status, self.subscription.error), ("error", "disk full"))
+
+    def test_recovery(self):
+        import_patients(patient_resource())
+        with mock.patch.object(QueueSink, "send", side_effect=DeliveryError("disk full")), \
+                self.assertLogs("medux.core.subscriptions", "WARNING"):
+            deliver_all()
+        Subscription.objects.update(retry_after=None)
+        self.assertEqual(deliver_all(), 1)
+        self.subscription.refresh_from_db()
+        self.assertEqual((self.subscription.failures, self.subscription.error), (0, ""))
+
+    def test_invalid_criteria(self):
+        subscription = Subscription.objects.create(criteria="Patient?_sort=name", endpoint="http://example.org")
+        deliver_all()
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, "error")
+        self.assertIn("_sort", subscription.error)
+        with self.assertRaises(ValueError):
+            parse_criteria("Unknown?name=x")
+        self.assertEqual(parse_criteria("Patient?family=Hu"), ("Patient", [("family", "Hu")]))
+
+
+NAME_USE = "http://hl7.org/fhir/StructureDefinition/iso21090-EN-use"
+
+
+class ExtensionTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.patient, = import_patients(patient_resource(name=[{
+            "extension": [{"url": NAME_USE, "valueCode": "I"}], "family": "Huber", "given": ["Anna"]}]))
+        import_patients(patient_resource(family="Gruber"))
+
+    def test_round_trip(self):
+        response = self.client.get(reverse("read", args=["Patient", self.patient.pk]))
+        self.assertEqual(response.json()["name"][0]["extension"], [{"url": NAME_USE, "valueCode": "I"}])
+        # elements without extensions store NULL
+        self.assertEqual(HumanName.objects.filter(extensions__isnull=True).get().family, "Gruber")
+
+    def test_with_extension(self):
+        self.assertEqual([name.family for name in with_extension(HumanName.objects.all(), NAME_USE)], ["Huber"])
+        self.assertTrue(with_extension(HumanName.objects.all(), NAME_USE, {"valueCode": "I"}).exists())
+        self.assertFalse(with_extension(HumanName.objects.all(), NAME_USE, {"valueCode": "P"}).exists())
+        with self.assertRaises(ValueError):
+            with_extension(HumanName.objects.all(), "http://example.org/it's")
+
+    def test_index_extensions(self):
+        def indexes():
+            with connection.cursor() as cursor:
+                return [name for name in connection.introspection.get_constraints(cursor, Element._meta.db_table)
+                        if name.startswith("core_element_ext_")]
+
+        with override_settings(MEDUX_INDEXED_EXTENSIONS=[NAME_USE]):
+            call_command("index_extensions", stdout=io.StringIO())
+        self.assertEqual(indexes(), [extension_index_name(NAME_USE)])
+        with override_settings(MEDUX_INDEXED_EXTENSIONS=[]):
+            call_command("index_extensions", stdout=io.StringIO())
+        self.assertEqual(indexes(), [])
+
+    def test_invalid_extensions(self):
+        for extension in ({"url": NAME_USE}, {"url": NAME_USE, "valueCode": 1},
+                          {"url": NAME_USE, "valueCode": "I", "extension": [{"url": "a", "valueCode": "b"}]}):
+            with self.subTest(extension=extension), self.assertRaises(BundleError):
+                import_patients(patient_resource(name=[{"extension": [extension], "family": "Huber"}]))
+
+
+class MigrateExtensionsTests(TransactionTestCase):
+
+    def test_move_legacy_extensions(self):
+        owner = Element.objects.create()
+        # the old layout: Extension elements with a url, linked to the elements they extend
+        extensions = [Element.objects.create() for _ in range(3)]
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE core_extension (element_ptr_id integer PRIMARY KEY, url varchar(255))")
+            cursor.execute("CREATE TABLE core_element_extensions "
+                           "(id integer PRIMARY KEY, element_id integer, extension_id integer)")
+            for extension, url in zip(extensions, ("http://example.org/a", "http://example.org/b",
+                                                   "http://example.org/c")):
+                cursor.execute("INSERT INTO core_extension VALUES (%s, %s)", [extension.pk, url])
+            # a and b extend the element, c is nested in b
+            for id, (element, extension) in enumerate([(owner, extensions[0]), (owner, extensions[1]),
+                                                        (extensions[1], extensions[2])]):
+                cursor.execute("INSERT INTO core_element_extensions VALUES (%s, %s, %s)",
+                               [id, element.pk, extension.pk])
+
+        # none of them had a value, which FHIR requires
+        # like the migration, which disables the constraint checks of SQLite before its transaction
+        with self.assertRaisesMessage(UpgradeError, "http://example.org/b (1)"), \
+                connection.constraint_checks_disabled(), transaction.atomic():
+            move_legacy_extensions(connection)
+        self.assertIn("core_element_extensions", connection.introspection.table_names())
+
+        with self.assertLogs("medux.core.upgrades", "WARNING"):
+            moved, skipped = move_legacy_extensions(connection, discard=True)
+        self.assertEqual((moved, sum(skipped.values())), (0, 3))
+        owner.refresh_from_db()
+        self.assertEqual(owner.extensions, [])
+        tables = connection.introspection.table_names()
+        self.assertNotIn("core_extension", tables)
+        self.assertIn("core_element_extensions_legacy", tables)
+        # running it again does nothing
+        self.assertEqual(move_legacy_extensions(connection), (0, Counter()))
+
+        restore_legacy_extensions(connection)
+        self.assertIn("core_element_extensions", connection.introspection.table_names())
+
+
+class EverythingTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.organisations = [create_organisation("org-{}".format(number)) for number in range(3)]
+        self.patient, = import_patients(patient_resource(
+            managingOrganization={"reference": "Organization/org-1"},
+            # org-9 doesn't exist, so it isn't a member
+            generalPractitioner=[{"reference": "Organization/org-2"}, {"reference": "Organization/org-9"}]))
+        import_patients(patient_resource(family="Gruber", managingOrganization={"reference": "Organization/org-0"}))
+
+    def everything(self, **parameters):
+        response = self.client.get(reverse("everything", args=[self.patient.pk]), parameters)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content))
+
+    def members(self, bundle):
+        return [(entry["resource"]["resourceType"], entry["resource"]["id"], entry["search"]["mode"])
+                for entry in bundle["entry"]]
+
+    def test_everything(self):
+        bundle = self.everything()
+        self.assertEqual(bundle["total"], 3)
+        self.assertEqual(self.members(bundle), [("Patient", str(self.patient.pk), "match"),
+                                                ("Organization", "org-1", "include"),
+                                                ("Organization", "org-2", "include")])
+        self.assertEqual([link["relation"] for link in bundle["link"]], ["self"])
+
+    def test_paging(self):
+        members = []
+        parameters = {"_count": 2}
+        for _ in range(3):
+            bundle = self.everything(**parameters)
+            self.assertEqual(bundle["total"], 3)
+            members += self.members(bundle)
+            links = {link["relation"]: link["url"] for link in bundle["link"]}
+            if "next" not in links:
+                break
+            parameters["_cursor"] = parse_qs(urlsplit(links["next"]).query)["_cursor"][0]
+        self.assertEqual([member[:2] for member in members], [("Patient", str(self.patient.pk)),
+                                                              ("Organization", "org-1"), ("Organization", "org-2")])
+
+    def test_type_and_since(self):
+        bundle = self.everything(_type="Organization")
+        self.assertEqual(self.members(bundle), [("Organization", "org-1", "include"),
+                                                ("Organization", "org-2", "include")])
+        organisation = self.organisations[2]
+        organisation.language = "de"
+        organisation.save()
+        since = ResourceVersion.objects.get(resource_type="Organization", resource_id="org-2", current=True)
+        bundle = self.everything(_since=since.lastUpdated.isoformat())
+        self.assertEqual(self.members(bundle), [("Organization", "org-2", "include")])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get(reverse("everything", args=["unknown"])).status_code, 404)
+        self.assertEqual(self.client.get(reverse("everything", args=[self.patient.pk]),
+                                         {"_type": "Observation"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("everything", args=[self.patient.pk]),
+                                         {"_count": "all"}).status_code, 400)
+
+
+PROFILE = "http://medux.org/fhir/StructureDefinition/test-patient"
+
+
+def create_profile(url=PROFILE, elements=()):
+    return StructureDefinition.objects.create(
+        id=url.rpartition("/")[2], created=timezone.now(), security=security(), url=url, name="TestPatient",
+        status="active", experimental=False, description="", type="Patient", differential=json.dumps(elements))
+
+
+class ProfileTests(TestCase):
+
+    def setUp(self):
+        profiles.clear()
+        create_profile(elements=[
+            {"path": "Patient.identifier", "min": 1},
+            {"path": "Patient.gender", "fixedCode": "female"},
+            {"path": "Patient.birthDate", "type": [{"code": "date"}]},
+            {"path": "Patient.name", "max": "1"},
+            {"path": "Patient.name.family", "maxLength": 5},
+            {"path": "Patient.deceased[x]", "type": [{"code": "boolean"}]},
+        ])
+
+    def test_valid(self):
+        self.assertEqual(validate_resource(patient_resource(), [PROFILE]), [])
+
+    def test_errors(self):
+        resource = patient_resource(family="Hofbauer", gender="male", birth_date="17.05.1980",
+                                    deceasedDateTime="2017-03-01")
+        del resource["identifier"]
+        resource["name"].append({"family": "Huber"})
+        self.assertEqual(validate_resource(resource, [PROFILE]), [
+            "Patient.identifier: at least 1 required, found 0",
+            "Patient.gender: must be \"female\"",
+            "Patient.birthDate: '17.05.1980' is not a valid date",
+            "Patient.name: at most 1 allowed, found 2",
+            "Patient.name[0].family: longer than 5 characters",
+            "Patient.deceasedDateTime: the type DateTime is not allowed",
+        ])
+
+    def test_import_checks_meta_profile(self):
+        with self.assertRaises(BundleError):
+            import_patients(patient_resource(gender="male", meta={"profile": [PROFILE]}))
+        import_patients(patient_resource(meta={"profile": [PROFILE]}))
+        # unknown profiles are skipped
+        import_patients(patient_resource(gender="male", meta={"profile": [PROFILE + "-unknown"]}))
+
+    def test_validate_resources_command(self):
+        import_patients(patient_resource(), patient_resource(gender="male"))
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, "1 of 2 resources don't conform"):
+            call_command("validate_resources", PROFILE, stdout=out)
+        self.assertIn("Patient.gender: must be", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("validate_resources", PROFILE + "-unknown", stdout=out)
+
+    def test_cache(self):
+        self.assertIsNotNone(profiles.get(PROFILE))
+        self.assertIsNone(profiles.get(PROFILE + "-unknown"))
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(profiles.get(PROFILE))
+            self.assertIsNone(profiles.get(PROFILE + "-unknown"))
+        # cleared by the signal handlers
+        create_profile(PROFILE + "-unknown")
+        self.assertIsNotNone(profiles.get(PROFILE + "-unknown"))
+
+    def test_entries_expire(self):
+        # changes of other processes don't send signals here
+        cache = ProfileCache(timeout=60)
+        self.assertIsNone(cache.get(PROFILE + "-new"))
+        self.assertIsNotNone(cache.get(PROFILE))
+        StructureDefinition.objects.filter(url=PROFILE).update(url=PROFILE + "-new")
+        now = time.monotonic()
+        # profiles that weren't found are looked up again sooner
+        with mock.patch("medux.core.caches.time.monotonic", return_value=now + 10):
+            self.assertIsNotNone(cache.get(PROFILE + "-new"))
+            self.assertIsNotNone(cache.get(PROFILE))
+        with mock.patch("medux.core.caches.time.monotonic", return_value=now + 61):
+            self.assertIsNone(cache.get(PROFILE))
+
+
+def mrn(value):
+    return [{"system": "urn:medux:mrn", "value": value}]
+
+
+class MatchingTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.mueller, self.mueller_typo, self.gruber, self.huber = [patient.pk for patient in import_patients(
+            patient_resource(family="Müller", identifier=mrn("MRN1")),
+            patient_resource(family="Mueller", identifier=mrn("MRN2")),
+            patient_resource(family="Gruber", given=("Lena",), birth_date="1990-01-01", identifier=mrn("MRN3")),
+            # shares the identifier with the first one
+            patient_resource(family="Huber", given=("Hans",), birth_date="1970-01-01", identifier=mrn("MRN1")))]
+
+    def test_phonetic(self):
+        self.assertEqual({phonetic(name) for name in ("Müller", "Mueller", "Miller")}, {"657"})
+        self.assertNotEqual(phonetic("Gruber"), phonetic("Huber"))
+
+    def test_scores(self):
+        record = match_record(patient_resource(family="Müller"))
+        others = [match_record(patient_resource(family=family, birth_date=birth_date)) for family, birth_date in (
+            ("Müller", "1980-05-17"), ("Mueller", "1980-05-17"), ("Müller", "1980-17-05"), ("Gruber", "1990-01-01"))]
+        result = [float(score) for score in scores([record], others)[0]]
+        self.assertAlmostEqual(result[0], 1.0, places=4)
+        self.assertEqual([grade(score) for score in result], ["certain", "probable", "probable", "certainly-not"])
+        # a swapped day and month is closer than a different date
+        self.assertGreater(result[2], float(scores([record], [match_record(patient_resource(
+            family="Müller", birth_date="1980-06-18"))])[0][0]))
+
+    def post_match(self, resource, **parameters):
+        response = self.client.post(reverse("match"), json.dumps({"resourceType": "Parameters", "parameter": [
+            {"name": "resource", "resource": resource}] + [dict({"name": name}, **value)
+                                                           for name, value in parameters.items()]}),
+            content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 200)
+        return [(entry["resource"]["id"], entry["search"]["score"], entry["search"]["extension"][0]["valueCode"])
+                for entry in response.json()["entry"]]
+
+    def test_match(self):
+        matches = self.post_match(patient_resource(family="Müller", identifier=mrn("MRN9")))
+        self.assertEqual([(id, grade) for id, _, grade in matches],
+                         [(str(self.mueller), "certain"), (str(self.mueller_typo), "probable")])
+        self.assertAlmostEqual(matches[1][1], 0.93, places=2)
+        # a common identifier is a certain match
+        matches = self.post_match(patient_resource(family="Gruber", identifier=mrn("MRN1")), count={
+            "valueInteger": 5})
+        self.assertEqual({id for id, score, _ in matches if score == 1.0}, {str(self.mueller), str(self.huber)})
+        self.assertEqual(self.post_match(patient_resource(family="Müller", identifier=mrn("MRN9")),
+                                         onlyCertainMatches={"valueBoolean": True}),
+                         [(str(self.mueller), 1.0, "certain")])
+
+    def test_match_errors(self):
+        response = self.client.post(reverse("match"), json.dumps({"resourceType": "Patient"}),
+                                    content_type=FHIR_JSON)
+        self.assertEqual(response.status_code, 400)
+
+    def test_find_duplicates(self):
+        pairs = {frozenset(pair[:2]): pair[2] for pair in find_duplicates()}
+        self.assertEqual(set(pairs), {frozenset((str(self.mueller), str(self.huber))),
+                                      frozenset((str(self.mueller), str(self.mueller_typo)))})
+        self.assertEqual(pairs[frozenset((str(self.mueller), str(self.huber)))], 1.0)
+        self.assertAlmostEqual(pairs[frozenset((str(self.mueller), str(self.mueller_typo)))], 0.93, places=2)
+        # Patients without a common blocking key or identifier are never compared
+        self.assertEqual(len(list(find_duplicates(min_score=0))), 2)
+
+    def test_find_duplicates_command(self):
+        output = os.path.join(temporary_directory(self), "duplicates.tsv")
+        call_command("find_duplicates", output=output, stdout=io.StringIO())
+        with open(output, encoding="utf-8") as stream:
+            rows = sorted(line.rstrip("\n").split("\t")[2:] for line in stream)
+        self.assertEqual(rows, [["0.9300", "probable"], ["1.0000", "certain"]])
+
+
+class PeriodTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(api_user())
+        self.patient, = import_patients(patient_resource(address=[
+            {"use": "old", "city": "Graz", "period": {"start": "2000-01-01T00:00:00+00:00",
+                                                       "end": "2009-12-31T23:59:59+00:00"}},
+            {"use": "home", "city": "Wien", "period": {"start": "2010-01-01T00:00:00+00:00"}},
+            {"use": "work", "city": "Linz"},
+        ]))
+
+    def cities(self, instant=None):
+        return sorted(self.patient.address.valid_at(instant).values_list("city", flat=True))
+
+    def instant(self, value):
+        return datetime.datetime.fromisoformat(value)
+
+    def test_valid_at(self):
+        # addresses without a period are always valid
+        self.assertEqual(self.cities(), ["Linz", "Wien"])
+        self.assertEqual(self.cities(self.instant("2005-06-01T00:00:00+00:00")), ["Graz", "Linz"])
+        self.assertEqual(self.cities(self.instant("1999-06-01T00:00:00+00:00")), ["Linz"])
+        # both ends are part of the period
+        self.assertEqual(self.cities(self.instant("2009-12-31T23:59:59+00:00")), ["Graz", "Linz"])
+        self.assertEqual(self.cities(self.instant("2010-01-01T00:00:00+00:00")), ["Linz", "Wien"])
+
+    def test_open_ends(self):
+        addresses = {address.city: address for address in self.patient.address.all()}
+        self.assertIsNone(addresses["Linz"].period)
+        self.assertEqual(addresses["Wien"].period, Period(self.instant("2010-01-01T00:00:00+00:00"), None))
+        self.assertEqual(addresses["Wien"].period_end, PERIOD_MAX)
+        address = addresses["Linz"]
+        address.period = Period(None, self.instant("2020-01-01T00:00:00+00:00"))
+        address.save()
+        self.assertEqual(self.cities(self.instant("2021-01-01T00:00:00+00:00")), ["Wien"])
+
+    def test_open_ends_in_time_zones(self):
+        for hours in (-12, 14):
+            zone = datetime.timezone(datetime.timedelta(hours=hours))
+            self.assertLess(timezone.localtime(PERIOD_MIN, zone), timezone.localtime(PERIOD_MAX, zone))
+
+    def test_date_ends(self):
+        # the period includes the whole last day
+        patient, = import_patients(patient_resource(address=[{"city": "Salzburg", "period": {"end": "2009-12-31"}}]))
+        self.assertTrue(patient.address.valid_at(self.instant("2009-12-31T18:00:00+00:00")).exists())
+        self.assertFalse(patient.address.valid_at(self.instant("2010-01-01T00:00:00+00:00")).exists())
+
+    def test_fhir(self):
+        response = self.client.get(reverse("read", args=["Patient", self.patient.pk]))
+        periods = {address["city"]: address.get("period") for address in response.json()["address"]}
+        self.assertEqual(periods["Wien"], {"start": "2010-01-01T00:00:00+00:00"})
+        self.assertIsNone(periods["Linz"])
+        self.assertEqual(set(periods["Graz"]), {"start", "end"})
+
+
+class MigratePeriodsTests(TransactionTestCase):
+
+    def columns(self):
+        with connection.cursor() as cursor:
+            return {column.name for column in connection.introspection.get_table_description(
+                cursor, Address._meta.db_table)}
+
+    def test_move_legacy_periods(self):
+        patient, = import_patients(patient_resource())
+        address = patient.address.get()
+        # the old layout: a ForeignKey to the Period table
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE core_period (id integer PRIMARY KEY, start datetime NULL, "end" datetime NULL)')
+            cursor.execute("INSERT INTO core_period VALUES (1, '2010-01-01 00:00:00', NULL)")
+            cursor.execute("ALTER TABLE {} ADD COLUMN period_id integer NULL".format(Address._meta.db_table))
+            cursor.execute("UPDATE {} SET period_id = 1".format(Address._meta.db_table))
+        self.assertEqual(move_legacy_periods(connection), 1)
+
+        address.refresh_from_db()
+        self.assertEqual(address.period, Period(datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc), None))
+        self.assertNotIn("period_id", self.columns())
+        self.assertNotIn("core_period", connection.introspection.table_names())
+        # running it again does nothing
+        self.assertEqual(move_legacy_periods(connection), 0)
@@ -0,0 +1,333 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.color import no_style
+
+from medux.core.models import FLAT_RESOURCES, Address, ContactPoint, Element, Identifier, Resource, StructureDefinition
+
+# Conversions of databases created with older layouts of the models, run by the migration
+# 0002_unmigrated_databases. Each one looks at the tables that actually exist, so they do
+# nothing on new databases, and nothing when run again.
+
+__all__ = ["UpgradeError", "flatten_resources", "move_legacy_extensions", "move_legacy_periods",
+           "restore_legacy_extensions"]
+
+logger = logging.getLogger(__name__)
+
+# The table of the old period layout, where the elements had a ForeignKey "period" to it
+PERIOD_TABLE = "core_period"
+PERIOD_COLUMN = "period_id"
+
+# The tables of the old extension layout, where extensions were Elements themselves, linked by a M2M field.
+# They are kept under the LEGACY_SUFFIX names after moving the extensions, so that it can be undone.
+EXTENSION_TABLE = "core_extension"
+THROUGH_TABLE = "core_element_extensions"
+LEGACY_SUFFIX = "_legacy"
+
+# The tables of the multi-table inheritance layout that don't exist any more in the flat one
+RESOURCE_TABLE = "core_resource"
+DOMAIN_RESOURCE_TABLE = "core_domainresource"
+PROFILE_TABLE = "core_resource_profile"
+CONTAINED_TABLE = "core_domainresource_contained"
+
+# elements per batch, and values per IN list
+BATCH_SIZE = 500
+
+
+class UpgradeError(Exception):
+    """A database can't be converted without losing data, which has to be allowed explicitly"""
+
+
+def move_legacy_periods(using_connection):
+    """Moves the periods of identifiers, contact points and addresses from the old Period table into their
+    inline period columns, and drops it. Returns the number of moved periods."""
+    if PERIOD_TABLE not in using_connection.introspection.table_names():
+        return 0
+    quote = using_connection.ops.quote_name
+    moved = 0
+    with using_connection.schema_editor() as editor:
+        for model in (Identifier, ContactPoint, Address):
+            table = model._meta.db_table
+            with using_connection.cursor() as cursor:
+                columns = {column.name for column in
+                           using_connection.introspection.get_table_description(cursor, table)}
+            for name in ("period_start", "period_end"):
+                if name not in columns:
+                    # not editor.add_field(), which rebuilds the table from the model on SQLite - without period_id
+                    definition, params = editor.column_sql(model, model._meta.get_field(name), include_default=True)
+                    editor.execute(editor.sql_create_column % {
+                        "table": quote(table), "column": quote(name),
+                        "definition": definition % tuple(editor.quote_value(param) for param in params)})
+            with using_connection.cursor() as cursor:
+                constraints = using_connection.introspection.get_constraints(cursor, table)
+            for index in model._meta.indexes:
+                if "period_start" in index.fields and index.name not in constraints:
+                    editor.add_index(model, index)
+            if PERIOD_COLUMN not in columns:
+                continue
+
+            # open ends get the defaults of the inline columns
+            for name, old_name in (("period_start", "start"), ("period_end", "end")):
+                field = model._meta.get_field(name)
+                editor.execute("UPDATE {table} SET {column} = COALESCE((SELECT {old_column} FROM {periods} "
+                               "WHERE {periods}.{id} = {table}.{period}), %s) WHERE {period} IS NOT NULL".format(
+                                   table=quote(table), column=quote(field.column), old_column=quote(old_name),
+                                   periods=quote(PERIOD_TABLE), id=quote("id"), period=quote(PERIOD_COLUMN)),
+                               [field.get_db_prep_value(field.default, using_connection)])
+            with using_connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM {} WHERE {} IS NOT NULL".format(
+                    quote(table), quote(PERIOD_COLUMN)))
+                moved += cursor.fetchone()[0]
+
+            if using_connection.vendor == "sqlite":
+                # SQLite can't drop a column with a foreign key, the table is rebuilt from the model instead
+                editor._remake_table(model)
+                continue
+            for name, constraint in constraints.items():
+                if constraint["foreign_key"] and constraint["columns"] == [PERIOD_COLUMN]:
+                    editor.execute(editor.sql_delete_fk % {"table": quote(table), "name": quote(name)})
+            editor.execute(editor.sql_delete_column % {"table": quote(table), "column": quote(PERIOD_COLUMN)})
+        editor.execute(editor.sql_delete_table % {"table": quote(PERIOD_TABLE)})
+    return moved
+
+
+def move_legacy_extensions(using_connection, discard=None):
+    """Moves the extensions of elements from the old Extension table into their inline extensions column.
+
+    The old layout never stored values, and an extension without value and without nested extensions
+    is invalid (ext-1), so those can't be moved. Unless discard (default: MEDUX_DISCARD_INVALID_EXTENSIONS)
+    is true, UpgradeError is raised then, after writing the valid ones - the caller's transaction has to
+    be rolled back. The old tables (and the Extension elements) are kept, the tables under new names, so that
+    restore_legacy_extensions() can undo this.
+    Returns the number of elements with moved extensions, and the number of discarded extensions per url."""
+    tables = using_connection.introspection.table_names()
+    if THROUGH_TABLE not in tables:
+        return 0, Counter()
+    if discard is None:
+        discard = getattr(settings, "MEDUX_DISCARD_INVALID_EXTENSIONS", False)
+    quote = using_connection.ops.quote_name
+    field = Element._meta.get_field("extensions")
+    with using_connection.cursor() as cursor:
+        columns = {column.name for column in
+                   using_connection.introspection.get_table_description(cursor, Element._meta.db_table)}
+
+    moved = 0
+    # url -> number of extensions which couldn't be moved
+    skipped = Counter()
+    with using_connection.schema_editor() as editor:
+        if field.column not in columns:
+            editor.add_field(Element, field)
+        for owners in _owner_batches(using_connection):
+            children, urls = _extension_tree(using_connection, owners)
+
+            def to_fhir(extension, seen):
+                nested = [data for data in (to_fhir(child, seen | {child}) for child in children.get(extension, [])
+                                            if child not in seen) if data is not None]
+                if not nested:
+                    skipped[urls[extension]] += 1
+                    return None
+                return {"url": urls[extension], "extension": nested}
+
+            # the Extension elements themselves become part of the elements they extend
+            elements = []
+            for owner in owners:
+                extensions = [data for data in (to_fhir(extension, {extension})
+                                                for extension in children.get(owner, [])) if data is not None]
+                if extensions:
+                    elements.append(Element(pk=owner, extensions=extensions))
+            Element.objects.using(using_connection.alias).bulk_update(elements, ["extensions"])
+            moved += len(elements)
+
+        if skipped and not discard:
+            raise UpgradeError(
+                "{} extensions have neither a value nor nested extensions, which FHIR requires - the old layout "
+                "couldn't store values: {}. Set MEDUX_DISCARD_INVALID_EXTENSIONS = True to discard them.".format(
+                    sum(skipped.values()), ", ".join("{} ({})".format(url, count)
+                                                     for url, count in skipped.most_common())))
+        for table in (THROUGH_TABLE, EXTENSION_TABLE):
+            editor.execute(editor.sql_rename_table % {"old_table": quote(table),
+                                                      "new_table": quote(table + LEGACY_SUFFIX)})
+    if skipped:
+        logger.warning("Discarded %d extensions without value", sum(skipped.values()))
+    return moved, skipped
+
+
+def restore_legacy_extensions(using_connection):
+    """Undoes move_legacy_extensions(): restores the old tables, and removes the moved extensions"""
+    if THROUGH_TABLE + LEGACY_SUFFIX not in using_connection.introspection.table_names():
+        return
+    quote = using_connection.ops.quote_name
+    with using_connection.schema_editor() as editor:
+        for table in (THROUGH_TABLE, EXTENSION_TABLE):
+            editor.execute(editor.sql_rename_table % {"old_table": quote(table + LEGACY_SUFFIX),
+                                                      "new_table": quote(table)})
+        editor.execute("UPDATE {element} SET {extensions} = NULL WHERE {pk} IN (SELECT {owner} FROM {through})".format(
+            element=quote(Element._meta.db_table), extensions=quote(Element._meta.get_field("extensions").column),
+            pk=quote(Element._meta.pk.column), owner=quote("element_id"), through=quote(THROUGH_TABLE)))
+
+
+def _owner_batches(using_connection):
+    """Yields lists of the ids of the elements with extensions, which aren't extensions themselves,
+    in batches ordered by id"""
+    quote = using_connection.ops.quote_name
+    sql = ("SELECT DISTINCT t.{element} FROM {through} t WHERE t.{element} > %s AND NOT EXISTS "
+           "(SELECT 1 FROM {extension} e WHERE e.{ptr} = t.{element}) ORDER BY t.{element}").format(
+        element=quote("element_id"), through=quote(THROUGH_TABLE), extension=quote(EXTENSION_TABLE),
+        ptr=quote("element_ptr_id"))
+    last = 0
+    while True:
+        with using_connection.cursor() as cursor:
+            cursor.execute("{} {}".format(sql, using_connection.ops.limit_offset_sql(0, BATCH_SIZE)), [last])
+            owners = [row[0] for row in cursor.fetchall()]
+        if not owners:
+            return
+        yield owners
+        last = owners[-1]
+
+
+def _extension_tree(using_connection, owners):
+    """Returns the extension ids per element ({element: [extension, ...]}), and the urls of the extensions,
+    for the given elements and all extensions nested below them"""
+    quote = using_connection.ops.quote_name
+    sql = ("SELECT t.{element}, t.{extension_id}, e.{url} FROM {through} t INNER JOIN {extension} e "
+           "ON e.{ptr} = t.{extension_id} WHERE t.{element} IN ({{}}) ORDER BY t.{id}").format(
+        element=quote("element_id"), extension_id=quote("extension_id"), url=quote("url"),
+        through=quote(THROUGH_TABLE), extension=quote(EXTENSION_TABLE), ptr=quote("element_ptr_id"),
+        id=quote("id"))
+    children = {}
+    urls = {}
+    level = owners
+    while level:
+        next_level = []
+        for start in range(0, len(level), BATCH_SIZE):
+            batch = level[start:start + BATCH_SIZE]
+            with using_connection.cursor() as cursor:
+                cursor.execute(sql.format(", ".join(["%s"] * len(batch))), batch)
+                rows = cursor.fetchall()
+            for element, extension, url in rows:
+                children.setdefault(element, []).append(extension)
+                if extension not in urls:
+                    urls[extension] = url
+                    next_level.append(extension)
+        level = next_level
+    return children, urls
+
+
+def flatten_resources(using_connection, drop_contained=False):
+    """Converts the resource tables from multi-table inheritance to the MEDUX_FLAT_RESOURCES layout.
+
+    Does nothing without the setting, or if they are flat already. Links to contained resources can't
+    be converted: UpgradeError is raised if there are any, unless drop_contained is true.
+    Returns the converted models."""
+    if not FLAT_RESOURCES or RESOURCE_TABLE not in using_connection.introspection.table_names():
+        return []
+    with using_connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM {}".format(using_connection.ops.quote_name(CONTAINED_TABLE)))
+        contained = cursor.fetchone()[0]
+    if contained and not drop_contained:
+        raise UpgradeError("There are {} links to contained resources, which can't be converted. "
+                           "Drop them with \"manage.py flatten_resources --drop-contained\".".format(contained))
+
+    # StructureDefinitions first, as all resources refer to them as profiles
+    resource_models = sorted((model for model in apps.get_app_config("core").get_models()
+                              if issubclass(model, Resource)), key=lambda model: model is not StructureDefinition)
+    # SQLite can't rename tables that are referred to within a transaction
+    with using_connection.schema_editor(atomic=using_connection.vendor != "sqlite") as editor:
+        for model in resource_models:
+            _flatten(editor, model)
+        for table in (PROFILE_TABLE, CONTAINED_TABLE, DOMAIN_RESOURCE_TABLE, RESOURCE_TABLE):
+            editor.execute(editor.sql_delete_table % {"table": editor.quote_name(table)})
+        # the copied through table rows keep their ids
+        through_models = [field.remote_field.through for model in resource_models
+                          for field in model._meta.local_many_to_many]
+        for sql in using_connection.ops.sequence_reset_sql(no_style(), through_models):
+            editor.execute(sql)
+    return resource_models
+
+
+def _flatten(editor, model):
+    """Moves the rows of one resource model into its new, flat table"""
+    connection = editor.connection
+    quote = editor.quote_name
+    table = model._meta.db_table
+    old_tables = {table: table + "_mti"}
+    for field in model._meta.local_many_to_many:
+        through = field.remote_field.through
+        if field.name != "profile" and through._meta.auto_created:
+            old_tables[through._meta.db_table] = through._meta.db_table + "_mti"
+    for old, new in old_tables.items():
+        editor.execute(editor.sql_rename_table % {"old_table": quote(old), "new_table": quote(new)})
+    editor.create_model(model)
+
+    # every column comes from one of the three old tables, which all share the primary key
+    with connection.cursor() as cursor:
+        columns = {
+            "r": {column.name for column in connection.introspection.get_table_description(cursor, RESOURCE_TABLE)},
+            "d": {column.name for column in
+                  connection.introspection.get_table_description(cursor, DOMAIN_RESOURCE_TABLE)},
+            "x": {column.name for column in
+                  connection.introspection.get_table_description(cursor, old_tables[table])},
+        }
+    targets = []
+    sources = []
+    params = []
+    for field in model._meta.concrete_fields:
+        targets.append(quote(field.column))
+        alias = next((alias for alias in ("r", "d", "x") if field.column in columns[alias]), None)
+        if alias is None:
+            # new in the flat layout, like DomainResource.contained
+            sources.append("%s")
+            params.append(editor.effective_default(field))
+        else:
+            sources.append("{}.{}".format(alias, quote(field.column)))
+    editor.execute(
+        "INSERT INTO {table} ({targets}) SELECT {sources} FROM {old} x "
+        "INNER JOIN {domain_resource} d ON d.{resource_ptr} = x.{domain_resource_ptr} "
+        "INNER JOIN {resource} r ON r.{pk} = d.{resource_ptr}".format(
+            table=quote(table), targets=", ".join(targets), sources=", ".join(sources),
+            old=quote(old_tables[table]), domain_resource=quote(DOMAIN_RESOURCE_TABLE),
+            resource=quote(RESOURCE_TABLE), resource_ptr=quote("resource_ptr_id"),
+            domain_resource_ptr=quote("domainresource_ptr_id"), pk=quote(model._meta.pk.column)), params)
+
+    for field in model._meta.local_many_to_many:
+        through = field.remote_field.through
+        if not through._meta.auto_created:
+            continue
+        source, target = quote(field.m2m_column_name()), quote(field.m2m_reverse_name())
+        if field.name == "profile":
+            # the profiles of all resources were in one table
+            editor.execute(
+                "INSERT INTO {through} ({source}, {target}) SELECT p.{resource}, p.{profile} FROM {old} p "
+                "INNER JOIN {table} t ON t.{pk} = p.{resource}".format(
+                    through=quote(through._meta.db_table), source=source, target=target, old=quote(PROFILE_TABLE),
+                    resource=quote("resource_id"), profile=quote("structuredefinition_id"), table=quote(table),
+                    pk=quote(model._meta.pk.column)))
+        else:
+            columns = ", ".join(quote(column)
+                                for column in ("id", field.m2m_column_name(), field.m2m_reverse_name()))
+            editor.execute("INSERT INTO {} ({columns}) SELECT {columns} FROM {}".format(
+                quote(through._meta.db_table), quote(old_tables[through._meta.db_table]), columns=columns))
+
+    for old in reversed(list(old_tables.values())):
+        editor.execute(editor.sql_delete_table % {"table": quote(old)})
+    logger.info("%s: %s -> %s", model.__name__, ", ".join(old_tables.values()), table)
@@ -0,0 +1,48 @@
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.conf.urls import url
+
+from medux.core import views
+
+# FHIR RESTful API, see http://hl7.org/fhir/http.html
+urlpatterns = [
+    url(r'^$', views.process_bundle, name='process_bundle'),
+    url(r'^\$export$', views.export_kickoff, name='export_kickoff'),
+    url(r'^(?P<resource_type>Patient)/\$export$', views.export_kickoff, name='export_kickoff'),
+    url(r'^\$export-status/(?P<job_id>[0-9a-f-]+)$', views.export_status, name='export_status'),
+    url(r'^\$export-file/(?P<job_id>[0-9a-f-]+)/(?P<resource_type>[A-Za-z]+)\.ndjson$', views.export_download,
+        name='export_download'),
+    url(r'^ValueSet/\$expand$', views.expand, name='expand'),
+    url(r'^ValueSet/\$validate-code$', views.validate_code, name='validate_code'),
+    url(r'^ValueSet/(?P<id>[A-Za-z0-9\-\.]{1,64})/\$validate-code$', views.validate_code, name='validate_code'),
+    url(r'^Binary$', views.binary_upload, name='binary_upload'),
+    url(r'^Binary/(?P<key>[0-9a-f]{40})$', views.binary_download, name='binary_download'),
+    url(r'^\$graphql$', views.graphql, name='graphql'),
+    url(r'^\$changes$', views.change_feed, name='changes'),
+    url(r'^Patient/(?P<id>[A-Za-z0-9\-\.]{1,64})/\$everything$', views.everything, name='everything'),
+    url(r'^Patient/\$match$', views.match, name='match'),
+    url(r'^_history$', views.resource_history, name='history'),
+    url(r'^(?P<resource_type>[A-Za-z]+)$', views.search, name='search'),
+    url(r'^(?P<resource_type>[A-Za-z]+)/_history$', views.resource_history, name='history'),
+    url(r'^(?P<resource_type>[A-Za-z]+)/(?P<id>[A-Za-z0-9\-\.]{1,64})$', views.read, name='read'),
+    url(r'^(?P<resource_type>[A-Za-z]+)/(?P<id>[A-Za-z0-9\-\.]{1,64})/_history$', views.resource_history,
+        name='history'),
+    url(r'^(?P<resource_type>[A-Za-z]+)/(?P<id>[A-Za-z0-9\-\.]{1,64})/_history/(?P<version_id>[0-9]{1,9})$',
+        views.vread, name='vread'),
+]
@@ -16,6 +16,774 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from django.shortcuts import render
+import base64
+import binascii
+import json
+import os
+from functools import wraps
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.auth import authenticate, get_permission_codename
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+
+from medux.core.blobs import BlobTooLargeError, encode_hash, get_blob_store, max_blob_size
+from medux.core.bundle import BundleError, BundleImporter
+from medux.core.code_search import DEFAULT_LIMIT as DEFAULT_CODE_COUNT, search_codes
+from medux.core.compartments import (DEFAULT_COUNT as DEFAULT_EVERYTHING_COUNT, MAX_COUNT as MAX_EVERYTHING_COUNT,
+                                     compartment_page, iter_entries, stored_resources)
+from medux.core.documents import current_document, document_store_enabled
+from medux.core.export import EXPORT_TYPES, export_file, start_export
+from medux.core.fhir import RESOURCE_TYPES, attachment_to_fhir, requested_elements, resource_queryset, to_fhir
+from medux.core.history import (changes, current_version, current_versions, get_version, history, history_bundle,
+                                history_entry, with_version_meta)
+from medux.core.instrumentation import metrics as instrumentation_metrics
+from medux.core.matching import (DEFAULT_COUNT as DEFAULT_MATCH_COUNT, MATCH_GRADE_URL, MAX_COUNT as MAX_MATCH_COUNT,
+                                 grade, match as match_patients)
+from medux.core.models import Attachment, ExportJob, ValueSet
+from medux.core.response_cache import get_response_cache
+from medux.core.schema import execute_query
+from medux.core.search import (DEFAULT_COUNT, MAX_COUNT, SEARCH_PARAMETERS, SearchError, search as search_index,
+                               search_count)
+from medux.core.streaming import iter_file, streaming_content
+from medux.core.terminology import expansions
+
+FHIR_JSON = "application/fhir+json"
+
+
+def operation_outcome(message, code="invalid", status=400):
+    """Returns a FHIR OperationOutcome response with one error issue"""
+    return JsonResponse({
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": code, "diagnostics": message}],
+    }, status=status, content_type=FHIR_JSON)
+
+
+# Authentication and permissions of the FHIR API.
+#
+# Browsers use the session of the admin login, and need a CSRF token for unsafe methods then. Other
+# clients send the username and password of a Django user with every request (HTTP Basic), which
+# needs no CSRF token, as no browser sends it on its own. Resources need the model permissions of
+# their type: "view" to read and search them, "add" and "change" to write them.
+
+def _basic_auth_user(request):
+    """Returns the user of the "Authorization: Basic ..." header, or None"""
+    scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    if scheme.lower() != "basic":
+        return None
+    try:
+        username, _, password = base64.b64decode(credentials.strip(), validate=True).decode("utf-8").partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    return authenticate(request, username=username, password=password)
+
+
+def _api_user(request):
+    """Authenticates a request to the API by its session or HTTP Basic.
+
+    Returns (user, None), or (None, the response rejecting the request)."""
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        user = _basic_auth_user(request)
+        if user is None:
+            response = operation_outcome("Authentication required", code="login", status=401)
+            response["WWW-Authenticate"] = 'Basic realm="MedUX"'
+            return None, response
+        request.user = user
+    elif request.method not in ("GET", "HEAD", "OPTIONS", "TRACE"):
+        # like the CsrfViewMiddleware would, which skips the API views for the Basic authenticated clients
+        check = CsrfViewMiddleware(lambda request: None)
+        check.process_request(request)
+        if check.process_view(request, None, (), {}) is not None:
+            return None, operation_outcome("CSRF verification failed", code="forbidden", status=403)
+    return user, None
+
+
+def resource_permissions(actions, resource_types):
+    """Returns the names of the model permissions ("core.view_patient") of actions on FHIR resource types"""
+    return ["{}.{}".format(RESOURCE_TYPES[resource_type]._meta.app_label,
+                           get_permission_codename(action, RESOURCE_TYPES[resource_type]._meta))
+            for resource_type in resource_types if resource_type in RESOURCE_TYPES for action in actions]
+
+
+def fhir_api(*actions, resource_types=None):
+    """Decorator of the FHIR API views: requires an authenticated user, with the permissions of the
+    actions ("view", "add", "change" or "delete") on the resource types.
+
+    Without resource_types, these are the resource_type argument of the view, or all resource types
+    if it has none. Unknown resource types are left to the view."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            user, rejected = _api_user(request)
+            if rejected is not None:
+                return rejected
+
+            types = resource_types
+            if types is None:
+                types = [kwargs["resource_type"]] if kwargs.get("resource_type") else list(RESOURCE_TYPES)
+            if not user.has_perms(resource_permissions(actions, types)):
+                return operation_outcome("Permission denied", code="forbidden", status=403)
+            return view(request, *args, **kwargs)
+
+        # the CSRF check is done above, for session authenticated requests only
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+@fhir_api("add", "change", resource_types=["Patient"])
+@require_POST
+def process_bundle(request):
+    """Processes a FHIR transaction/batch Bundle POSTed to the base URL.
+
+    http://hl7.org/fhir/http.html#transaction
+    The request body is read as stream, so the Bundle is never loaded completely into memory.
+    """
+    try:
+        responses = BundleImporter().run(request)
+    except BundleError as e:
+        return operation_outcome(str(e))
+    return JsonResponse({
+        "resourceType": "Bundle",
+        "type": "transaction-response",
+        "entry": responses,
+    }, content_type=FHIR_JSON)
+
+
+# Attachments are no resources, the views check the permissions of their model
+@fhir_api("add", resource_types=())
+@require_POST
+def binary_upload(request):
+    """Stores the request body in the blob store, and creates an Attachment for it.
+
+    The body is read in chunks and hashed on the way, so uploads of any size never have to fit into
+    memory. Bodies larger than MEDUX_BLOB_MAX_SIZE are rejected while they are read. Returns the
+    Attachment as FHIR JSON; its url is where the data can be downloaded.
+    """
+    if not request.user.has_perm("core.add_attachment"):
+        return operation_outcome("Permission denied", code="forbidden", status=403)
+    max_size = max_blob_size()
+    # rejected before anything is read, if the client tells the size
+    content_length = request.META.get("CONTENT_LENGTH", "")
+    too_large = max_size is not None and content_length.isdigit() and int(content_length) > max_size
+    if not too_large:
+        try:
+            key, size = get_blob_store().save(request, max_size=max_size)
+        except BlobTooLargeError:
+            too_large = True
+    if too_large:
+        return operation_outcome("The content is larger than {} bytes".format(max_size), code="too-long", status=413)
+    attachment = Attachment.objects.create(
+        contentType=request.META.get("CONTENT_TYPE") or "application/octet-stream",
+        url=request.build_absolute_uri(reverse("binary_download", args=[key])),
+        size=size,
+        hash=encode_hash(key),
+        title=request.GET.get("title", ""),
+        creation=timezone.now(),
+    )
+    response = JsonResponse(attachment_to_fhir(attachment), status=201, content_type=FHIR_JSON)
+    response["Location"] = attachment.url
+    return response
+
+
+def _parse_range(header, size):
+    """Returns (start, end) of a "Range: bytes=..." header, None for the whole content,
+    or False if the range can't be satisfied. Multiple ranges are answered with the whole content."""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].strip().partition("-")
+    try:
+        if not start:
+            # the last n bytes
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+@fhir_api("view", resource_types=())
+@require_GET
+def binary_download(request, key):
+    """Streams the data of an Attachment from the blob store, supporting range requests"""
+    if not request.user.has_perm("core.view_attachment"):
+        return operation_outcome("Permission denied", code="forbidden", status=403)
+    store = get_blob_store()
+    if not store.exists(key):
+        raise Http404
+    size = store.size(key)
+    content_type = Attachment.objects.filter(hash=encode_hash(key)).values_list("contentType", flat=True).first()
+
+    byte_range = _parse_range(request.META.get("HTTP_RANGE", ""), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */{}".format(size)
+        return response
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(streaming_content(request, store.iter_range(key, start, end)),
+                                     status=206 if byte_range else 200,
+                                     content_type=content_type or "application/octet-stream")
+    if byte_range:
+        response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+    response["Content-Length"] = str(end - start + 1)
+    response["Accept-Ranges"] = "bytes"
+    # the content of a key never changes
+    response["ETag"] = '"{}"'.format(key)
+    return response
+
+
+# the permissions of the exported resource types are checked by the views
+@fhir_api("view", resource_types=())
+@require_GET
+def export_kickoff(request, resource_type=None):
+    """Kick-off request of a FHIR Bulk Data export.
+
+    http://hl7.org/fhir/uv/bulkdata/export/index.html#bulk-data-kick-off-request
+    ``[base]/$export`` exports all supported resources, ``[base]/Patient/$export`` only those in the
+    compartments of the Patients.
+    """
+    if request.META.get("HTTP_PREFER") != "respond-async":
+        return operation_outcome("The $export operation requires the header 'Prefer: respond-async'")
+    output_format = request.GET.get("_outputFormat", "application/fhir+ndjson")
+    if output_format not in ("application/fhir+ndjson", "application/ndjson", "ndjson"):
+        return operation_outcome("Unsupported _outputFormat: {}".format(output_format), code="not-supported")
+    if "_since" in request.GET:
+        return operation_outcome("The _since parameter is not supported yet", code="not-supported")
+
+    types = list(EXPORT_TYPES)
+    if "_type" in request.GET:
+        types = [t for t in request.GET["_type"].split(",") if t]
+        unknown = [t for t in types if t not in EXPORT_TYPES]
+        if unknown:
+            return operation_outcome("Can't export resource type(s): {}".format(", ".join(unknown)),
+                                     code="not-supported")
+    if not request.user.has_perms(resource_permissions(["view"], types)):
+        return operation_outcome("Permission denied", code="forbidden", status=403)
+
+    job = ExportJob.objects.create(user=request.user, request=request.build_absolute_uri(), types=",".join(types),
+                                   compartment=resource_type or "")
+    start_export(job)
+    response = HttpResponse(status=202)
+    response["Content-Location"] = request.build_absolute_uri(reverse("export_status", args=[job.pk]))
+    return response
+
+
+@fhir_api("view", resource_types=())
+@require_http_methods(["GET", "DELETE"])
+def export_status(request, job_id):
+    """Status request of a FHIR Bulk Data export, DELETE cancels it.
+
+    http://hl7.org/fhir/uv/bulkdata/export/index.html#bulk-data-status-request
+    Other users than the one who requested the export get a 404.
+    """
+    job = get_object_or_404(ExportJob, pk=job_id, user=request.user)
+
+    if request.method == "DELETE":
+        if job.status in ("accepted", "in-progress"):
+            ExportJob.objects.filter(pk=job.pk).update(status="cancelled")
+        return HttpResponse(status=202)
+
+    if job.status in ("accepted", "in-progress"):
+        response = HttpResponse(status=202)
+        response["X-Progress"] = job.status
+        response["Retry-After"] = "10"
+        return response
+    if job.status == "cancelled":
+        return operation_outcome("Export was cancelled", code="not-found", status=404)
+    if job.status == "error":
+        return operation_outcome(job.error, code="exception", status=500)
+
+    counts = json.loads(job.output)
+    return JsonResponse({
+        "transactionTime": job.created.isoformat(),
+        "request": job.request,
+        "requiresAccessToken": True,
+        "output": [{
+            "type": resource_type,
+            "url": request.build_absolute_uri(reverse("export_download", args=[job.pk, resource_type])),
+            "count": counts[resource_type],
+        } for resource_type in job.type_list],
+        "error": [],
+    })
+
+
+@fhir_api("view", resource_types=())
+@require_GET
+def export_download(request, job_id, resource_type):
+    """Streams one of the NDJSON files of a completed export, to the user who requested it"""
+    job = get_object_or_404(ExportJob, pk=job_id, user=request.user, status="completed")
+    if resource_type not in job.type_list:
+        raise Http404
+    path = export_file(job, resource_type)
+    response = StreamingHttpResponse(streaming_content(request, iter_file(path)),
+                                     content_type="application/fhir+ndjson")
+    response["Content-Length"] = str(os.path.getsize(path))
+    response["Content-Disposition"] = 'inline; filename="{}"'.format(os.path.basename(path))
+    return response
+
+
+@fhir_api("view", resource_types=["ValueSet"])
+@require_GET
+def validate_code(request, id=None):
+    """The ValueSet $validate-code operation, answered from the in-memory expansion cache.
+
+    http://hl7.org/fhir/valueset-operations.html#validate-code
+    """
+    code = request.GET.get("code")
+    if not code:
+        return operation_outcome("The parameter 'code' is required")
+    if id is not None:
+        value_set = get_object_or_404(ValueSet, id=id)
+        url, version = value_set.url, value_set.version
+    else:
+        url, version = request.GET.get("url"), request.GET.get("valueSetVersion")
+        if not url:
+            return operation_outcome("The parameter 'url' is required")
+
+    result, display, message = expansions.validate_code(url, code, request.GET.get("system"), version)
+    if result and request.GET.get("display") not in (None, display):
+        result, message = False, "The display '{}' is not valid for the code '{}'".format(
+            request.GET["display"], code)
+
+    parameters = [{"name": "result", "valueBoolean": result}]
+    if message:
+        parameters.append({"name": "message", "valueString": message})
+    if display:
+        parameters.append({"name": "display", "valueString": display})
+    return JsonResponse({"resourceType": "Parameters", "parameter": parameters}, content_type=FHIR_JSON)
+
+
+@fhir_api("view", resource_types=["ValueSet"])
+@require_GET
+def expand(request):
+    """Typeahead search over all codes, in the form of the ValueSet $expand operation.
+
+    http://hl7.org/fhir/valueset-operations.html#expand
+    Supports the parameters filter (required), count, and system to restrict the codes to one code
+    system. The codes are ranked: exact and prefix matches of the code first, then prefix matches
+    of the display, then fuzzy matches.
+    """
+    text = request.GET.get("filter", "")
+    if not text.strip():
+        return operation_outcome("The parameter 'filter' is required")
+    try:
+        count = max(1, min(int(request.GET.get("count", DEFAULT_CODE_COUNT)), MAX_COUNT))
+    except ValueError:
+        return operation_outcome("count must be an integer")
+    matches = search_codes(text, request.GET.get("system"), count)
+    return JsonResponse({
+        "resourceType": "ValueSet",
+        "status": "active",
+        "expansion": {
+            "timestamp": timezone.now().isoformat(),
+            "parameter": [{"name": "filter", "valueString": text}],
+            "contains": [{key: value for key, value in (
+                ("system", match.system), ("version", match.version), ("code", match.code),
+                ("display", match.display)) if value} for match in matches],
+        },
+    }, content_type=FHIR_JSON)
+
+
+def _subsetted_resources(resource_type, ids, elements):
+    """Serializes the requested elements of the resources, loading only the related objects they need.
+
+    Returns a dict {id: JSON string}"""
+    versions = current_versions(resource_type, ids)
+    resources = {}
+    for instance in resource_queryset(RESOURCE_TYPES[resource_type], ids, elements):
+        data = to_fhir(instance, elements)
+        if data["id"] in versions:
+            # the versionId and lastUpdated of the history, like in the stored JSON
+            data = with_version_meta(data, versions[data["id"]])
+        resources[data["id"]] = json.dumps(data)
+    return resources
+
+
+@fhir_api("view")
+@require_GET
+def search(request, resource_type):
+    """The FHIR search interaction: returns a "searchset" Bundle of the matching resources.
+
+    http://hl7.org/fhir/search.html
+    The parameters are looked up in the precomputed index tables (see medux.core.search). Pages are
+    given by _count and a _cursor (the last id of the previous page) instead of an offset, so that
+    deep pages are as fast as the first one.
+    With _summary or _elements, only the requested elements are loaded and serialized, instead of
+    returning the stored JSON.
+    """
+    if resource_type not in SEARCH_PARAMETERS:
+        return operation_outcome("Unknown resource type: {}".format(resource_type), code="not-supported", status=404)
+    try:
+        count = int(request.GET.get("_count", DEFAULT_COUNT))
+    except ValueError:
+        return operation_outcome("_count must be an integer")
+    summary = request.GET.get("_summary")
+    try:
+        elements = requested_elements(RESOURCE_TYPES[resource_type], summary, request.GET.get("_elements"))
+    except ValueError as e:
+        return operation_outcome(str(e))
+    params = [(name, value) for name, values in request.GET.lists() for value in values]
+    try:
+        if summary == "count":
+            return JsonResponse({"resourceType": "Bundle", "type": "searchset",
+                                 "total": search_count(resource_type, params)}, content_type=FHIR_JSON)
+        ids, next_cursor = search_index(resource_type, params, count, request.GET.get("_cursor"))
+    except SearchError as e:
+        return operation_outcome(str(e))
+
+    base_url = request.build_absolute_uri(reverse("search", args=[resource_type]))
+    links = [{"relation": "self", "url": request.build_absolute_uri()}]
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query["_cursor"] = next_cursor
+        links.append({"relation": "next", "url": "{}?{}".format(base_url, query.urlencode())})
+
+    # the stored JSON is put into the Bundle without decoding it
+    if elements is not None:
+        resources = _subsetted_resources(resource_type, ids, elements)
+    else:
+        resources = stored_resources(resource_type, ids)
+    entries = ['{{"fullUrl":{},"resource":{},"search":{{"mode":"match"}}}}'.format(
+        json.dumps(request.build_absolute_uri(reverse("read", args=[resource_type, id]))), resources[id])
+        for id in ids if id in resources]
+
+    bundle = json.dumps({"resourceType": "Bundle", "type": "searchset", "link": links, "entry": []})
+    # "entry" is the last key, so the entries can be stitched in before the closing brackets
+    content = bundle[:-2] + ",".join(entries) + "]}"
+    return HttpResponse(content, content_type=FHIR_JSON)
+
+
+@fhir_api("view", resource_types=["Patient", "Organization"])
+@require_http_methods(["GET", "POST"])
+def graphql(request):
+    """Executes a GraphQL query, see http://hl7.org/fhir/graphql.html
+
+    The query is taken from the "query", "variables" and "operationName" of a JSON body,
+    or of the query string for GET requests."""
+    if request.method == "POST":
+        try:
+            params = json.loads(request.body.decode("utf-8"))
+        except ValueError:
+            return JsonResponse({"errors": [{"message": "The body must be JSON"}]}, status=400)
+    else:
+        params = request.GET.dict()
+        try:
+            params["variables"] = json.loads(params["variables"]) if params.get("variables") else None
+        except ValueError:
+            return JsonResponse({"errors": [{"message": "variables must be JSON"}]}, status=400)
+    if not isinstance(params, dict) or not params.get("query"):
+        return JsonResponse({"errors": [{"message": "No query given"}]}, status=400)
+    result = execute_query(params["query"], params.get("variables"), params.get("operationName"), request)
+    return JsonResponse(result.formatted, status=400 if result.data is None else 200)
+
+
+def _version_headers(response, version_id, last_updated):
+    """Sets the ETag and Last-Modified headers of a resource version.
+
+    http://hl7.org/fhir/http.html#versioning"""
+    if version_id:
+        response["ETag"] = 'W/"{}"'.format(version_id)
+    response["Last-Modified"] = http_date(last_updated.timestamp())
+    return response
+
+
+def _not_modified(request, version_id, last_updated):
+    """Returns a 304 response if the client's copy (If-None-Match, If-Modified-Since) is current, else None"""
+    response = get_conditional_response(request, etag='W/"{}"'.format(version_id) if version_id else None,
+                                        last_modified=int(last_updated.timestamp()))
+    if response is None:
+        return None
+    return _version_headers(response, version_id, last_updated)
+
+
+@fhir_api("view")
+@require_GET
+def read(request, resource_type, id):
+    """The FHIR read interaction: returns the current version of a resource.
+
+    http://hl7.org/fhir/http.html#read
+    This is a single-row fetch of the stored JSON, from the document store if MEDUX_DOCUMENT_STORE
+    is enabled, else from the current version in the history. With _summary or _elements, only the
+    requested elements are loaded and serialized.
+
+    The versionId is sent as ETag, so clients can poll with If-None-Match (or If-Modified-Since),
+    and get a 304 response after the indexed version lookup only. If MEDUX_RESPONSE_CACHE is
+    enabled, the content of unchanged resources comes from the cache.
+    """
+    if resource_type not in RESOURCE_TYPES:
+        return operation_outcome("Unknown resource type: {}".format(resource_type), code="not-supported", status=404)
+    summary = request.GET.get("_summary")
+    try:
+        elements = requested_elements(RESOURCE_TYPES[resource_type], summary, request.GET.get("_elements"))
+    except ValueError as e:
+        return operation_outcome(str(e))
+
+    # any combination of _elements may be requested, but there are only a few _summary modes worth caching
+    cache = get_response_cache() if "_elements" not in request.GET else None
+    variant = summary if elements is not None else ""
+    conditional = "HTTP_IF_NONE_MATCH" in request.META or "HTTP_IF_MODIFIED_SINCE" in request.META
+    # the stored JSON is only loaded from the database when it is going to be sent
+    load_content = elements is None and cache is None and not conditional
+
+    if document_store_enabled():
+        current = current_document(resource_type, id, content=load_content)
+        if current is None:
+            return operation_outcome("{}/{} not found".format(resource_type, id), code="not-found", status=404)
+        version_id = current.versionId
+    else:
+        current = current_version(resource_type, id, content=load_content)
+        if current is None or current.method == "delete":
+            return _version_response(request, current, resource_type, id)
+        version_id = str(current.version)
+
+    not_modified = _not_modified(request, version_id, current.lastUpdated)
+    if not_modified is not None:
+        return not_modified
+    content = cache.get(resource_type, id, version_id, variant) if cache is not None else None
+    if content is None:
+        if elements is not None:
+            content = _subsetted_resources(resource_type, [id], elements).get(id)
+            if content is None:
+                # deleted in the meantime
+                return operation_outcome("{}/{} not found".format(resource_type, id), code="not-found", status=404)
+        else:
+            content = current.content
+        if cache is not None:
+            cache.set(resource_type, id, version_id, content, variant)
+    return _version_headers(HttpResponse(content, content_type=FHIR_JSON), version_id, current.lastUpdated)
+
+
+def _version_response(request, version, resource_type, id):
+    if version is None:
+        return operation_outcome("{}/{} not found".format(resource_type, id), code="not-found", status=404)
+    if version.method == "delete":
+        return operation_outcome("{}/{} was deleted".format(resource_type, id), code="deleted", status=410)
+    # versions never change
+    not_modified = _not_modified(request, str(version.version), version.lastUpdated)
+    if not_modified is not None:
+        return not_modified
+    return _version_headers(HttpResponse(version.content, content_type=FHIR_JSON), str(version.version),
+                            version.lastUpdated)
+
+
+@fhir_api("view")
+@require_GET
+def vread(request, resource_type, id, version_id):
+    """The FHIR vread interaction: returns a specific version of a resource.
+
+    http://hl7.org/fhir/http.html#vread
+    """
+    if resource_type not in RESOURCE_TYPES:
+        return operation_outcome("Unknown resource type: {}".format(resource_type), code="not-supported", status=404)
+    version = get_version(resource_type, id, int(version_id))
+    if version is None:
+        return operation_outcome("Version {} of {}/{} not found".format(version_id, resource_type, id),
+                                 code="not-found", status=404)
+    return _version_response(request, version, resource_type, id)
+
+
+@fhir_api("view")
+@require_GET
+def resource_history(request, resource_type=None, id=None):
+    """The FHIR history interaction, of one resource, all resources of a type or the whole server.
+
+    http://hl7.org/fhir/http.html#history
+    Returns a "history" Bundle, newest version first. Pages are given by _count and a _cursor.
+    """
+    if resource_type is not None and resource_type not in RESOURCE_TYPES:
+        return operation_outcome("Unknown resource type: {}".format(resource_type), code="not-supported", status=404)
+    try:
+        count = max(1, min(int(request.GET.get("_count", DEFAULT_COUNT)), MAX_COUNT))
+        cursor = int(request.GET.get("_cursor", 0))
+    except ValueError:
+        return operation_outcome("_count and _cursor must be integers")
+    since = None
+    if request.GET.get("_since"):
+        since = parse_datetime(request.GET["_since"])
+        if since is None:
+            return operation_outcome("Invalid _since: {}".format(request.GET["_since"]))
+
+    versions, next_cursor = history(resource_type, id, since, count, cursor)
+
+    links = [{"relation": "self", "url": request.build_absolute_uri()}]
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query["_cursor"] = next_cursor
+        links.append({"relation": "next", "url": "{}?{}".format(
+            request.build_absolute_uri(request.path), query.urlencode())})
+
+    entries = [history_entry(version, _full_url(request, version)) for version in versions]
+    return HttpResponse(history_bundle(entries, links), content_type=FHIR_JSON)
+
+
+def _full_url(request, version):
+    return request.build_absolute_uri(reverse("read", args=[version.resource_type, version.resource_id]))
+
+
+@fhir_api("view")
+@require_GET
+def change_feed(request):
+    """The change feed: all versions recorded after a cursor, oldest first, as "history" Bundle.
+
+    Instead of polling the resources by lastUpdated, clients follow the "next" link, which holds
+    the cursor of the last returned version - also if there were no changes, so they can just
+    poll it again. The first request may give _since instead of a _cursor, and _type to only get
+    some resource types."""
+    resource_types = [name for name in request.GET.get("_type", "").split(",") if name]
+    unknown = [name for name in resource_types if name not in RESOURCE_TYPES]
+    if unknown:
+        return operation_outcome("Unknown resource type: {}".format(", ".join(unknown)), code="not-supported")
+    try:
+        count = max(1, min(int(request.GET.get("_count", DEFAULT_COUNT)), MAX_COUNT))
+        cursor = int(request.GET.get("_cursor", 0))
+    except ValueError:
+        return operation_outcome("_count and _cursor must be integers")
+    since = None
+    if request.GET.get("_since"):
+        since = parse_datetime(request.GET["_since"])
+        if since is None:
+            return operation_outcome("Invalid _since: {}".format(request.GET["_since"]))
+
+    versions, next_cursor = changes(cursor, resource_types, count, since)
+    query = request.GET.copy()
+    query.pop("_since", None)
+    query["_cursor"] = next_cursor
+    links = [
+        {"relation": "self", "url": request.build_absolute_uri()},
+        {"relation": "next", "url": "{}?{}".format(request.build_absolute_uri(request.path), query.urlencode())},
+    ]
+    entries = [history_entry(version, _full_url(request, version)) for version in versions]
+    return HttpResponse(history_bundle(entries, links), content_type=FHIR_JSON)
+
+
+@fhir_api("view")
+@require_GET
+def everything(request, id):
+    """The Patient $everything operation: the Patient and all resources of its compartment, as "searchset" Bundle.
+
+    http://hl7.org/fhir/patient-operation-everything.html
+    The members are found in the reference index (see medux.core.compartments), and the Bundle is
+    streamed while the resources are loaded, one query per resource type and batch. Supports
+    _since, _type and _count; further pages are given by a _cursor.
+    """
+    try:
+        count = max(1, min(int(request.GET.get("_count", DEFAULT_EVERYTHING_COUNT)), MAX_EVERYTHING_COUNT))
+    except ValueError:
+        return operation_outcome("_count must be an integer")
+    since = None
+    if request.GET.get("_since"):
+        since = parse_datetime(request.GET["_since"])
+        if since is None:
+            return operation_outcome("Invalid _since: {}".format(request.GET["_since"]))
+    types = [name for name in request.GET.get("_type", "").split(",") if name]
+    unknown = [name for name in types if name not in RESOURCE_TYPES]
+    if unknown:
+        return operation_outcome("Unknown resource type: {}".format(", ".join(unknown)), code="not-supported")
+
+    page = compartment_page("Patient", id, since, types, count, request.GET.get("_cursor"))
+    if page is None:
+        return operation_outcome("Patient/{} not found".format(id), code="not-found", status=404)
+    total, members, next_cursor = page
+
+    links = [{"relation": "self", "url": request.build_absolute_uri()}]
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query["_cursor"] = next_cursor
+        links.append({"relation": "next", "url": "{}?{}".format(
+            request.build_absolute_uri(request.path), query.urlencode())})
+
+    def full_url(resource_type, resource_id):
+        return request.build_absolute_uri(reverse("read", args=[resource_type, resource_id]))
+
+    def chunks():
+        bundle = json.dumps({"resourceType": "Bundle", "type": "searchset", "total": total, "link": links,
+                             "entry": []})
+        # "entry" is the last key, so the entries can be streamed in before the closing brackets
+        yield bundle[:-2]
+        separator = ""
+        for entries in iter_entries(members, full_url, match=("Patient", id)):
+            yield separator + entries
+            separator = ","
+        yield "]}"
+
+    return StreamingHttpResponse(streaming_content(request, chunks(), thread_sensitive=True),
+                                 content_type=FHIR_JSON)
+
+
+@fhir_api("view", resource_types=["Patient"])
+@require_POST
+def match(request):
+    """The Patient $match operation: a "searchset" Bundle of the stored Patients that match the given one,
+    best first, with their score and match grade.
+
+    http://hl7.org/fhir/patient-operation-match.html
+    Only Patients with a common blocking key or identifier are compared, see medux.core.matching.
+    Supports the parameters resource, count and onlyCertainMatches.
+    """
+    try:
+        parameters = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        return operation_outcome("The request body must be a Parameters resource as JSON")
+    if not isinstance(parameters, dict) or parameters.get("resourceType") != "Parameters":
+        return operation_outcome("The request body must be a Parameters resource as JSON")
+    values = {parameter.get("name"): parameter for parameter in parameters.get("parameter", [])
+              if isinstance(parameter, dict)}
+    patient = values.get("resource", {}).get("resource")
+    if not isinstance(patient, dict) or patient.get("resourceType") != "Patient":
+        return operation_outcome("The parameter 'resource' must be a Patient")
+    count = values.get("count", {}).get("valueInteger", DEFAULT_MATCH_COUNT)
+    if not isinstance(count, int) or count < 1:
+        return operation_outcome("count must be a positive integer")
+    only_certain = values.get("onlyCertainMatches", {}).get("valueBoolean") is True
+
+    matches = match_patients(patient, min(count, MAX_MATCH_COUNT))
+    if only_certain:
+        # a certain match is only returned if it is the only one
+        matches = [(id, score) for id, score in matches if grade(score) == "certain"]
+        matches = matches if len(matches) == 1 else []
+    resources = stored_resources("Patient", [id for id, _ in matches])
+    entries = ['{{"fullUrl":{},"resource":{},"search":{}}}'.format(
+        json.dumps(request.build_absolute_uri(reverse("read", args=["Patient", id]))), resources[id],
+        json.dumps({"extension": [{"url": MATCH_GRADE_URL, "valueCode": grade(score)}], "mode": "match",
+                    "score": round(score, 4)}))
+        for id, score in matches if id in resources]
+
+    bundle = json.dumps({"resourceType": "Bundle", "type": "searchset", "total": len(entries), "entry": []})
+    # "entry" is the last key, so the entries can be stitched in before the closing brackets
+    return HttpResponse(bundle[:-2] + ",".join(entries) + "]}", content_type=FHIR_JSON)
+
+
+@require_http_methods(["GET", "DELETE"])
+def metrics(request):
+    """Returns the metrics of the InstrumentationMiddleware as JSON, DELETE resets them.
+
+    Only available to staff users, and to monitoring clients sending the MEDUX_METRICS_TOKEN setting
+    as "Authorization: Bearer <token>"."""
+    token = getattr(settings, "MEDUX_METRICS_TOKEN", None)
+    scheme, _, credentials = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    if not (token and scheme.lower() == "bearer" and constant_time_compare(credentials.strip(), token)):
+        user, rejected = _api_user(request)
+        if rejected is not None:
+            return rejected
+        if not user.is_staff:
+            return operation_outcome("Permission denied", code="forbidden", status=403)
+    if request.method == "DELETE":
+        instrumentation_metrics.reset()
+        return HttpResponse(status=204)
+    return JsonResponse(instrumentation_metrics.snapshot())
+
+
+# the CSRF check is done by _api_user(), for session authenticated requests only
+metrics.csrf_exempt = True
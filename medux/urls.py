@@ -13,12 +13,16 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
-from django.conf.urls import url
+from django.conf.urls import include, url
 from django.contrib import admin
 
+from medux.core.views import metrics
+
 # TODO make MedUX translatable:
 # https://stackoverflow.com/questions/20467626/how-to-setup-up-django-translation-in-the-correct-way
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^fhir/', include('medux.core.urls')),
+    url(r'^metrics$', metrics, name='metrics'),
 ]
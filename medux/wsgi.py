@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "medux.settings")
 
 application = get_wsgi_application()
+
+# after the apps are loaded: the in-process code index is built while the server starts, not on the first search
+from medux.core.code_search import start_code_index  # noqa: E402
+
+start_code_index()
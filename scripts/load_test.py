@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+MedUX - A Free/OpenSource Electronic Medical Record
+Copyright (C) 2017 Christian González
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Load test of the FHIR API with concurrent clients, to compare WSGI and ASGI deployments.
+#
+# Start both deployments with the same number of workers, e.g.
+#
+#   gunicorn medux.wsgi:application --workers 4 --bind 127.0.0.1:8000
+#   uvicorn medux.asgi:application --workers 4 --port 8001
+#
+# and run the same paths against both:
+#
+#   scripts/load_test.py --clients 200 --duration 30 --read-delay 0.05 \
+#       wsgi=http://127.0.0.1:8000 asgi=http://127.0.0.1:8001 \
+#       /fhir/Patient/1 '/fhir/$export-file/<job id>/Patient.ndjson'
+#
+# --read-delay makes the clients read slowly (a pause after each received chunk), like clients on
+# a slow network. A WSGI worker is blocked until the last byte is sent, an ASGI worker is not.
+# Only the standard library is used, so this runs anywhere.
+
+import argparse
+import asyncio
+import random
+import re
+import statistics
+import time
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 16 * 1024
+
+TARGET_RE = re.compile(r"^\w+=https?://")
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.statuses = {}
+
+    def report(self, seconds):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return "{:<10} no successful requests, {} errors".format(self.name, self.errors)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        return "{:<10} {:>8.1f} req/s {:>9.1f} MiB/s  p50 {:>8.1f} ms  p95 {:>8.1f} ms  p99 {:>8.1f} ms  " \
+               "mean {:>8.1f} ms  {} errors  {}".format(
+                   self.name, len(latencies) / seconds, self.bytes / seconds / 1024 / 1024, percentile(0.5),
+                   percentile(0.95), percentile(0.99), statistics.mean(latencies) * 1000, self.errors,
+                   " ".join("{}: {}".format(status, count) for status, count in sorted(self.statuses.items())))
+
+
+async def fetch(host, port, path, headers, read_delay):
+    """Sends one GET request, and returns (status, number of received body bytes)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        request = "GET {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: close\r\nAccept: application/fhir+json\r\n" \
+                  "{}\r\n".format(path, host, port, "".join("{}\r\n".format(header) for header in headers))
+        writer.write(request.encode("latin-1"))
+        await writer.drain()
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        # the headers
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        size = 0
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if read_delay:
+                await asyncio.sleep(read_delay)
+        return status, size
+    finally:
+        writer.close()
+
+
+async def client(target, paths, headers, deadline, read_delay, result):
+    url = urlsplit(target)
+    host, port = url.hostname, url.port or 80
+    while time.monotonic() < deadline:
+        path = url.path.rstrip("/") + random.choice(paths)
+        start = time.monotonic()
+        try:
+            status, size = await fetch(host, port, path, headers, read_delay)
+        except (OSError, ValueError, IndexError):
+            result.errors += 1
+            # don't hammer a server that refuses connections
+            await asyncio.sleep(0.1)
+            continue
+        result.statuses[status] = result.statuses.get(status, 0) + 1
+        if status >= 400:
+            result.errors += 1
+            continue
+        result.latencies.append(time.monotonic() - start)
+        result.bytes += size
+
+
+async def run(name, target, options):
+    result = Result(name)
+    deadline = time.monotonic() + options.duration
+    await asyncio.gather(*(client(target, options.paths, options.header, deadline, options.read_delay, result)
+                           for _ in range(options.clients)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the FHIR API with concurrent clients")
+    parser.add_argument("targets", nargs="+", metavar="NAME=URL",
+                        help="Base URLs of the deployments to compare, e.g. wsgi=http://127.0.0.1:8000")
+    parser.add_argument("paths", nargs="+", metavar="PATH", help="Paths to request, picked at random")
+    parser.add_argument("--clients", type=int, default=50, help="Number of concurrent clients (default: 50)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per deployment (default: 10)")
+    parser.add_argument("--read-delay", type=float, default=0,
+                        help="Seconds to wait after each received chunk of {} bytes, to simulate slow "
+                             "clients".format(CHUNK_SIZE))
+    parser.add_argument("--header", action="append", default=[], help='Extra header, like "Authorization: ..."')
+    # argparse can't split two variable length positional lists, so the targets are told by their form
+    args = parser.parse_args()
+    positional = args.targets + args.paths
+    targets = [argument.split("=", 1) for argument in positional if TARGET_RE.match(argument)]
+    args.paths = [argument for argument in positional if not TARGET_RE.match(argument)]
+    if not targets or not args.paths:
+        parser.error("Give at least one NAME=URL and one PATH")
+
+    print("{} clients, {} s per deployment, read delay {} s".format(args.clients, args.duration, args.read_delay))
+    for name, target in targets:
+        result = asyncio.run(run(name, target, args))
+        print(result.report(args.duration))
+
+
+if __name__ == "__main__":
+    main()